@@ -5,4 +5,4 @@ data items via the web.
 from .client import (RESTServiceClient, DistribResourceNotFound,
                      DistribServiceException, DistribServerError,
                      DistribClientError)
-from .bagclient import BagDistribClient
+from .bagclient import BagDistribClient, BagInfoCache, bag_info_cache_for
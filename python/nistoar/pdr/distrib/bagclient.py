@@ -2,10 +2,172 @@
 This distrib submodule provides a client interface to the part of the PDR 
 Distribution Service that provides access to preservation bags. 
 """
-import os
+import os, json, time, threading, logging
+from copy import deepcopy
+from .. import utils
 from .client import (RESTServiceClient, DistribResourceNotFound, DistribServiceException,
                      DistribClientError, DistribServiceException)
 
+log = logging.getLogger(__name__)
+
+DEF_LISTING_CACHE_TTL = 300   # seconds
+
+class BagInfoCache(object):
+    """
+    a thread-safe cache of the responses to the bag listing and description 
+    queries made by BagDistribClient instances.  Entries are organized by AIP
+    and expire after a configured time-to-live.  Queries for AIPs that are 
+    not found are remembered as well.  
+
+    The cache can optionally be saved to a file, allowing it to be shared 
+    between processes:  changes are written to the file immediately, and 
+    the cache is reloaded whenever the file has been updated by another 
+    process.  Updates hold an exclusive lock on a companion lock file 
+    (the cache file name plus ".lock") while the file is re-read, modified,
+    and rewritten so that concurrent updates from different processes are
+    not lost.  This allows, for example, the preservation service to 
+    invalidate entries for an AIP (via invalidate()) after a new version of 
+    it is preserved.
+    """
+    _NOT_FOUND = "__not_found__"
+
+    def __init__(self, ttl=DEF_LISTING_CACHE_TTL, cachefile=None):
+        """
+        create the cache
+
+        :param float ttl:      the number of seconds entries remain valid
+        :param str cachefile:  the path to a file where the cache should be 
+                               persisted; if None, the cache is kept only in 
+                               memory.
+        """
+        self.ttl = ttl
+        self.file = cachefile
+        self._data = {}
+        self._lock = threading.RLock()
+        self._loaded = None
+        self._load()
+
+    def _load(self, force=False):
+        # (re)load the cache from its file if the file has changed (or
+        # unconditionally, if force is True)
+        if not self.file:
+            return
+        try:
+            mtime = os.stat(self.file).st_mtime
+        except OSError:
+            return
+        if mtime == self._loaded and not force:
+            return
+        try:
+            with open(self.file) as fd:
+                self._data = json.load(fd)
+            self._loaded = mtime
+        except (IOError, ValueError) as ex:
+            log.warning("Ignoring unreadable bag info cache, %s: %s", self.file, str(ex))
+
+    def _save(self):
+        if not self.file:
+            return
+        tmpf = "{0}.{1}.tmp".format(self.file, os.getpid())
+        with open(tmpf, 'w') as fd:
+            json.dump(self._data, fd)
+        os.rename(tmpf, self.file)
+        self._loaded = os.stat(self.file).st_mtime
+
+    def _lock_file(self):
+        # lock the cache file against updates from other processes; the 
+        # returned LockedFile (or None, if the cache is not persisted) must
+        # be closed to release the lock.
+        if not self.file:
+            return None
+        lock = utils.LockedFile(self.file+".lock", 'a')
+        lock.open()
+        return lock
+
+    def get(self, aipid, query):
+        """
+        return a 2-tuple containing a cached response and a flag indicating 
+        whether the AIP was not found.  If there is no unexpired entry for 
+        the query, (None, False) is returned.
+
+        :param str aipid:  the AIP that the query is about
+        :param str query:  a label identifying the query (e.g. its relative URL)
+        """
+        with self._lock:
+            self._load()
+            ent = self._data.get(aipid, {}).get(query)
+            if not ent or time.time() - ent[0] > self.ttl:
+                return (None, False)
+            if ent[1] == self._NOT_FOUND:
+                return (None, True)
+            return (deepcopy(ent[1]), False)
+
+    def put(self, aipid, query, value, notfound=False):
+        """
+        save the response to a query
+
+        :param str aipid:  the AIP that the query is about
+        :param str query:  a label identifying the query 
+        :param value:      the JSON-encodable response to cache
+        :param bool notfound:  if True, record that the AIP or requested item
+                           was not found (value is ignored)
+        """
+        if notfound:
+            value = self._NOT_FOUND
+        with self._lock:
+            lock = self._lock_file()
+            try:
+                self._load(True)
+                self._data.setdefault(aipid, {})[query] = [time.time(), deepcopy(value)]
+                self._save()
+            finally:
+                if lock:
+                    lock.close()
+
+    def invalidate(self, aipid=None):
+        """
+        forget all cached responses for the given AIP, or for all AIPs if 
+        aipid is None.  
+        """
+        with self._lock:
+            lock = self._lock_file()
+            try:
+                self._load(True)
+                if aipid is None:
+                    self._data = {}
+                else:
+                    self._data.pop(aipid, None)
+                self._save()
+            finally:
+                if lock:
+                    lock.close()
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def bag_info_cache_for(config):
+    """
+    return the BagInfoCache instance to use for the given distribution service 
+    configuration, or None if caching has been turned off.  Instances are 
+    shared across the process.  The following configuration properties are 
+    consulted:
+    :prop listing_cache_ttl float (300):  the number of seconds that bag 
+                              listings and descriptions remain cached; a 
+                              value of zero or less turns off caching.
+    :prop listing_cache_file str:  the file to persist the cache to (see 
+                              BagInfoCache).
+    """
+    if config is None:
+        config = {}
+    ttl = float(config.get('listing_cache_ttl', DEF_LISTING_CACHE_TTL))
+    if ttl <= 0:
+        return None
+    key = (ttl, config.get('listing_cache_file'))
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = BagInfoCache(ttl, key[1])
+        return _caches[key]
+
 class BagDistribClient(object):
     """
     a client for getting bags and information about bags that are available 
@@ -23,7 +185,7 @@ class BagDistribClient(object):
     complete metadata for that version.
     """
 
-    def __init__(self, aipid, svcclient):
+    def __init__(self, aipid, svcclient, cache=None):
         """
         create a client that accesses information about an archive 
         information package (AIP) with the given id
@@ -33,6 +195,9 @@ class BagDistribClient(object):
                             service endpoint; otherwise, it can be an 
                             an instance of generic client to the REST service
         :type svcclient:    ServiceClient or str 
+        :param BagInfoCache cache:  a cache for saving the responses to 
+                            listing and description queries; if None, 
+                            responses are not cached.
         """
         if not aipid:
             raise ValueError("BagClient: aipid must be non-empty str")
@@ -41,6 +206,25 @@ class BagDistribClient(object):
         self.id = aipid
         self.svc = svcclient
         self.op = "/".join([self.id, "_aip"])
+        self.cache = cache
+
+    def _get_json(self, rurl):
+        # retrieve the JSON response to a query, consulting the cache first
+        if self.cache is None:
+            return self.svc.get_json(rurl)
+
+        (out, notfound) = self.cache.get(self.id, rurl)
+        if notfound:
+            raise DistribResourceNotFound(rurl, message="Requested distribution "+
+                                          "resource not found (cached): "+rurl)
+        if out is None:
+            try:
+                out = self.svc.get_json(rurl)
+            except DistribResourceNotFound:
+                self.cache.put(self.id, rurl, None, notfound=True)
+                raise
+            self.cache.put(self.id, rurl, out)
+        return out
 
     def list_versions(self):
         """
@@ -49,7 +233,7 @@ class BagDistribClient(object):
         This accesses the following resource from the service: <base>/<aipid>/_v
         """
         rurl = "/".join([self.op,"_v"])
-        return self.svc.get_json(rurl)
+        return self._get_json(rurl)
 
     def list_all(self):
         """
@@ -68,7 +252,7 @@ class BagDistribClient(object):
         :prop str hashtype:  the algorithm used to calculate the hash (e.g. 
                          'sha256')
         """
-        return self.svc.get_json(self.op)
+        return self._get_json(self.op)
 
     def list_for_version(self, version=None):
         """
@@ -92,7 +276,7 @@ class BagDistribClient(object):
         if not version:
             version = "latest"
         rurl = "/".join([self.op,"_v",version])
-        return self.svc.get_json(rurl)
+        return self._get_json(rurl)
 
     def describe_head_for_version(self, version=None):
         """
@@ -107,7 +291,7 @@ class BagDistribClient(object):
         if not version:
             version = "latest"
         rurl = "/".join([self.op,"_v",version,"_head"])
-        return self.svc.get_json(rurl)
+        return self._get_json(rurl)
 
     def head_for_version(self, version=None):
         """
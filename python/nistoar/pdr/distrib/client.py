@@ -2,23 +2,121 @@
 This distrib submodule provides a client interface to the PDR Distribution 
 Service.
 """
-import os, sys, shutil, logging, json
+import os, sys, shutil, logging, json, re, threading
+from multiprocessing.pool import ThreadPool
 
-import urllib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from ..exceptions import PDRException, PDRServiceException, PDRServerError
 
+log = logging.getLogger(__name__)
+
+DEF_CHUNK_SIZE = 1048576                  # 1 MB
+DEF_PARALLEL_THRESHOLD = 104857600        # 100 MB
+
+class _IncompleteRead(requests.exceptions.RequestException):
+    # raised when the server closes the connection before sending all content
+    pass
+
+_interruptions = (requests.exceptions.ChunkedEncodingError,
+                  requests.exceptions.ConnectionError,
+                  requests.exceptions.Timeout, _IncompleteRead)
+
 class RESTServiceClient(object):
     """
     a generic public client interface to a REST service
+
+    All requests made by a client instance are sent through a single 
+    keep-alive session that pools its connections to the service; thus, a
+    client instance should be shared as much as possible.  The client can 
+    take a configuration dictionary on construction; the following properties
+    are supported:
+    :prop chunk_size int (1048576):  the number of bytes to write at a time 
+                              when saving retrieved files to disk.
+    :prop retries int (2):    the number of times to retry a request that 
+                              fails to connect or that gets a 502, 503, or 504
+                              response; this is also the number of times an 
+                              interrupted file download will be resumed.
+    :prop backoff_factor float (0.5):  the factor controlling how long to wait
+                              between retries (see urllib3's Retry class).
+    :prop pool_size int (10): the maximum number of connections to keep open 
+                              to the service.  
+    :prop timeout float:      the number of seconds to wait for the service
+                              to respond before giving up; by default, there 
+                              is no timeout.
+    :prop parallel_downloads int (1):  the number of concurrent ranged 
+                              requests to use to retrieve a large file (see 
+                              retrieve_file()); a value of 1 disables 
+                              parallel downloads.
+    :prop parallel_threshold int (104857600):  the minimum size (in bytes)
+                              of a file for it to be retrieved via parallel 
+                              ranged requests.
     """
 
-    def __init__(self, baseurl):
+    def __init__(self, baseurl, config=None):
         """
         initialized the service to the given base URL
+
+        :param str baseurl:  the base URL for the service's endpoints
+        :param dict config:  the client configuration (see class 
+                             documentation for the supported properties).
         """
         self.base = baseurl
+        if config is None:
+            config = {}
+        self.cfg = config
+
+        self.chunk_size = int(self.cfg.get('chunk_size', DEF_CHUNK_SIZE))
+        self.retries = int(self.cfg.get('retries', 2))
+        self.timeout = self.cfg.get('timeout')
+        self._session = None
+        self._slock = threading.Lock()
+
+    @property
+    def session(self):
+        """
+        the requests Session used to send all requests to the service
+        """
+        with self._slock:
+            if self._session is None:
+                self._session = self._create_session()
+            return self._session
+
+    def _create_session(self):
+        retry = Retry(total=self.retries, 
+                      backoff_factor=float(self.cfg.get('backoff_factor', 0.5)),
+                      status_forcelist=(502, 503, 504), raise_on_status=False)
+        poolsz = int(self.cfg.get('pool_size', 10))
+        adapter = HTTPAdapter(pool_connections=poolsz, pool_maxsize=poolsz,
+                              max_retries=retry)
+        out = requests.Session()
+        out.mount("http://", adapter)
+        out.mount("https://", adapter)
+        return out
+
+    def close(self):
+        """
+        close all open connections to the service
+        """
+        with self._slock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def _check_status(self, relurl, resp):
+        # raise the appropriate exception for an unsuccessful response
+        if resp.status_code >= 500:
+            raise DistribServerError(relurl, resp.status_code, resp.reason)
+        elif resp.status_code == 404:
+            raise DistribResourceNotFound(relurl, resp.reason)
+        elif resp.status_code >= 400:
+            raise DistribClientError(relurl, resp.status_code, resp.reason)
+        elif resp.status_code not in (200, 206):
+            raise DistribServerError(relurl, resp.status_code, resp.reason,
+                           message="Unexpected response from server: {0} {1}"
+                                    .format(resp.status_code, resp.reason))
 
     def get_json(self, relurl):
         """
@@ -34,26 +132,18 @@ class RESTServiceClient(object):
 
         resp = None
         try:
-            resp = requests.get(self.base+relurl, headers=hdrs)
+            resp = self.session.get(self.base+relurl, headers=hdrs,
+                                    timeout=self.timeout)
 
-            if resp.status_code >= 500:
-                raise DistribServerError(relurl, resp.status_code, resp.reason)
-            elif resp.status_code == 404:
-                raise DistribResourceNotFound(relurl, resp.reason)
-            elif resp.status_code == 406:
+            if resp.status_code == 406:
                 raise DistribClientError(relurl, resp.status_code, resp.reason,
                                          message="JSON data not available from"+
                                          " this URL (is URL correct?)")
-            elif resp.status_code >= 400:
-                raise DistribClientError(relurl, resp.status_code, resp.reason)
-            elif resp.status_code != 200:
-                raise DistribServerError(relurl, resp.status_code, resp.reason,
-                               message="Unexpected response from server: {0} {1}"
-                                        .format(resp.status_code, resp.reason))
+            self._check_status(relurl, resp)
 
             return resp.json()
         except ValueError as ex:
-            if resp and resp.text and \
+            if resp is not None and resp.text and \
                ("<body" in resp.text or "<BODY" in resp.text):
                 raise DistribServerError(relurl,
                                          message="HTML returned where JSON "+
@@ -75,71 +165,191 @@ class RESTServiceClient(object):
         if not relurl.startswith('/'):
             relurl = '/'+relurl
 
+        resp = None
         try:
-            out = urllib.urlopen(self.base+relurl)
-
-            code = out.getcode()
-            hdrs = out.info()
-            reason = "(unknown)"
-            if 'status' in hdrs:
-                reason = hdrs['status']
-                if re.match(r'^\d{3} ', reason):
-                    reason = reason[4:]
-
-            if code >= 500:
-                raise DistribServerError(relurl, code, reason)
-            elif code == 404:
-                raise DistribResourceNotFound(relurl, reason)
-            elif code == 406:
-                raise DistribClientError(relurl, code, reason,
+            resp = self.session.get(self.base+relurl, stream=True,
+                                    timeout=self.timeout)
+            if resp.status_code == 406:
+                raise DistribClientError(relurl, resp.status_code, resp.reason,
                                          message="JSON data not available from"+
                                          " this URL (is URL correct?)")
-            elif code >= 400:
-                raise DistribClientError(relurl, code, reason)
-            elif code != 200:
-                raise DistribServerError(relurl, code, reason,
-                               message="Unexpected response from server: {0} {1}"
-                                        .format(code, reason))
+            self._check_status(relurl, resp)
 
+            out = resp.raw
+            out.decode_content = True
             return out
-        except IOError as ex:
+
+        except requests.RequestException as ex:
+            if resp is not None:
+                resp.close()
             raise DistribServerError(message="Trouble connecting to distribution"
                                      +" service: "+str(ex), cause=ex)
+        except Exception:
+            if resp is not None:
+                resp.close()
+            raise
 
     def retrieve_file(self, relurl, filepath):
         """
-        retrive the content at the given URL and save it to a local file
+        retrive the content at the given URL and save it to a local file.  
+
+        The content is first written to a temporary file (with a ".part" 
+        extension) which is renamed to filepath when the download is 
+        complete.  If the service supports ranged requests, an interrupted 
+        download is resumed from where it left off (up to the configured 
+        number of retries), and a large file may be downloaded in parallel 
+        pieces (if parallel_downloads is configured).
         """
         if not relurl.startswith('/'):
             relurl = '/'+relurl
 
-        resp = None
+        partfile = filepath + ".part"
         try:
-            resp = requests.get(self.base+relurl, stream=True)
-
-            if resp.status_code >= 500:
-                raise DistribServerError(relurl, resp.status_code, resp.reason)
-            elif resp.status_code == 404:
-                raise DistribResourceNotFound(relurl, resp.reason)
-            elif resp.status_code >= 400:
-                raise DistribClientError(relurl, resp.status_code, resp.reason)
-            elif resp.status_code != 200:
-                raise DistribServerError(relurl, resp.status_code, resp.reason,
-                               message="Unexpected response from server: {0} {1}"
-                                        .format(resp.status_code, resp.reason))
-
-            with open(filepath, "wb") as fd:
-                for chunk in resp.iter_content(chunk_size=1024):
-                    if chunk:
-                        fd.write(chunk)
-        
-        except requests.RequestException as ex:
-            raise DistribServerError(message="Trouble connecting to distribution"
-                                     +" service: "+ str(ex), cause=ex)
-        
+            try:
+                # the response to the first request is either used to plan a
+                # parallel download or read as the content itself
+                resp = self.session.get(self.base+relurl, stream=True,
+                                        timeout=self.timeout)
+                try:
+                    self._check_status(relurl, resp)
+                except Exception:
+                    resp.close()
+                    raise
+                if not self._retrieve_in_parallel(relurl, partfile, resp):
+                    self._retrieve_serially(relurl, partfile, resp)
+            except requests.RequestException as ex:
+                raise DistribServerError(message="Trouble connecting to distribution"
+                                         +" service: "+ str(ex), cause=ex)
+            os.rename(partfile, filepath)
+
         finally:
-            if resp is not None:
-                resp.close()
+            if os.path.exists(partfile):
+                os.remove(partfile)
+
+    def _retrieve_serially(self, relurl, filepath, resp=None):
+        # download the content in a single request, resuming if interrupted.
+        # If given, resp is an already-opened (unread) response for the full
+        # content to read from first.
+        done = 0
+        validator = None
+        attempts = 0
+        with open(filepath, "wb") as fd:
+            while True:
+                hdrs = {}
+                if done > 0:
+                    hdrs['Range'] = "bytes={0}-".format(done)
+                    if validator:
+                        hdrs['If-Range'] = validator
+
+                if resp is None:
+                    resp = self.session.get(self.base+relurl, headers=hdrs, stream=True,
+                                            timeout=self.timeout)
+                try:
+                    self._check_status(relurl, resp)
+                    if done > 0 and resp.status_code != 206:
+                        # server sent the whole thing; start over
+                        log.debug("%s: resume not honored; restarting download", relurl)
+                        fd.seek(0)
+                        fd.truncate()
+                        done = 0
+                    resumable = resp.headers.get('Accept-Ranges') == 'bytes' and \
+                                not resp.headers.get('Content-Encoding')
+                    if done == 0:
+                        validator = resp.headers.get('ETag') or \
+                                    resp.headers.get('Last-Modified')
+
+                    expected = None
+                    if resp.headers.get('Content-Length') and \
+                       not resp.headers.get('Content-Encoding'):
+                        expected = done + int(resp.headers['Content-Length'])
+
+                    try:
+                        for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                            if chunk:
+                                fd.write(chunk)
+                                done += len(chunk)
+                        if expected is not None and done < expected:
+                            raise _IncompleteRead("connection closed after {0} of {1} bytes"
+                                                  .format(done, expected))
+                        return done
+                    except _interruptions as ex:
+                        attempts += 1
+                        if not resumable or attempts > self.retries:
+                            raise
+                        log.warning("%s: download interrupted after %d bytes; resuming",
+                                    relurl, done)
+                finally:
+                    resp.close()
+                    resp = None
+
+    def _retrieve_in_parallel(self, relurl, filepath, resp):
+        # download the content in pieces via concurrent ranged requests, 
+        # planned from the headers of resp, an open response for the full 
+        # content.  If this is not appropriate, False is returned without 
+        # reading from or closing resp (so that it can be read serially); 
+        # otherwise, resp is closed before the pieces are requested.
+        workers = int(self.cfg.get('parallel_downloads', 1))
+        if workers < 2:
+            return False
+
+        size = int(resp.headers.get('Content-Length', 0))
+        if resp.headers.get('Accept-Ranges') != 'bytes' or \
+           resp.headers.get('Content-Encoding') or \
+           size < int(self.cfg.get('parallel_threshold', DEF_PARALLEL_THRESHOLD)):
+            return False
+        validator = resp.headers.get('ETag') or resp.headers.get('Last-Modified')
+        resp.close()
+
+        piece = size // workers + 1
+        ranges = [(start, min(start+piece, size)-1) for start in range(0, size, piece)]
+        with open(filepath, "wb") as fd:
+            fd.truncate(size)
+        log.debug("%s: downloading %d bytes in %d pieces", relurl, size, len(ranges))
+
+        def fetch(rng):
+            return self._retrieve_range(relurl, filepath, rng[0], rng[1], validator)
+
+        pool = ThreadPool(len(ranges))
+        try:
+            pool.map(fetch, ranges, 1)
+        finally:
+            pool.close()
+            pool.join()
+        return True
+
+    def _retrieve_range(self, relurl, filepath, start, end, validator=None):
+        # download the given byte range into place within filepath
+        attempts = 0
+        with open(filepath, "r+b") as fd:
+            fd.seek(start)
+            while start <= end:
+                hdrs = { 'Range': "bytes={0}-{1}".format(start, end) }
+                if validator:
+                    hdrs['If-Range'] = validator
+                resp = self.session.get(self.base+relurl, headers=hdrs, stream=True,
+                                        timeout=self.timeout)
+                try:
+                    self._check_status(relurl, resp)
+                    if resp.status_code != 206:
+                        raise DistribServerError(relurl, resp.status_code, resp.reason,
+                                         message="Ranged request not honored "+
+                                                 "(has the file changed?)")
+                    for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                        if chunk:
+                            chunk = chunk[:end-start+1]
+                            fd.write(chunk)
+                            start += len(chunk)
+                    if start <= end:
+                        raise _IncompleteRead("connection closed with {0} bytes "
+                                              "remaining".format(end-start+1))
+                except _interruptions as ex:
+                    attempts += 1
+                    if attempts > self.retries:
+                        raise
+                    log.warning("%s: ranged download interrupted; resuming at %d",
+                                relurl, start)
+                finally:
+                    resp.close()
 
     def head(self, relurl):
         """
@@ -156,7 +366,9 @@ class RESTServiceClient(object):
 
         resp = None
         try:
-            resp = requests.get(self.base+relurl, allow_redirects=True)
+            # (the body, if any, is never read)
+            resp = self.session.get(self.base+relurl, allow_redirects=True, stream=True,
+                                    timeout=self.timeout)
             return (resp.status_code, resp.reason)
 
         except requests.RequestException as ex:
@@ -5,7 +5,8 @@ import os, sys, shutil, logging, json
 from collections import Mapping, Sequence, OrderedDict
 
 from .exceptions import (StateException, ConfigurationException, PDRException, NERDError)
-from .utils import write_json, read_nerd, read_json
+from .utils import write_json, read_nerd, read_json, submit_batch
+from .ingest.rmm import IngestFileNotStaged
 from ..doi import datacite as dc
 from ..pdr import def_jq_libdir, def_schema_dir
 from .. import jq
@@ -15,6 +16,16 @@ class DOIMintingClient(object):
     """
     a client class for minting and updating DataCite DOIs as part of the PDR preservation 
     process.
+
+    When all staged records are submitted (via submit_all()), they can be submitted 
+    concurrently, and submissions that fail due to a service or communication error 
+    can be retried after a delay.  This is controlled by the following configuration 
+    parameters:
+    :prop submit_workers int (1):  the maximum number of records to submit concurrently
+    :prop submit_retries int (0):  the number of times to retry a submission that fails 
+                                   due to a service or communication error
+    :prop submit_backoff float (1.0):  the seconds to wait before the first retry; the 
+                                   wait doubles for each subsequent retry.  
     """
 
     def __init__(self, config, log=None):
@@ -308,31 +319,27 @@ class DOIMintingClient(object):
 
     def submit_all(self):
         """
-        submit all staged datacite records to the datacite service.
+        submit all staged datacite records to the datacite service.  Records may be 
+        submitted concurrently according to the 'submit_workers' configuration 
+        parameter.  
 
         :return dict:  3 lists accessed via the keys, 'succeeded', 'failed', 
                           'skipped', each listing the names of records that 
                           ended up in that state after submitting all to the 
-                          ingest service.
+                          ingest service.  The 'latency' key maps each 
+                          submitted record name to the seconds it took to 
+                          submit it, and 'elapsed' gives the total time.
         """
-        succeeded = []
-        failed = []
-        skipped = []
-        for rec in self.staged_names():
-            try:
-                self.submit_staged(rec)
-                succeeded.append(rec)
-            except dc.DOIResolverError as ex:
-                failed.append(rec)
-
-            # Let DOIClientExcpetion and other PDR exceptions break the loop, 
-            # because it's probably a programming error somewhere.
-
-        return {
-            "succeeded": succeeded,
-            "failed": failed,
-            "skipped": skipped
-        }
+        # Let DOIClientExcpetion and other PDR exceptions abort the batch, 
+        # because it's probably a programming error somewhere.
+        return submit_batch(self.submit_staged, self.staged_names(),
+                            max(1, int(self._cfg.get('submit_workers', 1))),
+                            retryable=(dc.DOIResolverError, dc.DOICommunicationError),
+                            failures=(dc.DOIResolverError,),
+                            skippable=(IngestFileNotStaged,),
+                            retries=int(self._cfg.get('submit_retries', 0)),
+                            backoff=float(self._cfg.get('submit_backoff', 1.0)),
+                            log=self.log)
 
     def submit(self, name=None):
         """
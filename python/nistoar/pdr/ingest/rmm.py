@@ -1,15 +1,16 @@
 """
 Module providing client-side support for the RMM ingest service.  
 """
-import os, sys, shutil, logging, requests
+import os, sys, shutil, logging, requests, threading
 from collections import Mapping, Sequence, OrderedDict
+from requests.adapters import HTTPAdapter
 
 from ..exceptions import (StateException, ConfigurationException, PDRException,
                           NERDError)
-from ..utils import write_json, read_nerd
+from ..utils import write_json, read_nerd, submit_batch
 
 def submit_for_ingest(record, endpoint, name=None,
-                      authkey=None, authmeth='qparam'):
+                      authkey=None, authmeth='qparam', session=None):
     """
     Send the given JSON data-object to the ingest service.
 
@@ -23,6 +24,9 @@ def submit_for_ingest(record, endpoint, name=None,
                              Authorization header field) or 'qparam' (send
                              as a query parameter to the URL).  If not provided,
                              'qparam' is assumed.
+    :param session requests.Session:  the session to send the request through, 
+                             allowing connections to be reused across 
+                             submissions; if None, a new connection is made.
 
     :raises TypeError:          if the input is not a Mapping (dict-like) object.
     :raises IngestClientError:  raised ingest fails due to a client problem 
@@ -42,7 +46,7 @@ def submit_for_ingest(record, endpoint, name=None,
             endpoint += "?auth="+authkey
     
     try:
-        resp = requests.post(endpoint, json=record, headers=hdrs)
+        resp = (session or requests).post(endpoint, json=record, headers=hdrs)
         if resp.status_code >= 500:
             raise IngestServerError(resp.status_code, resp.reason, name)
         elif resp.status_code == 401:
@@ -95,6 +99,18 @@ class IngestClient(object):
     (4xx), it is moved to a failed subdirectory.  If the service responds with 
     a server error (5xx, or otherwise does not respond), the record is moved 
     back to the staging subdirectory so that a re-attempt can be tried later.  
+
+    When all staged records are submitted (via submit_all()), they can be 
+    submitted concurrently over a pool of reusable connections, and 
+    submissions that fail due to a server error can be retried after a delay.  
+    This is controlled by the following configuration parameters:
+    :prop submit_workers int (1):  the maximum number of records to submit 
+                                   concurrently
+    :prop submit_retries int (0):  the number of times to retry a submission
+                                   that fails due to a server error
+    :prop submit_backoff float (1.0):  the seconds to wait before the first 
+                                   retry; the wait doubles for each subsequent 
+                                   retry.  
     """
     def __init__(self, config, log=None):
         if not log:
@@ -152,6 +168,10 @@ class IngestClient(object):
             self.log.warn("submit config value not recognized: %s",
                           self.submit_mode)
 
+        self._workers = max(1, int(self._cfg.get('submit_workers', 1)))
+        self._session = None
+        self._seslock = threading.Lock()
+
     @property
     def endpoint(self):
         """
@@ -159,6 +179,29 @@ class IngestClient(object):
         """
         return self._endpt
 
+    @property
+    def session(self):
+        """
+        the requests Session used to submit records, which pools connections 
+        to the ingest service.
+        """
+        with self._seslock:
+            if self._session is None:
+                self._session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._workers)
+                self._session.mount("http://", adapter)
+                self._session.mount("https://", adapter)
+            return self._session
+
+    def close(self):
+        """
+        release the connections held open to the ingest service
+        """
+        with self._seslock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
     def stage(self, record, name=None):
         """
         write the given NERDm record to a file in JSON format in the staging
@@ -229,7 +272,7 @@ class IngestClient(object):
             try:
 
                 submit_for_ingest(rec, self._endpt, name,
-                                  self._auth[1], self._auth[0])
+                                  self._auth[1], self._auth[0], self.session)
 
             except NotValidForIngest as ex:
                 # the file is bad, send it to jail
@@ -309,36 +352,31 @@ class IngestClient(object):
 
     def submit_all(self):
         """
-        submit all available records to the ingest service.
+        submit all available records to the ingest service.  Records may be 
+        submitted concurrently according to the 'submit_workers' configuration 
+        parameter.  
 
         :return dict:  3 lists accessed via the keys, 'succeeded', 'failed', 
                           'skipped', each listing the names of records that 
                           ended up in that state after submitting all to the 
-                          ingest service.
+                          ingest service.  The 'latency' key maps each 
+                          submitted record name to the seconds it took to 
+                          submit it, and 'elapsed' gives the total time.
         :raises IngestAuthzError:   raised if the ingest fails due to an 
                                     authorization error.  
         :raises OSError:            raised if an error occurs while reading 
                                     the record file or moving the file between
                                     directories.  
         """
-        succeeded = []
-        failed = []
-        skipped = []
-        for rec in self.staged_names():
-            try:
-                self.submit_staged(rec)
-                succeeded.append(rec)
-            except (NotValidForIngest, IngestServerError) as ex:
-                failed.append(rec)
-
-            # Let IngestClientError break the loop, because it's probably
-            # a programming error somewhere.
-
-        return {
-            "succeeded": succeeded,
-            "failed": failed,
-            "skipped": skipped
-        }
+        # Let IngestClientError abort the batch, because it's probably
+        # a programming error somewhere.
+        return submit_batch(self.submit_staged, self.staged_names(), self._workers,
+                            retryable=(IngestServerError,),
+                            failures=(NotValidForIngest, IngestServerError),
+                            skippable=(IngestFileNotStaged,),
+                            retries=int(self._cfg.get('submit_retries', 0)),
+                            backoff=float(self._cfg.get('submit_backoff', 1.0)),
+                            log=self.log)
 
     def submit(self, name=None):
         """
@@ -473,4 +511,13 @@ class IngestAuthzError(IngestClientError):
     """
     pass
 
-
+class IngestFileNotStaged(StateException):
+    """
+    an error indicating that a requested record is not currently staged for 
+    submission (e.g. because it has already been submitted).
+    """
+    def __init__(self, name, message=None):
+        if not message:
+            message = "{0}: record is not staged for submission".format(name)
+        super(IngestFileNotStaged, self).__init__(message)
+        self.recname = name
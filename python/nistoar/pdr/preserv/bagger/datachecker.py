@@ -2,14 +2,17 @@
 tools for checking the availability of distributions described in a NIST bag.
 """
 import os, re
-from collections import Mapping
+from collections import Mapping, OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import multibag as mb
 import requests
+from requests.adapters import HTTPAdapter
 
 from .utils import parse_bag_name
 from ...exceptions import ConfigurationException, StateException
 from ...distrib import (RESTServiceClient, BagDistribClient, DistribServerError,
+                        bag_info_cache_for,
                         DistribServiceException, DistribResourceNotFound)
 
 class DataChecker(object):
@@ -27,6 +30,25 @@ class DataChecker(object):
        a) a cached copy of the specified member bag
        b) in a remote copy of the specified member bag available via the 
           distribution service.
+
+    To check many files at once, use availability_report() (which 
+    unavailable_files() is based on):  it opens each cached member bag only
+    once and issues the download URL HEAD requests concurrently over a shared
+    pool of keep-alive connections.  
+
+    This class can take a configuration dictionary on construction; the 
+    following properties are supported:
+    :prop store_dir str:   the directory where serialized member bags are cached
+    :prop pdr_dist_url_pattern str:  a regular expression that matches download 
+                           URLs that point to the PDR's distribution service; 
+                           it must capture the file path in its first group.
+    :prop repo_access dict:  the configuration for accessing the repository; 
+                           the distrib_service.service_endpoint sub-property 
+                           enables checks against remote bags.
+    :prop url_check_workers int (8):  the maximum number of HEAD requests to 
+                           have outstanding at one time when checking many files
+    :prop url_check_timeout float (60):  the number of seconds to wait for a 
+                           response to a HEAD request before giving up.
     """
 
     AVAIL_NOT = "not available"
@@ -60,10 +82,19 @@ class DataChecker(object):
                                          "not compile: " + self._disturlpat)
 
         self._distsvc = None
-        svcurl = self.cfg.get('repo_access',{}).get('distrib_service',{}) \
-                         .get('service_endpoint')
+        self._baginfo = None
+        dscfg = self.cfg.get('repo_access',{}).get('distrib_service',{})
+        svcurl = dscfg.get('service_endpoint')
         if svcurl:
-            self._distsvc = RESTServiceClient(svcurl)
+            self._distsvc = RESTServiceClient(svcurl, dscfg)
+
+            # the bag listings retrieved from the service are cached (unless
+            # turned off via listing_cache_ttl) so that checking many files in
+            # the same bag requires only one query
+            self._baginfo = bag_info_cache_for(dscfg)
+
+        self._urlworkers = max(1, int(self.cfg.get('url_check_workers', 8)))
+        self._urltimeout = self.cfg.get('url_check_timeout', 60)
 
     def available_in_bag(self, cmp):
         """
@@ -149,24 +180,28 @@ class DataChecker(object):
         if not inbag:
             return False
 
+        return self._in_cached_bags(cmp, self._open_cached_bags(inbag))
+
+    def _open_cached_bags(self, inbag):
+        # return the opened copies of the named member bag found in the cache
         locs = [ os.path.join(self._store, inbag) ]
         if not os.path.isdir(locs[0]):
             locs = [os.path.join(self._store, f) for f in os.listdir(self._store)
                                                  if f.startswith(inbag+".")]
-            if len(locs) == 0:
-                return False
 
+        out = []
         for loc in locs:
             if not os.path.isfile(loc):
                 continue
             try:
-                mbag = mb.open_bag(loc)
+                out.append(mb.open_bag(loc))
             except Exception as ex:
                 continue
-            if mbag.isfile('/'.join(['data', cmp])):
-                return True
+        return out
 
-        return False
+    def _in_cached_bags(self, filepath, mbags):
+        path = '/'.join(['data', filepath])
+        return any(mbag.isfile(path) for mbag in mbags)
 
     def has_pdr_url(self, cmp):
         """
@@ -190,17 +225,25 @@ class DataChecker(object):
         return bool(self._disturlpat.match(cmp))
 
     @classmethod
-    def head_url(cls, url):
+    def head_url(cls, url, session=None, timeout=None):
         """
         make a HEAD request on the given URL and return the status code
         and associated message as a tuple.  
 
         This raises a requests.RequestsException if a connection cannot be 
         made.
+
+        :param str url:     the URL to access
+        :param requests.Session session:  the session to make the request 
+                            through (allowing connections to be reused); if 
+                            None, a one-time connection is made.
+        :param float timeout:  the number of seconds to wait for a response
         """
+        if session is None:
+            session = requests
         resp = None
         try:
-            resp = requests.head(url, allow_redirects=True)
+            resp = session.head(url, allow_redirects=True, timeout=timeout)
             return (resp.status_code, resp.reason)
         finally:
             if resp is not None:
@@ -222,6 +265,9 @@ class DataChecker(object):
         :param cmp:   either a dict containing the component metadata describing 
                       the data file or a string giving the file's download URL.
         """
+        return self._available_via_url(cmp)
+
+    def _available_via_url(self, cmp, session=None):
         dlurl = cmp
         if isinstance(cmp, Mapping):
             if 'downloadURL' not in cmp:
@@ -230,7 +276,7 @@ class DataChecker(object):
             cmp = cmp.get('filepath', dlurl)
 
         try:
-            (stat, msg) = self.head_url(dlurl)
+            (stat, msg) = self.head_url(dlurl, session, self._urltimeout)
             ok = stat >= 200 and stat < 300
             if not ok and self.log:
                 self.log.debug("HEAD on %s: %s (%i)", cmp, msg, stat)
@@ -321,7 +367,7 @@ class DataChecker(object):
         
         if not self._distsvc:
             raise StateException("Distribution service not configured")
-        bagsvc = BagDistribClient(parts[0], self._distsvc)
+        bagsvc = BagDistribClient(parts[0], self._distsvc, self._baginfo)
 
         try:
             matches = [f for f in bagsvc.list_for_version(parts[1])
@@ -362,19 +408,114 @@ class DataChecker(object):
                              its download URL points to the PDR's 
                              distribution service. 
         """
-        missing = []
-        nerd = self.bag.nerdm_record(False)
-        for cmp in nerd.get('components',[]):
+        return [f for f, avail in self.availability_report(strict, viadistrib).items()
+                  if avail is self.AVAIL_NOT]
+
+    def availability_report(self, strict=False, viadistrib=True, components=None):
+        """
+        determine the availability of many data files at once, returning a 
+        dictionary that maps each file's filepath (or download URL, if it 
+        does not have a filepath) to one of the AVAIL_* values (as returned by
+        available_as()).  
+
+        The checks are batched for efficiency:  files not in the current bag
+        are grouped by the member bag that contains them so that each cached 
+        member bag is opened only once; the HEAD requests on download URLs 
+        are made concurrently (limited by the url_check_workers config 
+        parameter) using pooled, keep-alive connections; and the distribution
+        service is queried at most once per member bag.  
+
+        :param bool strict:  if True, don't assume if remote bag containing the
+                             file is available that the file is actually in the
+                             bag.
+        :param bool viadistrib:  if True, only check those files whose download
+                             URLs point to the PDR's distribution service. 
+        :param list components:  the component metadata for the files to check;
+                             if not provided, all of the downloadable components
+                             described in the bag will be checked.  
+        """
+        if components is None:
+            components = self.bag.nerdm_record(False).get('components',[])
+
+        cmps = OrderedDict()
+        for cmp in components:
             if "dcat:Distribution" not in cmp.get('@type',[]) or \
                'downloadURL' not in cmp:
                 continue
-            if viadistrib and 'downloadURL' in cmp and \
-               not self.has_pdr_url(cmp['downloadURL']):
+            if viadistrib and not self.has_pdr_url(cmp['downloadURL']):
                 continue
-            if not self.available(cmp, strict, False):
-                missing.append(cmp.get('filepath') or cmp.get('downloadURL'))
+            cmps[cmp.get('filepath') or cmp.get('downloadURL')] = cmp
+
+        out = OrderedDict([(k, None) for k in cmps])
+        todo = []
+        for key, cmp in cmps.items():
+            if self.available_in_bag(cmp):
+                out[key] = self.AVAIL_IN_BAG
+            else:
+                todo.append(key)
+
+        # group remaining files by the member bag that should contain them
+        inbag = {}
+        for key in todo:
+            if 'filepath' in cmps[key]:
+                inbag[key] = self.bag_location(cmps[key])
+
+        if self._store:
+            opened = {}
+            for key in todo:
+                mbname = inbag.get(key)
+                if not mbname:
+                    continue
+                if mbname not in opened:
+                    opened[mbname] = self._open_cached_bags(mbname)
+                if self._in_cached_bags(cmps[key]['filepath'], opened[mbname]):
+                    out[key] = self.AVAIL_IN_CACHED_BAG
+            opened = None
+            todo = [k for k in todo if out[k] is None]
+
+        if todo:
+            for key, ok in zip(todo, self._check_urls([cmps[k] for k in todo])):
+                if ok:
+                    out[key] = self.AVAIL_VIA_URL
+            todo = [k for k in todo if out[k] is None]
+
+        if todo and not strict and self._distsvc:
+            remote = {}
+            for key in todo:
+                mbname = inbag.get(key)
+                if not mbname:
+                    continue
+                if mbname not in remote:
+                    remote[mbname] = self.containing_bag_available(cmps[key])
+                if remote[mbname]:
+                    out[key] = self.AVAIL_IN_REMOTE_BAG
+
+        for key in out:
+            if out[key] is None:
+                out[key] = self.AVAIL_NOT
+        return out
+
+    def _check_urls(self, cmps):
+        # return a list of booleans indicating whether each of the given 
+        # components are available via their download URLs
+        workers = min(self._urlworkers, len(cmps))
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        try:
+            if workers < 2:
+                return [self._available_via_url(c, session) for c in cmps]
 
-        return missing
+            pool = ThreadPool(workers)
+            try:
+                return pool.map(lambda c: self._available_via_url(c, session),
+                                cmps, 1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            session.close()
 
     def all_files_available(self, strict=False, viadistrib=True):
         """
@@ -0,0 +1,314 @@
+"""
+This module provides a service for examining data files asynchronously (i.e. for
+extracting metadata from them) on behalf of many baggers at once.
+
+Examining a file (which includes calculating its checksum) can take a long time for
+large files.  Rather than dedicating a thread to each bag, the FileExaminerService
+maintains a single bounded pool of worker threads shared by all the bags being
+processed in a process.  Work is scheduled fairly:  the workers take turns among the
+bags that have files waiting, and within a bag, the smallest files are examined first
+so that as much of a dataset's metadata as possible (e.g. for its landing page) is
+filled in quickly.  Counts of the queued, running, completed, and failed
+examinations are kept for each bag.
+"""
+import os, logging, threading, heapq
+from collections import OrderedDict, deque
+
+DEF_MAX_WORKERS = 4
+
+log = logging.getLogger(__name__)
+
+class _Job(object):
+    # the examination work for one bag
+    def __init__(self, jobid):
+        self.id = jobid
+        self.queue = []        # heap of (size, seq, filepath, location)
+        self.queued = set()    # filepaths in queue
+        self.examine = None
+        self.log = log
+        self.whendone = []
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.finishing = False
+        self.forgotten = False
+        self.idle = threading.Event()
+        self.idle.set()
+
+    def is_active(self):
+        return bool(self.queue) or self.running > 0 or self.finishing
+
+    def status(self):
+        return OrderedDict([
+            ("queued",  len(self.queue)),
+            ("running", self.running),
+            ("done",    self.done),
+            ("failed",  self.failed)
+        ])
+
+class FileExaminerService(object):
+    """
+    a service that examines files using a bounded pool of threads shared across
+    many jobs, where a job is typically the set of files in a single bag.
+
+    Files are submitted for a job via submit() along with the function that should
+    examine each file.  Worker threads are started as needed (up to the configured
+    maximum) and exit when there is no more work to do.
+    """
+
+    def __init__(self, max_workers=DEF_MAX_WORKERS):
+        """
+        create the service
+        :param int max_workers:  the maximum number of files to examine at once
+        """
+        self.max_workers = max(1, max_workers)
+        self._jobs = {}
+        self._ready = deque()     # ids of jobs with files waiting
+        self._workers = 0
+        self._seq = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._local = threading.local()
+
+    def set_max_workers(self, max_workers):
+        """
+        reset the maximum number of files to examine at once.  A reduction takes
+        effect as currently running workers finish their current files.
+        """
+        with self._cond:
+            self.max_workers = max(1, max_workers)
+            self._start_workers()
+
+    def submit(self, jobid, files, examine, whendone=None, logger=None):
+        """
+        queue files for examination.  If the job is already active, the files are
+        added to it; otherwise, the job's counters are reset.  A file already waiting
+        in the job's queue will not be queued again.
+
+        :param str jobid:        an identifier for the job (e.g. the bag's directory)
+        :param dict files:       a mapping of file paths (as known to the bag) to
+                                 locations of the files on disk
+        :param function examine: the function that examines a file; it will be called
+                                 with the filepath and location as arguments.  An
+                                 exception it raises counts as a failure.
+        :param function whendone:  a function (taking no arguments) to call once
+                                 all of the job's files have been examined
+        :param Logger logger:    the logger to report failures to
+        """
+        entries = []
+        for filepath, location in files.items():
+            try:
+                size = os.stat(location).st_size
+            except (OSError, TypeError):
+                size = 0
+            entries.append((size, filepath, location))
+
+        whendone_now = None
+        with self._cond:
+            job = self._jobs.get(jobid)
+            if not job:
+                job = _Job(jobid)
+                self._jobs[jobid] = job
+            if not job.is_active():
+                job.done = job.failed = 0
+            job.forgotten = False
+            job.examine = examine
+            if logger:
+                job.log = logger
+            if whendone:
+                job.whendone.append(whendone)
+
+            for size, filepath, location in entries:
+                if filepath in job.queued:
+                    continue
+                self._seq += 1
+                heapq.heappush(job.queue, (size, self._seq, filepath, location))
+                job.queued.add(filepath)
+
+            if job.queue:
+                job.idle.clear()
+                if jobid not in self._ready:
+                    self._ready.append(jobid)
+                self._start_workers()
+            elif job.running == 0 and not job.finishing:
+                # nothing to examine; just run the whendone functions
+                job.finishing = True
+                whendone_now = job.whendone
+                job.whendone = []
+
+        if whendone_now is not None:
+            self._run_whendone(job, whendone_now)
+
+    def _start_workers(self):
+        # must be called while holding the lock
+        waiting = sum([len(self._jobs[j].queue) for j in self._ready])
+        while self._workers < self.max_workers and self._workers < waiting:
+            self._workers += 1
+            thrd = threading.Thread(target=self._work, name="FileExaminer")
+            thrd.daemon = True
+            thrd.start()
+
+    def _next(self):
+        # must be called while holding the lock; returns None when there's no
+        # more work (or this worker is surplus)
+        if self._workers > self.max_workers or not self._ready:
+            return None
+
+        # round-robin across jobs:  take one file from the job at the head of
+        # the line, then send it to the back of the line
+        job = self._jobs[self._ready.popleft()]
+        size, seq, filepath, location = heapq.heappop(job.queue)
+        job.queued.discard(filepath)
+        if job.queue:
+            self._ready.append(job.id)
+        job.running += 1
+        return (job, filepath, location)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                nxt = self._next()
+                if not nxt:
+                    self._workers -= 1
+                    return
+            job, filepath, location = nxt
+
+            self._local.jobid = job.id
+            ok = True
+            try:
+                job.examine(filepath, location)
+            except Exception as ex:
+                ok = False
+                job.log.error("%s: Failed to extract file metadata: %s",
+                              location, str(ex))
+
+            with self._cond:
+                job.running -= 1
+                if ok:
+                    job.done += 1
+                else:
+                    job.failed += 1
+                whendone = None
+                if not job.queue and job.running == 0 and not job.finishing:
+                    job.finishing = True
+                    whendone = job.whendone
+                    job.whendone = []
+
+            if whendone is not None:
+                self._run_whendone(job, whendone)
+            self._local.jobid = None
+
+    def _run_whendone(self, job, whendone):
+        while True:
+            for func in whendone:
+                try:
+                    func()
+                except Exception as ex:
+                    job.log.exception("post-file-examine function failure: "+str(ex))
+
+            with self._cond:
+                if job.queue or job.running > 0:
+                    # more files were submitted in the meantime; the worker that
+                    # finishes them will call any new whendone functions
+                    job.finishing = False
+                    return
+                if not job.whendone:
+                    job.finishing = False
+                    job.idle.set()
+                    if job.forgotten and self._jobs.get(job.id) is job:
+                        del self._jobs[job.id]
+                    return
+                whendone = job.whendone
+                job.whendone = []
+
+    def is_active(self, jobid):
+        """
+        return True if the given job has files waiting or being examined
+        """
+        with self._cond:
+            job = self._jobs.get(jobid)
+            return bool(job) and job.is_active()
+
+    def in_worker(self, jobid=None):
+        """
+        return True if the current thread is one of this service's workers.  If
+        jobid is given, return True only if the thread is working on that job.
+        """
+        current = getattr(self._local, 'jobid', None)
+        if jobid is None:
+            return current is not None
+        return current == jobid
+
+    def status(self, jobid):
+        """
+        return the progress counters for the given job as a dictionary with the
+        properties, "queued", "running", "done", and "failed".  The counters are
+        reset when files are submitted to a job that is not active.  None is returned
+        if no files have been submitted for the job.
+        """
+        with self._cond:
+            job = self._jobs.get(jobid)
+            if not job:
+                return None
+            return job.status()
+
+    def forget(self, jobid):
+        """
+        drop the progress counters for the given job.  If the job is still 
+        active, it will be dropped as soon as it finishes (unless more files 
+        are submitted for it in the meantime).
+        """
+        with self._cond:
+            job = self._jobs.get(jobid)
+            if not job:
+                return
+            if job.is_active():
+                job.forgotten = True
+            else:
+                del self._jobs[jobid]
+
+    def wait(self, jobid, timeout=None):
+        """
+        wait for the given job to finish.
+        :param float timeout:  the maximum number of seconds to wait; if None,
+                               wait indefinitely
+        :return bool:  True if the job is finished, False if the wait timed out
+        """
+        with self._cond:
+            job = self._jobs.get(jobid)
+        if not job:
+            return True
+        return job.idle.wait(timeout)
+
+    def wait_for_all(self, timeout=None):
+        """
+        wait for all jobs to finish.
+        :param float timeout:  the maximum number of seconds to wait for each job
+        :return bool:  True if all jobs are finished, False if the wait timed out
+        """
+        with self._cond:
+            jobs = list(self._jobs.values())
+        return all([job.idle.wait(timeout) for job in jobs])
+
+_service = None
+_service_lock = threading.Lock()
+
+def examiner_service_for(config=None):
+    """
+    return the FileExaminerService shared across the current process.  If it does
+    not exist yet, it will be created according to the given configuration.
+
+    :param dict config:  the configuration for the service; the following
+                         properties are supported:
+    :prop max_workers int (4):  the maximum number of files to examine at once
+                         across all bags.  If provided, this will reset the maximum
+                         for an existing service.
+    """
+    global _service
+    if config is None:
+        config = {}
+    with _service_lock:
+        if _service is None:
+            _service = FileExaminerService(config.get('max_workers', DEF_MAX_WORKERS))
+        elif 'max_workers' in config and config['max_workers'] != _service.max_workers:
+            _service.set_max_workers(config['max_workers'])
+    return _service
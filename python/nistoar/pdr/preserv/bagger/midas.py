@@ -240,6 +240,14 @@ class MIDASMetadataBagger(SIPBagger):
         """
         return self.bagbldr.bagdir
 
+    @property
+    def input_dirs(self):
+        """
+        the SIP directories in the MIDAS submission areas that the bag is 
+        built from
+        """
+        return tuple(self._indirs)
+
     def find_pod_file(self):
         """
         find an existing pod file given a list of existing possible locations
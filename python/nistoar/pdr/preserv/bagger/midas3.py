@@ -33,6 +33,8 @@ from .. import (SIPDirectoryError, SIPDirectoryNotFound, AIPValidationError,
 from .... import pdr
 from .prepupd import UpdatePrepService
 from .datachecker import DataChecker
+from .examiner import examiner_service_for
+from .sipscan import SIPScanner, scan_files
 from nistoar.nerdm.merge import MergerFactory
 from nistoar.nerdm.validate import create_validator
 
@@ -296,7 +298,7 @@ class MIDASSIP(object):
                 for d in pod.get('distribution',[]) if 'downloadURL' in d]
                 
 
-    def registered_files(self, prefer_pod=False):
+    def registered_files(self, prefer_pod=False, scanned=None):
         """
         return a mapping of component filepaths to actual filesystem paths
         to the corresponding file on disk.  To be included in the map, the 
@@ -305,6 +307,9 @@ class MIDASSIP(object):
         the PDR's data distribution service, and there is a corresponding 
         file in either the SIP upload directory or review directory.  
 
+        :param dict scanned:  the output of a recent scan of the SIP directories
+                      (see sipscan.scan_files()); if provided, the files' locations
+                      will be taken from it rather than looked up on disk.
         :return dict: a mapping of logical filepaths relative to the dataset 
                       root to full paths to the input data file for all data
                       files found in the SIP.
@@ -312,45 +317,32 @@ class MIDASSIP(object):
         out = OrderedDict()
 
         for fp in self.list_registered_filepaths(prefer_pod):
-            srcpath = self.find_source_file_for(fp)
+            if scanned is not None and fp in scanned:
+                srcpath = scanned[fp][0]
+            else:
+                srcpath = self.find_source_file_for(fp)
             if srcpath:
                 out[fp] = srcpath
 
         return out
 
-    def available_files(self):
+    def available_files(self, scanned=None):
         """
         get a list of the data files available in the SIP input directories
         (including hash files).  Some may not be currently part of the 
         collection; such files must be listed as distributions in the 
         POD record.
 
+        :param dict scanned:  the output of a recent scan of the SIP directories
+                      (see sipscan.scan_files()) to use instead of rescanning them
         :return dict: a mapping of logical filepaths relative to the dataset 
                       root to full paths to the input data file for all data
                       files found in the SIP.
         """
-        datafiles = {}
-
-        # check each of the possible locations; locations found later take
-        # precedence
-        for root in self._indirs:
-            root = root.rstrip('/')
-            for dir, subdirs, files in os.walk(root):
-                reldir = dir[len(root)+1:]
-                for f in files:
-                    # don't descend into subdirectories with ignorable names
-                    for d in range(len(subdirs)-1, -1, -1):
-                        if subdirs[d].startswith('.') or \
-                           subdirs[d].startswith('_'):
-                            del subdirs[d]
-                    
-                    if f.startswith('.') or f.startswith('_'):
-                        # skip dot-files and pod files written by MIDAS
-                        continue
-
-                    datafiles[os.path.join(reldir, f)] = os.path.join(dir, f)
-
-        return datafiles
+        # locations found later take precedence
+        if scanned is None:
+            scanned = scan_files(self._indirs)
+        return dict([(f, e[0]) for f, e in scanned.items()])
 
     def find_source_file_for(self, filepath):
         """
@@ -444,8 +436,15 @@ class MIDASMetadataBagger(SIPBagger):
     :prop doi_resolver    dict:  data for configuring the DOI resolver client; 
                                  see bagit.tools.enhance.ReferenceEnhancer for 
                                  for info.
+    :prop file_examiner   dict:  data for configuring the process-wide service that 
+                                 examines data files asynchronously; see 
+                                 examiner.examiner_service_for() for supported 
+                                 parameters.  In addition, snapshot_batch_size (int, 
+                                 200) sets how many examined files are recorded in
+                                 the SIP snapshot at a time.
     """
     BGRMD_FILENAME = "__bagger-midas3.json"
+    SIPSCAN_FILENAME = "__sipscan.json"
 
     @classmethod
     def forMetadataBag(cls, bagdir, config=None, minter=None, for_pres=False):
@@ -601,6 +600,11 @@ class MIDASMetadataBagger(SIPBagger):
 
         # The file-examiner allows for ansynchronous examination of the data files
         self.fileExaminer = self._AsyncFileExaminer(self)
+
+        # The SIP scanner detects which data files have changed since they were
+        # last examined
+        self.sipscanner = SIPScanner(self.sip.input_dirs,
+                                     os.path.join(self.bagbldr.bagdir, self.SIPSCAN_FILENAME))
 #        self.fileExaminer_mode = "none"
 #        if examine_file_mode:
 #            self.fileExaminer_mode = examine_file_mode
@@ -611,11 +615,14 @@ class MIDASMetadataBagger(SIPBagger):
         """
         signal that no further updates will be made to the bag via this bagger.  
 
-        Currently, this only disconnects the internal BagBuilder's log file inside
-        the bag; thus, it's okay if further updates are made after calling this 
-        function since the BagBuilder will reconnect the log file automatically.
+        This disconnects the internal BagBuilder's log file inside the bag and 
+        releases the file examiner's record of this bag (once any examination 
+        in progress finishes); it's okay if further updates are made after 
+        calling this function since the BagBuilder will reconnect the log file 
+        automatically.
         """
         self.bagbldr.disconnect_logfile()
+        self.fileExaminer.forget()
 
     def _mint_id(self, ediid):
         if not self._minter:
@@ -969,8 +976,8 @@ class MIDASMetadataBagger(SIPBagger):
                              to the output bag.  False will copy the files.
         :param bool force:   if False (default), the data files will be examined
                              for additional metadata only if the source data 
-                             file is newer than the corresponding metadata file 
-                             in the output bag.  
+                             file has been added or changed (according to the 
+                             sipscanner) since the last time it was examined.  
         :param str|bool examine:  a flag indicating whether and how to examine the 
                              individual files for metadata to extract.  A value of 
                              "async" will cause the files to be examined asynchronously
@@ -989,32 +996,38 @@ class MIDASMetadataBagger(SIPBagger):
         if not self.sip.nerd:
             self.ensure_res_metadata()
 
-        # we will determine if any of the submitted data files have changed since 
-        # we last checked; get that last timestamp and update it.
+        # record when we last checked for changes to the submitted data files
         now = time.time()
-        bmd = self.baggermd_for("")
-        lasttime = bmd.get('last_file_examine', 0.0)
         self.update_bagger_metadata_for("", {
             'last_file_examine': now,
             'last_file_examine_datetime': datetime.fromtimestamp(now).isoformat(' ')
         })
 
-        for destpath, srcpath in self.datafiles.items():
-            fforce = force
-            if not fforce:
-                dfmd = self.bagbldr.bag.nerd_metadata_for(destpath)
-                fforce = 'size' not in dfmd or 'checksum' not in dfmd
-
-            if srcpath and moddate_of(srcpath) > lasttime:
-                fforce = True
-                self.fileExaminer.add(srcpath, destpath)
+        # find the files that have been added or changed since we last looked;
+        # the one scan also serves to locate the registered files
+        current = self.sipscanner.scan()
+        self.datafiles = self.sip.registered_files(scanned=current)
+        diff = self.sipscanner.compare(current, self.datafiles)
+        updated = set(diff['added'] + diff['changed'])
+        self.log.debug("%d of %d data files added or changed since last examination",
+                       len(updated), len(self.datafiles))
 
-            self.ensure_file_metadata(srcpath, destpath, fforce, False)
+        for destpath, srcpath in self.datafiles.items():
+            if destpath in updated:
+                self.fileExaminer.add(srcpath, destpath, current.get(destpath))
+            if force or destpath in updated:
+                self.ensure_file_metadata(srcpath, destpath, True, False)
 
             if not nodata:
                 self.bagbldr.add_data_file(destpath, srcpath, False,
                                            self.hardlinkdata)
 
+        # files waiting to be examined are left out of the snapshot (so that they 
+        # will be considered changed the next time around); the examiner adds 
+        # each one after it is successfully examined.
+        self.sipscanner.save(current, [f for f in self.datafiles
+                                         if f not in self.fileExaminer.files])
+
         # re-examine the files that have changed.
         if examine and len(self.fileExaminer.files) > 0:
             if examine == "async":
@@ -1338,6 +1351,7 @@ class MIDASMetadataBagger(SIPBagger):
             self.sip.nerd['releaseHistory'] = relhist
         
         utils.write_json(adata, annotf)
+        self.bagbldr.bag.component_changed('')
         self.bagbldr.record("Preparing for preservation of %s by setting version, "
                             "release history", self.sip.nerd['version'])
         return self.sip.nerd
@@ -1352,15 +1366,19 @@ class MIDASMetadataBagger(SIPBagger):
                 rel['status'] = 'removed'
         return relhist
         
-    class _AsyncFileExaminer():
+    class _AsyncFileExaminer(object):
         """
         a class for extracting metadata from files asynchronously.  The files 
         to be examined should be added via the add() function.  When all 
-        desired files have been added, executing launch() will launch the 
-        examination in a separate thread. 
-        """
+        desired files have been added, executing launch() will hand them over to 
+        the process-wide FileExaminerService (see the examiner module) which 
+        examines the files of all bags with a shared, bounded pool of threads.
 
-        threads = OrderedDict()
+        The SIP snapshot entries of successfully examined files are collected 
+        and written to the snapshot in batches (of up to the number set by the 
+        file_examiner.snapshot_batch_size config parameter) and when all of 
+        the launched files have been examined.
+        """
 
         def __init__(self, bagger):
             self.bagger = bagger
@@ -1368,54 +1386,97 @@ class MIDASMetadataBagger(SIPBagger):
                 raise ValueError("Bagger not prepped: no bag root dir set")
             self.id = self.bagger.bagdir
             self.files = OrderedDict()
-
-        def add(self, location, filepath):
+            cfg = self.bagger.cfg.get('file_examiner') or {}
+            self.service = examiner_service_for(cfg)
+            self.batch_size = cfg.get('snapshot_batch_size', 200)
+            self._scanned = {}
+            self._examined = OrderedDict()
+            self._exlock = threading.Lock()
+
+        def add(self, location, filepath, scanned=None):
+            """
+            add a file to be examined.  
+
+            :param str location:  the path to the file on disk
+            :param str filepath:  the file's path within the bag's data directory
+            :param tuple scanned: the file's description from the SIP scan (see 
+                                  the sipscan module); if provided, it will be 
+                                  added to the bagger's SIP snapshot once the file 
+                                  is successfully examined.
+            """
             if filepath not in self.files:
                 self.files[filepath] = location
-
-        def _createThread(self, stoplogging=False, whendone=None):
-            if self.running():
-                self.bagger.log.debug("File examiner thread is still running")
-                return None
-            self.threads[self.id] = self._Thread(self, stoplogging, whendone)
-            return self.threads[self.id]
+            if scanned:
+                self._scanned[filepath] = scanned
 
         def running(self):
-            thread = self.threads.get(self.id)
-            return thread and thread.is_alive()
+            return self.service.is_active(self.id)
+
+        def forget(self):
+            """
+            release the service's record of this bag's examinations (see 
+            FileExaminerService.forget()).
+            """
+            self.service.forget(self.id)
+
+        def status(self):
+            """
+            return the progress counters for the examination of this bag's files 
+            (see FileExaminerService.status()), or None if no files have been 
+            submitted for examination.
+            """
+            return self.service.status(self.id)
 
         def launch(self, stoplogging=False, whendone=None):
             # run asynchronously
-            thread = self._createThread(stoplogging, whendone)
-            if thread:
-                thread.start()
+            def finish():
+                try:
+                    self.save_examined()
+                    if whendone:
+                        whendone()
+                finally:
+                    if stoplogging:
+                        self.bagger.bagbldr.disconnect_logfile()
+
+            files = self.files
+            self.files = OrderedDict()
+            self.service.submit(self.id, files, self._examine, finish, self.bagger.log)
 
         def run(self, whendone=None):
             # run pseudo-synchronously
-            thread = self._createThread(False, whendone)
-            if thread:
-                thread.start()
+            if self.service.in_worker():
+                # we're already running in one of the service's threads; waiting
+                # on other workers could deadlock, so do the work here.
+                while self.files:
+                    self.examine_next()
+                self.save_examined()
+                if whendone:
+                    whendone()
+                return
+
+            excs = []
+            def finish():
+                try:
+                    if whendone:
+                        whendone()
+                except Exception as ex:
+                    excs.append(ex)
+                    raise
+            self.launch(False, finish)
             self.waitForCompletion(None)
-            if thread.exc:
-                raise thread.exc
+            if excs:
+                raise excs[0]
 
         def waitForCompletion(self, timeout):
-            thread = self.threads.get(self.id)
-            if not thread or not thread.is_alive():
+            if not self.running():
                 return True
 
-            if thread is threading.current_thread():
-                log.warn("Thread "+thread.getName()+" trying to wait on itself; ignoring")
+            if self.service.in_worker(self.id):
+                log.warn("Examiner for "+self.id+" trying to wait on itself; ignoring")
                 return False
 
-            try:
-                thread.join(timeout)
-            except RuntimeError as ex:
-                log.warn("Skipping wait for examiner thread, "+thread.getName()+
-                         ", for deadlock danger")
-                return False
-            if thread.is_alive():
-                log.warn("Thread waiting timed out: "+str(thread))
+            if not self.service.wait(self.id, timeout):
+                log.warn("File examiner waiting timed out: "+self.id)
                 return False
 
             return True
@@ -1423,86 +1484,79 @@ class MIDASMetadataBagger(SIPBagger):
         def examine_next(self):
             filepath, location = self.files.popitem()
             try:
-                md = self.bagger.bagbldr.bag.nerd_metadata_for(filepath)
-
-                # if the metadata has been set, determine the conponent type
-                ct = md.get('@type')
-                if ct:
-                    ct = re.sub(r'^[^:]*:', '', ct[0])
-            
-                md = self.bagger.bagbldr.describe_data_file(location, filepath,
-                                                            True, ct)
-                if '__status' in md:
-                    md['__status'] = "updated"
-
-                # it's possible that this file has been deleted while this
-                # thread was launched; make sure it still exists
-                if not self.bagger.bagbldr.bag.comp_exists(filepath):
-                    self.bagger.log.warning("Examiner thread detected that component no " +
-                                            "longer exists; skipping update for bag="+
-                                            self.bagger.name+", path="+filepath)
-                    return
-
-                md = self.bagger.bagbldr.update_metadata_for(filepath, md, ct,
-                                   "async metadata update for file, "+filepath)
-                if '__status' in md:
-                    del md['__status']
-                    self.bagger.bagbldr.replace_metadata_for(filepath, md, '')
-                self.bagger._mark_filepath_synced(filepath)
-
+                self._examine(filepath, location)
             except Exception as ex:
                 self.bagger.log.error("%s: Failed to extract file metadata: %s"
                                       % (location, str(ex)))
 
-        @classmethod
-        def wait_for_all(cls, timeout=10):
-            log.info("Waiting for file examiner threads to finish")
-            tids = list(cls.threads.keys())
-            done = []
-            for tid in tids:
-                thread = cls.threads.get(tid)
-                if not thread:
-                    done.append(tid) 
-                    continue
-                if thread is threading.current_thread():
-                    continue
+        def _examine(self, filepath, location):
+            scanned = self._scanned.pop(filepath, None)
+            try:
+                self._examine_file(filepath, location)
+            except Exception:
+                # make sure the file gets examined again the next time around
                 try:
-                    exmnr.thread.join(timeout)
-                    if thrd.is_alive():
-                        log.warn("Thread waiting timed out: "+str(thrd))
-                    else:
-                        done.append(tid)
-                except RuntimeError as ex:
-                    log.warn("Skipping wait for thread, "+str(thrd)+
-                             ", for deadlock danger")
-            return len(done) == len(tids)
-
-        class _Thread(threading.Thread):
-            def __init__(self, exmnr, stoplogging=False, whendone=None):
-                super(MIDASMetadataBagger._AsyncFileExaminer._Thread, self). \
-                    __init__(name="Examiner-"+exmnr.id)
-                self.exif = exmnr
-                self.stop_logging = stoplogging
-                self.on_finish = whendone
-                self.exc = None
-
-            def run(self):
-                # time.sleep(0.1)
-                while self.exif.files:
-                    self.exif.examine_next()
-
+                    self.bagger.sipscanner.forget([filepath])
+                except Exception as ex:
+                    self.bagger.log.warning("Failed to update SIP snapshot: %s", str(ex))
+                raise
+
+            if scanned:
+                # record that this version of the file has been examined
+                with self._exlock:
+                    self._examined[filepath] = scanned
+                    full = len(self._examined) >= self.batch_size
+                if full:
+                    self.save_examined()
+
+        def save_examined(self):
+            """
+            add the files examined since the last call to the bagger's SIP snapshot
+            """
+            with self._exlock:
+                examined = self._examined
+                self._examined = OrderedDict()
+            if examined:
                 try:
-                    if self.on_finish:
-                        self.on_finish()
+                    self.bagger.sipscanner.update(examined)
                 except Exception as ex:
-                    self.exif.bagger.log.exception("post-file-examine function failure: "+
-                                                   str(ex))
-                    self.exc = ex
+                    self.bagger.log.warning("Failed to update SIP snapshot: %s", str(ex))
+
+        def _examine_file(self, filepath, location):
+            md = self.bagger.bagbldr.bag.nerd_metadata_for(filepath)
 
-                if self.stop_logging:
-                    self.exif.bagger.bagbldr.disconnect_logfile()
+            # if the metadata has been set, determine the conponent type
+            ct = md.get('@type')
+            if ct:
+                ct = re.sub(r'^[^:]*:', '', ct[0])
+            
+            md = self.bagger.bagbldr.describe_data_file(location, filepath,
+                                                        True, ct)
+            if '__status' in md:
+                md['__status'] = "updated"
+
+            # it's possible that this file has been deleted while this
+            # file was waiting to be examined; make sure it still exists
+            if not self.bagger.bagbldr.bag.comp_exists(filepath):
+                self.bagger.log.warning("Examiner thread detected that component no " +
+                                        "longer exists; skipping update for bag="+
+                                        self.bagger.name+", path="+filepath)
+                return
+
+            md = self.bagger.bagbldr.update_metadata_for(filepath, md, ct,
+                               "async metadata update for file, "+filepath)
+            if '__status' in md:
+                del md['__status']
+                self.bagger.bagbldr.replace_metadata_for(filepath, md, '')
+            self.bagger._mark_filepath_synced(filepath)
 
-                del self.exif.threads[self.exif.id]
+        @classmethod
+        def wait_for_all(cls, timeout=10):
+            log.info("Waiting for file examiner threads to finish")
+            if not examiner_service_for().wait_for_all(timeout):
+                log.warn("File examiner waiting timed out")
+                return False
+            return True
         
 
 class PreservationBagger(SIPBagger):
@@ -2029,5 +2083,7 @@ class PreservationBagger(SIPBagger):
                         for key in rmkeys:
                             del md[key]
                         utils.write_json(md, nf)
+                        self.bagbldr.bag.component_changed(
+                            root[len(self.bagbldr.bag.metadata_dir)+1:])
     
 
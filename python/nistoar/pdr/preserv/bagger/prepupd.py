@@ -18,6 +18,7 @@ from ...describe import rmm
 from ... import distrib
 from ...exceptions import IDNotFound
 from ... import utils
+from ..checksum import ChecksumLedger
 from ..bagit.builder import BagBuilder, ARK_NAAN
 from ..bagit.bag import NISTBag
 from ... import PDR_PUBLIC_SERVER
@@ -29,8 +30,21 @@ ARK_PFX = "ark:/{0}/".format(ARK_NAAN)
 class HeadBagCacher(object):
     """
     a helper class that manages serialized head bags in a local cache.
+
+    The cache can be limited to a maximum total size; when a newly cached bag
+    causes the cache to exceed this limit, the least recently used bags are 
+    removed until it is back within the limit.  To avoid re-reading cached 
+    bags, the checksums of bags that have been confirmed are recorded (along 
+    with the size and modification time of the bag file); a bag will not be 
+    re-checksummed unless the file has changed.  Requests for the same AIP 
+    from different threads or processes are serialized so that a bag is only 
+    fetched once.
     """
-    def __init__(self, distrib_service, cachedir, infodir=None):
+    LEDGER_FILENAME = "_checksums.json"
+    ACCESS_FILENAME = "_access.json"
+
+    def __init__(self, distrib_service, cachedir, infodir=None, max_size=None,
+                 min_idle=0):
         """
         set up the cache
         :param RESTServiceClient distrib_service:  the distribution service 
@@ -40,12 +54,21 @@ class HeadBagCacher(object):
         :param str infodir:    the path to the directory where bag metadata 
                                will be stored.  If not provided, a subdirectory
                                of cachedir, "_info", will be used.
+        :param int max_size:   the maximum number of bytes of bags to keep in 
+                               the cache.  If None or less than 1, the cache 
+                               size is unlimited.
+        :param int min_idle:   the number of seconds since a bag was last 
+                               requested before it may be evicted from the 
+                               cache; this protects bags that a caller may 
+                               still be reading.  
         """
         self.distsvc = distrib_service
         self.cachedir = cachedir
         if not infodir:
             infodir = os.path.join(self.cachedir, "_info")
         self.infodir = infodir
+        self.max_size = max_size
+        self.min_idle = min_idle
 
         if not os.path.exists(self.cachedir):
             os.mkdir(self.cachedir)
@@ -57,6 +80,11 @@ class HeadBagCacher(object):
         if not os.path.isdir(self.infodir):
             raise StateException("HeadBagCacher: not a directory: "+
                                  self.cachedir)
+        self._lockdir = os.path.join(self.infodir, "_locks")
+        if not os.path.exists(self._lockdir):
+            os.mkdir(self._lockdir)
+        self._ledgerfile = os.path.join(self.infodir, self.LEDGER_FILENAME)
+        self._accessfile = os.path.join(self.infodir, self.ACCESS_FILENAME)
         
 
     def cache_headbag(self, aipid, version=None, confirm=True):
@@ -67,55 +95,192 @@ class HeadBagCacher(object):
         """
         bagcli = distrib.BagDistribClient(aipid, self.distsvc)
 
-        hinfo = None
-        if version and version != 'latest':
-            # map id,version to bagfile using our local cache
-            info = self._recall_head_info(aipid)
-            if version in info and 'name' in info[version]:
-                hinfo = info[version]
-
-        if not hinfo:
-            # map id,version to bagfile using the remote service
-            try:
-                hinfo = bagcli.describe_head_for_version(version)
-            except distrib.DistribResourceNotFound as ex:
-                return None
-
-            # cache the info locally
-            if not version or version == 'latest':
-                version = hinfo['sinceVersion']
-            self._cache_head_info(aipid, version, hinfo)
-
-        # look for bag in cache; if not there, fetch a copy
-        bagfile = os.path.join(self.cachedir, hinfo['name'])
-        if not os.path.exists(bagfile):
-            bagcli.save_bag(hinfo['name'], self.cachedir)
-        if confirm:
-            self.confirm_bagfile(hinfo)
-
+        # Holding the lock for this AIP ensures that concurrent requests for 
+        # it share a single fetch.
+        with utils.LockedFile(os.path.join(self._lockdir, aipid), 'a'):
+            hinfo = None
+            if version and version != 'latest':
+                # map id,version to bagfile using our local cache
+                info = self._recall_head_info(aipid)
+                if version in info and 'name' in info[version]:
+                    hinfo = info[version]
+
+            if not hinfo:
+                # map id,version to bagfile using the remote service
+                try:
+                    hinfo = bagcli.describe_head_for_version(version)
+                except distrib.DistribResourceNotFound as ex:
+                    return None
+
+                # cache the info locally
+                if not version or version == 'latest':
+                    version = hinfo['sinceVersion']
+                self._cache_head_info(aipid, version, hinfo)
+
+            # look for bag in cache; if not there, fetch a copy.
+            bagfile = os.path.join(self.cachedir, hinfo['name'])
+            if not os.path.exists(bagfile):
+                bagcli.save_bag(hinfo['name'], self.cachedir)
+            if confirm:
+                self.confirm_bagfile(hinfo)
+            self._record_access(hinfo['name'])
+
+        self.evict(keep=[hinfo['name']])
         return bagfile
 
     def confirm_bagfile(self, baginfo, purge_on_error=True):
         """
         Make sure the cached bag described by bag metadata was transfered
-        correctly by checking it checksum.  
+        correctly by checking it checksum.  The checksum is only calculated if
+        the bag file has changed since it was last confirmed.
         :raise CorruptedBagError: if an error was detected.
         """
         bagfile = os.path.join(self.cachedir, baginfo['name'])
         try:
+            sig = ChecksumLedger.signature_of(bagfile)
+            with utils.LockedFile(self._ledgerfile+".lock", 'a'):
+                confirmed = ChecksumLedger(self._ledgerfile).get(baginfo['name'], sig)
+            if confirmed and confirmed == baginfo['checksum']['hash']:
+                return
+
             if utils.checksum_of(bagfile) != baginfo['checksum']['hash']:
                 if purge_on_error:
                     # bag file looks corrupted; purge it from the cache
                     self._clear_from_cache(bagfile, baginfo)
                     
                 raise CorruptedBagError(bagfile, bagfile+": checksum failure")
-        except OSError as ex:
+        except (OSError, IOError) as ex:
             if purge_on_error:
                 self._clear_from_cache(bagfile, baginfo)
                 
             raise CorruptedBagError(bagfile, "Failure reading bag file: " +
                                     bagfile + ": " + str(ex), cause=ex)
 
+        with utils.LockedFile(self._ledgerfile+".lock", 'a'):
+            ledger = ChecksumLedger(self._ledgerfile)
+            ledger.put(baginfo['name'], sig, baginfo['checksum']['hash'])
+            ledger.save()
+
+    def cached_bags(self):
+        """
+        return a list of the bags currently in the cache, ordered from least
+        to most recently used.  Each item is a (name, size, last_access) tuple.
+        """
+        access = self._recall_access()
+        out = []
+        for name in os.listdir(self.cachedir):
+            if name.startswith('_') or name.startswith('.') or name.endswith('.part'):
+                # not a (completely downloaded) bag
+                continue
+            try:
+                st = os.stat(os.path.join(self.cachedir, name))
+            except OSError:
+                continue
+            if not os.path.isfile(os.path.join(self.cachedir, name)):
+                continue
+            out.append( (name, st.st_size, access.get(name, st.st_mtime)) )
+        out.sort(key=lambda b: b[2])
+        return out
+
+    def evict(self, keep=None, max_size=None):
+        """
+        remove the least recently used bags from the cache until the total
+        size of the cached bags is within the configured maximum size.  Bags 
+        that are not yet fully cached (i.e. not yet recorded as accessed), that 
+        were requested within the last min_idle seconds, or whose AIP is 
+        currently being fetched are not removed.
+
+        :param list keep:     names of bags that should not be removed
+        :param int  max_size: the size limit to enforce, overriding the 
+                              configured one
+        :return list:  the names of the bags that were removed
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if not max_size or max_size < 1:
+            return []
+        if not keep:
+            keep = []
+
+        out = []
+        with utils.LockedFile(self._accessfile+".lock", 'a'):
+            access = self._recall_access()
+            bags = self.cached_bags()
+            total = sum([b[1] for b in bags])
+            idle_since = time.time() - (self.min_idle or 0)
+            for name, size, used in bags:
+                if total <= max_size:
+                    break
+                if name in keep or name not in access or access[name] > idle_since:
+                    continue
+
+                # make sure no one is fetching or confirming the bag while we 
+                # remove it
+                aiplock = self._try_lock_aip_of(name)
+                if aiplock is False:
+                    continue
+                try:
+                    os.remove(os.path.join(self.cachedir, name))
+                except OSError as ex:
+                    deflog.warning("Unable to evict %s from head bag cache: %s",
+                                   name, str(ex))
+                    continue
+                finally:
+                    if aiplock:
+                        aiplock.close()
+                total -= size
+                out.append(name)
+
+            if out:
+                for name in out:
+                    access.pop(name, None)
+                self._save_access(access)
+
+        if out:
+            with utils.LockedFile(self._ledgerfile+".lock", 'a'):
+                ledger = ChecksumLedger(self._ledgerfile)
+                for name in out:
+                    ledger.remove(name)
+                ledger.save()
+            deflog.info("Evicted %d bag(s) from head bag cache", len(out))
+
+        return out
+
+    def _try_lock_aip_of(self, bagname):
+        # lock the AIP that the named bag belongs to without waiting.  Returns 
+        # the open LockedFile, False if the AIP is locked by another, or None 
+        # if the AIP cannot be determined.
+        try:
+            aipid = bagutils.parse_bag_name(bagname)[0]
+        except ValueError:
+            return None
+        lock = utils.LockedFile(os.path.join(self._lockdir, aipid), 'a')
+        if lock.try_open() is None:
+            return False
+        return lock
+
+    def _record_access(self, bagname):
+        with utils.LockedFile(self._accessfile+".lock", 'a'):
+            access = self._recall_access()
+            access[bagname] = time.time()
+            self._save_access(access)
+
+    def _recall_access(self):
+        if not os.path.exists(self._accessfile):
+            return {}
+        try:
+            with open(self._accessfile) as fd:
+                return json.load(fd)
+        except ValueError as ex:
+            deflog.warning("Ignoring corrupted head bag cache access record: %s", str(ex))
+            return {}
+
+    def _save_access(self, access):
+        tmpf = self._accessfile + ".tmp"
+        with open(tmpf, 'w') as fd:
+            json.dump(access, fd)
+        os.rename(tmpf, self._accessfile)
+
     def _clear_from_cache(self, bagfile, baginfo=None):
         if os.path.exists(bagfile):
             os.remove(bagfile)
@@ -159,8 +324,10 @@ class UpdatePrepService(object):
         self.storedir = self.cfg.get('store_dir')
         self.restricted_storedir = self.cfg.get('restricted_store_dir')
         scfg = self.cfg.get('distrib_service', {})
-        self.distsvc = distrib.RESTServiceClient(scfg.get('service_endpoint'))
-        self.cacher = HeadBagCacher(self.distsvc, self.sercache)
+        self.distsvc = distrib.RESTServiceClient(scfg.get('service_endpoint'), scfg)
+        self.cacher = HeadBagCacher(self.distsvc, self.sercache,
+                                    max_size=self.cfg.get('headbag_cache_max_size'),
+                                    min_idle=self.cfg.get('headbag_cache_min_idle', 60))
 
         self.mdsvc = None
         scfg = self.cfg.get('metadata_service', {})
@@ -307,11 +474,11 @@ class UpdatePrepper(object):
         """
         return self.cache_nerdm_rec(shallow=not deep) is not None
         
-    def _unpack_bag_as(self, bagfile, destbag):
+    def _unpack_bag_as(self, bagfile, destbag, payload=True):
         destdir = os.path.dirname(destbag)
 
         if bagfile.endswith('.zip'):
-            root = self._unpack_zip_into(bagfile, destdir)
+            root = self._unpack_zip_into(bagfile, destdir, payload)
         else:
             raise StateException("Don't know how to unpack serialized bag: "+
                                  os.path.basename(bagfile))
@@ -321,8 +488,17 @@ class UpdatePrepper(object):
             raise RuntimeException("Apparent bag unpack failure; root "+
                                    "not created: "+tmpname)
         os.rename(tmpname, destbag)
+
+    @staticmethod
+    def _zip_bag_root(zip, bagfile):
+        # return the name of the bag's root directory within an open zip file
+        for name in zip.namelist():
+            root = name.split("/")[0]
+            if root:
+                return root
+        raise StateException("Bag appears to be empty: "+bagfile)
         
-    def _unpack_zip_into(self, bagfile, destdir):
+    def _unpack_zip_into(self, bagfile, destdir, payload=True):
         if not os.path.exists(destdir):
             raise StateException("Bag destination directory not found: "+destdir)
                                  
@@ -331,19 +507,18 @@ class UpdatePrepper(object):
         # for restoring the content's original data-time stamps.
 
         dirs = {}
+        skipped = 0
         with ZipFile(bagfile, 'r') as zip:
-            contents = zip.namelist()
-            root = None
-            for name in contents:
-                parts = name.split("/")
-                root = parts[0]
-                if root:
-                    break
-
-            if not root:
-                raise StateException("Bag appears to be empty: "+bagfile)
+            root = self._zip_bag_root(zip, bagfile)
+            datapfx = root + "/data/"
 
             for entry in zip.infolist():
+                if not payload and entry.filename.startswith(datapfx) and \
+                   entry.filename != datapfx:
+                    # skip the data files (but not the data directory itself)
+                    skipped += entry.file_size
+                    continue
+                    
                 zip.extract(entry, destdir)
                 extracted = os.path.join(destdir, entry.filename)
                 date_time = time.mktime(entry.date_time + (0, 0, -1))
@@ -353,11 +528,54 @@ class UpdatePrepper(object):
                 else:
                     os.utime(extracted, (date_time, date_time))
 
+        if not payload:
+            datadir = os.path.join(destdir, root, "data")
+            if not os.path.exists(datadir):
+                os.makedirs(datadir)
+            self.log.debug("Skipped unpacking %d bytes of payload from %s",
+                           skipped, os.path.basename(bagfile))
+
         for name in dirs:
             os.utime(name, (dirs[name], dirs[name]))
 
         return root
 
+    def open_bag_member(self, bagfile, filepath):
+        """
+        open a file from within a serialized bag for reading without unpacking
+        the bag.  
+
+        :param str bagfile:   the path to the serialized bag; currently only
+                              zip-formatted bags are supported.
+        :param str filepath:  the path of the desired file relative to the 
+                              bag's root directory (e.g. "metadata/nerdm.json")
+        :return:  a file-like object opened for reading; the caller should 
+                  close it when done.
+        :raise KeyError:  if the file does not exist in the bag
+        :raise StateException:  if the bag's serialization format is not 
+                                supported
+        """
+        if not bagfile.endswith('.zip'):
+            raise StateException("Don't know how to read serialized bag: "+
+                                 os.path.basename(bagfile))
+        with ZipFile(bagfile, 'r') as zip:
+            member = "/".join([self._zip_bag_root(zip, bagfile)] +
+                              [p for p in filepath.split(os.sep) if p])
+            # (the returned member keeps its own handle on the zip file)
+            return zip.open(member)
+
+    def read_bag_member(self, bagfile, filepath):
+        """
+        return the contents of a file from within a serialized bag without 
+        unpacking the bag.  See open_bag_member() for a description of the 
+        parameters.
+        """
+        fd = self.open_bag_member(bagfile, filepath)
+        try:
+            return fd.read()
+        finally:
+            fd.close()
+
 
     def create_new_update(self, destbag):
         """
@@ -456,8 +674,8 @@ class UpdatePrepper(object):
             raise ValueError("UpdatePrepper: head bag does not exist: "+headbag)
 
         else:
-            # serialized bag file
-            self._unpack_bag_as(headbag, mdbag)
+            # serialized bag file; the data files will not be needed
+            self._unpack_bag_as(headbag, mdbag, payload=False)
 
         # save the the bag-info.txt as deprecated-info.txt for later use
         mbdir = os.path.join(mdbag, "multibag")
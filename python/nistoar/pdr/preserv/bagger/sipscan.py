@@ -0,0 +1,189 @@
+"""
+This module provides a scanner for detecting changes to the data files in SIP
+directories.
+
+For large datasets (particularly those on network file systems), walking the SIP
+directories and examining each file to see if it has changed can dominate the time
+it takes to process an update.  The SIPScanner walks the directories once (using
+``scandir``, when available, to avoid a separate ``stat`` call per entry), and
+compares the result against a snapshot of (location, size, modification time, inode)
+saved from the previous scan.  This allows a bagger to limit its work to the files
+that have been added or changed since then.
+"""
+import os, json, threading
+from collections import OrderedDict
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from ... import utils
+
+def _is_ignorable(name):
+    # dot-files and files starting with an underscore (e.g. pod files written
+    # by MIDAS) are not data files
+    return name.startswith('.') or name.startswith('_')
+
+def _scan_dir(root, reldir, out):
+    dirpath = os.path.join(root, reldir) if reldir else root
+    if scandir:
+        for ent in scandir(dirpath):
+            if _is_ignorable(ent.name):
+                continue
+            relpath = os.path.join(reldir, ent.name)
+            if ent.is_dir():
+                _scan_dir(root, relpath, out)
+            elif ent.is_file():
+                st = ent.stat()
+                out[relpath] = (ent.path, st.st_size, st.st_mtime, st.st_ino)
+    else:
+        for name in os.listdir(dirpath):
+            if _is_ignorable(name):
+                continue
+            relpath = os.path.join(reldir, name)
+            path = os.path.join(dirpath, name)
+            if os.path.isdir(path):
+                _scan_dir(root, relpath, out)
+            elif os.path.isfile(path):
+                st = os.stat(path)
+                out[relpath] = (path, st.st_size, st.st_mtime, st.st_ino)
+
+def scan_files(roots):
+    """
+    return a description of the data files found below the given directories.  Files
+    and directories whose names start with a dot or underscore are ignored.
+
+    :param list roots:  the directories to scan; when a file path appears under more
+                        than one, the one found in the later directory takes precedence.
+    :return dict:  a mapping of file paths (relative to the root directories) to a
+                   tuple of (location, size, mtime, inode), where location is the full
+                   path to the file.
+    """
+    out = OrderedDict()
+    for root in roots:
+        _scan_dir(root.rstrip('/'), '', out)
+    return out
+
+class SIPScanner(object):
+    """
+    a scanner for detecting changes to the files in a set of SIP directories since
+    the last time they were scanned.
+
+    The state of the files is saved to a snapshot file via save(); the next scan()
+    will be compared against it.  A file is considered changed if its location, size,
+    modification time, or inode is different from its snapshot.
+    """
+
+    def __init__(self, roots, snapshotfile):
+        """
+        :param list roots:         the SIP directories to scan (see scan_files())
+        :param str snapshotfile:   the path to the file where the snapshot should be
+                                   saved
+        """
+        self.roots = list(roots)
+        self.snapshotfile = snapshotfile
+        self._lock = threading.RLock()
+
+    def scan(self):
+        """
+        scan the SIP directories and return their current state (as returned by
+        scan_files()).
+        """
+        return scan_files(self.roots)
+
+    def load_snapshot(self):
+        """
+        return the last saved snapshot, or None if no snapshot has been saved.  The
+        snapshot has the same form as the output of scan().
+        """
+        with self._lock:
+            if not os.path.exists(self.snapshotfile):
+                return None
+            try:
+                data = utils.read_json(self.snapshotfile)
+            except Exception:
+                # treat it as missing
+                return None
+            return OrderedDict([(k, tuple(v)) for k, v in data.get('files', {}).items()])
+
+    def compare(self, current, only=None):
+        """
+        compare the given scan output with the saved snapshot and return the
+        differences as a dictionary with "added", "changed", and "removed" properties,
+        each listing file paths.  If no snapshot exists, all current files are
+        considered added.
+
+        :param dict current:  the output of scan()
+        :param only:          if provided, the list (or dictionary) of the only file
+                              paths to consider.
+        """
+        snap = self.load_snapshot() or {}
+        if only is not None:
+            current = OrderedDict([(f, current[f]) for f in only if f in current])
+            snap = dict([(f, snap[f]) for f in only if f in snap])
+
+        out = OrderedDict([("added", []), ("changed", []), ("removed", [])])
+        for filepath, ent in current.items():
+            if filepath not in snap:
+                out['added'].append(filepath)
+            elif tuple(snap[filepath]) != tuple(ent):
+                out['changed'].append(filepath)
+        out['removed'] = [f for f in snap if f not in current]
+        return out
+
+    def save(self, current, only=None):
+        """
+        save the given scan output as the snapshot to compare the next scan to.
+
+        :param dict current:  the output of scan()
+        :param only:          if provided, the list (or dictionary) of the only file
+                              paths to save.
+        """
+        if only is not None:
+            current = OrderedDict([(f, current[f]) for f in only if f in current])
+        with self._lock:
+            self._write(current)
+
+    def update(self, entries):
+        """
+        add or replace the given entries in the saved snapshot.  This is used to 
+        record files individually as they are processed.  
+
+        :param dict entries:  a mapping of file paths to their descriptions, as 
+                              found in the output of scan()
+        """
+        with self._lock:
+            snap = self.load_snapshot() or OrderedDict()
+            snap.update(entries)
+            self._write(snap)
+
+    def forget(self, filepaths):
+        """
+        remove the given files from the saved snapshot so that they will be
+        considered added the next time the directories are scanned.
+        """
+        with self._lock:
+            snap = self.load_snapshot()
+            if not snap:
+                return
+            for filepath in filepaths:
+                snap.pop(filepath, None)
+            self._write(snap)
+
+    def clear(self):
+        """
+        delete the saved snapshot
+        """
+        with self._lock:
+            if os.path.exists(self.snapshotfile):
+                os.remove(self.snapshotfile)
+
+    def _write(self, files):
+        tmpf = self.snapshotfile + ".tmp"
+        with open(tmpf, 'w') as fd:
+            json.dump({"roots": self.roots, "files": files}, fd)
+        os.rename(tmpf, self.snapshotfile)
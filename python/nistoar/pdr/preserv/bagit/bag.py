@@ -2,12 +2,14 @@
 Tools for reading data from a bag
 """
 
-import os, logging, re, json, hashlib
+import os, logging, re, json, hashlib, threading
 from collections import OrderedDict
+from copy import deepcopy
 
 from .. import PreservationSystem, read_nerd, read_pod
 from .. import NERDError, PODError, StateException
 from .exceptions import BadBagRequest, ComponentNotFound, BagFormatError
+from .index import ComponentIndex, INDEX_FILENAME
 from ... import def_jq_libdir, def_merge_etcdir
 from ....nerdm.merge import MergerFactory, Merger
 from ....nerdm.convert import ComponentCounter, HierarchyBuilder
@@ -23,12 +25,33 @@ MERGECONF = def_merge_etcdir
 class NISTBag(PreservationSystem):
     """
     an interface for reading data in a NIST-compliant BagIt bag.
+
+    If constructed with use_index=True, the bag will maintain an index of
+    its components (see :class:`~nistoar.pdr.preserv.bagit.index.ComponentIndex`)
+    inside its metadata directory; this index is used to look up component 
+    types, list subcollection contents, and assemble the NERDm record without
+    re-reading every component's metadata.  Code that writes component 
+    metadata into the bag should call index_component() or unindex_component() 
+    to keep the index current (as the BagBuilder does).  The entries a query 
+    returns are checked against the size and modification time of their 
+    nerdm.json files, and the whole index is resynced with the metadata tree 
+    if the tree's top-level directory has changed since the index was last 
+    updated; thus, edits to or removals of existing components and the 
+    addition of top-level components made without updating the index are 
+    still picked up.  
+
+    If constructed with cache_record=True, the bag will hold on to the NERDm
+    record assembled by nerdm_record() so that subsequent calls only need to
+    re-read the components that have changed in the meantime.  This requires 
+    that all code that changes the bag's metadata report the changes via
+    component_changed() (or index_component() or unindex_component()).  
     """
 
     # NOTE: this is an incomplete implementation
     # (what's missing?)
 
-    def __init__(self, rootdir, merge_annots=False, merge_conf_dir=None):
+    def __init__(self, rootdir, merge_annots=False, merge_conf_dir=None,
+                 use_index=False, cache_record=False):
         if not os.path.isdir(rootdir):
             raise StateException("Bag directory does not exist as a directory: "+
                                  rootdir, sys=self)
@@ -50,6 +73,13 @@ class NISTBag(PreservationSystem):
             self._mergeconf = MERGECONF
         self._mergerfact = None
 
+        self._useindex = use_index
+        self._index = None
+
+        self._cacherec = cache_record
+        self._reccache = {}
+        self._reclock = threading.RLock()
+
     @property
     def dir(self):
         """
@@ -129,6 +159,210 @@ class NISTBag(PreservationSystem):
         """
         return bool(self.get_baginfo().get("Multibag-Head-Version",[""])[-1])
 
+    def index_file(self):
+        """
+        the path to the file where this bag's component index is stored
+        """
+        return os.path.join(self._metadir, INDEX_FILENAME)
+
+    @property
+    def index(self):
+        """
+        the ComponentIndex for this bag, or None if the bag was not configured
+        to use one.  If the index does not exist yet, it will be created by 
+        walking the metadata tree.
+        """
+        if self._useindex and self._index is None and \
+           os.path.isdir(self._metadir):
+            self._index = ComponentIndex(self.index_file())
+            if not self._index.is_complete():
+                self._load_index()
+        return self._index
+
+    def _load_index(self):
+        self._index.clear()
+        for root, subdirs, files in os.walk(self._metadir):
+            if root != self._metadir and NERDMD_FILENAME in files:
+                nerdfile = os.path.join(root, NERDMD_FILENAME)
+                self._index.put(root[len(self._metadir)+1:],
+                                self.read_nerd(nerdfile),
+                                self._mdsig(nerdfile), commit=False)
+        self._index.commit()
+        self._index.mark_complete()
+        self._index.set_stamp(self._metadir_stamp())
+
+    def _metadir_stamp(self):
+        # a cheap signature of the metadata tree: the modification time of its
+        # top directory changes whenever a top-level component is added or removed
+        return repr(os.stat(self._metadir).st_mtime)
+
+    def _checked_index(self):
+        # return the index, first resyncing it with the metadata tree if the 
+        # tree has changed in a way the index was not told about.  None is 
+        # returned if no index is in use.
+        idx = self.index
+        if idx is None:
+            return None
+
+        stamp = self._metadir_stamp()
+        if idx.stamp() != stamp:
+            self._sync_index(idx)
+            idx.set_stamp(stamp)
+        return idx
+
+    def _sync_index(self, idx):
+        # bring the index up to date with the metadata tree: entries are added 
+        # or re-read for nerdm.json files that are new or whose size or 
+        # modification time has changed, and entries for removed components 
+        # are dropped.  
+        ondisk = {}
+        for root, subdirs, files in os.walk(self._metadir):
+            if root != self._metadir and NERDMD_FILENAME in files:
+                try:
+                    ondisk[root[len(self._metadir)+1:]] = \
+                        self._mdsig(os.path.join(root, NERDMD_FILENAME))
+                except OSError:
+                    pass
+
+        known = idx.signatures()
+        for filepath in known:
+            if filepath not in ondisk:
+                idx.remove(filepath)
+        changed = False
+        for filepath, sig in ondisk.items():
+            old = known.get(filepath)
+            if not old or old[0] != sig[0] or old[1] != sig[1]:
+                try:
+                    idx.put(filepath, self.read_nerd(self.nerd_file_for(filepath)),
+                            sig, commit=False)
+                except (IOError, OSError):
+                    continue
+                changed = True
+        if changed:
+            idx.commit()
+
+    def _mdsig(self, nerdfile):
+        st = os.stat(nerdfile)
+        return (st.st_size, st.st_mtime)
+
+    def index_component(self, filepath, mdata=None):
+        """
+        update the component index to reflect the current metadata saved for
+        the component with the given filepath.  This should be called after 
+        the component's nerdm.json file is written.  If this bag is not 
+        using an index, any existing index file will be deleted as it can no
+        longer be trusted.
+
+        :param str filepath:  the filepath of the component that was updated
+        :param dict mdata:    the metadata that was written; if not provided,
+                              it will be read from the bag.
+        """
+        self.component_changed(filepath)
+        if not filepath:
+            # resource-level metadata is not indexed
+            return
+        if not self._useindex:
+            self._discard_index()
+            return
+        idx = self.index
+        if idx is None:
+            return
+
+        nerdfile = self.nerd_file_for(filepath)
+        if not os.path.exists(nerdfile):
+            idx.remove(filepath)
+            return
+        if mdata is None:
+            mdata = self.read_nerd(nerdfile)
+        idx.put(filepath, mdata, self._mdsig(nerdfile))
+        self._restamp_index(idx, filepath)
+
+    def unindex_component(self, filepath):
+        """
+        remove the component with the given filepath, along with any of its
+        descendents, from the component index.  This should be called after 
+        the component's metadata has been deleted from the bag.
+        """
+        self.component_changed(filepath)
+        if not self._useindex:
+            self._discard_index()
+        elif filepath and self.index is not None:
+            self.index.remove(filepath)
+            self._restamp_index(self.index, filepath)
+
+    def _restamp_index(self, idx, filepath):
+        # adding or removing a top-level component changes the metadata tree's
+        # stamp; record it so that the change is not mistaken for one made
+        # behind the index's back.
+        if '/' not in filepath:
+            try:
+                idx.set_stamp(self._metadir_stamp())
+            except OSError:
+                pass
+
+    def component_changed(self, filepath):
+        """
+        note that the metadata (or annotations) for the component with the 
+        given filepath has been updated or removed so that it will be reloaded
+        the next time a cached NERDm record is requested.  
+
+        :param str filepath:  the filepath of the component that changed; an 
+                              empty string indicates that the resource-level 
+                              metadata (which includes non-file components)
+                              changed.
+        """
+        with self._reclock:
+            for cache in self._reccache.values():
+                cache['dirty'].add(filepath)
+
+    def forget_cached_record(self):
+        """
+        discard any NERDm record data cached by nerdm_record() so that the 
+        next call will rebuild it completely.
+        """
+        with self._reclock:
+            self._reccache = {}
+
+    def drop_index(self, disable=False):
+        """
+        delete the bag's component index from disk.  If this bag is 
+        configured to use an index, it will be recreated when next needed 
+        unless disable is True.
+
+        :param bool disable:  if True, stop using an index with this instance
+        """
+        if self._index:
+            self._index.close()
+            self._index = None
+        if disable:
+            self._useindex = False
+        self._discard_index()
+
+    def _discard_index(self):
+        idxfile = self.index_file()
+        for f in (idxfile, idxfile+"-journal"):
+            if os.path.exists(f):
+                os.remove(f)
+
+    def _indexed_nerd_for(self, filepath):
+        # return the component metadata from the index, refreshing it first 
+        # if the nerdm.json file has changed.  None is returned if the 
+        # component no longer exists.
+        nerdfile = self.nerd_file_for(filepath)
+        try:
+            sig = self._mdsig(nerdfile)
+        except OSError:
+            self._index.remove(filepath)
+            return None
+
+        found = self._index.metadata_for(filepath)
+        if found and found[1] == sig[0] and found[2] == sig[1]:
+            return found[0]
+
+        out = self.read_nerd(nerdfile)
+        self._index.put(filepath, out, sig)
+        return out
+
     def pod_file(self):
         return os.path.join(self._metadir, POD_FILENAME)
 
@@ -231,34 +465,11 @@ class NISTBag(PreservationSystem):
         if not os.path.isdir(self._metadir):
             raise BadBagRequest(self.name +
                                 ": Bag does not contain NERDm metadata")
-        for root, subdirs, files in os.walk(self._metadir):
-            if root == self._metadir:
-                out = self.nerd_metadata_for("")
-                if 'components' not in out:
-                    out['components'] = []
-
-                if merge_annots:
-                    annotfile = os.path.join(root,ANNOTS_FILENAME)
-                    if os.path.exists(annotfile):
-                        annots = self.read_nerd(annotfile)
-                        merger = self._make_merger(merge_annots, 'Resource')
-                        out = merger.merge(out, annots)
-
-            elif NERDMD_FILENAME in files:
-                comp = self.read_nerd(os.path.join(root, NERDMD_FILENAME))
-
-                # remove properties that support standalone use/validation
-                for key in "_schema $schema @context".split():
-                    if key in comp:
-                        del comp[key]
-
-                if merge_annots:
-                    annotfile = os.path.join(root,ANNOTS_FILENAME)
-                    if os.path.exists(annotfile):
-                        annots = self.read_nerd(annotfile)
-                        comp = compmerger.merge(comp, annots)
-
-                out['components'].append(comp)
+        if self._cacherec:
+            out = self._cached_nerdm_record(merge_annots, compmerger)
+        else:
+            out = self._resource_md(merge_annots)
+            out['components'].extend([c for f, c in self._iter_comp_md(compmerger)])
 
         if incl_inventory and 'inventory' not in out:
             self.update_inventory_in(out)
@@ -267,6 +478,102 @@ class NISTBag(PreservationSystem):
         
         return out
 
+    def _resource_md(self, merge_annots):
+        out = self.nerd_metadata_for("")
+        if 'components' not in out:
+            out['components'] = []
+
+        if merge_annots:
+            annotfile = self.annotations_file_for("")
+            if os.path.exists(annotfile):
+                annots = self.read_nerd(annotfile)
+                merger = self._make_merger(merge_annots, 'Resource')
+                out = merger.merge(out, annots)
+        return out
+
+    def _prep_comp_md(self, comp, compdir, compmerger):
+        # remove properties that support standalone use/validation
+        for key in "_schema $schema @context".split():
+            if key in comp:
+                del comp[key]
+
+        if compmerger:
+            annotfile = os.path.join(compdir, ANNOTS_FILENAME)
+            if os.path.exists(annotfile):
+                annots = self.read_nerd(annotfile)
+                comp = compmerger.merge(comp, annots)
+        return comp
+
+    def _iter_comp_md(self, compmerger):
+        # iterate through the metadata for the components described in the
+        # metadata tree, returning (filepath, metadata) tuples
+        if self.index is not None:
+            for filepath in self._checked_index().filepaths():
+                comp = self._indexed_nerd_for(filepath)
+                if comp is not None:
+                    yield (filepath, 
+                           self._prep_comp_md(comp,
+                                              os.path.join(self._metadir, filepath),
+                                              compmerger))
+            return
+
+        for root, subdirs, files in os.walk(self._metadir):
+            if root != self._metadir and NERDMD_FILENAME in files:
+                comp = self.read_nerd(os.path.join(root, NERDMD_FILENAME))
+                yield (root[len(self._metadir)+1:],
+                       self._prep_comp_md(comp, root, compmerger))
+
+    def _comp_md_for(self, filepath, compmerger):
+        # return the prepared metadata for a single component or None if it
+        # no longer exists
+        if self.index is not None:
+            comp = self._indexed_nerd_for(filepath)
+        else:
+            nerdfile = self.nerd_file_for(filepath)
+            comp = None
+            if os.path.exists(nerdfile):
+                comp = self.read_nerd(nerdfile)
+        if comp is None:
+            return None
+        return self._prep_comp_md(comp, os.path.join(self._metadir, filepath),
+                                  compmerger)
+
+    def _cached_nerdm_record(self, merge_annots, compmerger):
+        # assemble the record from the cache, reloading only those parts that
+        # have changed since the last call.  A separate cache is kept for each
+        # merge convention.
+        with self._reclock:
+            key = merge_annots or ""
+            cache = self._reccache.get(key)
+            if cache is None:
+                cache = { 'dirty': set() }
+                cache['resmd'] = self._resource_md(merge_annots)
+                cache['comps'] = OrderedDict(self._iter_comp_md(compmerger))
+                self._reccache[key] = cache
+
+            elif cache['dirty']:
+                dirty = cache['dirty']
+                cache['dirty'] = set()
+                if "" in dirty:
+                    dirty.discard("")
+                    cache['resmd'] = self._resource_md(merge_annots)
+
+                comps = cache['comps']
+                for filepath in sorted(dirty):
+                    comp = self._comp_md_for(filepath, compmerger)
+                    if comp is not None:
+                        comps[filepath] = comp
+                    else:
+                        # component was removed along with its descendents
+                        for fp in [f for f in comps if f == filepath or 
+                                                       f.startswith(filepath+'/')]:
+                            del comps[fp]
+
+            out = deepcopy(cache['resmd'])
+            out['components'].extend(deepcopy(list(cache['comps'].values())))
+
+        return out
+
     @classmethod
     def update_inventory_in(cls, resmd):
         """
@@ -334,6 +641,11 @@ class NISTBag(PreservationSystem):
         if os.path.isfile(path):
             return True
 
+        if self.index is not None:
+            mdata = self._indexed_nerd_for(comppath)
+            return bool(mdata) and \
+                   any([t for t in mdata.get('@type', []) if ':DataFile' in t])
+
         path = self.nerd_file_for(comppath)
         if os.path.exists(path):
             mdata = self.read_nerd(path)
@@ -356,6 +668,11 @@ class NISTBag(PreservationSystem):
         if os.path.isdir(path):
             return True
 
+        if self.index is not None:
+            mdata = self._indexed_nerd_for(comppath)
+            return bool(mdata) and \
+                   any([t for t in mdata.get('@type', []) if ':Subcollection' in t])
+
         path = self.nerd_file_for(comppath)
         if os.path.exists(path):
             mdata = self.read_nerd(path)
@@ -380,6 +697,14 @@ class NISTBag(PreservationSystem):
                 if not c.startswith('.') and not c.startswith('_'):
                     children.add( c )
 
+        if self.index is not None:
+            for c in self._checked_index().children_of(comppath):
+                if not c.startswith('.') and not c.startswith('_') and \
+                   (c in children or
+                    self._indexed_nerd_for(os.path.join(comppath, c)) is not None):
+                    children.add(c)
+            return list(children)
+
         cdir = os.path.join(self.metadata_dir, comppath)
         if os.path.exists(cdir):
             # add in child metadata directories that have a nerdm.json file
@@ -418,13 +743,38 @@ class NISTBag(PreservationSystem):
                 #     continue
                 yield os.path.join(reldir, f)
 
-    def iter_data_components(self):
+    def iter_data_components(self, comptype=None):
         """
         iterate through components that have entries in the metadata directory,
         returning the filepath for those components
 
+        :param str comptype:  if provided, only return the components having 
+                              this type (e.g. "DataFile" or "nrdp:DataFile")
         :return generator:  
         """
+        if self.index is not None:
+            if comptype:
+                comptype = comptype.split(':', 1)[-1]
+            for fp in self._checked_index().filepaths(comptype):
+                if os.path.basename(fp).startswith('_'):
+                    continue
+                mdata = self._indexed_nerd_for(fp)
+                if mdata is not None and \
+                   (not comptype or any([t.split(':', 1)[-1] == comptype
+                                         for t in mdata.get('@type', [])])):
+                    yield fp
+            return
+
+        if comptype:
+            comptype = comptype.split(':', 1)[-1]
+            for fp in self.iter_data_components():
+                nerdfile = self.nerd_file_for(fp)
+                if os.path.exists(nerdfile) and \
+                   any([t.split(':', 1)[-1] == comptype
+                        for t in self.read_nerd(nerdfile).get('@type', [])]):
+                    yield fp
+            return
+
         for dir, subdirs, files in os.walk(self.metadata_dir):
             reldir = dir[len(self.metadata_dir)+1:]
             for f in subdirs:
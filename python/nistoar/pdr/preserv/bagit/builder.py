@@ -24,9 +24,10 @@ from ...utils import (build_mime_type_map, checksum_of, measure_dir_size,
 from ....id import PDRMinter
 from ... import def_jq_libdir, def_etc_dir
 from ...config import load_from_file, merge_config
-from .bag import NISTBag
+from .bag import NISTBag, ANNOTS_FILENAME
 from .exceptions import BadBagRequest
 from .validate.nist import NISTAIPValidator
+from ..checksum import ChecksumEngine
 
 from multibag import open_headbag
 
@@ -131,6 +132,10 @@ class BagBuilder(PreservationSystem):
     :prop copy_on_link_failure bool (True):  If True, then when moving datafiles 
                               to output bag via a hardlink, then the file 
                               will get copied if the linking fails.  
+    :prop checksum_on_copy bool (True):  If True, the checksum of a data file 
+                              copied into the bag will be calculated while it 
+                              is being copied so that the file need not be 
+                              re-read to register its metadata.
     :prop file_md_extract dict (None):  a set of parameters to pass to the 
                               configured file metadata extractor.
     :prop json_indent int (4):  The amount of indent to use when exporting JSON
@@ -155,6 +160,20 @@ class BagBuilder(PreservationSystem):
                               the bag from the Distribution Service.  
     :prop validator dict:     a set of properties for configuring the bag validation;
                               see nistoar.pdr.preserv.bagit.validate for details.
+    :prop checksum dict:      a set of properties for configuring how file checksums
+                              are calculated (e.g. the number of parallel workers);
+                              see nistoar.pdr.preserv.checksum.ChecksumEngine for 
+                              details.
+    :prop component_index bool (False):  if True, maintain an on-disk index of the
+                              bag's components (see NISTBag) to speed up queries
+                              on bags with many files.  The index is removed when
+                              the bag is finalized.
+    :prop cache_nerdm_record bool (False):  if True, the bag will cache the NERDm
+                              record assembled by bag.nerdm_record() so that later
+                              calls only reload the components that this builder 
+                              has changed since.  This should only be turned on if
+                              the bag's metadata is not changed by other means 
+                              while this builder is in use.
     """
 
     nistprofile = "0.4"
@@ -207,6 +226,7 @@ class BagBuilder(PreservationSystem):
 
         jqlib = self.cfg.get('jq_lib', def_jq_libdir)
         self.pod2nrd = PODds2Res(jqlib)
+        self.csengine = ChecksumEngine(self.cfg.get('checksum', {}))
 
         self._create_defmd_fn = {
             "Resource": self._create_def_res_md,
@@ -538,7 +558,7 @@ class BagBuilder(PreservationSystem):
         self._bagdir = newdir
 
         if self._bag:
-            self._bag = NISTBag(self._bagdir)
+            self._bag = self._open_bag()
 
     def ensure_bagdir(self):
         """
@@ -561,7 +581,7 @@ class BagBuilder(PreservationSystem):
         self.connect_logfile()
         if didit:
             self.record("Created bag with name, %s", self.bagname)
-        self._bag = NISTBag(self.bagdir)
+        self._bag = self._open_bag()
         if (not self._id or not self._ediid) and \
            os.path.exists(self._bag.nerd_file_for("")):
             # load the resource-level metadata that's already there
@@ -571,6 +591,11 @@ class BagBuilder(PreservationSystem):
             if not self._ediid:
                 self._ediid = md.get('ediid')
         
+    def _open_bag(self):
+        return NISTBag(self._bagdir,
+                       use_index=self.cfg.get('component_index', False),
+                       cache_record=self.cfg.get('cache_nerdm_record', False))
+
     def ensure_bag_structure(self):
         """
         make sure that the working bag contains the basic directory structure--
@@ -810,6 +835,7 @@ class BagBuilder(PreservationSystem):
         if os.path.isdir(target):
             removed = True
             rmtree(target)
+            self.bag.unindex_component(destpath)
         elif os.path.exists(target):
             raise BadBagRequest("Request path does not look like a data "+
                                 "component (it's a file in the metadata tree): "+
@@ -1337,10 +1363,16 @@ class BagBuilder(PreservationSystem):
                 else:
                     self.log.exception(msg, exc_info=True)
                     raise BagWriteError(msg, sys=self)
+        checksums = None
         if not hardlink:
             # ... by copying source (hard link is not possible or desired)
             try:
-                filecopy(srcpath, outfile)
+                if self.cfg.get('checksum_on_copy', True):
+                    # checksum while copying so that registering the file 
+                    # below need not read it again
+                    checksums = self.csengine.copy_file(srcpath, outfile)
+                else:
+                    filecopy(srcpath, outfile)
                 self.record("%s data file at %s" % (action, destpath))
             except Exception, ex:
                 msg = "Unable to copy data file (" + srcpath + \
@@ -1351,10 +1383,10 @@ class BagBuilder(PreservationSystem):
         # Now set its metadata
         if register:
             self.register_data_file(destpath, srcpath, True, comptype,
-                                    "...and updated its metadata.")
+                                    "...and updated its metadata.", checksums)
 
     def register_data_file(self, destpath, srcpath=None, examine=True,
-                           comptype=None, message=None):
+                           comptype=None, message=None, checksums=None):
         """
         create and install metadata into the bag for the given file to be (newly)
         added at the given destination path.  The file itself is not actually 
@@ -1377,6 +1409,10 @@ class BagBuilder(PreservationSystem):
                                component.  If not specified, the type will be
                                discerned by examining the file (defaulting 
                                to "DataFile").  
+        :param dict checksums: the already calculated checksums of the file, 
+                               mapping algorithm names to hex-encoded hashes 
+                               (as returned by ChecksumEngine.copy_file()); 
+                               see describe_data_file().
         """
         # determine the component type
         if not comptype:
@@ -1384,7 +1420,7 @@ class BagBuilder(PreservationSystem):
 
         if srcpath:
             mdata = self.describe_data_file(srcpath, destpath, examine,
-                                            comptype, False)
+                                            comptype, False, checksums)
         else:
             mdata = self.define_component(destpath, comptype)
             self._add_mediatype(destpath, mdata)
@@ -1394,7 +1430,7 @@ class BagBuilder(PreservationSystem):
         return self.replace_metadata_for(destpath, mdata, message)
 
     def describe_data_file(self, srcpath, destpath=None, examine=True,
-                           comptype=None, asupdate=True):
+                           comptype=None, asupdate=True, checksums=None):
         """
         examine the given file and return a metadata description of it.  
 
@@ -1421,6 +1457,13 @@ class BagBuilder(PreservationSystem):
                                returned will not take into account previous metadata
                                as if assuming the file is being examined for the first
                                time.  
+        :param dict checksums: the already calculated checksums of the file, 
+                               mapping algorithm names to hex-encoded hashes 
+                               (as returned by ChecksumEngine.copy_file()).  If 
+                               it includes the engine's algorithm, the file will 
+                               not be re-read to calculate its checksum; any 
+                               other algorithms are recorded in the 
+                               alternateChecksums property.  
         """
         if not destpath:
             destpath = os.path.basename(srcpath)
@@ -1438,7 +1481,13 @@ class BagBuilder(PreservationSystem):
         try:
             self._add_file_specs(srcpath, mdata)
             if examine:
-                self._add_checksum(checksum_of(srcpath), mdata)
+                alg = self.csengine.algorithm
+                if checksums and checksums.get(alg):
+                    hash = checksums[alg]
+                else:
+                    hash = self.csengine.checksum_of(srcpath)
+                self._add_alt_checksums(checksums, mdata, hash, alg)
+                self._add_checksum(hash, mdata, alg)
                 self._add_extracted_metadata(srcpath, mdata)
         except OSError as ex:
             raise BagWriteError("Unable to examine data file for metadata: "+
@@ -1481,7 +1530,7 @@ class BagBuilder(PreservationSystem):
         out = OrderedDict()
         self._add_file_specs(datafile, out)
         if checksum:
-            self._add_checksum(checksum_of(datafile), out)
+            self._add_checksum(self.csengine.checksum_of(datafile), out)
         return out
 
     def _add_file_specs(self, datafile, mdata):
@@ -1497,6 +1546,18 @@ class BagBuilder(PreservationSystem):
             'algorithm': { '@type': "Thing", 'tag': algorithm },
             'hash': hash
         }
+    def _add_alt_checksums(self, checksums, mdata, hash, algorithm='sha256'):
+        # record the checksums calculated with algorithms other than the primary 
+        # one; previously recorded ones are kept only if the file is unchanged
+        alts = [{'algorithm': { '@type': "Thing", 'tag': a }, 'hash': h}
+                for a, h in (checksums or {}).items() if a != algorithm]
+        if not alts and mdata.get('checksum', {}).get('hash') == hash:
+            return
+        if alts:
+            mdata['alternateChecksums'] = alts
+        else:
+            mdata.pop('alternateChecksums', None)
+
     def _add_mediatype(self, dfile, mdata, config=None):
         defmt = 'application/octet-stream'
         if 'mediaType' in mdata and mdata['mediaType'] != defmt:
@@ -1874,6 +1935,9 @@ class BagBuilder(PreservationSystem):
         if trim:
             self.trim_metadata_folders()
 
+        # the component index is a working aid, not part of the preserved bag
+        self.bag.drop_index(True)
+
         self.ensure_bagit_ver()
         self.write_data_manifest(finalcfg.get('confirm_checksums', False))
         self.write_mbag_files()
@@ -1928,6 +1992,7 @@ class BagBuilder(PreservationSystem):
                             # rm metadata directory if it's empty or rmmeta=True
                             if len(mcont) == 0 or rmmeta:
                                 rmtree(mdir)
+                                self.bag.unindex_component(ddir[len(droot)+1:])
 
                         else:
                             self.log.error("NIST bag profile error: not a " +
@@ -1968,10 +2033,26 @@ class BagBuilder(PreservationSystem):
         """
         if not self.bag:
             self.ensure_bagdir()
+
+        # first determine which files need checksums so that they can be
+        # calculated (in parallel) up front
+        todo = []
         for dfile in self.bag.iter_data_files():
             mdfile = self.bag.nerd_file_for(dfile)
             dfpath = os.path.join(self.bag.data_dir, dfile)
-            if not os.path.exists(mdfile):
+            md = None
+            updcstats = True
+            if os.path.exists(mdfile):
+                updcstats = updstats
+                md = self.bag.nerd_metadata_for(dfile)
+                if 'size' not in md or 'mediaType' not in md or \
+                   'checksum' not in md:
+                    updcstats = True
+            todo.append((dfile, dfpath, md is not None, updcstats))
+        self.csengine.precalculate([t[1] for t in todo if t[3]])
+
+        for dfile, dfpath, hasmd, updcstats in todo:
+            if not hasmd:
                 # no metadata found; start from scratch
                 comptype = self._determine_file_comp_type(dfile)
                 self.register_data_file(dfile, dfpath, extract, comptype)
@@ -1979,16 +2060,11 @@ class BagBuilder(PreservationSystem):
                     # register does not do checksum when examine=False;
                     # get it now
                     md = OrderedDict()
-                    self._add_checksum(checksum_of(dfpath), md)
+                    self._add_checksum(self.csengine.checksum_of(dfpath), md)
                     self.update_metadata_for(dfile, md,
                                          message="Updating checksum for "+dfile)
 
             else:
-                updcstats = updstats
-                md = self.bag.nerd_metadata_for(dfile)
-                if 'size' not in md or 'mediaType' not in md or \
-                   'checksum' not in md:
-                    updcstats = True
                 md = None
                 if updcstats:
                     md = self.get_file_specs(dfpath, True)
@@ -2064,22 +2140,30 @@ class BagBuilder(PreservationSystem):
         # self.ensure_merged_annotations()
         manfile = os.path.join(self.bagdir, "manifest-sha256.txt")
         try:
-          with open(manfile, 'w') as fd:
-            for datapath in self.bag.iter_data_files():
-                md = self.bag.nerd_metadata_for(datapath, merge_annots=False)
-                checksum = md.get('checksum')
-                if not checksum or 'hash' not in checksum:
-                    raise BagProfileError("Missing checksum for datafile: "+
-                                          datapath)
-                algo = checksum.get('algorithm', {}).get('tag')
-                if algo != 'sha256':
-                    raise BagProfileError("Unexpected checksum algorithm found: "+
-                                          str(algo))
-                checksum = checksum['hash']
-                if confirm:
-                    if checksum_of(self._bag._full_dpath(datapath)) != checksum:
-                        raise BagProfileError("Checksum failure for "+datapath)
+          entries = []
+          for datapath in self.bag.iter_data_files():
+              md = self.bag.nerd_metadata_for(datapath, merge_annots=False)
+              checksum = md.get('checksum')
+              if not checksum or 'hash' not in checksum:
+                  raise BagProfileError("Missing checksum for datafile: "+
+                                        datapath)
+              algo = checksum.get('algorithm', {}).get('tag')
+              if algo != 'sha256':
+                  raise BagProfileError("Unexpected checksum algorithm found: "+
+                                        str(algo))
+              entries.append((datapath, checksum['hash']))
+
+          if confirm:
+              # calculate the checksums in parallel (reusing those already
+              # calculated for unchanged files)
+              calcd = self.csengine.iter_checksums(
+                  [self._bag._full_dpath(e[0]) for e in entries], 'sha256')
+              for entry, calc in zip(entries, calcd):
+                  if calc[1] != entry[1]:
+                      raise BagProfileError("Checksum failure for "+entry[0])
 
+          with open(manfile, 'w') as fd:
+            for datapath, checksum in entries:
                 self._record_manifest_checksum(fd, checksum,
                                                os.path.join('data', datapath))
 
@@ -2563,6 +2647,18 @@ format(nerdm['title'].replace('\n', ' '))
         indent = self.cfg.get('json_indent', 4)
         write_json(jsdata, destfile, indent)
 
+        # keep the bag's component index and cached record in sync
+        mdfile = os.path.basename(destfile)
+        if self._bag and mdfile in (NERDMD_FILENAME, ANNOTS_FILENAME):
+            mdir = os.path.dirname(os.path.abspath(destfile))
+            metadir = os.path.abspath(self._bag.metadata_dir)
+            if mdir == metadir or mdir.startswith(metadir+os.sep):
+                filepath = mdir[len(metadir)+1:]
+                if mdfile == NERDMD_FILENAME:
+                    self._bag.index_component(filepath, jsdata)
+                else:
+                    self._bag.component_changed(filepath)
+
     def _write_resmd(self, resmd, destfile=None):
         # Coming: control the order that JSON properties are written
         if not destfile:
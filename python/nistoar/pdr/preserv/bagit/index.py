@@ -0,0 +1,262 @@
+"""
+An on-disk index of the components described in a bag's metadata tree.
+
+Answering questions like "what are the children of this subcollection?" or
+"which components are DataFiles?" normally requires walking a bag's
+``metadata`` directory and parsing each ``nerdm.json`` file found there.  For
+bags containing many thousands of files, this gets expensive when done
+repeatedly.  The :class:`ComponentIndex` class maintains a small SQLite
+database--stored inside the bag's metadata tag directory--that records, for
+each component, its parent collection, its types, and a copy of its NERDm
+metadata (along with the size and modification time of the ``nerdm.json``
+file it came from so that stale copies can be detected).
+
+The :class:`~nistoar.pdr.preserv.bagit.bag.NISTBag` class uses this index
+(when so configured) to answer its queries, and the
+:class:`~nistoar.pdr.preserv.bagit.builder.BagBuilder` keeps it up to date as
+it writes metadata.
+"""
+import os, json, sqlite3, threading
+from collections import OrderedDict
+
+INDEX_FILENAME = "_compindex.sqlite"
+
+_schema = """
+CREATE TABLE IF NOT EXISTS components (
+    filepath  TEXT PRIMARY KEY,
+    parent    TEXT NOT NULL,
+    name      TEXT NOT NULL,
+    mdsize    INTEGER,
+    mdmtime   REAL,
+    metadata  TEXT
+);
+CREATE INDEX IF NOT EXISTS components_parent ON components (parent);
+CREATE TABLE IF NOT EXISTS comptypes (
+    filepath  TEXT NOT NULL,
+    type      TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS comptypes_filepath ON comptypes (filepath);
+CREATE INDEX IF NOT EXISTS comptypes_type ON comptypes (type);
+CREATE TABLE IF NOT EXISTS about (
+    name      TEXT PRIMARY KEY,
+    value     TEXT
+);
+"""
+
+def _local_type(typename):
+    # strip any namespace prefix off of a type name
+    return typename.split(':', 1)[-1]
+
+class ComponentIndex(object):
+    """
+    an index of the components described under a bag's metadata directory.
+
+    Component types are stored without their namespace prefixes; thus, a
+    component with type "nrdp:DataFile" is found with a query for "DataFile".
+    The index is safe to use from multiple threads.
+    """
+
+    def __init__(self, indexfile):
+        """
+        open (creating, if necessary) the index stored in the given file.
+
+        :param str indexfile:  the path to the SQLite database file
+        """
+        self._file = indexfile
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(indexfile, check_same_thread=False)
+        self._conn.text_factory = str
+        # keep the rollback journal in place between transactions so that 
+        # committing does not touch the directory holding the index (see 
+        # NISTBag, which watches that directory's modification time)
+        self._conn.execute("PRAGMA journal_mode=TRUNCATE")
+        self._conn.executescript(_schema)
+        self._conn.commit()
+
+    @property
+    def file(self):
+        """
+        the path to the file holding the index
+        """
+        return self._file
+
+    def close(self):
+        """
+        release the connection to the index database
+        """
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+    def is_complete(self):
+        """
+        return True if the index has been fully populated (see mark_complete())
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM about WHERE name=?",
+                                     ("complete",)).fetchone()
+        return bool(row and row[0] == "1")
+
+    def mark_complete(self, complete=True):
+        """
+        record whether the index describes all of the components in the bag.
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO about VALUES (?, ?)",
+                               ("complete", complete and "1" or "0"))
+            self._conn.commit()
+
+    def stamp(self):
+        """
+        return the stamp most recently recorded via set_stamp() or None if 
+        one has not been set.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM about WHERE name=?",
+                                     ("stamp",)).fetchone()
+        return row and row[0]
+
+    def set_stamp(self, stamp):
+        """
+        record an opaque stamp describing the state of the metadata tree at
+        the time the index was last known to be in sync with it.  
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO about VALUES (?, ?)",
+                               ("stamp", stamp))
+            self._conn.commit()
+
+    def clear(self):
+        """
+        remove all entries from the index
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM components")
+            self._conn.execute("DELETE FROM comptypes")
+            self._conn.execute("DELETE FROM about")
+            self._conn.commit()
+
+    def put(self, filepath, mdata, mdsig=None, commit=True):
+        """
+        add or update the entry for a component
+
+        :param str filepath:  the component's filepath
+        :param dict mdata:    the component's NERDm metadata
+        :param tuple mdsig:   the (size, mtime) of the nerdm.json file the
+                              metadata was read from
+        :param bool commit:   if False, do not commit the change yet (used
+                              for bulk loading)
+        """
+        if not mdsig:
+            mdsig = (None, None)
+        types = [_local_type(t) for t in mdata.get('@type', [])]
+        with self._lock:
+            self._conn.execute("DELETE FROM comptypes WHERE filepath=?",
+                               (filepath,))
+            self._conn.execute("INSERT OR REPLACE INTO components " +
+                               "VALUES (?, ?, ?, ?, ?, ?)",
+                               (filepath, os.path.dirname(filepath),
+                                os.path.basename(filepath), mdsig[0], mdsig[1],
+                                json.dumps(mdata)))
+            self._conn.executemany("INSERT INTO comptypes VALUES (?, ?)",
+                                   [(filepath, t) for t in types])
+            if commit:
+                self._conn.commit()
+
+    def commit(self):
+        """
+        commit changes made via put(..., commit=False)
+        """
+        with self._lock:
+            self._conn.commit()
+
+    def remove(self, filepath):
+        """
+        remove the entry for the component with the given filepath along with
+        the entries for all of its descendents.
+        """
+        pat = filepath.replace('\\','\\\\').replace('%','\\%') \
+                      .replace('_','\\_') + "/%"
+        with self._lock:
+            for tbl in ("components", "comptypes"):
+                self._conn.execute(("DELETE FROM {0} WHERE filepath=? OR " +
+                                    "filepath LIKE ? ESCAPE '\\'").format(tbl),
+                                   (filepath, pat))
+            self._conn.commit()
+
+    def exists(self, filepath):
+        """
+        return True if the index has an entry for the given filepath
+        """
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM components WHERE filepath=?",
+                                      (filepath,)).fetchone() is not None
+
+    def types_of(self, filepath):
+        """
+        return the (unprefixed) types of the component with the given
+        filepath or None if it is not in the index
+        """
+        with self._lock:
+            if not self.exists(filepath):
+                return None
+            return [r[0] for r in
+                    self._conn.execute("SELECT type FROM comptypes WHERE filepath=?",
+                                       (filepath,))]
+
+    def metadata_for(self, filepath):
+        """
+        return a 3-tuple containing the indexed metadata for a component along
+        with the size and modification time of the nerdm.json file it was
+        read from, or None if the component is not in the index.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT metadata, mdsize, mdmtime FROM " +
+                                     "components WHERE filepath=?",
+                                     (filepath,)).fetchone()
+        if not row:
+            return None
+        return (json.loads(row[0], object_pairs_hook=OrderedDict), row[1], row[2])
+
+    def signatures(self):
+        """
+        return a dictionary mapping the filepaths of all indexed components to 
+        the (size, mtime) of the nerdm.json files their entries were read from
+        """
+        with self._lock:
+            return dict([(r[0], (r[1], r[2])) for r in
+                         self._conn.execute("SELECT filepath, mdsize, mdmtime " +
+                                            "FROM components")])
+
+    def children_of(self, filepath):
+        """
+        return the names of the indexed components that are direct children
+        of the given collection filepath (where "" is the root collection).
+        """
+        with self._lock:
+            return [r[0] for r in
+                    self._conn.execute("SELECT name FROM components WHERE " +
+                                       "parent=? ORDER BY name", (filepath,))]
+
+    def filepaths(self, comptype=None):
+        """
+        return the sorted list of the filepaths of the indexed components.
+
+        :param str comptype:  if given, only return the components having this
+                              type (with or without a namespace prefix)
+        """
+        with self._lock:
+            if comptype:
+                cur = self._conn.execute("SELECT DISTINCT filepath FROM " +
+                                         "comptypes WHERE type=? ORDER BY " +
+                                         "filepath", (_local_type(comptype),))
+            else:
+                cur = self._conn.execute("SELECT filepath FROM components " +
+                                         "ORDER BY filepath")
+            return [r[0] for r in cur]
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM components") \
+                             .fetchone()[0]
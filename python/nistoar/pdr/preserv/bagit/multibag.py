@@ -3,16 +3,32 @@ Support for the multibag BagIt profile.  In particular, this module can split
 a single bag into multiple output multbags for preservation.  
 """
 from __future__ import print_function, absolute_import
-import os, logging, re, json, shutil
+import os, logging, re, json, shutil, math, time
+from collections import OrderedDict
+from copy import deepcopy
 from functools import cmp_to_key
 
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 import multibag
+from multibag.split import SplitPlan
 from multibag.restore import restore_bag
 
 from .. import ConfigurationException, StateException, AIPValidationError
 from ... import utils
 from .bag import NISTBag
 
+SPLIT_STRATEGIES = ("neighborly", "ffd", "balanced")
+DEF_SPLIT_STRATEGY = "neighborly"
+
 class MultibagSplitter(object):
     """
     a class responsible for splitting a source bag into one or more multibags.
@@ -58,10 +74,19 @@ class MultibagSplitter(object):
     :prop verify_complete bool:  if True, run checks that make sure that the 
                                  output bags appear to be complete in that they 
                                  include all of the input files.  Default: True
+    :prop verify_threads int:    the number of output bags to scan in parallel 
+                                 when verifying completeness.  Default: 1
     :prop validate bool:         if True, (re-)validate each of the output 
                                  multibags.  Default: False
     :prop replace bool:          When splitting, replace the input bag if 
                                  output directory is the same as the input's.
+    :prop split_strategy str:    the algorithm used to assign data files to output 
+                                 bags; one of "neighborly" (default), which fills 
+                                 each bag in turn with files from the same 
+                                 directories, "ffd", which packs directory groups 
+                                 into as few bags as possible (first-fit-decreasing),
+                                 or "balanced", which spreads directory groups 
+                                 evenly across the bags (see pack_files()).
     """
 
     def __init__(self, source_bagdir, config=None):
@@ -102,6 +127,10 @@ class MultibagSplitter(object):
         if prob:
             raise ConfigurationException("Properties not interpretable as " +
                                          "integers: " + ", ".join(prob))
+        if self.cfg.get('split_strategy', DEF_SPLIT_STRATEGY) not in SPLIT_STRATEGIES:
+            raise ConfigurationException("split_strategy: not one of " +
+                                         ", ".join(SPLIT_STRATEGIES) + ": " +
+                                         str(self.cfg['split_strategy']))
 
     def check(self, log=None):
         """
@@ -197,7 +226,7 @@ class MultibagSplitter(object):
                 shutil.rmtree(mb)
 
         try:
-            spltr = OARSplitter(self.maxsz, self.trgsz, self.maxhbsz)
+            spltr = self._make_splitter()
             out = spltr.split(self.srcdir, destdir, nameiter, ['Bag-Oxum'],
                               logger=log)
         except:
@@ -209,7 +238,7 @@ class MultibagSplitter(object):
             raise
 
         if self.cfg.get('verify_complete', True):
-            self._verify_complete(self.srcdir, out)
+            self._verify_complete(self.srcdir, out, log)
 
         if self.cfg.get('validate'):
             for bagdir in out:
@@ -228,33 +257,110 @@ class MultibagSplitter(object):
 
         return out
 
-    def _verify_complete(self, srcdir, multidirs):
+    def _make_splitter(self):
+        return OARSplitter(self.maxsz, self.trgsz, self.maxhbsz,
+                           strategy=self.cfg.get('split_strategy', DEF_SPLIT_STRATEGY))
+
+    def plan(self, log=None):
+        """
+        determine how the source bag would be split by split() without writing 
+        anything to disk.  
+
+        :return dict:  a summary of the plan, including "strategy", the name of 
+                       the splitting algorithm used, "total_size", and "members", 
+                       a list describing each output bag in order (the head bag 
+                       last), each giving the bag's "size" in bytes, the "count" 
+                       of file entries it will contain, and whether it is the "head".
+        """
+        plan = self._make_splitter().plan(self.srcdir)
+        mfs = list(plan.manifests())
+        members = [OrderedDict([("size", mf['totalsize']), ("count", len(mf['contents'])),
+                                ("head", i == len(mfs)-1)])
+                   for i, mf in enumerate(mfs)]
+        out = OrderedDict([
+            ("strategy", self.cfg.get('split_strategy', DEF_SPLIT_STRATEGY)),
+            ("total_size", sum([m['size'] for m in members])),
+            ("members", members)
+        ])
+        if log:
+            log.debug("Split plan (%s): %s", out['strategy'],
+                      ", ".join([str(m['size']) for m in members]))
+        return out
+
+    def _verify_complete(self, srcdir, multidirs, log=None):
+        # confirm that every data and metadata file in the source bag can be 
+        # found in the output multibags where the head bag's lookup file says
+        # it is.  Returns a report of the time spent.
+        t0 = time.time()
         headbag = multibag.open_headbag(multidirs[-1])
         if not headbag.is_head_multibag():
             raise AIPValidationError("Expected to be a head bag: "+multidirs[-1])
 
+        lookup = self._load_file_lookup(multidirs[-1])
+        members = dict([(os.path.basename(b.rstrip('/')), b) for b in multidirs])
+        t1 = time.time()
+
+        # list the contents of each output bag once
+        nthreads = min(int(self.cfg.get('verify_threads', 1)), len(multidirs))
+        if nthreads > 1:
+            pool = ThreadPool(nthreads)
+            try:
+                found = pool.map(_list_bag_files, multidirs)
+            finally:
+                pool.close()
+        else:
+            found = [_list_bag_files(b) for b in multidirs]
+        found = dict(zip([os.path.basename(b.rstrip('/')) for b in multidirs], found))
+        t2 = time.time()
+
         # walk through all data and metadata files found in source bag
         errors = []
-        datadir = os.path.join(srcdir, "data")
-        for dir, subdirs, files in os.walk(datadir):
-            dir = dir[len(datadir)-4:]   # = "data/..."
-            for file in files:
-                file = os.path.join(dir, file)
-                error = self._confirm_found(file, multidirs, headbag)
-                if error:
-                    errors.append(error)
-
-        datadir = os.path.join(srcdir, "metadata")
-        for dir, subdirs, files in os.walk(datadir):
-            dir = dir[len(datadir)-8:]   # = "metadata/..."
-            for file in files:
-                file = os.path.join(dir, file)
-                error = self._confirm_found(file, multidirs, headbag)
-                if error:
-                    errors.append(error)
+        nfiles = 0
+        for filepath in _iter_bag_files(srcdir):
+            nfiles += 1
+            location = lookup.get(filepath)
+            if not location:
+                errors.append("Failed to find input file in output multibag: " + filepath)
+            elif location not in members:
+                errors.append("Unrecognized location for " + filepath + ": "+location)
+            elif filepath not in found[location]:
+                errors.append("file not found in "+location+": "+filepath)
+        t3 = time.time()
+
+        report = OrderedDict([
+            ("files", nfiles),
+            ("members", len(multidirs)),
+            ("lookup_time", t1 - t0),
+            ("scan_time", t2 - t1),
+            ("check_time", t3 - t2),
+            ("total_time", t3 - t0)
+        ])
+        if log:
+            log.debug("Verified %d files across %d multibags in %.2fs "
+                      "(lookup: %.2fs, scan: %.2fs, check: %.2fs)", nfiles,
+                      len(multidirs), report['total_time'], report['lookup_time'],
+                      report['scan_time'], report['check_time'])
 
         if len(errors) > 0:
             raise AIPValidationError("Output multibags look incomplete", errors)
+        return report
+
+    def _load_file_lookup(self, headbagdir):
+        # read the head bag's file-lookup.tsv into a map of file paths to member 
+        # bag names
+        out = {}
+        mbagdir = NISTBag(headbagdir).multibag_dir
+        if not mbagdir:
+            mbagdir = os.path.join(headbagdir, "multibag")
+        lufile = os.path.join(mbagdir, "file-lookup.tsv")
+        if not os.path.isfile(lufile):
+            return out
+        with open(lufile) as fd:
+            for line in fd:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) > 1:
+                    out.setdefault(parts[0], parts[1].strip())
+        return out
 
     def _confirm_found(self, filepath, multidirs, headbag):
         # confirm that we can find the given file path in the output multibags
@@ -303,13 +409,37 @@ class MultibagSplitter(object):
             self.make_single_multibag()
         return [self.srcdir]
 
+class OARSplitPlan(SplitPlan):
+    """
+    a multibag.split.SplitPlan whose member bag manifests can be rearranged 
+    after the plan has been drafted.  OARSplitter uses this to apply its 
+    packing strategy and to fold the last member bag into the head bag.
+    """
+    def __init__(self, plan):
+        """
+        adopt the state of a plan drafted by one of the multibag splitters
+
+        :param SplitPlan plan:  the drafted plan
+        """
+        self.__dict__.update(vars(plan))
+
+    def set_manifests(self, manifests):
+        """
+        replace the manifests describing the member bags of this plan.  The 
+        head bag's manifest must be last.
+
+        :param list manifests:  the new manifests, each a dictionary of the 
+                                form returned by manifests()
+        """
+        self._manifests = list(manifests)
+
 class OARSplitter(multibag.NeighborlySplitter):
     """
     an implementation of multibag.split.Splitter used to split a source bag
     "the OAR way".  
     """
     def __init__(self, maxsize=60000, targetsize=None, maxhdsize=None,
-                 hbslop=0.05):
+                 hbslop=0.05, strategy=DEF_SPLIT_STRATEGY):
         """
         Create the splitter based on the "neighborly" algorithm
 
@@ -325,12 +455,21 @@ class OARSplitter(multibag.NeighborlySplitter):
                              typically smaller than maxsize (for faster 
                              retrieval and cheaper storage).  If not provided
                              (or out of range), it defaults to maxsize.
+        :param str strategy: the algorithm for assigning data files to output bags;
+                             "neighborly" uses the multibag NeighborlySplitter 
+                             algorithm; "ffd" and "balanced" repack its plan 
+                             using pack_files().  
         """
+        if strategy not in SPLIT_STRATEGIES:
+            raise ValueError("Unrecognized split strategy: "+str(strategy))
         if not maxhdsize or maxhdsize > maxsize:
             maxhdsize = maxsize
         super(OARSplitter, self).__init__(maxsize, targetsize)
         self.maxhdsz = maxhdsize
         self.hbslop = float(hbslop)
+        self.strategy = strategy
+        self._packmax = maxsize
+        self._packtrg = targetsize
 
     def _sorted_files(self, bag):
         datafs = bag._root.subfspath("data")
@@ -342,7 +481,9 @@ class OARSplitter(multibag.NeighborlySplitter):
         return finfos
     
     def _create_plan(self, bagpath):
-        out = super(OARSplitter, self)._create_plan(bagpath)
+        out = OARSplitPlan(super(OARSplitter, self)._create_plan(bagpath))
+        if self.strategy != "neighborly":
+            self._repack(out, bagpath)
 
         # the head bag should contain the metadata tree, the preservation log,
         # and other metadata files.  Now check to see if combining the last
@@ -355,10 +496,156 @@ class OARSplitter(multibag.NeighborlySplitter):
             mfs[-2]['contents']  += mfs[-1]['contents']
             mfs[-2]['totalsize'] += mfs[-1]['totalsize']
             del mfs[-1]
-            out._manifests = mfs
+            out.set_manifests(mfs)
 
         return out
 
+    def _repack(self, plan, bagpath):
+        # reassign the data files in the given OARSplitPlan to member bags according
+        # to the configured packing strategy.  The head bag keeps its non-data contents.
+        bag = bagpath
+        if isinstance(bagpath, (str, unicode)):
+            bag = multibag.open_bag(bagpath)
+        finfos = self._sorted_files(bag)
+        sizes = dict([(f['path'].lstrip('/'), f['size']) for f in finfos])
+
+        mfs = list(plan.manifests())
+        entries = {}
+        for mf in mfs:
+            for p in mf['contents']:
+                if p.lstrip('/') in sizes:
+                    entries[p.lstrip('/')] = p
+        if len(entries) < len(sizes):
+            # can't account for all of the data files; stick with the original plan
+            return
+
+        head = mfs[-1]
+        template = mfs[0]
+        headdata = [p for p in head['contents'] if p.lstrip('/') in sizes]
+        head['contents'] = [p for p in head['contents'] if p.lstrip('/') not in sizes]
+        head['totalsize'] -= sum([sizes[p.lstrip('/')] for p in headdata])
+
+        newmfs = []
+        for files in pack_files(finfos, self._packmax, self._packtrg, self.strategy):
+            mf = OrderedDict([(k, deepcopy(v)) for k, v in template.items()
+                                               if k not in ('contents', 'totalsize')])
+            mf['contents'] = [entries[f['path'].lstrip('/')] for f in files]
+            mf['totalsize'] = sum([f['size'] for f in files])
+            newmfs.append(mf)
+        newmfs.append(head)
+        plan.set_manifests(newmfs)
+
+def _group_by_dir(finfos, limit):
+    # group the files by their parent directories (in path order), breaking up 
+    # groups that are bigger than the given limit
+    groups = OrderedDict()
+    for f in sorted(finfos, key=lambda f: f['path']):
+        groups.setdefault(f['path'].rsplit('/', 1)[0], []).append(f)
+
+    out = []
+    for files in groups.values():
+        chunk = []
+        size = 0
+        for f in files:
+            if chunk and size + f['size'] > limit:
+                out.append((size, chunk))
+                chunk = []
+                size = 0
+            chunk.append(f)
+            size += f['size']
+        if chunk:
+            out.append((size, chunk))
+    return out
+
+def pack_files(finfos, maxsize, targetsize=None, strategy="balanced"):
+    """
+    partition a list of files into groups to be placed into separate output bags.
+    Files from the same directory are kept together except where the directory's 
+    files exceed the target size.  
+
+    :param list finfos:     a list of dictionaries describing the files, each with 
+                            at least a "path" and a "size"
+    :param int maxsize:     the maximum total size of a group; this is only exceeded 
+                            when a single file exceeds it.  If less than or equal to 
+                            zero, all files will be placed in one group.
+    :param int targetsize:  the preferred size of a group; if not set or out of range,
+                            maxsize is used.
+    :param str strategy:    either "ffd" (first-fit-decreasing), which fills groups up 
+                            to the target size and so creates as few groups as 
+                            possible, or "balanced", which spreads the files across 
+                            the minimum number of groups implied by the target size 
+                            so that the groups are of similar size.  
+    :return list:  a list of lists of the input file descriptions; the files within 
+                   each group are in path order.
+    """
+    if not targetsize or targetsize <= 0 or (maxsize > 0 and targetsize > maxsize):
+        targetsize = maxsize
+    if targetsize <= 0:
+        return [sorted(finfos, key=lambda f: f['path'])] if finfos else []
+
+    # place the biggest directory groups first
+    items = _group_by_dir(finfos, targetsize)
+    items.sort(key=lambda i: -i[0])
+
+    if strategy == "ffd":
+        bins = []
+        for size, files in items:
+            for b in bins:
+                if b[0] + size <= targetsize:
+                    b[0] += size
+                    b[1].extend(files)
+                    break
+            else:
+                bins.append([size, list(files)])
+
+    elif strategy == "balanced":
+        # files too big for the target get their own bags; the rest are spread
+        # across as many bags as the target size requires
+        bins = [[size, list(files)] for size, files in items if size > targetsize]
+        items = [i for i in items if i[0] <= targetsize]
+        total = sum([i[0] for i in items])
+        pool = [[0, []] for n in range(int(math.ceil(float(total)/targetsize)))]
+        for size, files in items:
+            b = min(pool, key=lambda b: b[0])
+            if b[1] and maxsize > 0 and b[0] + size > maxsize:
+                b = [0, []]
+                pool.append(b)
+            b[0] += size
+            b[1].extend(files)
+        bins.extend(pool)
+
+    else:
+        raise ValueError("Unrecognized packing strategy: "+str(strategy))
+
+    out = [sorted(b[1], key=lambda f: f['path']) for b in bins if b[1]]
+    out.sort(key=lambda g: g[0]['path'])
+    return out
+
+def _iter_bag_files(bagdir, subdirs=("data", "metadata")):
+    # yield the paths, relative to the bag's root directory, of the files found 
+    # below the given subdirectories
+    for subdir in subdirs:
+        if not os.path.isdir(os.path.join(bagdir, subdir)):
+            continue
+        if scandir:
+            dirs = [subdir]
+            while dirs:
+                reldir = dirs.pop()
+                for ent in scandir(os.path.join(bagdir, reldir)):
+                    if ent.is_dir():
+                        dirs.append(reldir+'/'+ent.name)
+                    else:
+                        yield reldir+'/'+ent.name
+        else:
+            root = os.path.join(bagdir, subdir)
+            for dir, dirs, files in os.walk(root):
+                reldir = subdir + dir[len(root):]
+                for f in files:
+                    yield reldir+'/'+f
+
+def _list_bag_files(bagdir):
+    return set(_iter_bag_files(bagdir))
+
 class _OARNamer(object):
     """
     A naming iterator that creates bag names matching the NIST-OAR bag 
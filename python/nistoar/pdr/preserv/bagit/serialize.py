@@ -3,11 +3,13 @@ Tools for serializing and running checksums on bags
 """
 import subprocess as sp
 from cStringIO import StringIO
-import logging, os
+import logging, os, struct, zlib, time, hashlib, threading, pkg_resources
 
 from .exceptions import BagSerializationError
 from ...exceptions import StateException
+from ...utils import build_mime_type_map, measure_dir_size
 from .. import sys as _sys
+from .. import checksum
 
 def _exec(cmd, dir, log):
     log.info("serializing bag: %s", ' '.join(cmd))
@@ -117,6 +119,410 @@ def zip7_serialize(bagdir, destdir, log, destfile=None):
 
     return destfile
 
+# Support for writing zip files natively.  
+#
+# The ZipStreamWriter writes the archive strictly sequentially (i.e. it never 
+# seeks backward to fill in sizes), using data descriptors after each entry's
+# data and ZIP64 extensions when sizes, offsets, or counts exceed the classic 
+# zip limits.  This allows the archive's checksum to be calculated as it is 
+# written.
+
+_ZIP64_LIMIT = (1 << 32) - 1
+_ZIP_COUNT_LIMIT = 0xFFFF
+_ZIP64_ENTRY_THRESHOLD = (1 << 32) - (1 << 26)   # leaves room for deflate overhead
+
+_LOCAL_HDR = "<L5H3L2H"
+_LOCAL_SIG = 0x04034b50
+_DATADESC_SIG = 0x08074b50
+_CENTRAL_HDR = "<L6H3L5H2L"
+_CENTRAL_SIG = 0x02014b50
+_END_REC = "<L4H2LH"
+_END_SIG = 0x06054b50
+_END64_REC = "<LQ2H2L4Q"
+_END64_SIG = 0x06064b50
+_END64_LOC = "<2LQL"
+_END64_LOC_SIG = 0x07064b50
+
+_STORED = 0
+_DEFLATED = 8
+_FLAG_DATADESC = 0x08
+_FLAG_UTF8 = 0x800
+_MADE_BY = (3 << 8) | 45      # Unix, spec version 4.5
+
+DEF_ZIP_BUFSIZE = 10240000     # 10 MB
+DEF_PROGRESS_INTERVAL = 5      # seconds
+
+# files of these types are already compressed; they are stored as is
+uncompressed_exts = set("""zip gz tgz bz2 tbz xz txz 7z rar lz lzma lz4 zst z
+                           jar war jpg jpeg jp2 png gif webp heic mp3 mp4 m4a m4v
+                           mov avi mkv mpg mpeg ogg oga ogv webm flac docx xlsx 
+                           pptx odt ods odp epub""".split())
+uncompressed_media_types = set(["application/zip", "application/gzip", 
+                                "application/x-gzip", "application/x-bzip2",
+                                "application/x-xz", "application/x-7z-compressed",
+                                "application/x-rar-compressed",
+                                "application/java-archive", "image/jpeg",
+                                "image/png", "image/gif", "image/webp"])
+uncompressed_media_type_prefixes = ["audio/", "video/"]
+
+class _HashingWriter(object):
+    # wraps an output file stream, counting and hashing all bytes written
+    def __init__(self, fd, algorithm="sha256"):
+        self.fd = fd
+        self.hash = hashlib.new(algorithm)
+        self.count = 0
+
+    def write(self, data):
+        self.fd.write(data)
+        self.hash.update(data)
+        self.count += len(data)
+
+    def tell(self):
+        return self.count
+
+class ZipStreamWriter(object):
+    """
+    a writer for creating a zip file in a single sequential pass.  Because 
+    the output is never re-read or rewritten, the checksum of the archive 
+    can be calculated as it is written; it is available via the checksum 
+    property after close() is called.  ZIP64 extensions are applied 
+    automatically as needed, allowing archives and member files larger than 
+    4 GB.
+    """
+
+    def __init__(self, fd, compresslevel=6, bufsize=DEF_ZIP_BUFSIZE,
+                 algorithm="sha256"):
+        """
+        wrap an output stream
+
+        :param file fd:          the file stream to write to; it must be open
+                                 for writing in binary mode
+        :param int compresslevel: the zlib compression level to apply to 
+                                 compressed entries
+        :param int bufsize:      the number of bytes to read from each input 
+                                 file at a time
+        :param str algorithm:    the hash algorithm to use to calculate the 
+                                 archive's checksum
+        """
+        self._out = _HashingWriter(fd, algorithm)
+        self.compresslevel = compresslevel
+        self.bufsize = bufsize
+        self._entries = []
+        self._closed = False
+
+    @property
+    def size(self):
+        """
+        the number of bytes written so far
+        """
+        return self._out.count
+
+    @property
+    def checksum(self):
+        """
+        the hex-encoded checksum of the bytes written so far
+        """
+        return self._out.hash.hexdigest()
+
+    def add_dir(self, arcname, srcpath=None):
+        """
+        add a directory entry to the archive
+
+        :param str arcname:  the name to give the directory within the archive
+        :param str srcpath:  the directory on disk to take the modification 
+                             time and permissions from
+        """
+        if not arcname.endswith('/'):
+            arcname += '/'
+        st = (srcpath and os.stat(srcpath)) or None
+        mode = (st and st.st_mode) or 0o40755
+        mtime = (st and st.st_mtime) or time.time()
+        entry = self._start_entry(arcname, _STORED, mtime, 
+                                  ((mode & 0xFFFF) << 16) | 0x10, False)
+        self._end_entry(entry, 0, 0, 0)
+
+    def add_file(self, srcpath, arcname, compress=True, callback=None):
+        """
+        add a file to the archive.
+
+        :param str srcpath:   the path to the file to add
+        :param str arcname:   the name to give to the file within the archive
+        :param bool compress: if False, store the file without compression
+        :param func callback: a function to call each time a buffer of the 
+                              file has been written; it is passed the number
+                              of bytes read in that buffer.
+        :return int:  the number of bytes read from the file
+        """
+        st = os.stat(srcpath)
+        method = (compress and st.st_size > 0 and _DEFLATED) or _STORED
+        zip64 = st.st_size >= _ZIP64_ENTRY_THRESHOLD
+        entry = self._start_entry(arcname, method, st.st_mtime,
+                                  (st.st_mode & 0xFFFF) << 16, zip64)
+
+        crc = 0
+        usize = 0
+        csize = 0
+        cmpr = None
+        if method == _DEFLATED:
+            cmpr = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+        with open(srcpath, 'rb') as fd:
+            while True:
+                buf = fd.read(self.bufsize)
+                if not buf:
+                    break
+                nread = len(buf)
+                usize += nread
+                crc = zlib.crc32(buf, crc)
+                if cmpr:
+                    buf = cmpr.compress(buf)
+                csize += len(buf)
+                self._out.write(buf)
+                if callback:
+                    callback(nread)
+            if cmpr:
+                buf = cmpr.flush()
+                csize += len(buf)
+                self._out.write(buf)
+
+        if usize >= _ZIP64_LIMIT and not zip64:
+            # file grew after we looked at its size
+            raise BagSerializationError("File size changed while being "+
+                                        "archived: "+srcpath, sys=_sys)
+        self._end_entry(entry, crc & 0xFFFFFFFF, csize, usize)
+        return usize
+
+    def _start_entry(self, arcname, method, mtime, extattr, zip64):
+        if self._closed:
+            raise StateException("ZipStreamWriter: archive already closed")
+        if isinstance(arcname, unicode):
+            arcname = arcname.encode('utf-8')
+        flags = _FLAG_DATADESC
+        try:
+            arcname.decode('ascii')
+        except UnicodeDecodeError:
+            flags |= _FLAG_UTF8
+
+        tm = time.localtime(mtime)
+        if tm[0] < 1980:
+            tm = (1980, 1, 1, 0, 0, 0)
+        dosdate = (tm[0] - 1980) << 9 | tm[1] << 5 | tm[2]
+        dostime = tm[3] << 11 | tm[4] << 5 | (tm[5] // 2)
+
+        version = (zip64 and 45) or (method == _DEFLATED and 20) or 10
+        entry = { "name": arcname, "flags": flags, "method": method, 
+                  "time": dostime, "date": dosdate, "extattr": extattr,
+                  "version": version, "zip64": zip64, 
+                  "offset": self._out.tell() }
+
+        extra = b""
+        size = 0
+        if zip64:
+            extra = struct.pack("<2H2Q", 1, 16, 0, 0)
+            size = 0xFFFFFFFF
+        self._out.write(struct.pack(_LOCAL_HDR, _LOCAL_SIG, version, flags,
+                                    method, dostime, dosdate, 0, size, size,
+                                    len(arcname), len(extra)))
+        self._out.write(arcname)
+        self._out.write(extra)
+        return entry
+
+    def _end_entry(self, entry, crc, csize, usize):
+        entry.update({ "crc": crc, "csize": csize, "usize": usize })
+        if entry['zip64']:
+            self._out.write(struct.pack("<2L2Q", _DATADESC_SIG, crc, csize, usize))
+        else:
+            self._out.write(struct.pack("<4L", _DATADESC_SIG, crc, csize, usize))
+        self._entries.append(entry)
+
+    def close(self):
+        """
+        complete the archive by writing out its central directory.  The 
+        underlying output stream is not closed.
+
+        :return str:  the hex-encoded checksum of the complete archive
+        """
+        if self._closed:
+            return self.checksum
+
+        cdstart = self._out.tell()
+        for entry in self._entries:
+            z64 = []
+            usize, csize, offset = entry['usize'], entry['csize'], entry['offset']
+            if usize >= _ZIP64_LIMIT:
+                z64.append(usize)
+                usize = 0xFFFFFFFF
+            if csize >= _ZIP64_LIMIT:
+                z64.append(csize)
+                csize = 0xFFFFFFFF
+            if offset >= _ZIP64_LIMIT:
+                z64.append(offset)
+                offset = 0xFFFFFFFF
+            extra = b""
+            version = entry['version']
+            if z64:
+                extra = struct.pack("<2H%dQ" % len(z64), 1, 8*len(z64), *z64)
+                version = 45
+            self._out.write(struct.pack(_CENTRAL_HDR, _CENTRAL_SIG, _MADE_BY,
+                                        version, entry['flags'], entry['method'],
+                                        entry['time'], entry['date'],
+                                        entry['crc'], csize, usize,
+                                        len(entry['name']), len(extra), 0, 0, 0,
+                                        entry['extattr'], offset))
+            self._out.write(entry['name'])
+            self._out.write(extra)
+        cdend = self._out.tell()
+
+        count = len(self._entries)
+        cdsize = cdend - cdstart
+        if count >= _ZIP_COUNT_LIMIT or cdsize >= _ZIP64_LIMIT or \
+           cdstart >= _ZIP64_LIMIT:
+            self._out.write(struct.pack(_END64_REC, _END64_SIG, 44, _MADE_BY, 45,
+                                        0, 0, count, count, cdsize, cdstart))
+            self._out.write(struct.pack(_END64_LOC, _END64_LOC_SIG, 0, cdend, 1))
+            if count >= _ZIP_COUNT_LIMIT:
+                count = 0xFFFF
+            if cdsize >= _ZIP64_LIMIT:
+                cdsize = 0xFFFFFFFF
+            if cdstart >= _ZIP64_LIMIT:
+                cdstart = 0xFFFFFFFF
+        self._out.write(struct.pack(_END_REC, _END_SIG, 0, 0, count, count,
+                                    cdsize, cdstart, 0))
+        self._closed = True
+        return self.checksum
+
+class BandwidthLimiter(object):
+    """
+    a thread-safe limiter on the aggregate rate at which bytes are processed
+    by one or more concurrent consumers (e.g. serializers running in 
+    parallel).  Each consumer calls consume() after processing a chunk of 
+    bytes; the call will block as long as necessary to keep the total rate
+    across all consumers at or below the maximum.
+    """
+
+    def __init__(self, max_rate):
+        """
+        :param int max_rate:  the maximum number of bytes per second; a value 
+                              less than 1 means no limit.
+        """
+        self.max_rate = max_rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """
+        account for the processing of the given number of bytes, pausing as
+        needed to keep within the rate limit.
+        """
+        if not self.max_rate or self.max_rate < 1 or nbytes <= 0:
+            return
+        with self._lock:
+            now = time.time()
+            self._next = max(now, self._next) + float(nbytes) / self.max_rate
+            wait = self._next - now
+        if wait > 0:
+            time.sleep(wait)
+
+_mimetypes = None
+def _is_compressed(filename):
+    # return True if the file appears to already be compressed
+    global _mimetypes
+    ext = os.path.splitext(filename)[1][1:].lower()
+    if ext in uncompressed_exts:
+        return True
+    if _mimetypes is None:
+        _mimetypes = build_mime_type_map([
+            pkg_resources.resource_filename('nistoar.pdr', 'data/mime.types')])
+    mt = _mimetypes.get(ext)
+    return bool(mt) and (mt in uncompressed_media_types or 
+                     any([mt.startswith(p) for p in uncompressed_media_type_prefixes]))
+
+def zipstream_serialize(bagdir, destdir, log, destfile=None, progress=None,
+                        throttle=None):
+    """
+    serialize a bag into a zip file natively (i.e. without an external 
+    program).  Files that are already compressed (based on their extension
+    or media type) are stored without further compression.  The checksum of 
+    the output file is calculated while it is written and saved into the 
+    shared checksum cache (see nistoar.pdr.preserv.checksum) so that a 
+    subsequent call to ChecksumEngine.checksum_of() does not need to re-read 
+    the file.
+
+    :param bagdir   str:  path to the bag root directory to be serialized
+    :param destdir  str:  path to the output directory to write serialized 
+                             file to.  
+    :param log   Logger:  a logger to write messages to
+    :param destfile str:  the name to give to the serialized file.  If not 
+                             provided, one will be constructed from the 
+                             bag directory name (and an appropriate extension)
+    :param progress func: a function that will be called periodically to 
+                             report progress; it is passed two arguments: 
+                             the number of bytes of the bag processed so 
+                             far and the total number of bytes in the bag.
+                             It is first called (with zero bytes processed)
+                             as soon as the bag's total size is known.
+    :param BandwidthLimiter throttle:  a limiter to use to cap the rate at 
+                             which the bag's contents are read (which may be
+                             shared with other concurrent serializations).
+    """
+    parent, name = os.path.split(bagdir)
+    if not destfile:
+        destfile = name+'.zip'
+    destfile = os.path.join(destdir, destfile)
+
+    if not os.path.exists(bagdir):
+        raise StateException("Can't serialize missing bag directory: "+bagdir)
+    if not os.path.exists(destdir):
+        raise StateException("Can't serialize to missing destination directory: "
+                             +destdir)
+
+    total = measure_dir_size(bagdir)[0]
+    stat = { "done": 0, "last": time.time() }
+    def report(nbytes, final=False):
+        stat['done'] += nbytes
+        if throttle:
+            throttle.consume(nbytes)
+        if progress and (final or
+                         time.time() - stat['last'] > DEF_PROGRESS_INTERVAL):
+            stat['last'] = time.time()
+            try:
+                progress(stat['done'], total)
+            except Exception as ex:
+                log.warning("Failed to report serialization progress: %s", str(ex))
+
+    # let the caller know the total right away
+    report(0, True)
+
+    log.info("serializing bag natively to %s", destfile)
+    try:
+        with open(destfile, 'wb') as fd:
+            zipw = ZipStreamWriter(fd)
+            for root, subdirs, files in os.walk(bagdir):
+                subdirs.sort()
+                arcdir = name + root[len(bagdir):]
+                zipw.add_dir(arcdir, root)
+                for f in sorted(files):
+                    fp = os.path.join(root, f)
+                    zipw.add_file(fp, arcdir+'/'+f, not _is_compressed(f), report)
+            csum = zipw.close()
+        report(0, True)
+
+        checksum.default_cache.put(checksum.file_signature(destfile), csum,
+                                   "sha256")
+
+    except Exception as ex:
+        if os.path.exists(destfile):
+            try:
+                os.remove(destfile)
+            except Exception:
+                pass
+        log.exception("Native zip serialization failed: "+str(ex))
+        raise BagSerializationError("Bag serialization failure: "+str(ex),
+                                    name, ex, sys=_sys)
+
+    return destfile
+zipstream_serialize.reports_progress = True
+zipstream_serialize.supports_throttle = True
+
 class Serializer(object):
     """
     a class that serialize a bag using the archiving technique identified 
@@ -148,6 +554,10 @@ class Serializer(object):
           bagdir -- the root directory of the bag to serialize
           destination -- the path to the desired output bagfile.  
           log -- a logger object to send messages to.
+        If the function has an attribute, reports_progress, set to True, it 
+        must also accept a progress keyword argument (see serialize()); 
+        likewise, if it has an attribute, supports_throttle, set to True, it
+        must accept a throttle keyword argument.
 
         :param format str:   the name users can use to select the serialization
                              format.
@@ -159,9 +569,24 @@ class Serializer(object):
                             str(func))
         self._map[format] = serfunc
 
-    def serialize(self, bagdir, destdir, format, log=None):
+    def serialize(self, bagdir, destdir, format, log=None, progress=None,
+                  throttle=None):
         """
         serialize a bag using the named serialization format
+
+        :param str bagdir:     the root directory of the bag to serialize
+        :param str destdir:    the directory to write the serialized bag to
+        :param str format:     the name of the serialization format to apply
+        :param Logger log:     the logger to send messages to
+        :param func progress:  a function to call periodically to report on 
+                               progress; it will be passed two integers: the 
+                               number of bytes processed so far and the total
+                               number to process.  It is ignored if the 
+                               requested format does not support progress 
+                               reporting.
+        :param BandwidthLimiter throttle:  a limiter for capping the rate that 
+                               the bag is read at.  It is ignored if the 
+                               requested format does not support throttling.
         """
         if format not in self._map:
             raise BagSerializationError("Serialization format not supported: "+
@@ -172,15 +597,24 @@ class Serializer(object):
             else:
                 log = logging.getLogger(_sys.system_abbrev).\
                               getChild(_sys.subsystem_abbrev)
-        return self._map[format](bagdir, destdir, log)
+        serfunc = self._map[format]
+        kw = {}
+        if progress and getattr(serfunc, 'reports_progress', False):
+            kw['progress'] = progress
+        if throttle and getattr(serfunc, 'supports_throttle', False):
+            kw['throttle'] = throttle
+        return serfunc(bagdir, destdir, log, **kw)
 
 class DefaultSerializer(Serializer):
     """
     a Serializer configured for some default serialization formats: zip, 7z.
+    The "zip" format is written natively (see zipstream_serialize()); 
+    "zipcmd" writes zip files via the external zip program.
     """
 
     def __init__(self, log=None):
         super(DefaultSerializer, self).__init__({
-            "zip": zip_serialize,
+            "zip": zipstream_serialize,
+            "zipcmd": zip_serialize,
             "7z": zip7_serialize
         }, log)
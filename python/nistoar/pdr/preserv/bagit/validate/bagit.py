@@ -1,7 +1,7 @@
 """
 This module implements a validator for the base BagIt standard
 """
-import os, re
+import os, re, logging
 from collections import OrderedDict
 from urlparse import urlparse
 
@@ -9,6 +9,9 @@ from .base import (Validator, ValidatorBase, ALL, ValidationResults,
                    ERROR, WARN, REC, ALL, PROB)
 from ..bag import NISTBag
 from ....utils import checksum_of
+from ...checksum import ChecksumEngine, ChecksumLedger
+
+log = logging.getLogger(__name__)
 
 csfunctions = {
     "sha256":  checksum_of
@@ -17,11 +20,28 @@ csfunctions = {
 class BagItValidator(ValidatorBase):
     """
     A validator that runs tests for compliance to the base BagIt standard
+
+    In addition to the common validator configuration properties, this class
+    supports:
+    :prop checksum dict:  a set of properties for configuring how file 
+                          checksums are calculated when checking manifests
+                          (e.g. the number of parallel workers); see 
+                          nistoar.pdr.preserv.checksum.ChecksumEngine.
+    :prop test_manifest dict:  properties that control the manifest tests:
+       :prop check_checksums bool (True):  if False, do not verify the 
+                          checksums listed in the manifests.
+       :prop checksum_ledger_dir str (None):  a directory where a ledger of
+                          verified checksums is kept for each bag validated
+                          (as <bagname>.csledger.json).  When set, a file
+                          whose size, modification time, and inode match 
+                          those recorded in the ledger is not re-read.  The 
+                          directory should be outside of the bag.
     """
     profile = ("BagIt", "v0.97")
 
     def __init__(self, config=None):
         super(BagItValidator, self).__init__(config)
+        self.csengine = ChecksumEngine(self.cfg.get('checksum', {}))
 
     def test_bagit_txt(self, bag, want=ALL, results=None):
         """
@@ -106,12 +126,18 @@ class BagItValidator(ValidatorBase):
             if t.failed():
                 return out
 
+        ledger = None
+        if check:
+            ledger = self._open_ledger(bag)
+
+        # the payload is walked at most once, regardless of the number of
+        # manifests
+        walked = None
+
         delimre = re.compile(r'[ \t]+')
         for mfile in manifests:
             alg = manire.match(mfile).group(1)
-            csfunc = None
-            if alg in csfunctions:
-                csfunc = csfunctions[alg]
+            cancheck = alg in csfunctions
 
             badlines = []
             notdata = []
@@ -190,20 +216,18 @@ class BagItValidator(ValidatorBase):
 
             # check that all files in the payload are listed in the manifest
             notfound = []
-            failed = []
+            tocheck = []
             if check or basename == "manifest":
-              top = (basename == "manifest" and bag.data_dir) or bag.dir
-              for root, subdirs, files in os.walk(top):
-                for f in files:
-                    fp = os.path.join(root, f)
-                    assert fp.startswith(bag.dir+'/')
-                    datap = fp[len(bag.dir)+1:]
-
+                if walked is None:
+                    walked = self._walk_files(bag, basename)
+                for fp, datap in walked:
                     if datap not in paths:
                         if basename == "manifest":
                             notfound.append(datap)
-                    elif check and csfunc and csfunc(fp) != paths[datap]:
-                        failed.append(datap)
+                    elif check and cancheck:
+                        tocheck.append((fp, datap))
+
+            failed = self._check_checksums(tocheck, paths, alg, ledger)
 
             t = self._issue("2.1.3-4",
                      "All payload files must be listed in at least one manifest")
@@ -224,7 +248,67 @@ class BagItValidator(ValidatorBase):
                 comm += failed
             out._err(t, len(failed) == 0, comm)
 
+        if ledger is not None:
+            try:
+                ledger.save()
+            except (IOError, OSError) as ex:
+                log.warning("Unable to save checksum ledger: %s", str(ex))
+
         return out
+
+    def _walk_files(self, bag, basename):
+        # return (filepath, bag-relative path) pairs for all files that
+        # could be listed in the given type of manifest
+        out = []
+        top = (basename == "manifest" and bag.data_dir) or bag.dir
+        for root, subdirs, files in os.walk(top):
+            for f in files:
+                fp = os.path.join(root, f)
+                assert fp.startswith(bag.dir+'/')
+                out.append((fp, fp[len(bag.dir)+1:]))
+        return out
+
+    def _open_ledger(self, bag):
+        ledgerdir = self.cfg.get("test_manifest", {}).get('checksum_ledger_dir')
+        if not ledgerdir:
+            return None
+        if not os.path.isdir(ledgerdir):
+            try:
+                os.makedirs(ledgerdir)
+            except OSError as ex:
+                log.warning("Unable to create checksum ledger dir: %s",
+                                 str(ex))
+                return None
+        return ChecksumLedger(os.path.join(ledgerdir,
+                                           bag.name+".csledger.json"))
+
+    def _check_checksums(self, tocheck, paths, alg, ledger=None):
+        # verify the checksums of the given (filepath, bag-relative path)
+        # pairs against the values listed in paths, returning the relative
+        # paths of those that fail.  Files found unchanged in the ledger are
+        # not re-read; the rest are checksummed in parallel.
+        failed = []
+        tocalc = []
+        sigs = {}
+        for fp, datap in tocheck:
+            known = None
+            if ledger is not None:
+                sigs[datap] = ledger.signature_of(fp)
+                known = ledger.get(datap, sigs[datap], alg)
+            if known:
+                if known != paths[datap]:
+                    failed.append(datap)
+            else:
+                tocalc.append((fp, datap))
+
+        calcd = self.csengine.iter_checksums([c[0] for c in tocalc], alg)
+        for chk, calc in zip(tocalc, calcd):
+            if ledger is not None:
+                ledger.put(chk[1], sigs[chk[1]], calc[1], alg)
+            if calc[1] != paths[chk[1]]:
+                failed.append(chk[1])
+
+        return failed
             
     def test_baginfo(self, bag, want=ALL, results=None):
         out = results
@@ -1,9 +1,10 @@
 """
 This module implements a validator for the NIST-generated bags
 """
-import os, re, json
+import os, re, json, threading, multiprocessing
 from collections import OrderedDict, Mapping
 from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
 
 import ejsonschema as ejs
 
@@ -23,6 +24,79 @@ DEF_NERDM_SUBCOLL_SCHEMA = DEF_PUB_NERDM_SCHEMA + "/definitions/Subcollection"
 DEF_BASE_POD_SCHEMA = "https://data.nist.gov/od/dm/pod-schema/v1.1#"
 DEF_POD_DATASET_SCHEMA = DEF_BASE_POD_SCHEMA + "/definitions/Dataset"
 
+class _MetadataTreeScan(object):
+    """
+    the results of a single walk of a bag's data directory, shared by the 
+    tests that examine the metadata tree.  The existence and type of 
+    metadata files and directories are looked up once, and each nerdm.json 
+    file is read and parsed at most once.
+    """
+    def __init__(self, bag):
+        self.bagdir = bag.dir
+        self.metadir = os.path.join(bag.dir, "metadata")
+        self.datadir = os.path.join(bag.dir, "data")
+        self._walk = None
+        self._kinds = {}
+        self._loaded = {}
+
+    @property
+    def walk(self):
+        """
+        the list of (root, subdirs, files) tuples from walking the data 
+        directory
+        """
+        if self._walk is None:
+            self._walk = list(os.walk(self.datadir))
+        return self._walk
+
+    def kind(self, path):
+        """
+        return "dir" or "file" if the given path exists as a directory or 
+        non-directory, respectively, or None if it does not exist.
+        """
+        if path not in self._kinds:
+            try:
+                isdir = os.path.isdir(path)
+                self._kinds[path] = (isdir and "dir") or \
+                                    (os.path.exists(path) and "file") or None
+            except OSError:
+                self._kinds[path] = None
+        return self._kinds[path]
+
+    def load(self, nerdmf):
+        """
+        return the parsed contents of the given JSON file as a 2-tuple of the
+        data and the exception raised while reading it (one of which will be
+        None).
+        """
+        if nerdmf not in self._loaded:
+            try:
+                with open(nerdmf) as fd:
+                    self._loaded[nerdmf] = \
+                        (json.load(fd, object_pairs_hook=OrderedDict), None)
+            except Exception as ex:
+                self._loaded[nerdmf] = (None, ex)
+        return self._loaded[nerdmf]
+
+# the validators used by schema validation worker processes
+_worker_mdval = None
+
+def _init_schema_worker(schemadir):
+    global _worker_mdval
+    _worker_mdval = {
+        "_": ejs.ExtValidator.with_schema_dir(schemadir, ejsprefix='_'),
+        "$": ejs.ExtValidator.with_schema_dir(schemadir, ejsprefix='$')
+    }
+
+def _schema_errors(mdval, flav, data, schemauri):
+    verrs = mdval[flav].validate(data, schemauri=schemauri,
+                                 strict=True, raiseex=False)
+    return [str(e) for e in (verrs or [])]
+
+def _schema_job(args):
+    # a picklable wrapper around _schema_errors() for use in a process pool
+    return _schema_errors(_worker_mdval, *args)
+
 
 class NISTBagValidator(ValidatorBase):
     """
@@ -30,6 +104,23 @@ class NISTBagValidator(ValidatorBase):
     Profile.  Specifically, this validator only covers the NIST Profile-specific
     parts (excluding Multibag and basic BagIt compliance; see 
     NISTAIPValidator)
+
+    In addition to the common validator configuration properties, this class
+    supports:
+    :prop validate_metadata bool (True):  if False, do not validate NERDm 
+                          metadata against its JSON schemas.
+    :prop nerdm_schema_dir str:  the directory containing the schemas to 
+                          validate NERDm metadata against.
+    :prop validation_workers int (1):  the number of component metadata 
+                          records to schema-validate in parallel.  A value 
+                          less than 1 sets this to the number of CPUs.
+    :prop validation_pool str ("process"):  the type of worker pool to use for
+                          parallel schema validation, either "process" or 
+                          "thread".  
+
+    When run via validate(), the tests that examine the metadata tree share a 
+    single walk of the data directory and read each nerdm.json file only 
+    once.
     """
     namere02 = re.compile("^(\w[\w\-]*).mbag(\d+)_(\d+)-(\d+)$")
     namere04 = re.compile("^(\w[\w\-]*).(\d+(_\d+)*).mbag(\d+)_(\d+)-(\d+)$")
@@ -51,6 +142,55 @@ class NISTBagValidator(ValidatorBase):
                 "_": ejs.ExtValidator.with_schema_dir(schemadir, ejsprefix='_'),
                 "$": ejs.ExtValidator.with_schema_dir(schemadir, ejsprefix='$')
             }
+            self._schemadir = schemadir
+
+        self.workers = int(self.cfg.get('validation_workers', 1))
+        if self.workers < 1:
+            self.workers = multiprocessing.cpu_count()
+        self.pooltype = self.cfg.get('validation_pool', 'process')
+        if self.pooltype not in ('thread', 'process'):
+            raise ConfigurationException("validation_pool: unsupported pool "+
+                                         "type: " + str(self.pooltype))
+        self._running = threading.local()
+
+    def validate(self, bag, want=ALL, results=None, *kw):
+        self._running.scan = _MetadataTreeScan(bag)
+        try:
+            return super(NISTBagValidator, self).validate(bag, want, results, *kw)
+        finally:
+            self._running.scan = None
+
+    def _scan_for(self, bag):
+        # return the metadata tree scan shared by the tests during a call to
+        # validate(), or a new one if a test is called on its own
+        scan = getattr(self._running, 'scan', None)
+        if scan is None or scan.bagdir != bag.dir:
+            scan = _MetadataTreeScan(bag)
+        return scan
+
+    def _validate_schemas(self, jobs):
+        """
+        schema-validate a list of NERDm records, possibly in parallel.  Each 
+        job is a tuple of the meta-property flavor, the record, and the URI
+        of the schema to validate against.  A list of error messages is 
+        returned for each job, in order.
+        """
+        workers = min(self.workers, len(jobs))
+        if workers < 2:
+            return [_schema_errors(self.mdval, *j) for j in jobs]
+
+        if self.pooltype == 'process':
+            pool = multiprocessing.Pool(workers, _init_schema_worker,
+                                        (self._schemadir,))
+            func = _schema_job
+        else:
+            pool = ThreadPool(workers)
+            func = lambda j: _schema_errors(self.mdval, *j)
+        try:
+            return pool.map(func, jobs, max(1, len(jobs) // (4 * workers)))
+        finally:
+            pool.close()
+            pool.join()
 
     def test_name(self, bag, want=ALL, results=None):
         """
@@ -336,19 +476,18 @@ class NISTBagValidator(ValidatorBase):
         if not out:
             out = ValidationResults(bag.name, want)
         mdfile = os.path.join(bag.metadata_dir, "nerdm.json")
+        scan = self._scan_for(bag)
         
         t = self._issue("4.1-3-0",
                       "Metadata tag directory must contain the file, nerdm.json")
-        out._err(t, os.path.isfile(mdfile))
+        out._err(t, scan.kind(mdfile) == "file")
         if t.failed():
             return out
 
         t = self._issue("4.1-3-1",
                "metadata/nerdm.json must contain a legal NERDm Resource record") 
-        try:
-            with open(mdfile) as fd:
-                data = json.load(fd)
-        except Exception as ex:
+        data, ex = scan.load(mdfile)
+        if ex:
             comm = ["Failed reading JSON file: "+str(ex)]
             out._err(t, False, comm)
             return out
@@ -386,8 +525,9 @@ class NISTBagValidator(ValidatorBase):
         out = results
         if not out:
             out = ValidationResults(bag.name, want)
-        metadir = os.path.join(bag.dir, "metadata")
-        datadir = os.path.join(bag.dir, "data")
+        scan = self._scan_for(bag)
+        metadir = scan.metadir
+        datadir = scan.datadir
 
         dotdir   = []
         dotfile  = []
@@ -396,7 +536,7 @@ class NISTBagValidator(ValidatorBase):
         dnotadir = []
         fnotadir = []
         nonerd   = []
-        for root, subdirs, files in os.walk(datadir):
+        for root, subdirs, files in scan.walk:
             for dir in subdirs:
                 path = os.path.join(root[len(datadir)-5:], dir)
                 if dir.startswith('.'):
@@ -404,11 +544,12 @@ class NISTBagValidator(ValidatorBase):
                     continue
                 dir = os.path.join(root, dir)
                 mdir = os.path.join(metadir, dir[len(datadir)+1:])
-                if not os.path.exists(mdir):
+                kind = scan.kind(mdir)
+                if not kind:
                     misngdir.append(path)
-                elif not os.path.isdir(mdir):
+                elif kind != "dir":
                     dnotadir.append("meta"+path)
-                elif not os.path.exists(os.path.join(mdir,"nerdm.json")):
+                elif not scan.kind(os.path.join(mdir,"nerdm.json")):
                     nonerd.append("meta"+path)
 
             for f in files:
@@ -417,11 +558,12 @@ class NISTBagValidator(ValidatorBase):
                     dotfile.append(path)
                     continue
                 f = os.path.join(metadir, root[len(datadir)+1:], f)
-                if not os.path.exists(f):
+                kind = scan.kind(f)
+                if not kind:
                     misngfil.append(path)
-                elif not os.path.isdir(f):
+                elif kind != "dir":
                     fnotadir.append("meta"+path)
-                elif not os.path.exists(os.path.join(f,"nerdm.json")):
+                elif not scan.kind(os.path.join(f,"nerdm.json")):
                     nonerd.append("meta"+path)
 
         t = self._issue("4.1-4-5", "Data directory should not contain files "+
@@ -490,8 +632,37 @@ class NISTBagValidator(ValidatorBase):
         out = results
         if not out:
             out = ValidationResults(bag.name, want)
-        metadir = os.path.join(bag.dir, "metadata")
-        datadir = os.path.join(bag.dir, "data")
+        scan = self._scan_for(bag)
+        metadir = scan.metadir
+        datadir = scan.datadir
+
+        # gather the component records, in the order they will be tested
+        comps = []
+        for root, subdirs, files in scan.walk:
+            for f in files:
+                comps.append((os.path.join(root[len(datadir):], f), False))
+            for d in subdirs:
+                comps.append((os.path.join(root[len(datadir):], d), True))
+        comps = [(path, isdir, os.path.join(metadir, path, "nerdm.json"))
+                 for path, isdir in comps]
+        comps = [c for c in comps if scan.kind(c[2]) == "file"]
+
+        # schema-validate all of the (legal) records together so that it can
+        # be done in parallel
+        verrs = {}
+        if self._validatemd:
+            jobs = []
+            for path, isdir, mdf in comps:
+                data = scan.load(mdf)[0]
+                if isinstance(data, Mapping):
+                    flav = self._get_mdval_flavor(data)
+                    schemauri = data.get(flav+"schema")
+                    if not schemauri:
+                        schemauri = (isdir and DEF_NERDM_SUBCOLL_SCHEMA) or \
+                                    DEF_NERDM_DATAFILE_SCHEMA
+                    jobs.append((path, (flav, data, schemauri)))
+            verrs = dict(zip([j[0] for j in jobs],
+                             self._validate_schemas([j[1] for j in jobs])))
 
         vt = self._issue("4.1-4-2b", "A data file directory must " +
                          "contain a valid NERDm metadata file.")
@@ -501,18 +672,18 @@ class NISTBagValidator(ValidatorBase):
                          "of @type=nrdp:Subcollection.")
         kt = self._issue("4.1-4-2e", "_schema and @context fields recommended "+
                          "for inclusion in component NERDm data file")
-        for root, subdirs, files in os.walk(datadir):
-            for f in files:
-                path = os.path.join(root[len(datadir):], f)
-                mdf = os.path.join(metadir, path, "nerdm.json")
-                if not os.path.isfile(mdf):
-                    continue
-
-                data = self._check_comp_legal(mdf, path, out)
-                if data is None:
-                    continue
+        for path, isdir, mdf in comps:
+            data = self._check_comp_legal(scan, mdf, path, out)
+            if data is None:
+                continue
 
-                comm = None
+            comm = None
+            if isdir:
+                ok = '@type' in data and "nrdp:Subcollection" in data['@type']
+                if not ok:
+                    comm = [path + ": " + str(data['@type'])]
+                out._err(ct, ok, comm)
+            else:
                 ok = '@type' in data and \
                      ("nrdp:DataFile" in data['@type'] or \
                       "nrdp:ChecksumFile" in data['@type'])
@@ -527,66 +698,30 @@ class NISTBagValidator(ValidatorBase):
                     comm = ["filepath: " +path]
                 out._rec(kt, ok, comm)
 
-                if self._validatemd:
-                    flav = self._get_mdval_flavor(data)
-                    schemauri = data.get(flav+"schema")
-                    if not schemauri:
-                        schemauri = DEF_NERDM_DATAFILE_SCHEMA
-                    verrs = self.mdval[flav].validate(data, schemauri=schemauri,
-                                                      strict=True, raiseex=False)
-                    comm = None
-                    if verrs:
-                        s = (len(verrs) > 1 and "s") or ""
-                        comm = ["{0} validation error{1} detected"
-                                .format(len(verrs), s)]
-                        comm += [str(e) for e in verrs]
-                    out._err(vt, not comm, comm)
-            
-            for d in subdirs:
-                path = os.path.join(root[len(datadir):], d)
-                mdf = os.path.join(metadir, path, "nerdm.json")
-                if not os.path.isfile(mdf):
-                    continue
-
-                data = self._check_comp_legal(mdf, path, out)
-                if data is None:
-                    continue
-
+            if self._validatemd:
+                errs = verrs.get(path)
                 comm = None
-                ok = '@type' in data and "nrdp:Subcollection" in data['@type']
-                if not ok:
-                    comm = [path + ": " + str(data['@type'])]
-                out._err(ct, ok, comm)
-
-                if self._validatemd:
-                    flav = self._get_mdval_flavor(data)
-                    schemauri = data.get(flav+"schema")
-                    if not schemauri:
-                        schemauri = DEF_NERDM_SUBCOLL_SCHEMA
-                    verrs = self.mdval[flav].validate(data, schemauri=schemauri,
-                                                      strict=True, raiseex=False)
-                    comm = None
-                    if verrs:
-                        s = (len(verrs) > 1 and "s") or ""
-                        comm = ["{0} validation error{1} detected"
-                                .format(len(verrs), s)]
-                        comm += [str(e) for e in verrs]
-                    out._err(vt, not comm, comm)
+                if errs:
+                    s = (len(errs) > 1 and "s") or ""
+                    comm = ["{0} validation error{1} detected"
+                            .format(len(errs), s)]
+                    comm += errs
+                out._err(vt, not comm, comm)
             
         return out
 
-    def _check_comp_legal(self, nerdmf, path, res):
+    def _check_comp_legal(self, scan, nerdmf, path, res):
         vt = self._issue("4.1-4-2a", "A data file directory must " +
                          "contain a legal NERDm metadata file.")
         pt = self._issue("4.1-4-2f", "A data component's NERDm data must have "+
                          "a correct filepath property")
-        try:
-            with open(nerdmf) as fd:
-                data = json.load(fd, object_pairs_hook=OrderedDict)
-        except ValueError as ex:
+        data, ex = scan.load(nerdmf)
+        if isinstance(ex, ValueError):
             res._err(vt, False,
                      ["metadata/"+path+"/nerdm.json: Not a legal JSON file"])
             return None
+        elif ex:
+            raise ex
 
         comm = None
         ok = isinstance(data, Mapping)
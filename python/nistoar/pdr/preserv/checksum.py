@@ -0,0 +1,402 @@
+"""
+Support for calculating the checksums of many (potentially large) files.
+
+The :class:`ChecksumEngine` class calculates checksums for files either one at
+a time or in batches; batches can be processed in parallel using a pool of
+threads or of processes.  Calculated checksums are saved in a
+:class:`ChecksumCache` which is keyed on the file's signature--its path, size,
+modification time, and inode--so that a file is not re-read unless it has
+changed since its checksum was last calculated.  By default, all engines share
+a single, module-level cache; thus, a checksum calculated by the
+:class:`~nistoar.pdr.preserv.bagit.builder.BagBuilder` while registering a
+file's metadata will be reused when the bag's manifest is written and, later,
+validated.
+
+Because the in-memory cache does not outlive the process, this module also
+provides a :class:`ChecksumLedger`, a small file-backed record of checksums
+that have been verified for the files in a particular directory tree (e.g. a
+bag).  A validator can consult a ledger to avoid re-reading files that have
+not changed since they were last verified.
+"""
+import os, json, hashlib, threading, logging, multiprocessing, shutil
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from ..exceptions import ConfigurationException
+
+log = logging.getLogger(__name__)
+
+DEF_ALGORITHM = "sha256"
+DEF_BUFSIZE = 10240000     # 10 MB
+DEF_CACHE_SIZE = 500000    # entries
+
+def file_signature(filepath):
+    """
+    return a tuple that identifies the current state of a file.  The tuple
+    contains the file's absolute path, size, modification time, and inode
+    number, in that order.  If any of these change, the file should be
+    considered changed.
+
+    :raise OSError:  if the file does not exist or cannot be stat-ed
+    """
+    st = os.stat(filepath)
+    return (os.path.abspath(filepath), st.st_size, st.st_mtime, st.st_ino)
+
+def hash_file(filepath, algorithm=DEF_ALGORITHM, bufsize=DEF_BUFSIZE):
+    """
+    calculate and return the hex-encoded checksum of the given file.
+
+    :param str filepath:   the path to the file to checksum
+    :param str algorithm:  the name of the hash algorithm to use (as recognized
+                           by hashlib.new(); default: "sha256")
+    :param int bufsize:    the number of bytes to read from the file at a time
+    """
+    sum = hashlib.new(algorithm)
+    with open(filepath, 'rb') as fd:
+        while True:
+            buf = fd.read(bufsize)
+            if not buf: break
+            sum.update(buf)
+    return sum.hexdigest()
+
+def _hash_file_job(args):
+    # a picklable wrapper around hash_file() for use with a process pool
+    return hash_file(*args)
+
+class ChecksumCache(object):
+    """
+    a thread-safe, in-memory store of previously calculated checksums.  Entries
+    are keyed on a file's signature (see :func:`file_signature`) and the name
+    of the algorithm used, so a saved checksum will not be returned after the
+    file has changed.  When the cache exceeds its maximum size, the oldest
+    entries are discarded.
+    """
+
+    def __init__(self, maxsize=DEF_CACHE_SIZE):
+        """
+        create an empty cache
+        :param int maxsize:  the maximum number of entries to hold; a value
+                             less than 1 means no limit.
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, signature, algorithm=DEF_ALGORITHM):
+        """
+        return the cached checksum for the file with the given signature or
+        None if it is not cached.
+        """
+        with self._lock:
+            return self._data.get((signature, algorithm))
+
+    def put(self, signature, hash, algorithm=DEF_ALGORITHM):
+        """
+        save a checksum for the file with the given signature
+        """
+        with self._lock:
+            self._data.pop((signature, algorithm), None)
+            self._data[(signature, algorithm)] = hash
+            while self.maxsize > 0 and len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """
+        remove all entries from this cache
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+default_cache = ChecksumCache()
+
+class ChecksumLedger(object):
+    """
+    a persistent record of the checksums of files below a root directory.
+    Entries are keyed on the file's path relative to that root and are only
+    returned if the file's current size, modification time, and inode number
+    match those recorded with the checksum.  Keying on the relative path
+    allows the root directory to be renamed (as happens when a bag is
+    finalized) without invalidating the ledger.
+
+    The ledger is loaded from its file on construction; changes are not
+    written back until save() is called.  A ledger is safe to update from
+    multiple threads.
+    """
+
+    def __init__(self, ledgerfile):
+        """
+        open the ledger stored in the given file.  If the file does not exist
+        (or cannot be parsed), the ledger starts out empty.
+
+        :param str ledgerfile:  the path to the file where the ledger is saved
+        """
+        self.file = ledgerfile
+        self._data = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        if os.path.exists(ledgerfile):
+            try:
+                with open(ledgerfile) as fd:
+                    self._data = json.load(fd)
+            except (IOError, ValueError) as ex:
+                log.warning("Ignoring unreadable checksum ledger, %s: %s",
+                            ledgerfile, str(ex))
+
+    @staticmethod
+    def signature_of(filepath):
+        """
+        return the (size, mtime, inode) signature recorded for a file in a
+        ledger.
+        """
+        return list(file_signature(filepath)[1:])
+
+    def get(self, relpath, signature, algorithm=DEF_ALGORITHM):
+        """
+        return the recorded checksum for a file or None if the file is not in
+        the ledger or its signature has changed.
+
+        :param str relpath:     the path to the file relative to the root
+        :param list signature:  the file's current signature (see
+                                signature_of())
+        :param str algorithm:   the hash algorithm of the desired checksum
+        """
+        with self._lock:
+            ent = self._data.get(relpath)
+        if not ent or list(ent.get('sig', [])) != list(signature):
+            return None
+        return ent.get('checksums', {}).get(algorithm)
+
+    def put(self, relpath, signature, hash, algorithm=DEF_ALGORITHM):
+        """
+        record the checksum of a file.  Any checksums previously recorded for
+        the file under a different signature are discarded.
+        """
+        signature = list(signature)
+        with self._lock:
+            ent = self._data.get(relpath)
+            if not ent or list(ent.get('sig', [])) != signature:
+                ent = { 'sig': signature, 'checksums': {} }
+                self._data[relpath] = ent
+            ent['checksums'][algorithm] = hash
+            self._dirty = True
+
+    def remove(self, relpath):
+        """
+        forget the checksums recorded for a file
+        """
+        with self._lock:
+            if self._data.pop(relpath, None) is not None:
+                self._dirty = True
+
+    def save(self):
+        """
+        write the ledger out to its file if it has changed since it was
+        loaded.  The file is replaced atomically.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            tmpf = self.file + ".tmp"
+            with open(tmpf, 'w') as fd:
+                json.dump(self._data, fd)
+            os.rename(tmpf, self.file)
+            self._dirty = False
+
+    def __len__(self):
+        return len(self._data)
+
+class ChecksumEngine(object):
+    """
+    a class for calculating the checksums of files, possibly in parallel.
+
+    This class can take a configuration dictionary on construction; the
+    following properties are supported:
+    :prop workers int (1):  the number of files to checksum in parallel when
+                              checksums are requested in batches (via
+                              checksums_of() or iter_checksums()).  A value
+                              less than 1 sets this to the number of CPUs.
+    :prop pool str ("thread"):  the type of worker pool to use, either "thread"
+                              or "process".  As the hashlib functions release
+                              the GIL while hashing, threads are usually
+                              sufficient.
+    :prop bufsize int (10240000):  the number of bytes each worker reads from
+                              a file at a time.
+    :prop use_cache bool (True):  if False, never reuse previously calculated
+                              checksums.
+    :prop algorithm str ("sha256"):  the default hash algorithm to use.
+    :prop extra_algorithms list of str ([]):  additional hash algorithms to 
+                              calculate (and cache) when copying a file via 
+                              copy_file().
+    """
+
+    def __init__(self, config=None, cache=None):
+        """
+        create the engine.
+
+        :param dict config:   the configuration for this engine (see class
+                              documentation for supported properties).
+        :param ChecksumCache cache:  the cache to use to save calculated
+                              checksums; if None, the shared module-level
+                              cache will be used.
+        """
+        if config is None:
+            config = {}
+        self.cfg = config
+
+        self.workers = int(self.cfg.get('workers', 1))
+        if self.workers < 1:
+            self.workers = multiprocessing.cpu_count()
+        self.pooltype = self.cfg.get('pool', 'thread')
+        if self.pooltype not in ('thread', 'process'):
+            raise ConfigurationException("checksum: unsupported pool type: " +
+                                         str(self.pooltype))
+        self.bufsize = int(self.cfg.get('bufsize', DEF_BUFSIZE))
+        self.algorithm = self.cfg.get('algorithm', DEF_ALGORITHM)
+
+        if cache is None:
+            cache = default_cache
+        if not self.cfg.get('use_cache', True):
+            cache = None
+        self.cache = cache
+
+    def checksum_of(self, filepath, algorithm=None):
+        """
+        return the checksum of the given file, calculating it only if it has
+        not been previously cached.
+        """
+        if not algorithm:
+            algorithm = self.algorithm
+        sig = self._cached(filepath, algorithm)
+        if sig[1]:
+            return sig[1]
+        hash = hash_file(filepath, algorithm, self.bufsize)
+        self._save(sig[0], hash, algorithm)
+        return hash
+
+    def checksums_of(self, filepaths, algorithm=None):
+        """
+        return the checksums of the given files as a dictionary mapping each
+        file path to its checksum.  Files not previously cached are checksummed
+        in parallel.
+        """
+        return OrderedDict(self.iter_checksums(filepaths, algorithm))
+
+    def iter_checksums(self, filepaths, algorithm=None):
+        """
+        iterate through the checksums of the given files, calculating (in
+        parallel) those that have not been cached.  Each item returned is a
+        (filepath, checksum) tuple, returned in the order of the input list.
+        """
+        if not algorithm:
+            algorithm = self.algorithm
+
+        todo = []
+        sigs = []
+        for fp in filepaths:
+            sig = self._cached(fp, algorithm)
+            sigs.append((fp, sig[0], sig[1]))
+            if not sig[1]:
+                todo.append(fp)
+
+        calcd = {}
+        if todo:
+            for fp, hash in zip(todo, self._calc(todo, algorithm)):
+                calcd[fp] = hash
+
+        for fp, sig, hash in sigs:
+            if not hash:
+                hash = calcd[fp]
+                self._save(sig, hash, algorithm)
+            yield (fp, hash)
+
+    def precalculate(self, filepaths, algorithm=None):
+        """
+        ensure that the checksums of the given files are calculated and cached
+        so that subsequent requests via checksum_of() are fast.
+        """
+        for item in self.iter_checksums(filepaths, algorithm):
+            pass
+
+    def copy_file(self, srcpath, destpath, algorithms=None):
+        """
+        copy a file while calculating its checksums in the same pass, so that 
+        the file's contents only need to be read once.  The checksums are 
+        cached for both the source and the destination file; thus, a 
+        subsequent call to checksum_of() for either file will not require 
+        re-reading the file.  Like shutil.copy(), the source's permission bits
+        are also copied.
+
+        :param str srcpath:     the path to the file to copy
+        :param str destpath:    the path to copy the file to; if it exists, 
+                                it will be overwritten.
+        :param list algorithms: the names of the hash algorithms to calculate;
+                                if not provided, the engine's default algorithm
+                                plus its configured extra_algorithms are used.
+        :return OrderedDict:  a mapping of algorithm names to the hex-encoded 
+                              checksums of the file
+        """
+        if not algorithms:
+            algorithms = [self.algorithm] + \
+                         [a for a in self.cfg.get('extra_algorithms', [])
+                            if a != self.algorithm]
+        if os.path.isdir(destpath):
+            destpath = os.path.join(destpath, os.path.basename(srcpath))
+        if os.path.exists(destpath) and os.path.samefile(srcpath, destpath):
+            raise shutil.Error("{0} and {1} are the same file"
+                               .format(srcpath, destpath))
+        srcsig = None
+        if self.cache is not None:
+            srcsig = file_signature(srcpath)
+
+        sums = OrderedDict([(a, hashlib.new(a)) for a in algorithms])
+        with open(srcpath, 'rb') as ifd, open(destpath, 'wb') as ofd:
+            while True:
+                buf = ifd.read(self.bufsize)
+                if not buf: break
+                for sum in sums.values():
+                    sum.update(buf)
+                ofd.write(buf)
+        shutil.copymode(srcpath, destpath)
+
+        out = OrderedDict([(a, sums[a].hexdigest()) for a in sums])
+        if self.cache is not None:
+            destsig = file_signature(destpath)
+            for alg in out:
+                self._save(srcsig, out[alg], alg)
+                self._save(destsig, out[alg], alg)
+        return out
+
+    def _cached(self, filepath, algorithm):
+        # return a (signature, cached_hash) tuple for the file
+        if self.cache is None:
+            return (None, None)
+        sig = file_signature(filepath)
+        return (sig, self.cache.get(sig, algorithm))
+
+    def _save(self, signature, hash, algorithm):
+        if self.cache is not None and signature:
+            self.cache.put(signature, hash, algorithm)
+
+    def _calc(self, filepaths, algorithm):
+        # calculate the checksums for the given list of files, returning
+        # them in order
+        workers = min(self.workers, len(filepaths))
+        if workers < 2:
+            return [hash_file(fp, algorithm, self.bufsize) for fp in filepaths]
+
+        log.debug("Calculating %d checksums with %d %s workers",
+                  len(filepaths), workers, self.pooltype)
+        if self.pooltype == 'process':
+            pool = multiprocessing.Pool(workers)
+        else:
+            pool = ThreadPool(workers)
+        try:
+            return pool.map(_hash_file_job,
+                            [(fp, algorithm, self.bufsize) for fp in filepaths],
+                            1)
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,323 @@
+"""
+This module provides a persistent queue of SIPs waiting to be preserved,
+used to limit the number of preservation processes running at one time.
+
+The :class:`SIPQueue` records, in a JSON file (normally kept alongside the
+SIP status cache files), the SIPs that are waiting for a preservation worker
+as well as the worker processes currently running.  Because the file is
+accessed under an exclusive file lock, a queue can be shared by all of the
+processes of a service (e.g. the web service processes that accept requests
+and the worker processes that carry them out), and its contents survive a
+restart of the service.
+"""
+import os, time, fcntl, json, threading
+from collections import OrderedDict
+from copy import deepcopy
+
+from ...exceptions import StateException
+from .. import sys as preservsys
+
+QUEUE_FILENAME = "_queue.json"
+MAX_WAIT_HISTORY = 100
+
+def process_token(pid):
+    """
+    return a string that distinguishes the process with the given ID from any 
+    other process that may later be given the same ID, or None if this cannot 
+    be determined (e.g. because the process does not exist or the platform 
+    does not provide /proc).  The token is based on the process's start time.
+    """
+    try:
+        with open("/proc/{0}/stat".format(pid)) as fd:
+            stat = fd.read()
+    except (IOError, OSError):
+        return None
+
+    # the command name (field 2) may contain spaces; start time is field 22
+    fields = stat[stat.rfind(')')+2:].split()
+    if len(fields) < 20:
+        return None
+    return fields[19]
+
+class SIPQueue(object):
+    """
+    a persistent, priority-ordered queue of SIPs awaiting preservation, along
+    with a registry of the worker processes currently preserving SIPs.
+
+    Entries with a higher priority are dispatched first; entries of equal
+    priority are dispatched in the order they were added.  All reads and
+    updates of the queue must take place within a transaction (see
+    transaction()), which holds an exclusive lock on the queue file; for
+    example:
+
+        with queue.transaction():
+            queue.prune(is_alive)
+            if queue.free_slots(maxworkers) > 0:
+                entry = queue.pop()
+    """
+
+    def __init__(self, queuefile):
+        """
+        open the queue saved in the given file
+
+        :param str queuefile:  the path to the file where the queue is
+                               persisted; it will be created if necessary.
+        """
+        self.file = queuefile
+        self._lockfile = queuefile + ".lock"
+        self._tlock = threading.RLock()
+        self._data = None
+        self._depth = 0
+
+    def transaction(self):
+        """
+        return a context manager that locks the queue, loads its current
+        contents, and saves any changes when the context is exited without
+        an exception.  Transactions may be nested.
+        """
+        return _QueueTransaction(self)
+
+    def _load(self):
+        data = None
+        if os.path.exists(self.file):
+            try:
+                with open(self.file) as fd:
+                    data = json.load(fd, object_pairs_hook=OrderedDict)
+            except ValueError as ex:
+                raise StateException("Corrupted SIP queue file: " + self.file +
+                                     ": " + str(ex), cause=ex, sys=preservsys)
+        if not data:
+            data = OrderedDict()
+        data.setdefault('pending', [])
+        data.setdefault('running', OrderedDict())
+        data.setdefault('waits', [])
+        data.setdefault('completed', 0)
+        return data
+
+    def _save(self):
+        tmpf = self.file + ".tmp"
+        with open(tmpf, 'w') as fd:
+            json.dump(self._data, fd, indent=2, separators=(',', ': '))
+        os.rename(tmpf, self.file)
+
+    def _check(self):
+        if self._data is None:
+            raise RuntimeError("SIPQueue accessed outside of a transaction")
+
+    def push(self, sipid, siptype, asupdate=None, priority=0):
+        """
+        add an SIP to the queue.  If the SIP is already queued, its priority
+        is updated but its place in line is otherwise retained.
+
+        :param str  sipid:     the identifier of the SIP to preserve
+        :param str  siptype:   the name of the SIP's type
+        :param bool asupdate:  the update mode to preserve the SIP with
+        :param int  priority:  the dispatch priority; higher values are
+                               dispatched first
+        :return dict:  the queue entry
+        """
+        self._check()
+        for ent in self._data['pending']:
+            if ent['id'] == sipid:
+                ent['priority'] = priority
+                return deepcopy(ent)
+        ent = OrderedDict([('id', sipid), ('siptype', siptype),
+                           ('asupdate', asupdate), ('priority', priority),
+                           ('queue_time', time.time())])
+        self._data['pending'].append(ent)
+        return deepcopy(ent)
+
+    def _next_index(self):
+        best = None
+        for i, ent in enumerate(self._data['pending']):
+            if best is None or \
+               ent.get('priority', 0) > self._data['pending'][best].get('priority', 0):
+                best = i
+        return best
+
+    def pop(self):
+        """
+        remove and return the next entry to be dispatched, or None if the
+        queue is empty.  The time the entry spent in the queue is recorded
+        in the queue's wait statistics.
+        """
+        self._check()
+        i = self._next_index()
+        if i is None:
+            return None
+        ent = self._data['pending'].pop(i)
+        waits = self._data['waits']
+        waits.append(time.time() - ent.get('queue_time', time.time()))
+        del waits[:-MAX_WAIT_HISTORY]
+        return ent
+
+    def remove(self, sipid):
+        """
+        remove the given SIP from the queue, returning True if it was queued.
+        """
+        self._check()
+        n = len(self._data['pending'])
+        self._data['pending'] = [e for e in self._data['pending']
+                                   if e['id'] != sipid]
+        return len(self._data['pending']) < n
+
+    def pending(self):
+        """
+        return the list of queued entries in the order they will be dispatched
+        """
+        self._check()
+        ents = list(enumerate(self._data['pending']))
+        ents.sort(key=lambda e: (-e[1].get('priority', 0), e[0]))
+        return [deepcopy(e[1]) for e in ents]
+
+    def position(self, sipid):
+        """
+        return the (1-based) place of the given SIP in line for dispatch, or
+        0 if the SIP is not queued.
+        """
+        for i, ent in enumerate(self.pending()):
+            if ent['id'] == sipid:
+                return i + 1
+        return 0
+
+    def add_running(self, pid, entry, token=None):
+        """
+        record that the given worker process is now preserving the SIP
+        described by the given queue entry.
+
+        :param int pid:     the worker's process ID
+        :param dict entry:  the queue entry for the SIP being preserved
+        :param str token:   a value (as returned by process_token()) that 
+                            distinguishes the worker from a later process that 
+                            reuses its ID.  
+        """
+        self._check()
+        self._data['running'][str(pid)] = OrderedDict([
+            ('id', entry['id']), ('siptype', entry.get('siptype')),
+            ('start_time', time.time()), ('token', token)
+        ])
+
+    def is_running(self, sipid):
+        """
+        return True if the given SIP is registered as being preserved by a 
+        worker process.
+        """
+        self._check()
+        return any([e['id'] == sipid for e in self._data['running'].values()])
+
+    def finish(self, pid):
+        """
+        record that the given worker process is no longer preserving an SIP.
+        """
+        self._check()
+        if self._data['running'].pop(str(pid), None) is not None:
+            self._data['completed'] += 1
+
+    def running(self):
+        """
+        return a dictionary mapping the process IDs of the registered workers
+        to descriptions of the SIPs they are preserving
+        """
+        self._check()
+        return OrderedDict([(int(p), deepcopy(e))
+                            for p, e in self._data['running'].items()])
+
+    def prune(self, is_alive):
+        """
+        unregister any workers that are no longer running.  A worker that was 
+        registered with a token is also considered no longer running if its 
+        process ID now belongs to a different process.
+
+        :param function is_alive:  a function that takes a process ID and
+                                   returns False if that process has died
+        :return list:  the queue entries of the SIPs whose workers died
+        """
+        self._check()
+        out = []
+        for pid, ent in list(self._data['running'].items()):
+            alive = is_alive(int(pid))
+            if alive and ent.get('token'):
+                tok = process_token(int(pid))
+                alive = tok is None or tok == ent['token']
+            if not alive:
+                out.append(self._data['running'].pop(pid))
+        return out
+
+    def free_slots(self, maxworkers):
+        """
+        return the number of additional workers that can be started given a
+        maximum number of concurrent workers.
+        """
+        self._check()
+        return max(0, maxworkers - len(self._data['running']))
+
+    def stats(self, maxworkers=None):
+        """
+        return a dictionary of statistics describing the current state of
+        the queue, including its depth and the time SIPs have spent waiting
+        in it.
+        """
+        self._check()
+        now = time.time()
+        pendwaits = [now - e.get('queue_time', now) for e in self._data['pending']]
+        waits = self._data['waits']
+        out = OrderedDict([
+            ('queue_depth', len(self._data['pending'])),
+            ('running', len(self._data['running'])),
+            ('max_workers', maxworkers),
+            ('completed', self._data['completed']),
+            ('oldest_wait', (pendwaits and max(pendwaits)) or 0.0),
+            ('mean_wait', (waits and sum(waits) / len(waits)) or 0.0),
+            ('max_wait', (waits and max(waits)) or 0.0)
+        ])
+        return out
+
+    def __len__(self):
+        with self.transaction():
+            return len(self._data['pending'])
+
+class _QueueTransaction(object):
+    def __init__(self, queue):
+        self._q = queue
+        self._fd = None
+
+    def __enter__(self):
+        q = self._q
+        q._tlock.acquire()
+        try:
+            if q._depth == 0:
+                pdir = os.path.dirname(q.file)
+                if pdir and not os.path.exists(pdir):
+                    os.makedirs(pdir)
+                self._fd = open(q._lockfile, 'a')
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+                try:
+                    q._data = q._load()
+                except:
+                    self._unlock()
+                    raise
+            q._depth += 1
+        except:
+            q._tlock.release()
+            raise
+        return q
+
+    def __exit__(self, ex_type, ex_val, ex_tb):
+        q = self._q
+        try:
+            q._depth -= 1
+            if q._depth == 0:
+                try:
+                    if ex_type is None:
+                        q._save()
+                finally:
+                    q._data = None
+                    self._unlock()
+        finally:
+            q._tlock.release()
+
+    def _unlock(self):
+        if self._fd:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._fd.close()
+            self._fd = None
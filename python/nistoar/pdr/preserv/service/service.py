@@ -25,6 +25,7 @@ submit the metadata to the PDR metadata database.
 """
 from __future__ import print_function
 from copy import deepcopy
+from collections import OrderedDict
 from abc import ABCMeta, abstractmethod, abstractproperty
 import os, sys, logging, threading, multiprocessing, time, errno, re
 
@@ -34,6 +35,7 @@ from .. import (PDRException, StateException, IDNotFound,
 from ....id import PDRMinter
 from . import status
 from . import siphandler as hndlr
+from .scheduler import SIPQueue, QUEUE_FILENAME, process_token
 from ...notify import NotificationService
 from ..bagger.prepupd import UpdatePrepService
 from ..bagger.midas3 import midasid_to_bagname
@@ -192,11 +194,16 @@ class PreservationService(object):
             raise RerequestException(hdlr.state,
                             "initial preservation already completed for "+sipid)
 
-        elif hdlr.state == status.IN_PROGRESS or hdlr.state == status.PENDING:
+        elif hdlr.state in (status.IN_PROGRESS, status.PENDING):
             log.warn("%s: requested preservation is already in progress", sipid)
             raise RerequestException(hdlr.state,
                                      "preservation already underway for "+sipid)
 
+        elif hdlr.state == status.QUEUED:
+            # relaunching will restore its place in the queue and start it if
+            # a worker is available
+            log.info("%s: preservation re-requested while queued", sipid)
+
         # A final check for readiness:  this call allows the handler to carry
         # out additional SIP-type-specific checks of the SIP's state.
         if not hdlr.isready():
@@ -274,11 +281,16 @@ class PreservationService(object):
                      sipid)
             hdlr._status.reset()
 
-        elif hdlr.state == status.IN_PROGRESS or hdlr.state == status.PENDING:
+        elif hdlr.state in (status.IN_PROGRESS, status.PENDING):
             log.warn("%s: preservation is already in progress", sipid)
             raise RerequestException(hdlr.state,
                                      "preservation already underway for "+sipid)
 
+        elif hdlr.state == status.QUEUED:
+            # relaunching will restore its place in the queue and start it if
+            # a worker is available
+            log.info("%s: preservation update re-requested while queued", sipid)
+
         # A final check for readiness:  this call allows the handler to carry
         # out additional SIP-type-specific checks of the SIP's state.
         if not hdlr.isready():
@@ -351,7 +363,7 @@ class PreservationService(object):
             "history": []
         }
 
-    def requests(self, siptype=None):
+    def requests(self, siptype=None, withstats=False):
         """
         return the known SIP identifiers for which preservation requests 
         have been made.  These values can be used to return status information 
@@ -359,24 +371,59 @@ class PreservationService(object):
 
         :param siptype str: return IDs only of the given type.  If None, all 
              types are returned.
+        :param withstats bool:  if True, also return statistics about the 
+             requests waiting to be processed (see queue_stats()).
         :return dict:  a dictionary where the keys are identifiers and the values
-             are their corresponding SIP type names.  
+             are their corresponding SIP type names.  If withstats is True, 
+             a 2-tuple is returned containing this dictionary and the 
+             dictionary of statistics.
         """
         out = {}
         stcfg = self.cfg.get('sip_type', {})
         for tp in stcfg.keys():
             if siptype and siptype != tp:
                 continue
-            hndlrcfg = self._get_handler_config(tp)
-            cfg = hndlrcfg.get('status_manager',{})
-            if 'cachedir' not in cfg:
-                cfg['cachedir'] = os.path.join(self.workdir, 'preserv_status')
+            cfg = self._status_config(tp)
             ids = status.SIPStatus.requests(cfg)
             for id in ids:
                 out[id] = tp
 
+        if withstats:
+            return (out, self.queue_stats())
         return out
 
+    def queue_stats(self):
+        """
+        return a dictionary of statistics describing the preservation requests
+        that are waiting to be processed.  This includes:
+        :prop queue_depth int:  the number of requests waiting for a worker
+        :prop running     int:  the number of requests currently being 
+                                 processed by a worker
+        :prop max_workers int:  the maximum number of requests that will be 
+                                 processed at once (None if there is no limit)
+        :prop oldest_wait float:  the number of seconds that the longest 
+                                 waiting request has been queued
+        :prop mean_wait   float:  the average number of seconds that recently
+                                 dispatched requests spent in the queue
+        :prop max_wait    float:  the longest time (in seconds) that a recently
+                                 dispatched request spent in the queue
+
+        This implementation does not queue requests, so it always reports an
+        empty queue.
+        """
+        return OrderedDict([ ('queue_depth', 0), ('running', 0), 
+                             ('max_workers', None), ('completed', 0),
+                             ('oldest_wait', 0.0), ('mean_wait', 0.0),
+                             ('max_wait', 0.0) ])
+
+    def _status_config(self, siptype):
+        # return the status_manager configuration for the given SIP type
+        hndlrcfg = self._get_handler_config(siptype)
+        cfg = hndlrcfg.get('status_manager',{})
+        if 'cachedir' not in cfg:
+            cfg['cachedir'] = os.path.join(self.workdir, 'preserv_status')
+        return cfg
+
 
     def _make_handler(self, sipid, siptype=None, asupdate=False):
         """
@@ -384,16 +431,7 @@ class PreservationService(object):
         """
         if not siptype:
             siptype = self._get_def_siptype()
-        cls = None
-        if siptype == hndlr.MIDASSIPHandler.key or siptype == hndlr.MIDASSIPHandler.name:
-            # key = "midas"
-            cls = hndlr.MIDASSIPHandler
-        elif siptype == hndlr.MIDAS3SIPHandler.key or siptype == hndlr.MIDAS3SIPHandler.name:
-            # key = "midas3"
-            cls = hndlr.MIDAS3SIPHandler
-        else:
-            raise PDRException("SIP type not supported: "+siptype, sys=_sys)
-
+        cls = self._handler_class(siptype)
         pcfg = self._get_handler_config(cls.key)
             
         # get an IDMinter we can use
@@ -406,6 +444,16 @@ class PreservationService(object):
 
         return cls(sipid, pcfg, self.minters[siptype], notifier=self._notifier)
 
+    def _handler_class(self, siptype):
+        # return the SIPHandler class for the given SIP type key or name
+        if siptype == hndlr.MIDASSIPHandler.key or siptype == hndlr.MIDASSIPHandler.name:
+            # key = "midas"
+            return hndlr.MIDASSIPHandler
+        elif siptype == hndlr.MIDAS3SIPHandler.key or siptype == hndlr.MIDAS3SIPHandler.name:
+            # key = "midas3"
+            return hndlr.MIDAS3SIPHandler
+        raise PDRException("SIP type not supported: "+siptype, sys=_sys)
+
     def _get_handler_config(self, siptype):
         # from our service configuration, build a configuration object that
         # can be used to preserve an SIP of a particular type
@@ -545,10 +593,35 @@ class MultiprocPreservationService(PreservationService):
 
     This implementation launches preservation requests via a child process
     (running a standalone bagging script).  
+
+    By default, each request is launched in its own process immediately.  The 
+    number of preservation processes running at once can be limited via the 
+    'scheduler' configuration property, a dictionary that supports the 
+    following sub-properties:
+    :prop max_workers int (0):  the maximum number of preservation processes 
+                             to run at once.  Requests received while all 
+                             workers are busy are queued (with the status 
+                             state, "queued") and are processed as workers 
+                             become available.  A value less than 1 means 
+                             no limit (and no queuing).
+    :prop queue_file str:    the path to the file where the queue of waiting
+                             requests is saved.  By default, this is a file
+                             called "_queue.json" in the status cache 
+                             directory of the default SIP type.
+    :prop update_priority int (0):  the queue priority given to update 
+                             requests relative to requests for initial 
+                             preservation (which have priority 0).  Requests
+                             with a higher priority are processed first.
     """
-    def __init__(self, config):
+    def __init__(self, config, dispatch=True):
         """
         initialize the service based on the given configuration.
+
+        :param dict config:    the service configuration
+        :param bool dispatch:  if True and requests are being queued, start 
+                               any queued requests that there are free workers 
+                               for (e.g. ones left waiting when the service 
+                               was restarted).  
         """
         super(MultiprocPreservationService, self).__init__(config)
         self._oldlogfile = None
@@ -556,6 +629,35 @@ class MultiprocPreservationService(PreservationService):
         self.combinedlog = os.path.join(self.cfg.get('logdir', deflogdir),
                                         self.cfg.get('logfile', 'preservation.log'))
 
+        schcfg = self.cfg.get('scheduler', {})
+        self.max_workers = int(schcfg.get('max_workers', 0))
+        self._queue = None
+        if self.max_workers > 0:
+            qfile = schcfg.get('queue_file')
+            if not qfile:
+                siptype = self._get_def_siptype()
+                if self.siptypes and siptype not in self.siptypes:
+                    siptype = self.siptypes[0]
+                qfile = os.path.join(self._status_config(siptype)['cachedir'],
+                                     QUEUE_FILENAME)
+            self._queue = SIPQueue(qfile)
+
+            if dispatch:
+                try:
+                    with self._queue.transaction():
+                        self._dispatch()
+                except Exception as ex:
+                    log.exception("Failed to start queued preservation requests: %s",
+                                  str(ex))
+
+    def queue_stats(self):
+        if self._queue is None:
+            return super(MultiprocPreservationService, self).queue_stats()
+        with self._queue.transaction():
+            if self._prune_workers():
+                self._dispatch()
+            return self._queue.stats(self.max_workers)
+
     def _pid_is_alive(self, pid):
         if pid <= 0:
             return False
@@ -620,42 +722,14 @@ class MultiprocPreservationService(PreservationService):
             timeout = self.cfg.get('sync_timeout', 5)
 
         proc = None
-        if not sync:
+        if not sync and self._queue is not None:
+            return self._schedule_handler(handler, timeout)
+        elif not sync:
             try:
-                # work out where the log in the subprocess will go
-                hlog = os.path.join(handler.name, midasid_to_bagname(handler.sipid) + ".log")
-                hlogd = handler.cfg.get('logdir')
-                if hlogd:
-                    if not os.path.exists(os.path.join(hlogd, handler.name)):
-                        os.makedirs(os.path.join(hlogd, handler.name))
-                    hlog = os.path.join(hlogd, hlog)
-            
                 # launch a subprocess
-                proc = multiprocessing.Process(target=_subprocess_handle,
-                                               args=(self.cfg, hlog, handler.sipid, handler.name,
-                                                     handler._asupdate, timeout))
-                proc.start()
-                proc.join(timeout)
-                    
-                if not proc.is_alive():
-                    handler.refresh_state()
-                    origstate = handler.state
-                    if handler.state == status.IN_PROGRESS:
-                        handler.set_state(status.FAILED,
-                                     "preservation thread died for unknown reasons")
-                    elif handler.state == status.READY:
-                        handler.set_state(status.FAILED,
-                                 "preservation failed to start for unknown reasons")
-                    if handler.state == status.FAILED:
-                        log.error("%s: preservation process completed synchronously (%s)",
-                                  handler._sipid, origstate)
-                    else:
-                        log.info("%s: preservation completed synchronously (%s)",
-                                 handler._sipid, origstate)
-                else:
-                    log.info("%s: preservation running asynchronously",
-                             handler._sipid)
-                return (handler.status, proc)
+                proc = self._start_worker(handler.sipid, handler.name,
+                                          handler._asupdate, timeout)
+                return self._await_worker(handler, proc, timeout)
 
             except Exception, e:
                 if proc is None:
@@ -670,6 +744,146 @@ class MultiprocPreservationService(PreservationService):
             # this is the child
             self._in_child_handle(handler, sync=True)  # (handles exceptions)
             return (handler.status, None)
+
+    def _handler_logfile(self, sipid, siptype):
+        # work out where the log in the subprocess will go
+        hlog = os.path.join(siptype, midasid_to_bagname(sipid) + ".log")
+        hlogd = self._get_handler_config(self._handler_class(siptype).key).get('logdir')
+        if hlogd:
+            if not os.path.exists(os.path.join(hlogd, siptype)):
+                os.makedirs(os.path.join(hlogd, siptype))
+            hlog = os.path.join(hlogd, hlog)
+        return hlog
+
+    def _start_worker(self, sipid, siptype, asupdate, timeout):
+        # launch a subprocess to preserve the given SIP
+        hlog = self._handler_logfile(sipid, siptype)
+        proc = multiprocessing.Process(target=_subprocess_handle,
+                                       args=(self.cfg, hlog, sipid, siptype,
+                                             asupdate, timeout))
+        proc.start()
+        return proc
+
+    def _schedule_handler(self, handler, timeout):
+        # queue the handler's SIP and start it if a worker slot is free
+        priority = 0
+        if handler._asupdate:
+            priority = int(self.cfg.get('scheduler', {}).get('update_priority', 0))
+
+        proc = None
+        try:
+            with self._queue.transaction():
+                if self._queue.is_running(handler.sipid):
+                    # a worker has already claimed it
+                    log.info("%s: preservation already started", handler.sipid)
+                    return (handler.status, None)
+                self._queue.push(handler.sipid, handler.name, handler._asupdate,
+                                 priority)
+                proc = self._dispatch(timeout).get(handler.sipid)
+                if not proc:
+                    pos = self._queue.position(handler.sipid)
+                    handler._status.queue("Waiting for an available preservation "
+                                          "worker (number {0} in line)".format(pos))
+                    log.info("%s: preservation queued (%d in line)",
+                             handler.sipid, pos)
+        except Exception, e:
+            log.exception("Failed to queue preservation request: %s", str(e))
+            handler.set_state(status.FAILED, "Failed to launch preservation process")
+            return (handler.status, None)
+
+        if not proc:
+            return (handler.status, None)
+        try:
+            return self._await_worker(handler, proc, timeout)
+        except Exception, e:
+            log.exception("Unexpected failure while monitoring "+
+                          "preservation process: %s", str(e))
+            return (handler.status, proc)
+
+    def _prune_workers(self):
+        # unregister dead worker processes, marking their SIPs as failed, and 
+        # return the number unregistered.  This must be called within a queue 
+        # transaction.
+        multiprocessing.active_children()   # reaps finished children
+        died = self._queue.prune(self._pid_is_alive)
+        for ent in died:
+            log.error("%s: preservation process died unexpectedly", ent['id'])
+            try:
+                stat = status.SIPStatus(ent['id'], self._status_config(
+                                    self._handler_class(ent['siptype']).key))
+                if stat.state == status.IN_PROGRESS:
+                    stat.update(status.FAILED,
+                                "preservation process died for unknown reasons")
+            except Exception as ex:
+                log.exception("Unable to update status of SIP=%s: %s",
+                              ent['id'], str(ex))
+        return len(died)
+
+    def _dispatch(self, timeout=None):
+        # start queued SIPs while there are free worker slots, returning a
+        # dictionary of the processes started, keyed by SIP ID.  This must be
+        # called within a queue transaction.
+        self._prune_workers()
+        started = {}
+        while self._queue.free_slots(self.max_workers) > 0:
+            ent = self._queue.pop()
+            if not ent:
+                break
+            try:
+                proc = self._start_worker(ent['id'], ent['siptype'],
+                                          ent.get('asupdate'), timeout)
+            except Exception as ex:
+                log.exception("%s: Failed to launch preservation process: %s",
+                              ent['id'], str(ex))
+                stat = status.SIPStatus(ent['id'], self._status_config(
+                                    self._handler_class(ent['siptype']).key))
+                stat.update(status.FAILED, "Failed to launch preservation process")
+                continue
+            self._queue.add_running(proc.pid, ent, process_token(proc.pid))
+            started[ent['id']] = proc
+        return started
+
+    def _next_queued(self, pid=None):
+        # called by a worker process when it finishes an SIP: release its 
+        # slot and, if there are queued SIPs, claim the next one.
+        if pid is None:
+            pid = os.getpid()
+        with self._queue.transaction():
+            self._queue.finish(pid)
+            pruned = self._prune_workers()
+            if self._queue.free_slots(self.max_workers) < 1:
+                return None
+            ent = self._queue.pop()
+            if ent:
+                self._queue.add_running(pid, ent, process_token(pid))
+                if pruned:
+                    # start workers for the slots freed by dead workers
+                    self._dispatch()
+            return ent
+
+    def _await_worker(self, handler, proc, timeout):
+        # wait up to timeout seconds for the worker process to finish
+        proc.join(timeout)
+
+        if not proc.is_alive():
+            handler.refresh_state()
+            origstate = handler.state
+            if handler.state == status.IN_PROGRESS:
+                handler.set_state(status.FAILED,
+                                  "preservation thread died for unknown reasons")
+            elif handler.state == status.READY:
+                handler.set_state(status.FAILED,
+                                  "preservation failed to start for unknown reasons")
+            if handler.state == status.FAILED:
+                log.error("%s: preservation process completed synchronously (%s)",
+                          handler._sipid, origstate)
+            else:
+                log.info("%s: preservation completed synchronously (%s)",
+                         handler._sipid, origstate)
+        else:
+            log.info("%s: preservation running asynchronously",
+                     handler._sipid)
+        return (handler.status, proc)
                 
 
     def _save_preserv_log(self, sipid, forlog=None):
@@ -736,13 +950,32 @@ class RerequestException(PreservationException):
         self.state = request_state
 
 def _subprocess_handle(config, logfile, sipid, siptype, asupdate, timeout):
+    svc = _subprocess_handle_one(config, logfile, sipid, siptype, asupdate, timeout)
+
+    # if requests are being queued, keep working until the queue is empty
+    if not svc:
+        svc = MultiprocPreservationService(config, False)
+    while svc._queue is not None:
+        try:
+            ent = svc._next_queued()
+        except Exception as ex:
+            log.exception("Failed to retrieve next queued preservation request: %s",
+                          str(ex))
+            break
+        if not ent:
+            break
+        logfile = svc._handler_logfile(ent['id'], ent['siptype'])
+        _subprocess_handle_one(config, logfile, ent['id'], ent['siptype'],
+                               ent.get('asupdate'), timeout)
+
+def _subprocess_handle_one(config, logfile, sipid, siptype, asupdate, timeout):
     svc = None
     shout = config.get('announce_subproc', True)
     try:
         if shout:
             print("{0} preservation process for {1} started".format(siptype, sipid))
         configmod.configure_log(logfile, config=config)
-        svc = MultiprocPreservationService(config)
+        svc = MultiprocPreservationService(config, False)
         handler = svc._make_handler(sipid, siptype, asupdate)
         svc._launch_handler(handler, timeout, sync=True)
     except Exception as ex:
@@ -756,5 +989,6 @@ def _subprocess_handle(config, logfile, sipid, siptype, asupdate, timeout):
     finally:
         if svc:
             svc._save_preserv_log(sipid)
+    return svc
 
 
@@ -14,17 +14,19 @@ as well as how to orchestrate the preservation with the context of a
 controlling process (e.g. a web service).  
 """
 from __future__ import print_function
-import os, sys, re, shutil, logging, errno
+import os, sys, re, shutil, logging, errno, time, threading
+from multiprocessing.pool import ThreadPool
 from abc import ABCMeta, abstractmethod, abstractproperty
 from collections import OrderedDict
 from copy import deepcopy
 
-from ..bagit.serialize import DefaultSerializer
+from ..bagit.serialize import DefaultSerializer, BandwidthLimiter
 from ..bagit.bag import NISTBag
 from ..bagit.validate import NISTAIPValidator
 from ..bagit.multibag import MultibagSplitter, restore_bag
 from ..bagger import utils as bagutils
 from ..bagger.base import checksum_of
+from ..checksum import ChecksumEngine
 from ..bagger.midas import PreservationBagger, midasid_to_bagname, _midadid_to_dirname
 from ..bagger.midas3 import PreservationBagger as PreservationM3Bagger 
 from .. import (ConfigurationException, StateException, PODError, PreservationException, 
@@ -61,6 +63,27 @@ class SIPHandler(object):
                                  the sub-property 'cachedir' will be set to
                                  a directory call 'preserv_status' just below
                                  the working directory ('working_dir').  
+    :prop checksum dict ({}):    configuration properties for the 
+                                 ChecksumEngine used to calculate checksums
+                                 of the serialized bags (see 
+                                 nistoar.pdr.preserv.checksum).
+    :prop serialization dict ({}):  properties controlling how the bags making
+                                 up an AIP are serialized, including:
+                                   workers int (1): the maximum number of 
+                                     member bags to serialize concurrently
+                                   max_bytes_per_sec int: a cap on the 
+                                     aggregate rate at which bags are read 
+                                     while serializing (for formats that 
+                                     support it).
+    :prop delivery dict ({}):    properties controlling how the serialized 
+                                 bags are delivered to long-term storage, 
+                                 including:
+                                   workers int (1): the maximum number of 
+                                     files to copy concurrently
+                                   verify bool (True): if True, the checksum
+                                     of each delivered bag (calculated while 
+                                     it is copied) is compared with the one
+                                     calculated at serialization.
     """
     __metaclass__ = ABCMeta
 
@@ -124,6 +147,8 @@ class SIPHandler(object):
         # set the notification service we can send alerts to
         self.notifier = notifier
 
+        self._csengine = ChecksumEngine(self.cfg.get('checksum', {}))
+
     @abstractmethod
     def isready(self, _inprogress=False):
         """
@@ -131,12 +156,13 @@ class SIPHandler(object):
         processed into an AIP.  If it is not ready, return False.
 
         Implementations should first call this inherited version which ensures 
-        that the current status is either FORGOTTEN, PENDING, or READY.  False
+        that the current status is either FORGOTTEN, PENDING, QUEUED, or READY.  False
         is returned if this is not true, and the child implementation should not 
         proceed.  The child implementation should then do a quick check that the
         input data exists and appears to be in a state ready for preservation.  
         """
-        ok = [status.FORGOTTEN, status.PENDING, status.READY, status.NOT_READY]
+        ok = [status.FORGOTTEN, status.PENDING, status.QUEUED, status.READY,
+              status.NOT_READY]
         if _inprogress:
             ok.append(status.IN_PROGRESS)
         if self._asupdate:
@@ -211,6 +237,17 @@ class SIPHandler(object):
         """
         self._status.update(state, message, cache)
 
+    def _progress_reporter(self, label):
+        # return a function that records byte-level progress to the status;
+        # the percentage complete is calculated from the byte counts unless
+        # it is given explicitly.
+        def report(done, total, pct=None):
+            if pct is None:
+                pct = (total and int(100.0 * done / total)) or 100
+            self._status.record_progress("{0}: {1}% ({2} of {3} bytes)"
+                                         .format(label, pct, done, total))
+        return report
+
     def _serialize(self, bagdir, destdir, format=None):
         """
         serialize a given bag into a given destination directory.
@@ -224,41 +261,59 @@ class SIPHandler(object):
                                 If not provided a default serialization 
                                 will be applied (as given in the configuration).
         """
-        srcbags = [ bagdir ]
-
-        # split the bag if it exceed size limits
-        mbcfg = self.cfg.get('multibag', {})
-        maxhbsz = mbcfg.get('max_headbag_size', mbcfg.get('max_bag_size'))
-        if maxhbsz:
-            log.info("Considering multibagging (max size: %d)", maxhbsz)
-            mbspltr = MultibagSplitter(bagdir, mbcfg)
-
-            # check the size of the source bag and split it if it exceeds
-            # limits.  
-            srcbags = mbspltr.check_and_split(os.path.dirname(bagdir), log)
-
-            # TODO: Run NIST validator on output files
-        elif not mbcfg:
-            log.warning("multibag splitting not configured")
-            
+        srcbags = self._split_bag(bagdir)
+
+        sercfg = self.cfg.get('serialization', {})
+        workers = max(1, min(int(sercfg.get('workers', 1)), len(srcbags)))
+        throttle = None
+        if sercfg.get('max_bytes_per_sec'):
+            throttle = BandwidthLimiter(int(sercfg['max_bytes_per_sec']))
+
+        # aggregate the progress of the concurrently serialized bags.  Each
+        # member's serializer reports its total size when it starts; as those
+        # of members that have not started yet are unknown, the overall 
+        # percentage weighs each member equally so that it never goes down.
+        report = self._progress_reporter("Serializing")
+        progress = {}
+        plock = threading.Lock()
+        def member_reporter(bagd):
+            def rpt(done, total):
+                with plock:
+                    progress[bagd] = (done, total)
+                    frac = sum([(float(d) / t if t else 1.0)
+                                for d, t in progress.values()]) / len(srcbags)
+                    report(sum([p[0] for p in progress.values()]),
+                           sum([p[1] for p in progress.values()]),
+                           int(100.0 * frac))
+            return rpt
+
+        def serialize_member(bagd):
+            return self._serialize_member(bagd, destdir, format,
+                                          member_reporter(bagd), throttle)
+
+        if workers > 1:
+            log.info("Serializing %d bags using %d workers", len(srcbags), workers)
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(serialize_member, srcbags, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [serialize_member(bagd) for bagd in srcbags]
 
         self._status.data['user']['bagfiles'] = []
         outfiles = []
-        for bagd in srcbags:
-            bagfile = self._ser.serialize(bagd, destdir, format)
-            outfiles.append(bagfile)
-
-            csumfile = bagfile + ".sha256"
-            csum = checksum_of(bagfile)
-            with open(csumfile, 'w') as fd:
-                fd.write(csum)
-                fd.write('\n')
-            outfiles.append(csumfile)
-
-            # write the checksum to our status object
+        for res in results:
+            outfiles.extend([res['bagfile'], res['csumfile']])
+
+            # write the checksum and timing to our status object
             self._status.data['user']['bagfiles'].append({
-                'name': os.path.basename(bagfile),
-                'sha256': csum
+                'name': os.path.basename(res['bagfile']),
+                'sha256': res['sha256'],
+                'size': res['size'],
+                'serialize_time': res['serialize_time'],
+                'checksum_time': res['checksum_time']
             })
 
         self._status.cache()
@@ -273,6 +328,49 @@ class SIPHandler(object):
         
         return outfiles
 
+    def _split_bag(self, bagdir):
+        # split the bag if it exceeds size limits, returning the list of bag 
+        # directories to serialize
+        mbcfg = self.cfg.get('multibag', {})
+        maxhbsz = mbcfg.get('max_headbag_size', mbcfg.get('max_bag_size'))
+        if maxhbsz:
+            log.info("Considering multibagging (max size: %d)", maxhbsz)
+            mbspltr = MultibagSplitter(bagdir, mbcfg)
+
+            # check the size of the source bag and split it if it exceeds
+            # limits.  
+            # TODO: Run NIST validator on output files
+            return mbspltr.check_and_split(os.path.dirname(bagdir), log)
+        elif not mbcfg:
+            log.warning("multibag splitting not configured")
+
+        return [ bagdir ]
+
+    def _serialize_member(self, bagdir, destdir, format=None, progress=None,
+                          throttle=None):
+        # serialize a single bag and write its checksum file, returning a 
+        # dictionary describing the outputs and how long it took to create them
+        start = time.time()
+        bagfile = self._ser.serialize(bagdir, destdir, format, progress=progress,
+                                      throttle=throttle)
+        sertime = time.time() - start
+
+        # Note: natively serialized bags have their checksums cached
+        start = time.time()
+        csumfile = bagfile + ".sha256"
+        csum = self._csengine.checksum_of(bagfile)
+        with open(csumfile, 'w') as fd:
+            fd.write(csum)
+            fd.write('\n')
+        cstime = time.time() - start
+
+        log.info("Serialized %s in %.1f s (checksum: %.1f s)",
+                 os.path.basename(bagfile), sertime, cstime)
+        return { 'bagfile': bagfile, 'csumfile': csumfile, 'sha256': csum,
+                 'size': os.stat(bagfile).st_size,
+                 'serialize_time': round(sertime, 3),
+                 'checksum_time': round(cstime, 3) }
+
     def _serialize_restricted(self, headbagdir, aipid, destdir, format=None, workdir=None):
         """
         serialize a given bag for distribution through the restricted public gateway.
@@ -319,7 +417,8 @@ class SIPHandler(object):
             if not baseurl:
                 raise ConfigurationException("Missing required repo_access.distrib property: "+
                                              "service_endpoint")
-            bagcli = distrib.BagDistribClient(aipid, distrib.RESTServiceClient(baseurl))
+            bagcli = distrib.BagDistribClient(aipid, distrib.RESTServiceClient(baseurl,
+                                             self.cfg['repo_access']['distrib_service']))
 
         def fetch(bagname, destd):
             bagfile = "%s.%s" % (bagname, format)
@@ -336,9 +435,10 @@ class SIPHandler(object):
 
         restore_bag(headbagdir, outbag, destdir, fetch)
 
-        bagfile = self._ser.serialize(outbag, destdir, format)
+        bagfile = self._ser.serialize(outbag, destdir, format, progress=
+                                      self._progress_reporter("Serializing "+outbagname))
         csumfile = bagfile + ".sha256"
-        csum = checksum_of(bagfile)
+        csum = self._csengine.checksum_of(bagfile)
         with open(csumfile, 'w') as fd:
             fd.write(csum)
             fd.write('\n')
@@ -352,6 +452,146 @@ class SIPHandler(object):
         
         return [bagfile, csumfile]
 
+    def _deliver(self, savefiles, destdir):
+        """
+        copy the given preservation artifacts--serialized bags and their 
+        checksum files--into long-term storage.  Each file is first written 
+        under a temporary name and renamed into place only after it has been 
+        completely copied (and, for a bag, its checksum has been verified); 
+        thus, a file in long-term storage with a final name is always 
+        complete.  The bags are delivered before their checksum files.  If 
+        any file fails to be delivered, files already delivered are removed, 
+        the state is set to FAILED, and a PreservationException is raised.
+
+        :param list savefiles:  the paths to the files to deliver
+        :param str    destdir:  the directory to deliver the files to
+        :return list:  the paths of the delivered files in destdir
+        """
+        dlcfg = self.cfg.get('delivery', {})
+        verify = dlcfg.get('verify', True)
+        alg = self._csengine.algorithm
+
+        # the checksums recorded at serialization time, keyed by bag file
+        expected = {}
+        if verify and alg == "sha256":
+            for f in savefiles:
+                if f.endswith(".sha256") and f[:-len(".sha256")] in savefiles:
+                    with open(f) as fd:
+                        expected[f[:-len(".sha256")]] = (fd.read().split() or [''])[0]
+
+        bagfiles = [f for f in savefiles if not f.endswith(".sha256")]
+        csumfiles = [f for f in savefiles if f.endswith(".sha256")]
+        total = sum([os.stat(f).st_size for f in savefiles])
+        report = self._progress_reporter("Delivering preservation artifacts")
+        progress = [0]
+        plock = threading.Lock()
+
+        # every file renamed into place (for rolling back) and the first failure;
+        # once a delivery fails, no other (in-flight) file gets renamed into place
+        placed = []
+        failures = []
+
+        def deliver(f):
+            destfile = os.path.join(destdir, os.path.basename(f))
+            tmpfile = os.path.join(destdir, "."+os.path.basename(f)+".tmp")
+            try:
+                sums = self._csengine.copy_file(f, tmpfile, [alg])
+                if f in expected and sums[alg] != expected[f]:
+                    raise IOError(errno.EIO, "Checksum mismatch after copy", destfile)
+                with plock:
+                    if failures:
+                        raise IOError(errno.ECANCELED, "Delivery aborted", destfile)
+                    os.rename(tmpfile, destfile)
+                    placed.append(destfile)
+            except Exception as ex:
+                with plock:
+                    failures.append(ex)
+                raise
+            finally:
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+            with plock:
+                progress[0] += os.stat(destfile).st_size
+                report(progress[0], total)
+            return destfile
+
+        log.debug("writing files to %s", destdir)
+        workers = max(1, min(int(dlcfg.get('workers', 1)), len(bagfiles)))
+        saved = []
+        start = time.time()
+        f = None
+        try:
+            for f in savefiles:
+                destfile = os.path.join(destdir, os.path.basename(f))
+
+                # (Note: can overwrite restricted-public artifacts)
+                if os.path.exists(destfile) and \
+                   not self.cfg.get('allow_bag_overwrite', False) and \
+                   bagutils.is_legal_bag_name(re.sub(r'.sha256$', '', os.path.basename(f))):
+                    raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), destfile)
+            f = None
+
+            if workers > 1:
+                log.info("Delivering %d bags using %d workers", len(bagfiles), workers)
+                pool = ThreadPool(workers)
+                try:
+                    for destfile in pool.imap_unordered(deliver, bagfiles):
+                        saved.append(destfile)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for f in bagfiles:
+                    saved.append(deliver(f))
+            for f in csumfiles:
+                saved.append(deliver(f))
+
+        except (OSError, IOError) as ex:
+            if failures:
+                # report the original failure rather than a cancellation
+                ex = failures[0]
+            log.error("Failed to copy preservation file: %s\n" +
+                      "  to long-term storage: %s", 
+                      f or getattr(ex, 'filename', None), destdir)
+            log.exception("Reason: %s", str(ex))
+            log.error("Rolling back successfully copied files")
+            msg = "Failed to copy preservation files to long-term storage"
+            self.set_state(status.FAILED, msg)
+
+            for fp in placed:
+                if os.path.exists(fp):
+                    log.warn("Removing %s from long-term storage", os.path.basename(fp))
+                    os.remove(fp)
+
+            raise PreservationException(msg, [str(ex)])
+
+        dltime = time.time() - start
+        rate = (dltime > 0 and int(total / dltime)) or total
+        self._status.data['user']['delivery'] = OrderedDict([
+            ('bytes', total), ('files', len(saved)),
+            ('delivery_time', round(dltime, 3)), ('bytes_per_sec', rate)
+        ])
+        self._status.record_progress("Delivered {0} bytes to long-term storage "
+                                     "({1} bytes/s)".format(total, rate))
+        log.info("Delivered %d files (%d bytes) in %.1f s (%d bytes/s)",
+                 len(saved), total, dltime, rate)
+
+        self._invalidate_bag_info(bagfiles)
+        return saved
+
+    def _invalidate_bag_info(self, bagfiles):
+        """
+        forget any cached distribution service listings for the AIPs that 
+        the given bags belong to, as they are now out of date.
+        """
+        dscfg = self.cfg.get('repo_access', {}).get('distrib_service')
+        cache = dscfg and distrib.bag_info_cache_for(dscfg)
+        if not cache:
+            return
+        for aipid in set([bagutils.parse_bag_name(os.path.basename(f))[0]
+                          for f in bagfiles if bagutils.is_legal_bag_name(os.path.basename(f))]):
+            cache.invalidate(aipid)
+
     def _is_ingested(self):
         """
         return True if some version of this SIP has been ingested into the PDR already.
@@ -631,37 +871,7 @@ class MIDASSIPHandler(SIPHandler):
             if nerdm.get('accessLevel', 'public') != 'public':
                 destdir = self.cfg['restricted_store_dir']
         self._status.record_progress("Delivering preservation artifacts")
-        log.debug("writing files to %s", destdir)
-        errors = []
-        saved = []
-        try:
-            for f in savefiles:
-                destfile = os.path.join(destdir, os.path.basename(f))
-
-                # (Note: can overwrite restricted-public artifacts)
-                if os.path.exists(destfile) and \
-                   not self.cfg.get('allow_bag_overwrite', False) and \
-                   bagutils.is_legal_bag_name(re.sub(r'.sha256$', '', os.path.basename(f))):
-                    raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), destfile)
-                                  
-                shutil.copy(f, destdir)
-                saved.append(f)
-
-        except OSError, ex:
-            log.error("Failed to copy preservation file: %s\n" +
-                      "  to long-term storage: %s", f, destdir)
-            log.exception("Reason: %s", str(ex))
-            log.error("Rolling back successfully copied files")
-            msg = "Failed to copy preservation files to long-term storage"
-            self.set_state(status.FAILED, msg)
-
-            for f in saved:
-                fp = os.path.join(destdir, os.path.basename(f))
-                if os.path.exists(fp):
-                    log.warn("Removing %s from long-term storage", f)
-                    os.remove(fp)
-
-            raise PreservationException(msg, [str(ex)])
+        self._deliver(savefiles, destdir)
 
         # Now write copies of the checksum files to the review SIP dir.
         # MIDAS will scoop these up and save them in its database.
@@ -1094,34 +1304,7 @@ class MIDAS3SIPHandler(SIPHandler):
             if nerdm.get('accessLevel', 'public') != 'public':
                 destdir = self.cfg['restricted_store_dir']
         self._status.record_progress("Delivering preservation artifacts")
-        log.debug("writing files to %s", destdir)
-        errors = []
-        saved = []
-        try:
-            for f in savefiles:
-                destfile = os.path.join(destdir, os.path.basename(f))
-                if os.path.exists(destfile) and \
-                   not self.cfg.get('allow_bag_overwrite', False) and \
-                   bagutils.is_legal_bag_name(re.sub(r'.sha256$', '', os.path.basename(f))):
-                    raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), destfile)
-
-                shutil.copy(f, destdir)
-                saved.append(f)
-        except OSError, ex:
-            log.error("Failed to copy preservation file: %s\n" +
-                      "  to long-term storage: %s", f, destdir)
-            log.exception("Reason: %s", str(ex))
-            log.error("Rolling back successfully copied files")
-            msg = "Failed to copy preservation files to long-term storage"
-            self.set_state(status.FAILED, msg)
-
-            for f in saved:
-                fp = os.path.join(destdir, os.path.basename(f))
-                if os.path.exists(fp):
-                    log.warn("Removing %s from long-term storage", f)
-                    os.remove(fp)
-
-            raise PreservationException(msg, [str(ex)])
+        self._deliver(savefiles, destdir)
 
         if nerdm.get('status', 'available') == "removed":
             # This dataset needs to be "deactivated": make this version and previous minor versions
@@ -1274,7 +1457,7 @@ class MIDAS3SIPHandler(SIPHandler):
         distsvc = None
         scfg = baggercfg.get('repo_access',{}).get('distrib_service',{})
         if scfg:
-            distsvc = distrib.RESTServiceClient(scfg.get('service_endpoint'))
+            distsvc = distrib.RESTServiceClient(scfg.get('service_endpoint'), scfg)
             distsvc = distrib.BagDistribClient(aipid, distsvc)
         else:
             log.warn("No access to remote long-term storage for deactivating bag files: " +
@@ -1,8 +1,15 @@
 """
 This module provides tools for managing and retrieving the status of a 
 preservation efforts across multiple processes.  
+
+By default, the status of each SIP is cached to its own JSON file in a cache 
+directory.  Alternatively (by setting the status_manager's "backend" 
+configuration parameter to "sqlite"), the status data can be kept in an SQLite 
+database in the cache directory (see SQLiteStatusStore) which supports efficient 
+queries by state and update time (see SIPStatus.query()).  Existing JSON status 
+files can be loaded into the database with migrate_status_files().
 """
-import json, os, time, fcntl, re, time, warnings
+import json, os, time, fcntl, re, time, warnings, sqlite3
 from collections import OrderedDict
 from copy import deepcopy
 
@@ -14,13 +21,14 @@ NOT_FOUND   = "not found"
 READY       = "ready"
 NOT_READY   = "not ready"
 PENDING     = "pending"
+QUEUED      = "queued"
 IN_PROGRESS = "in progress"
 SUCCESSFUL  = "successful"
 FAILED      = "failed"
 CONFLICT    = "conflict"     # wrong state
 FORGOTTEN   = "forgotten"
 
-states = [ NOT_FOUND, READY, NOT_READY, PENDING, 
+states = [ NOT_FOUND, READY, NOT_READY, PENDING, QUEUED,
            IN_PROGRESS, SUCCESSFUL, FAILED, FORGOTTEN, CONFLICT ]
 
 user_message = {
@@ -28,6 +36,7 @@ user_message = {
     READY:       "Data is available for preservation",
     NOT_READY:   "Data found appears not ready for preservation",
     PENDING:     "Preservation requested, will start shortly",
+    QUEUED:      "Preservation requested, waiting for an available worker",
     IN_PROGRESS: "Preservation processing in progress",
     SUCCESSFUL:  "Data was successfully preserved",
     FAILED:      "Data preservation failed due to internal errors",
@@ -180,6 +189,214 @@ def _write_status(filepath, data):
                              +filepath+": "+str(ex), cause=ex,
                              sys=preservsys)
 
+class SQLiteStatusStore(object):
+    """
+    a store for SIP status data kept in an SQLite database.  The state and update 
+    time of each SIP are indexed, allowing SIPs to be listed by state and time 
+    without loading their full status data.
+
+    The database is opened in WAL mode so that readers do not block the (single) 
+    writer; each operation uses its own short-lived connection, making it safe to use 
+    the store from multiple processes (including forked preservation workers) at once.  
+    Note that SQLite databases should not be placed on a network file system.  
+    """
+    DEF_DBFILE = "_status.sqlite"
+    _initialized = set()    # databases known to be set up by this process
+
+    def __init__(self, dbfile, timeout=30.0):
+        """
+        open the store, creating the database if necessary
+        :param str dbfile:     the path to the database file
+        :param float timeout:  the number of seconds to wait for another process's
+                               write to finish
+        """
+        self.dbfile = dbfile
+        self.timeout = timeout
+        if dbfile in self._initialized and os.path.exists(dbfile):
+            return
+
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS sipstatus ("
+                             "id TEXT PRIMARY KEY, state TEXT, update_time REAL, "
+                             "data TEXT NOT NULL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS sipstatus_state "
+                             "ON sipstatus (state, update_time)")
+                conn.execute("CREATE INDEX IF NOT EXISTS sipstatus_time "
+                             "ON sipstatus (update_time)")
+        except sqlite3.Error as ex:
+            raise StateException("Can't initialize preservation status database: "
+                                 +self.dbfile+": "+str(ex), cause=ex,
+                                 sys=preservsys)
+        finally:
+            conn.close()
+        self._initialized.add(dbfile)
+
+    def _connect(self):
+        try:
+            return sqlite3.connect(self.dbfile, timeout=self.timeout)
+        except sqlite3.Error as ex:
+            raise StateException("Can't open preservation status database: "
+                                 +self.dbfile+": "+str(ex), cause=ex,
+                                 sys=preservsys)
+
+    def _execute(self, sql, params=(), write=False):
+        conn = self._connect()
+        try:
+            if write:
+                with conn:
+                    return conn.execute(sql, params).rowcount
+            return conn.execute(sql, params).fetchall()
+        except sqlite3.Error as ex:
+            raise StateException("Preservation status database error: "
+                                 +self.dbfile+": "+str(ex), cause=ex,
+                                 sys=preservsys)
+        finally:
+            conn.close()
+
+    def get(self, id):
+        """
+        return the status data for the SIP with the given identifier or None if 
+        the store has no data for it.
+        """
+        rows = self._execute("SELECT data FROM sipstatus WHERE id=?", (id,))
+        if not rows:
+            return None
+        return json.loads(rows[0][0], object_pairs_hook=OrderedDict)
+
+    def put(self, id, data):
+        """
+        save the status data for the SIP with the given identifier
+        """
+        user = data.get('user', {})
+        self._execute("INSERT OR REPLACE INTO sipstatus (id, state, update_time, data) "
+                      "VALUES (?, ?, ?, ?)",
+                      (id, user.get('state'), user.get('update_time'), json.dumps(data)),
+                      True)
+
+    def delete(self, id):
+        """
+        remove the status data for the SIP with the given identifier
+        """
+        self._execute("DELETE FROM sipstatus WHERE id=?", (id,), True)
+
+    def _where(self, state=None, since=None, before=None):
+        cond = []
+        params = []
+        if state:
+            if isinstance(state, (str, unicode)):
+                state = [state]
+            cond.append("state IN (" + ",".join(["?"]*len(state)) + ")")
+            params.extend(state)
+        if since is not None:
+            cond.append("update_time >= ?")
+            params.append(since)
+        if before is not None:
+            cond.append("update_time < ?")
+            params.append(before)
+        if cond:
+            return " WHERE " + " AND ".join(cond), params
+        return "", params
+
+    def query(self, state=None, since=None, before=None, limit=None, offset=0):
+        """
+        return a summary of the status of SIPs matching the given constraints, 
+        ordered from most to least recently updated.  
+
+        :param state:         if provided, include only SIPs in this state (or in one of
+                              the states in a given list)
+        :param float since:   if provided, include only SIPs updated at or after 
+                              this time (in epoch seconds)
+        :param float before:  if provided, include only SIPs updated before this time
+        :param int limit:     the maximum number of SIPs to return (None for no limit)
+        :param int offset:    the number of matching SIPs to skip over (for paging)
+        :return list:  a list of dictionaries with "id", "state", and "update_time" 
+                       properties
+        """
+        where, params = self._where(state, since, before)
+        sql = "SELECT id, state, update_time FROM sipstatus" + where + \
+              " ORDER BY update_time DESC, id"
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend([-1 if limit is None else limit, offset])
+        return [OrderedDict([("id", r[0]), ("state", r[1]), ("update_time", r[2])])
+                for r in self._execute(sql, params)]
+
+    def count(self, state=None, since=None, before=None):
+        """
+        return the number of SIPs matching the given constraints (see query())
+        """
+        where, params = self._where(state, since, before)
+        return self._execute("SELECT COUNT(*) FROM sipstatus"+where, params)[0][0]
+
+    def ids(self):
+        """
+        return the identifiers of all SIPs in the store
+        """
+        return [r[0] for r in self._execute("SELECT id FROM sipstatus ORDER BY id")]
+
+def status_store_for(config):
+    """
+    return the status store indicated by the given status_manager configuration, or 
+    None if the status should be cached to individual JSON files.  
+    """
+    if config.get('backend', 'json') != 'sqlite':
+        return None
+    cachedir = config.get('cachedir', '/tmp/sipstatus')
+    if not os.path.exists(cachedir):
+        try:
+            os.mkdir(cachedir)
+        except Exception as ex:
+            raise StateException("Can't create preservation status dir: "
+                                 +cachedir+": "+str(ex), cause=ex,
+                                 sys=preservsys)
+    return SQLiteStatusStore(os.path.join(cachedir,
+                                          config.get('dbfile', SQLiteStatusStore.DEF_DBFILE)))
+
+def migrate_status_files(config, remove=False, log=None):
+    """
+    load the SIP status data cached as JSON files in the configured cache 
+    directory into the SQLite status database.  Data for an SIP already in the 
+    database is replaced only if the file's data is more recent.  
+
+    :param dict config:  the status_manager configuration; the backend parameter 
+                         is ignored (the database is always used)
+    :param bool remove:  if True, remove each file once its data is loaded
+    :param Logger log:   if provided, log the progress to this logger
+    :return int:  the number of SIPs loaded into the database
+    """
+    config = dict(config)
+    config['backend'] = 'sqlite'
+    store = status_store_for(config)
+    cachedir = config.get('cachedir', '/tmp/sipstatus')
+
+    n = 0
+    for fname in sorted(os.listdir(cachedir)):
+        if fname.startswith('_') or fname.startswith('.') or not fname.endswith('.json'):
+            continue
+        filepath = os.path.join(cachedir, fname)
+        try:
+            data = _read_status(filepath)
+        except (IOError, ValueError) as ex:
+            if log:
+                log.warning("%s: skipping unreadable status file: %s", fname, str(ex))
+            continue
+        id = os.path.splitext(fname)[0]
+
+        current = store.get(id)
+        if not current or current['user'].get('update_time', 0) < \
+                          data['user'].get('update_time', 0):
+            store.put(id, data)
+            n += 1
+            if log:
+                log.debug("%s: migrated status", id)
+        if remove:
+            os.remove(filepath)
+
+    return n
+
 class SIPStatus(object):
     """
     a class that represents the status of an SIP process effort (for 
@@ -199,7 +416,11 @@ class SIPStatus(object):
         :param config str:   the configuration data to apply.  If not provided
                              defaults will be used; in particular, the status
                              data will be cached to /tmp (intended only for 
-                             testing purposes).
+                             testing purposes).  Supported parameters include
+                             "cachedir", the directory to cache the data to, 
+                             and "backend", the type of cache:  either "json" 
+                             (default), for one JSON file per SIP, or "sqlite", 
+                             for a shared database (see SQLiteStatusStore).
         :param sysdata dict: if not None, include this data as system data
         :param _data dict:   initialize the status with this data.  This is 
                              not intended for public use.   
@@ -211,11 +432,17 @@ class SIPStatus(object):
         cachedir = config.get('cachedir', '/tmp/sipstatus')
         fbase = re.sub(r'^ark:/\d+/', '', id)
         self._cachefile = os.path.join(cachedir, fbase + ".json")
+        self._store = status_store_for(config)
+        self._storeid = fbase
+
+        cached = None
+        if not _data:
+            cached = self._read_cache()
 
         if _data:
             self._data = deepcopy(_data)
-        elif os.path.exists(self._cachefile):
-            self._data = read_json(self._cachefile)
+        elif cached:
+            self._data = cached
         else:
             self._data = OrderedDict([
                 ('sys', {}),
@@ -248,8 +475,8 @@ class SIPStatus(object):
         """
         the SIP's status state.  
 
-        :return str:  one of NOT_FOUND, READY, PENDING, IN_PROGRESS, SUCCESSFUL,
-                      FAILED, FORGOTTEN
+        :return str:  one of NOT_FOUND, READY, PENDING, QUEUED, IN_PROGRESS, 
+                      SUCCESSFUL, FAILED, FORGOTTEN
         """
         return self._data['user']['state']
 
@@ -263,10 +490,23 @@ class SIPStatus(object):
         """
         return self._data
 
+    def _read_cache(self):
+        if self._store:
+            return self._store.get(self._storeid)
+        if os.path.exists(self._cachefile):
+            return read_json(self._cachefile)
+        return None
+
     def cache(self):
         """
-        cache the data to a JSON file on disk
+        cache the data to disk
         """
+        if self._store:
+            self._data['user']['update_time'] = time.time()
+            self._data['user']['updated'] = time.asctime()
+            self._store.put(self._storeid, self._data)
+            return
+
         if not os.path.exists(self._cachefile):
             cachedir = os.path.dirname(self._cachefile)
             if not os.path.exists(cachedir):
@@ -335,6 +575,19 @@ class SIPStatus(object):
         self._data['user']['started'] = time.asctime()
         self.update(IN_PROGRESS, message)
 
+    def queue(self, message=None):
+        """
+        Record the time the SIP was queued for processing and change the 
+        state to QUEUED.
+
+        :param message str:  an optional message for display to the end user
+                             explaining this state.  If not provided, a default
+                             explanation is set. 
+        """
+        self._data['user']['queue_time'] = time.time()
+        self._data['user']['queued'] = time.asctime()
+        self.update(QUEUED, message)
+
     def record_progress(self, message):
         """
         Update the status with a user-oriented message.  The state will be 
@@ -347,8 +600,9 @@ class SIPStatus(object):
         """
         Read the cached status data and replace the data in memory.
         """
-        if os.path.exists(self._cachefile):
-            self._data = read_json(self._cachefile)
+        cached = self._read_cache()
+        if cached:
+            self._data = cached
 
     def user_export(self):
         """
@@ -381,7 +635,50 @@ class SIPStatus(object):
         """
         return a list of SIP IDs for which there exist status information
         """
+        store = status_store_for(config)
+        if store:
+            return store.ids()
+
         cachedir = config.get('cachedir', '/tmp/sipstatus')
         return [ os.path.splitext(id)[0] for id in os.listdir(cachedir)
                                          if not id.startswith('_') and
                                             not id.startswith('.')          ]
+
+    @classmethod
+    def query(cls, config, state=None, since=None, before=None, limit=None, offset=0):
+        """
+        return a summary of the status of SIPs matching the given constraints, 
+        ordered from most to least recently updated.  This is efficient when the 
+        "sqlite" backend is configured; otherwise, every status file must be read.
+
+        :param dict config:   the status_manager configuration
+        :param state:         if provided, include only SIPs in this state (or in one of
+                              the states in a given list)
+        :param float since:   if provided, include only SIPs updated at or after 
+                              this time (in epoch seconds)
+        :param float before:  if provided, include only SIPs updated before this time
+        :param int limit:     the maximum number of SIPs to return (None for no limit)
+        :param int offset:    the number of matching SIPs to skip over (for paging)
+        :return list:  a list of dictionaries with "id", "state", and "update_time" 
+                       properties
+        """
+        store = status_store_for(config)
+        if store:
+            return store.query(state, since, before, limit, offset)
+
+        if isinstance(state, (str, unicode)):
+            state = [state]
+        out = []
+        for id in cls.requests(config):
+            user = cls(id, config).data['user']
+            uptime = user.get('update_time')
+            if (state and user['state'] not in state) or \
+               (since is not None and (uptime is None or uptime < since)) or \
+               (before is not None and (uptime is None or uptime >= before)):
+                continue
+            out.append(OrderedDict([("id", id), ("state", user['state']),
+                                    ("update_time", uptime)]))
+        out.sort(key=lambda s: (-(s['update_time'] or 0), s['id']))
+        if limit is None:
+            return out[offset:]
+        return out[offset:offset+limit]
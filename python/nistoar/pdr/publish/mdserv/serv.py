@@ -19,6 +19,7 @@ from ....nerdm import validate_nerdm
 from ....nerdm.convert import Res2PODds
 from .... import pdr
 from . import midasclient as midas
+from ..nerdcache import NERDmRecordCache, DEF_MAX_RECORDS
 
 log = logging.getLogger(PublishSystem().subsystem_abbrev)
 DEF_MERGE_CONV = "midas1"
@@ -55,6 +56,10 @@ class PrePubMetadataService(PublishSystem):
     :prop bagger dict ({}):  a dictionary for configuring the SIPBagger instance
                       used to process the SIP (see SIPBagger implementation 
                       documentation for supported sub-properties).  
+    :prop record_cache_size int (50):  the maximum number of assembled NERDm 
+                      records to hold in memory; a cached record is served 
+                      until the dataset's SIP directories or metadata bag 
+                      change.  A value of 0 turns off caching.
     """
 
     def __init__(self, config, workdir=None, reviewdir=None, uploaddir=None,
@@ -149,6 +154,8 @@ class PrePubMetadataService(PublishSystem):
             self._midascl = midas.MIDASClient(ucfg.get('midas_service', {}),
                                          logger=self.log.getChild('midasclient'))
 
+        self._reccache = NERDmRecordCache(self.cfg.get('record_cache_size', DEF_MAX_RECORDS))
+
     def _create_minter(self, parentdir):
         cfg = self.cfg.get('id_minter', {})
         out = PDRMinter(parentdir, cfg)
@@ -304,14 +311,30 @@ class PrePubMetadataService(PublishSystem):
             # Not previously published
             raise IDNotFound(id, "No data found for identifier: "+id)
 
-        # There is a MIDAS submission in progress; create/update the 
-        # metadata bag.
+        # There is a MIDAS submission in progress; if neither it nor the 
+        # metadata bag has changed since we last assembled the record, serve
+        # that one.
+        out = self._reccache.get(normid)
+        if out is not None:
+            self.log.debug("Serving cached record for id=%s", normid)
+            if bagger.bagbldr:
+                bagger.bagbldr.disconnect_logfile()
+            return out
+
+        # create/update the metadata bag.  (The submission is stamped before
+        # it is examined so that any changes made while it is being examined
+        # will be noticed next time.)
+        stamps = self._reccache.stamp(bagger.input_dirs)
         bagger = self.prepare_metadata_bag(id, bagger)
+        stamps.update(self._reccache.stamp([os.path.join(bagger.bagdir, "metadata")]))
         if bagger.fileExaminer:
             bagger.fileExaminer.launch(stop_logging=True)
         elif bagger.bagbldr:
             bagger.bagbldr.disconnect_logfile()
-        return self.make_nerdm_record(bagger.bagdir, bagger.datafiles)
+
+        out = self.make_nerdm_record(bagger.bagdir, bagger.datafiles)
+        self._reccache.put(normid, out, stamps)
+        return out
 
     def patch_id(self, id, frag):
         """
@@ -335,6 +358,7 @@ class PrePubMetadataService(PublishSystem):
                               request is invalid.
         """
         datafiles = None
+        self._reccache.remove(self.normalize_id(id))
         try:
 
             bagger = self.open_bagger(self.normalize_id(id));
@@ -13,6 +13,7 @@ from .. import PublishSystem
 from .serv import (PrePubMetadataService, SIPDirectoryNotFound, IDNotFound,
                    ConfigurationException, StateException, InvalidRequest)
 from . import midasclient as midas
+from ..streamfile import send_file_response
 from ... import ARK_NAAN
 
 log = logging.getLogger(PublishSystem().subsystem_abbrev).getChild("mdserv")
@@ -226,8 +227,8 @@ class Handler(object):
             self.send_error(500, "Internal error")
             return []
         if not loc:
-            self.send_error(404, "Dataset (ID={0}) does not contain file={1}".
-                                 format(id, filepath))
+            return self.send_error(404, "Dataset (ID={0}) does not contain file={1}".
+                                        format(id, filepath))
 
         xsend = None
         prfx = [p for p in self._fmap.keys() if loc.startswith(p+'/')]
@@ -235,22 +236,16 @@ class Handler(object):
             xsend = self._fmap[prfx[0]] + loc[len(prfx[0]):]
             log.debug("Sending file via X-Accel-Redirect: %s", xsend)
 
-        self.set_response(200, "Data file found")
         self.add_header('Content-Type', mtype)
         self.add_header('Content-Disposition', os.path.basename(filepath))
         if xsend:
+            self.set_response(200, "Data file found")
             self.add_header('X-Accel-Redirect', xsend)
-        self.end_headers()
-
-        if xsend:
+            self.end_headers()
             return []
-        return self.iter_file(loc)
 
-    def iter_file(self, loc):
-        # this is the backup, inefficient way to send a file
-        with open(loc, 'rb') as fd:
-            buf = fd.read(5000000)
-            yield buf
+        # this is the backup way to send a file
+        return send_file_response(self, self._env, loc)
 
     def test_permission(self, dsid, action, user=None):
         def answer(data):
@@ -18,6 +18,8 @@ from ...exceptions import (SIPDirectoryNotFound, IDNotFound,
 from ...utils import read_json, build_mime_type_map
 from . import midasclient as midas
 from ..readme import ReadmeGenerator
+from ..streamfile import send_file_response
+from ..nerdcache import NERDmRecordCache, DEF_MAX_RECORDS
 from ...preserv.bagger.midas3 import MIDASSIP
 from ... import ARK_NAAN
 
@@ -32,6 +34,11 @@ class MIDAS3DataAccessApp(object):
     """
     A WSGI-compliant service app for accessing data and metadata associated with a
     Submission Information Package (SIP).
+
+    Records served via send_metadata() are cached in memory; a cached record is 
+    served until its metadata file or the dataset's SIP directories change.  The
+    'record_cache_size' configuration parameter sets the maximum number of records
+    cached (default: 50; 0 turns off caching).
     """
     def __init__(self, config):
         self.cfg = config
@@ -84,6 +91,8 @@ class MIDAS3DataAccessApp(object):
         mimefiles = self.cfg.get('mimetype_files', [])
         self.mimetypes = build_mime_type_map(mimefiles)
 
+        self.reccache = NERDmRecordCache(self.cfg.get('record_cache_size', DEF_MAX_RECORDS))
+
     def handle_request(self, env, start_resp):
         handler = Handler(self, env, start_resp)
         return handler.handle()
@@ -320,20 +329,27 @@ class Handler(object):
         
     def send_metadata(self, dsid):
 
-        mdata = None
-        try:
-            mdata = self.get_metadata(dsid)
-            if mdata is None:
-                log.info("Metadata record not found for ID="+dsid)
-                return self.send_error(404,
-                                       "Dataset with ID={0} not being edited".format(dsid))
-        except ValueError as ex:
-            return self.send_error(500, "Internal parsing error")
-        except Exception as ex:
-            log.exception("Internal error: "+str(ex))
-            return self.send_error(500, "Internal error")
+        mdata = self.app.reccache.get(dsid)
+        if mdata is None:
+            # stamp the record's sources before reading them so that any 
+            # changes made while we are reading will be noticed next time
+            stamps = self.app.reccache.stamp([os.path.join(d, dsid+".json")
+                                              for d in self._dirs if d])
+            try:
+                mdata = self.get_metadata(dsid)
+                if mdata is None:
+                    log.info("Metadata record not found for ID="+dsid)
+                    return self.send_error(404,
+                                           "Dataset with ID={0} not being edited".format(dsid))
+            except ValueError as ex:
+                return self.send_error(500, "Internal parsing error")
+            except Exception as ex:
+                log.exception("Internal error: "+str(ex))
+                return self.send_error(500, "Internal error")
+
+            mdata = self._transform_dlurls(mdata, stamps)
+            self.app.reccache.put(dsid, mdata, stamps)
 
-        mdata = self._transform_dlurls(mdata)
         out = json.dumps(mdata, indent=4, separators=(',', ': '))
 
         self.set_response(200, "Identifier found")
@@ -343,9 +359,12 @@ class Handler(object):
 
         return [ out ]
 
-    def _transform_dlurls(self, mdata):
+    def _transform_dlurls(self, mdata, stamps=None):
+        # if stamps is given, the stamps of the SIP directories are added to it
         try: 
             sip = MIDASSIP.fromNERD(mdata, self.app.revdir, self.app.upldir)
+            if stamps is not None:
+                stamps.update(self.app.reccache.stamp(sip.input_dirs))
             datafiles = sip.registered_files()
             
             pat = self._distsvc
@@ -363,7 +382,7 @@ class Handler(object):
 
         except SIPDirectoryNotFound as ex:
             # (probably) because the record came from the post-pub cache
-            log.debug("NOTE: No SIP directories found for ID=%s", str(midas.get('ediid')))
+            log.debug("NOTE: No SIP directories found for ID=%s", str(mdata.get('ediid')))
         
         return mdata
 
@@ -391,40 +410,34 @@ class Handler(object):
         if len(cmp) == 0:
             return self.send_error(404, "Dataset (ID={0}) does not contain file={1}".
                                    format(id, filepath))
+        loc = sip.find_source_file_for(filepath)
+        if not loc:
+            return self.send_error(404, "{0}: File={1} is not available from MIDAS".
+                                   format(id, filepath))
+
         if 'mediaType' in cmp[0] and cmp[0]['mediaType']:
             mtype = str(cmp[0]['mediaType'])
         else:
             mtype = self.app.mimetypes.get(os.path.splitext(loc)[1][1:],
                                            'application/octet-stream')
 
-        loc = sip.find_source_file_for(filepath)
-        if not loc:
-            return self.send_error(404, "{0}: File={1} is not available from MIDAS".
-                                   format(id, filepath))
-
         xsend = None
         prfx = [p for p in self._fmap.keys() if loc.startswith(p+'/')]
         if len(prfx) > 0:
             xsend = self._fmap[prfx[0]] + loc[len(prfx[0]):]
             log.debug("Sending file via X-Accel-Redirect: %s", xsend)
 
-        self.set_response(200, "Data file found")
         self.add_header('Content-Type', mtype)
         self.add_header('Content-Disposition',
                         'inline; filename="%s"' % os.path.basename(filepath)) 
         if xsend:
+            self.set_response(200, "Data file found")
             self.add_header('X-Accel-Redirect', xsend)
-        self.end_headers()
-
-        if xsend:
+            self.end_headers()
             return []
-        return self.iter_file(loc)
 
-    def iter_file(self, loc):
-        # this is the backup, inefficient way to send a file
-        with open(loc, 'rb') as fd:
-            buf = fd.read(5000000)
-            yield buf
+        # this is the backup way to send a file
+        return send_file_response(self, self._env, loc)
 
     def test_permission(self, dsid, action, user=None):
         def answer(data):
@@ -880,7 +880,7 @@ class MIDAS3PublishingService(PublishSystem):
         if async is None:
             async = not bg_sync
         stat = self.pressvc.status(ediid, "midas3")
-        if stat['state'] in [ ps.PENDING, ps.IN_PROGRESS ]:
+        if stat['state'] in [ ps.PENDING, ps.QUEUED, ps.IN_PROGRESS ]:
             # can't comply with request; just return stat, which tells the story
             return stat
 
@@ -946,7 +946,7 @@ class MIDAS3PublishingService(PublishSystem):
         if async is None:
             async = not bg_sync
         stat = self.pressvc.status(ediid, "midas3")
-        if stat['state'] in [ ps.PENDING, ps.IN_PROGRESS ]:
+        if stat['state'] in [ ps.PENDING, ps.QUEUED, ps.IN_PROGRESS ]:
             # can't comply with request; just return stat, which tells the story
             return stat
 
@@ -993,6 +993,20 @@ class MIDAS3PublishingService(PublishSystem):
         worker = self._get_bagging_worker(ediid)
         return worker.preservation_status()
 
+    def examination_status(self, ediid):
+        """
+        return the progress of the asynchronous examination of the data files of
+        the specified dataset as a dictionary of counts of the files that are
+        "queued", "running", "done", and "failed".  None is returned if the
+        dataset's files have not been submitted for examination by this service.
+
+        :param str ediid:   the EDI ID for the dataset of interest
+        """
+        worker = self._bagging_workers.get(ediid)
+        if not worker or not worker.bagger.fileExaminer:
+            return None
+        return worker.bagger.fileExaminer.status()
+
     def preservation_requests(self):
         """
         return a list of identifiers for datasets for which there have been 
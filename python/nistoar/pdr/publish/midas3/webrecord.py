@@ -1,10 +1,120 @@
 """
 a module that manages the recording of web requests so that they can be played back
+
+Requests are recorded to a log file; alongside it, the WebRecorder maintains an index 
+file (with the same name plus the ".idx" extension) that holds the byte offset of each 
+record in the log.  The index allows the RequestLogParser to count records and to jump
+directly to any one of them without scanning the (potentially large) log.  
 """
-import logging, os
+import logging, os, re, struct, time, fcntl
+from array import array
 from cStringIO import StringIO
 
 RECORD_FORMAT = "=*= %(asctime)s %(name)s %(message)s"
+RECORD_MARKER = "=*="
+INDEX_EXT = ".idx"
+
+_OFFSET = struct.Struct(">Q")
+
+def index_file_for(recordfile):
+    """
+    return the path to the offset index file for the given request log file
+    """
+    return recordfile + INDEX_EXT
+
+def _sync_index(recfile, idx):
+    # bring the (open and locked) index file up to date with the log file, 
+    # returning the number of records in the log
+    idx.seek(0, 2)
+    n = idx.tell() // _OFFSET.size
+    if idx.tell() % _OFFSET.size:
+        # incomplete entry
+        idx.truncate(n * _OFFSET.size)
+
+    if not os.path.exists(recfile):
+        idx.truncate(0)
+        return 0
+
+    with open(recfile, 'rb') as fd:
+        if n > 0:
+            idx.seek((n-1) * _OFFSET.size)
+            fd.seek(_OFFSET.unpack(idx.read(_OFFSET.size))[0])
+            if not fd.readline().startswith(RECORD_MARKER):
+                # the index does not match the log (e.g. it has been replaced);
+                # start over
+                idx.truncate(0)
+                n = 0
+                fd.seek(0)
+
+        idx.seek(0, 2)
+        while True:
+            pos = fd.tell()
+            line = fd.readline()
+            if not line:
+                break
+            if line.startswith(RECORD_MARKER):
+                idx.write(_OFFSET.pack(pos))
+                n += 1
+    idx.flush()
+    return n
+
+def sync_record_index(recordfile):
+    """
+    ensure that the offset index for the given request log file is complete and 
+    consistent with the log, creating it if necessary.  Only the portion of the log 
+    beyond the last indexed record is scanned (unless the index turns out to be 
+    inconsistent with the log, in which case it is rebuilt).  
+    :return int:  the number of records in the log
+    :raises IOError:  if the index file cannot be written 
+    """
+    with open(index_file_for(recordfile), 'a+b') as idx:
+        fcntl.flock(idx, fcntl.LOCK_EX)
+        try:
+            return _sync_index(recordfile, idx)
+        finally:
+            fcntl.flock(idx, fcntl.LOCK_UN)
+
+class IndexedFileHandler(logging.FileHandler):
+    """
+    a logging FileHandler that records the byte offset of each record it writes in an 
+    index file (see index_file_for()).  Writes are serialized via a lock on the index 
+    file, so that several processes may record to the same log.  
+    """
+
+    def __init__(self, filename, mode='a', encoding=None, delay=0):
+        logging.FileHandler.__init__(self, filename, mode, encoding, delay)
+        self._idx = open(index_file_for(self.baseFilename), 'a+b')
+        self._synced = False
+
+    def emit(self, record):
+        fcntl.flock(self._idx, fcntl.LOCK_EX)
+        try:
+            if not self._synced:
+                # index any records written without an index
+                _sync_index(self.baseFilename, self._idx)
+                self._synced = True
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.seek(0, 2)
+            pos = self.stream.tell()
+
+            logging.FileHandler.emit(self, record)
+
+            self._idx.seek(0, 2)
+            self._idx.write(_OFFSET.pack(pos))
+            self._idx.flush()
+        finally:
+            fcntl.flock(self._idx, fcntl.LOCK_UN)
+
+    def close(self):
+        self.acquire()
+        try:
+            if self._idx:
+                self._idx.close()
+                self._idx = None
+        finally:
+            self.release()
+        logging.FileHandler.close(self)
 
 class WebRequest(object):
     """
@@ -188,7 +298,7 @@ class WebRecorder(object):
         is at construction), it does nothing.  Normally, this is called after a close_file().
         """
         if not self._handler and self._recfile:
-            self._handler = logging.FileHandler(self._recfile)
+            self._handler = IndexedFileHandler(self._recfile)
             self._handler.setFormatter(logging.Formatter(RECORD_FORMAT))
             self._handler.setLevel(logging.DEBUG)
             self.add_handler(self._handler)
@@ -311,7 +421,12 @@ class WebRecorder(object):
 
 class RequestLogParser(object):
     """
-    a parser that creates replayable request records from a logfile
+    a parser that creates replayable request records from a logfile.
+
+    The parser uses the offset index maintained by the WebRecorder (creating or 
+    updating it as necessary) to find records without scanning the whole log.  If the
+    index cannot be written (e.g. because the log directory is read-only), the offsets 
+    are held in memory instead.  
     """
 
     def __init__(self, recordfile):
@@ -321,6 +436,7 @@ class RequestLogParser(object):
         if not os.path.exists(recordfile):
             raise IOError("File not found: " + recordfile)
         self._recfile = recordfile
+        self._memidx = None
 
     class _byrecord(object):
         def __init__(self, fd):
@@ -363,7 +479,9 @@ class RequestLogParser(object):
         out = None
         line = recliter.next()
         out = self._init_req(line)
+        return self._parse_rest(out, recliter)
 
+    def _parse_rest(self, out, recliter):
         inbody = False
         for line in recliter:
             if line.startswith("-+-"):
@@ -388,58 +506,183 @@ class RequestLogParser(object):
 
         return out
 
+    def _sync(self):
+        # bring the offset index up to date and return the number of records
+        if self._memidx is None:
+            try:
+                return sync_record_index(self._recfile)
+            except (IOError, OSError) as ex:
+                # can't write the index; fall back to holding it in memory
+                self._memidx = array('L')
+
+        with open(self._recfile, 'rb') as fd:
+            if self._memidx:
+                fd.seek(self._memidx[-1])
+                if not fd.readline().startswith(RECORD_MARKER):
+                    self._memidx = array('L')
+                    fd.seek(0)
+            while True:
+                pos = fd.tell()
+                line = fd.readline()
+                if not line:
+                    break
+                if line.startswith(RECORD_MARKER):
+                    self._memidx.append(pos)
+        return len(self._memidx)
+
+    def _offsets(self, *recnums):
+        # return the byte offsets of the records with the given positions
+        if self._memidx is not None:
+            return [self._memidx[n] for n in recnums]
+        out = []
+        with open(index_file_for(self._recfile), 'rb') as idx:
+            for n in recnums:
+                idx.seek(n * _OFFSET.size)
+                out.append(_OFFSET.unpack(idx.read(_OFFSET.size))[0])
+        return out
+
     def count_records(self):
         """
         count and return the number of records in this file
         """
-        nl = 0
-        with open(self._recfile) as fd:
-            byrec = self._byrecord(fd)
-            for rec in byrec.records():
-                nl += 1
-        return nl
+        return self._sync()
 
-    def parse(self, start=0, count=-1):
+    def get_record(self, recnum):
         """
-        parse records out of the file
-        :param int start:  the position of the first record to emit.  The first record
-                           is at position 0.  If negative, start that many records from 
-                           the end of the file.  
-        :param int count:  the maximum number of records to emit.  If less than 0, parse 
-                           all records from the start position to the end of the file.
-        :rtype list:  an array of WebRequest records
+        return the record at the given position in the log.  
+        :param int recnum:  the position of the desired record.  The first record is at 
+                            position 0; a negative value counts back from the end of the 
+                            log (so that -1 returns the last record).
+        :rtype WebRequest:
+        :raises IndexError:  if there is no record at the given position
         """
-        out = []
+        total = self._sync()
+        if recnum < 0:
+            recnum += total
+        if recnum < 0 or recnum >= total:
+            raise IndexError("record number out of range: " + str(recnum))
+
+        with open(self._recfile) as fd:
+            fd.seek(self._offsets(recnum)[0])
+            byrec = self._byrecord(fd)
+            return self._parse_record(byrec.records().next())
+
+    def _find_time(self, total, since):
+        # find the position of the first record at or after the given time, assuming 
+        # the records are in time order
+        lo, hi = 0, total
+        with open(self._recfile) as fd:
+            while lo < hi:
+                mid = (lo + hi) // 2
+                fd.seek(self._offsets(mid)[0])
+                if self._init_req(fd.readline()).time < since:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        return lo
+
+    @staticmethod
+    def _as_timestr(t):
+        if t is None or isinstance(t, (str, unicode)):
+            return t
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+
+    def iter_records(self, start=0, count=-1, since=None, until=None, op=None,
+                     resource=None):
+        """
+        iterate through the records in the file, optionally filtering them.  Records 
+        are parsed as they are needed, so the log need not fit in memory.  
+
+        :param int start:  the position of the first record to consider.  The first 
+                           record is at position 0.  If negative, start that many records 
+                           from the end of the file.  
+        :param int count:  the maximum number of records to consider (before filtering).
+                           If less than 0, consider all records from the start position 
+                           to the end of the file.
+        :param since:      if provided, skip records made before this time, given either
+                           as seconds since the epoch or as a string in the format used 
+                           in the log (e.g. "2020-05-01 13:00:00").  The log is assumed 
+                           to be in time order, allowing the first such record to be 
+                           found without reading the records before it.
+        :param until:      if provided, stop at the first record made at or after this 
+                           time (in the same forms as since).
+        :param op:         if provided, only emit records for this HTTP method (or for any 
+                           of the methods in a given list)
+        :param resource:   if provided, only emit records for resources starting with 
+                           this string, or, if it is a compiled regular expression, 
+                           matching it.  
+        :rtype generator of WebRequest:
+        """
+        if count == 0:
+            return
+        total = self._sync()
         if start < 0:
-            total = self.count_records()
             start = total + start
         if start < 0 and count > 0 and start+count > 0:
             count += start
             start = 0
-        if start < 0:
-            return out
+        if start < 0 or start >= total:
+            return
+
+        since = self._as_timestr(since)
+        until = self._as_timestr(until)
+        if since:
+            p = self._find_time(total, since)
+            if p > start:
+                if count > 0:
+                    count = max(0, count - (p - start))
+                    if count == 0:
+                        return
+                start = p
+            if start >= total:
+                return
+        if isinstance(op, (str, unicode)):
+            op = [op]
 
         with open(self._recfile) as fd:
+            fd.seek(self._offsets(start)[0])
             byrec = self._byrecord(fd)
             p = 0
             for rec in byrec.records():
-                if count >= 0 and p-start >= count:
+                if count >= 0 and p >= count:
                     break
-                if p >= start:
-                    try:
-                        out.append(self._parse_record(rec))
-                    except Exception as ex:
-                        raise
-                        # pass  # log?
                 p += 1
 
-        return out
+                req = self._init_req(rec.next())
+                if until and req.time >= until:
+                    break
+                if (since and req.time < since) or (op and req.op not in op) or \
+                   (resource and not self._resource_matches(resource, req.resource)):
+                    # skip the rest of this record
+                    for line in rec:
+                        pass
+                    continue
+
+                yield self._parse_rest(req, rec)
+
+    @staticmethod
+    def _resource_matches(resource, path):
+        if hasattr(resource, 'search'):
+            return bool(resource.search(path))
+        return path.startswith(resource)
+
+    def parse(self, start=0, count=-1):
+        """
+        parse records out of the file
+        :param int start:  the position of the first record to emit.  The first record
+                           is at position 0.  If negative, start that many records from 
+                           the end of the file.  
+        :param int count:  the maximum number of records to emit.  If less than 0, parse 
+                           all records from the start position to the end of the file.
+        :rtype list:  an array of WebRequest records
+        """
+        return list(self.iter_records(start, count))
 
     def parse_last(self):
-        out = self.parse(-1)
-        if len(out) < 1:
+        """
+        return the last record in the log, or None if the log is empty
+        """
+        try:
+            return self.get_record(-1)
+        except IndexError:
             return None
-        return out[-1]
-
-    
-                        
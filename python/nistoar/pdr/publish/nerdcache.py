@@ -0,0 +1,188 @@
+"""
+An in-memory cache of assembled NERDm records for the pre-publication metadata
+services.
+
+Assembling a NERDm record for a dataset under review requires examining the
+MIDAS submission areas and (for the pre-publication metadata service)
+preparing a metadata bag, which is too much work to do for every landing page
+or file list request.  The :class:`NERDmRecordCache` holds recently assembled
+records along with "stamps" of the files and directories they were assembled
+from; a cached record is only returned if none of those sources have changed
+since.  Stamping a directory examines only the directories below it (see
+:func:`path_stamp`) so that checking a cached record does not require walking
+every file in a submission.
+"""
+import os, stat, threading
+from collections import OrderedDict
+from copy import deepcopy
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+DEF_MAX_RECORDS = 50
+
+def path_stamp(path):
+    """
+    return a value that summarizes the state of the given file or directory
+    such that a change to the file or (for a directory) to its contents will
+    (with high probability) result in a different value.  None is returned if
+    the path does not exist.
+
+    The stamp for a file is derived from its size and modification time.  To
+    keep the stamping of a large submission area cheap, the stamp for a
+    directory is derived only from the modification times of the directories
+    below it (which change whenever an entry is added, removed, or renamed)
+    and from the sizes and modification times of the files directly within
+    it (e.g. MIDAS's ``_pod.json`` or a metadata bag's component index, which
+    is updated whenever a component's metadata is written).  Files deeper in
+    the tree are not examined individually, so a data file that is rewritten
+    in place will go unnoticed until its directory changes.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not os.path.isdir(path):
+        return (1, st.st_size, st.st_mtime)
+
+    count = 0
+    size = 0
+    mtimes = 0.0
+    mtime = st.st_mtime
+    for name in _listdir(path):
+        try:
+            est = os.stat(os.path.join(path, name))
+        except OSError:
+            # disappeared while we were looking
+            continue
+        count += 1
+        size += est.st_size
+        mtimes += est.st_mtime
+        mtime = max(mtime, est.st_mtime)
+        if stat.S_ISDIR(est.st_mode) and not os.path.islink(os.path.join(path, name)):
+            for dst in _subdir_stats(os.path.join(path, name), est):
+                count += 1
+                mtimes += dst.st_mtime
+                mtime = max(mtime, dst.st_mtime)
+    return (count, size, mtimes, mtime)
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+def _subdir_stats(path, st):
+    # yield the stats of the directories below path (whose own stat is st)
+    # without examining the files within them
+    if st.st_nlink == 2:
+        # on POSIX file systems, a directory's link count is 2 plus the number
+        # of its subdirectories:  this one is a leaf; no need to list it.
+        return
+    if scandir:
+        try:
+            ents = [(e.path, e.stat()) for e in scandir(path)
+                    if e.is_dir(follow_symlinks=False)]
+        except OSError:
+            return
+    else:
+        ents = []
+        for name in _listdir(path):
+            sub = os.path.join(path, name)
+            try:
+                if os.path.isdir(sub) and not os.path.islink(sub):
+                    ents.append((sub, os.stat(sub)))
+            except OSError:
+                continue
+    for sub, sst in ents:
+        yield sst
+        for dst in _subdir_stats(sub, sst):
+            yield dst
+
+class NERDmRecordCache(object):
+    """
+    a thread-safe, size-limited cache of NERDm records, keyed by dataset
+    identifier.  Each record is saved with the stamps (see path_stamp()) of
+    the files and directories it was assembled from; when a record is
+    requested, it is returned only if those stamps are unchanged.  When the
+    cache is full, the least recently used record is dropped.
+    """
+
+    def __init__(self, maxrecs=DEF_MAX_RECORDS):
+        """
+        create an empty cache
+        :param int maxrecs:  the maximum number of records to hold
+        """
+        self.maxrecs = maxrecs
+        self._recs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def stamp(paths):
+        """
+        return the stamps for the given files and directories as a dictionary
+        (to be passed to put()).
+        """
+        return OrderedDict([(p, path_stamp(p)) for p in paths])
+
+    def get(self, id):
+        """
+        return a copy of the record cached for the given identifier, or None
+        if no record is cached or the record is out of date.
+        """
+        with self._lock:
+            ent = self._recs.get(id)
+        if not ent:
+            return None
+
+        # (don't hold the lock while examining the file system)
+        if any([path_stamp(p) != s for p, s in ent[0].items()]):
+            self.remove(id)
+            return None
+
+        with self._lock:
+            if id in self._recs:
+                self._recs[id] = self._recs.pop(id)
+        return deepcopy(ent[1])
+
+    def put(self, id, record, stamps):
+        """
+        save a record to the cache
+
+        :param str    id:      the dataset identifier to save the record under
+        :param dict record:    the NERDm record
+        :param dict stamps:    the stamps of the files and directories the record
+                               was assembled from, as returned by stamp().  These
+                               should be measured before the record is assembled
+                               so that changes made while assembling it are
+                               detected later.
+        """
+        if self.maxrecs < 1:
+            return
+        with self._lock:
+            self._recs.pop(id, None)
+            self._recs[id] = (stamps, deepcopy(record))
+            while len(self._recs) > self.maxrecs:
+                self._recs.popitem(last=False)
+
+    def remove(self, id):
+        """
+        drop the record for the given identifier from the cache
+        """
+        with self._lock:
+            self._recs.pop(id, None)
+
+    def clear(self):
+        """
+        drop all records from the cache
+        """
+        with self._lock:
+            self._recs.clear()
+
+    def __len__(self):
+        return len(self._recs)
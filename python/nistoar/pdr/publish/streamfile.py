@@ -0,0 +1,169 @@
+"""
+Support for streaming files from disk as responses from the publishing
+web services' WSGI handlers.
+
+The web services normally hand off the delivery of data files to the front-end
+web server (via X-Accel-Redirect); the function provided here,
+send_file_response(), is used when that is not possible.  It sends a file in
+bounded chunks (using the server's ``wsgi.file_wrapper`` when available),
+and it supports conditional GETs (via ETag and Last-Modified) and single byte
+range requests.
+"""
+import os, re
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+DEF_CHUNK_SIZE = 1048576   # 1 MB
+
+_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def file_etag(stat):
+    """
+    return the entity tag to use for a file with the given status
+    :param stat:  the output of os.stat() for the file
+    """
+    return '"{0:x}-{1:x}"'.format(int(stat.st_mtime), stat.st_size)
+
+def _parse_http_date(val):
+    try:
+        return mktime_tz(parsedate_tz(val))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def _etag_matches(etag, header):
+    tags = [t.strip() for t in header.split(',')]
+    return '*' in tags or etag in tags or ('W/'+etag) in tags
+
+def is_not_modified(env, etag, mtime):
+    """
+    return True if the conditional headers in the given request indicate that
+    the client's copy of the file is current.
+    """
+    inm = env.get('HTTP_IF_NONE_MATCH')
+    if inm:
+        return _etag_matches(etag, inm)
+    ims = env.get('HTTP_IF_MODIFIED_SINCE')
+    if ims:
+        since = _parse_http_date(ims)
+        return since is not None and int(mtime) <= since
+    return False
+
+def parse_range(env, size, etag, mtime):
+    """
+    return the byte range requested by the given request as a 2-tuple giving
+    the first and last byte positions (inclusive).  None is returned if the
+    request does not contain a Range header that should be honored (because,
+    for example, it is not a single byte range or its If-Range condition does
+    not hold).
+    :raises ValueError:  if the requested range cannot be satisfied
+    """
+    rng = env.get('HTTP_RANGE')
+    if not rng:
+        return None
+
+    ifrng = env.get('HTTP_IF_RANGE')
+    if ifrng:
+        if ifrng.startswith('"') or ifrng.startswith('W/'):
+            if ifrng != etag:
+                return None
+        elif _parse_http_date(ifrng) != int(mtime):
+            return None
+
+    m = _range_re.match(rng.replace(' ', ''))
+    if not m or (not m.group(1) and not m.group(2)):
+        # not a (single) byte range; ignore it
+        return None
+
+    if not m.group(1):
+        # suffix range: the last N bytes
+        n = int(m.group(2))
+        if n == 0:
+            raise ValueError("unsatisfiable range: "+rng)
+        return (max(0, size - n), size - 1)
+
+    first = int(m.group(1))
+    last = size - 1
+    if m.group(2):
+        last = int(m.group(2))
+    if first >= size or last < first:
+        raise ValueError("unsatisfiable range: "+rng)
+    return (first, min(last, size - 1))
+
+def iter_file(filepath, offset=0, length=None, chunksize=DEF_CHUNK_SIZE):
+    """
+    iterate through the contents of a file in chunks of a bounded size
+
+    :param str filepath:  the path to the file to read
+    :param int offset:    the position in the file to start reading from
+    :param int length:    the number of bytes to read; if None, read to the
+                          end of the file
+    :param int chunksize: the maximum number of bytes to return per iteration
+    """
+    with open(filepath, 'rb') as fd:
+        if offset:
+            fd.seek(offset)
+        while length is None or length > 0:
+            n = chunksize
+            if length is not None:
+                n = min(n, length)
+            buf = fd.read(n)
+            if not buf:
+                break
+            if length is not None:
+                length -= len(buf)
+            yield buf
+
+def send_file_response(handler, env, filepath, chunksize=DEF_CHUNK_SIZE):
+    """
+    complete a response to a GET or HEAD request for the given file,
+    returning the WSGI response body.
+
+    The given handler is expected to provide the set_response(), add_header(),
+    and end_headers() methods of the publishing services' WSGI Handler
+    classes.  Any headers specific to the file (e.g. Content-Type) should be
+    added to the handler before calling this function; this function will
+    set the response status and add the Content-Length, ETag, Last-Modified,
+    Accept-Ranges, and (when appropriate) Content-Range headers.
+
+    :param handler:       the Handler for the current request
+    :param dict env:      the WSGI environment for the current request
+    :param str filepath:  the path to the file to send
+    :param int chunksize: the maximum number of bytes to send at a time
+    """
+    st = os.stat(filepath)
+    size = st.st_size
+    etag = file_etag(st)
+
+    handler.add_header('ETag', etag)
+    handler.add_header('Last-Modified', formatdate(st.st_mtime, usegmt=True))
+    handler.add_header('Accept-Ranges', 'bytes')
+
+    if is_not_modified(env, etag, st.st_mtime):
+        handler.set_response(304, "Not Modified")
+        handler.end_headers()
+        return []
+
+    try:
+        rng = parse_range(env, size, etag, st.st_mtime)
+    except ValueError:
+        handler.set_response(416, "Requested Range Not Satisfiable")
+        handler.add_header('Content-Range', "bytes */{0}".format(size))
+        handler.end_headers()
+        return []
+
+    if rng:
+        length = rng[1] - rng[0] + 1
+        handler.set_response(206, "Partial content")
+        handler.add_header('Content-Range', "bytes {0}-{1}/{2}".format(rng[0], rng[1], size))
+    else:
+        length = size
+        handler.set_response(200, "Data file found")
+    handler.add_header('Content-Length', str(length))
+    handler.end_headers()
+
+    if env.get('REQUEST_METHOD') == 'HEAD':
+        return []
+    if rng:
+        return iter_file(filepath, rng[0], length, chunksize)
+    if 'wsgi.file_wrapper' in env:
+        return env['wsgi.file_wrapper'](open(filepath, 'rb'), chunksize)
+    return iter_file(filepath, chunksize=chunksize)
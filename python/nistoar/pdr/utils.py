@@ -2,7 +2,7 @@
 Utility functions useful across the pdr package
 """
 from collections import OrderedDict, Mapping
-import hashlib, json, re, shutil, os, time, subprocess, logging, threading
+import hashlib, json, re, shutil, os, sys, time, subprocess, logging, threading, errno
 try:
     import fcntl
 except ImportError:
@@ -83,6 +83,23 @@ class LockedFile(object):
                 self.ex_lock.acquire()
         def release_exclusive(self):
             self.ex_lock.release()
+        def try_acquire_shared(self):
+            if not self.ex_lock.acquire(False):
+                return False
+            try:
+                if not self._reader_count and not self.sh_lock.acquire(False):
+                    return False
+                self._reader_count += 1
+                return True
+            finally:
+                self.ex_lock.release()
+        def try_acquire_exclusive(self):
+            if not self.sh_lock.acquire(False):
+                return False
+            try:
+                return self.ex_lock.acquire(False)
+            finally:
+                self.sh_lock.release()
             
     @classmethod
     def _get_thread_lock_for(cls, filepath):
@@ -148,6 +165,45 @@ class LockedFile(object):
             fcntl.lockf(self.fo, lock_type)
         return self.fo
 
+    def try_open(self, mode=None):
+        """
+        Open and lock the file like open(), except that if the file is 
+        currently locked by another thread or process, None is returned 
+        immediately rather than waiting for the lock to be released.
+        """
+        if self._fo:
+            raise StateException(self._fname+": file is already open")
+        if mode:
+            self.mode = mode
+
+        self._writing = 'a' in self.mode or 'w' in self.mode or '+' in self.mode
+        if self._writing:
+            locked = self._thread_lock.try_acquire_exclusive()
+        else:
+            locked = self._thread_lock.try_acquire_shared()
+        if not locked:
+            self._writing = None
+            return None
+
+        try:
+            self._fo = open(self._fname, self.mode)
+        except:
+            self._release_thread_lock()
+            self._fo = None
+            self._writing = None
+            raise
+
+        if fcntl:
+            lock_type = (self._writing and fcntl.LOCK_EX) or fcntl.LOCK_SH
+            try:
+                fcntl.lockf(self.fo, lock_type | fcntl.LOCK_NB)
+            except IOError as ex:
+                self.close()
+                if ex.errno in (errno.EACCES, errno.EAGAIN):
+                    return None
+                raise
+        return self.fo
+
     def close(self):
         if not self._fo:
             return
@@ -376,3 +432,106 @@ def rmtree_retry(rootdir, retries=1):
             rmtree(root, retries=retries-1)
     
 rmtree = rmtree_retry
+
+def submit_batch(submit, names, workers=1, retryable=(), failures=(), skippable=(),
+                 retries=0, backoff=1.0, log=None):
+    """
+    submit a batch of named records via a given function, optionally using 
+    several concurrent threads.  This is intended for draining the staging 
+    areas of clients like the ingest and DOI-minting clients, where each 
+    record is submitted individually.  
+
+    An exception raised by the submit function is handled according to its 
+    type:  if it is one of the retryable types, the submission will be 
+    retried after a delay (which doubles with each attempt) until the number 
+    of retries is exhausted; if (after retries) it is one of the failures 
+    types, the record is counted as failed; if it is one of the skippable 
+    types, the record is counted as skipped.  Any other exception aborts the 
+    batch: no further submissions are started, and, once those already 
+    underway are complete, the exception is re-raised.  
+
+    :param function submit:  the function that submits a record; it takes 
+                             the record's name as its only argument
+    :param list names:       the names of the records to submit
+    :param int workers:      the maximum number of submissions to carry out
+                             concurrently
+    :param tuple retryable:  the exception types that should trigger a retry
+    :param tuple failures:   the exception types that indicate a record 
+                             failed to be submitted
+    :param tuple skippable:  the exception types that indicate a record was 
+                             not available for submission
+    :param int retries:      the maximum number of times to retry a record
+    :param float backoff:    the delay, in seconds, before the first retry
+    :param Logger log:       the Logger to send messages to
+    :return dict:  a summary with the keys, 'succeeded', 'failed', and 
+                   'skipped', each listing the names of records that ended 
+                   up in that state; 'latency', mapping each attempted name 
+                   to the seconds spent submitting it (including retries); 
+                   and 'elapsed', the total time in seconds.  
+    """
+    if not log:
+        log = logging.getLogger("pdr.utils")
+    abort = threading.Event()
+    start = time.time()
+
+    def submit1(name):
+        if abort.is_set():
+            return (name, "skipped", None, None)
+        t0 = time.time()
+        attempt = 0
+        while True:
+            try:
+                submit(name)
+                return (name, "succeeded", time.time() - t0, None)
+            except retryable as ex:
+                if attempt >= retries or abort.is_set():
+                    err = sys.exc_info()
+                else:
+                    delay = backoff * 2**attempt
+                    attempt += 1
+                    log.info("%s: retrying submission in %.1f s (attempt %d): %s",
+                             name, delay, attempt+1, str(ex))
+                    time.sleep(delay)
+                    continue
+            except Exception as ex:
+                err = sys.exc_info()
+
+            if isinstance(err[1], failures):
+                return (name, "failed", time.time() - t0, None)
+            if isinstance(err[1], skippable):
+                return (name, "skipped", time.time() - t0, None)
+            abort.set()
+            return (name, "aborted", time.time() - t0, err)
+
+    names = list(names)
+    workers = max(1, min(workers, len(names)))
+    if workers > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(submit1, names, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [submit1(n) for n in names]
+
+    out = OrderedDict([("succeeded", []), ("failed", []), ("skipped", []),
+                       ("latency", OrderedDict()), ("elapsed", None)])
+    excinfo = None
+    for name, outcome, latency, exc in results:
+        if latency is not None:
+            out['latency'][name] = latency
+        if outcome == "aborted":
+            excinfo = excinfo or exc
+        else:
+            out[outcome].append(name)
+    out['elapsed'] = time.time() - start
+
+    if excinfo:
+        raise excinfo[0], excinfo[1], excinfo[2]
+    if out['latency']:
+        lats = out['latency'].values()
+        log.info("Submitted %d records in %.1f s (mean latency: %.2f s, max: %.2f s)",
+                 len(lats), out['elapsed'], sum(lats)/len(lats), max(lats))
+    return out
@@ -1,9 +1,10 @@
 from __future__ import absolute_import
-import os, pdb, sys, json, requests, logging, time, re, hashlib
+import os, pdb, sys, json, requests, logging, time, re, hashlib, threading
 import unittest as test
 
 from nistoar.testing import *
 from nistoar.pdr.distrib import client, bagclient
+from nistoar.pdr import utils
 
 testdir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
 datadir = os.path.join(testdir, 'data')
@@ -196,6 +197,128 @@ class TestBagDistribClient(test.TestCase):
         with self.assertRaises(client.DistribResourceNotFound):
             cli.save_bag("goob.zip", tmpdir())
 
+class CountingClient(client.RESTServiceClient):
+    def __init__(self, baseurl):
+        super(CountingClient, self).__init__(baseurl)
+        self.count = 0
+    def get_json(self, relurl):
+        self.count += 1
+        return super(CountingClient, self).get_json(relurl)
+
+class TestCachedBagDistribClient(test.TestCase):
+
+    def setUp(self):
+        self.svc = CountingClient(baseurl)
+        self.cache = bagclient.BagInfoCache(60)
+
+    def test_list_for_version(self):
+        cli = bagclient.BagDistribClient("pdr2210", self.svc, self.cache)
+        self.assertEqual(cli.list_for_version("1.0"),
+                         ["pdr2210.1_0.mbag0_3-0.zip", "pdr2210.1_0.mbag0_3-1.zip"])
+        self.assertEqual(self.svc.count, 1)
+
+        cli = bagclient.BagDistribClient("pdr2210", self.svc, self.cache)
+        self.assertEqual(cli.list_for_version("1.0"),
+                         ["pdr2210.1_0.mbag0_3-0.zip", "pdr2210.1_0.mbag0_3-1.zip"])
+        self.assertEqual(self.svc.count, 1)
+        self.assertEqual(cli.head_for_version("1.0"), "pdr2210.1_0.mbag0_3-1.zip")
+        self.assertEqual(cli.head_for_version("1.0"), "pdr2210.1_0.mbag0_3-1.zip")
+        self.assertEqual(self.svc.count, 2)
+
+        self.cache.invalidate("pdr2210")
+        cli.list_for_version("1.0")
+        self.assertEqual(self.svc.count, 3)
+
+    def test_notfound(self):
+        cli = bagclient.BagDistribClient("goob", self.svc, self.cache)
+        with self.assertRaises(client.DistribResourceNotFound):
+            cli.list_versions()
+        with self.assertRaises(client.DistribResourceNotFound):
+            cli.list_versions()
+        self.assertEqual(self.svc.count, 1)
+
+class TestBagInfoCache(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.cachefile = os.path.join(self.tf.mkdir("bagcache"), "listings.json")
+
+    def tearDown(self):
+        self.tf.clean()
+
+    def test_get_put(self):
+        cache = bagclient.BagInfoCache(60)
+        self.assertEqual(cache.get("pdr1010", "pdr1010/_aip"), (None, False))
+        cache.put("pdr1010", "pdr1010/_aip", [{"name": "pdr1010.mbag0_3-1.zip"}])
+        self.assertEqual(cache.get("pdr1010", "pdr1010/_aip"),
+                         ([{"name": "pdr1010.mbag0_3-1.zip"}], False))
+        cache.put("goob", "goob/_aip", None, notfound=True)
+        self.assertEqual(cache.get("goob", "goob/_aip"), (None, True))
+
+        cache.invalidate("pdr1010")
+        self.assertEqual(cache.get("pdr1010", "pdr1010/_aip"), (None, False))
+        self.assertEqual(cache.get("goob", "goob/_aip"), (None, True))
+        cache.invalidate()
+        self.assertEqual(cache.get("goob", "goob/_aip"), (None, False))
+
+    def test_expire(self):
+        cache = bagclient.BagInfoCache(0.1)
+        cache.put("pdr1010", "pdr1010/_aip/_v", ["1"])
+        self.assertEqual(cache.get("pdr1010", "pdr1010/_aip/_v"), (["1"], False))
+        time.sleep(0.2)
+        self.assertEqual(cache.get("pdr1010", "pdr1010/_aip/_v"), (None, False))
+
+    def test_persist(self):
+        cache = bagclient.BagInfoCache(60, self.cachefile)
+        cache.put("pdr1010", "pdr1010/_aip/_v", ["1"])
+        self.assertTrue(os.path.exists(self.cachefile))
+
+        other = bagclient.BagInfoCache(60, self.cachefile)
+        self.assertEqual(other.get("pdr1010", "pdr1010/_aip/_v"), (["1"], False))
+
+        # make sure the change is seen even if the mtime resolution is coarse
+        time.sleep(0.01)
+        other.invalidate("pdr1010")
+        os.utime(self.cachefile, (time.time()+2, time.time()+2))
+        self.assertEqual(cache.get("pdr1010", "pdr1010/_aip/_v"), (None, False))
+
+    def test_concurrent_updates(self):
+        cache = bagclient.BagInfoCache(60, self.cachefile)
+        cache.put("pdr1010", "pdr1010/_aip/_v", ["1"])
+        other = bagclient.BagInfoCache(60, self.cachefile)
+        self.assertEqual(other.get("pdr1010", "pdr1010/_aip/_v"), (["1"], False))
+
+        # an invalidation from another process that lands within the same
+        # mtime tick must not be overwritten by the next update
+        mtime = os.stat(self.cachefile).st_mtime
+        other.invalidate("pdr1010")
+        os.utime(self.cachefile, (mtime, mtime))
+        cache.put("pdr2210", "pdr2210/_aip/_v", ["1"])
+        self.assertEqual(other.get("pdr1010", "pdr1010/_aip/_v"), (None, False))
+        self.assertEqual(other.get("pdr2210", "pdr2210/_aip/_v"), (["1"], False))
+        self.assertTrue(os.path.exists(self.cachefile+".lock"))
+
+        # updates wait for another holder of the lock
+        lock = utils.LockedFile(self.cachefile+".lock", 'a')
+        lock.open()
+        done = threading.Event()
+        def update():
+            other.invalidate("pdr2210")
+            done.set()
+        thrd = threading.Thread(target=update)
+        thrd.start()
+        self.assertFalse(done.wait(0.2))
+        lock.close()
+        thrd.join(5)
+        self.assertTrue(done.is_set())
+        self.assertEqual(cache.get("pdr2210", "pdr2210/_aip/_v"), (None, False))
+
+    def test_cache_for(self):
+        self.assertIsNone(bagclient.bag_info_cache_for({"listing_cache_ttl": 0}))
+        cache = bagclient.bag_info_cache_for({})
+        self.assertIsNotNone(cache)
+        self.assertIs(bagclient.bag_info_cache_for({"service_endpoint": baseurl}), cache)
+        self.assertIsNot(bagclient.bag_info_cache_for({"listing_cache_ttl": 10}), cache)
         
 
 
@@ -135,6 +135,139 @@ class TestRESTServiceClient(test.TestCase):
         self.assertTrue(self.cli.is_available("/_aip/pdr1010.mbag0_3-2.zip"))
         self.assertFalse(self.cli.is_available("/_aip/goob.zip"))
         
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import threading
+
+class RangedHandler(BaseHTTPRequestHandler):
+    # serves a single file, honoring Range requests; the first full request
+    # for "/flaky" is cut off part-way through.
+    content = "".join([chr(i % 251) for i in range(300000)])
+    requests = []
+    flaked = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get('Range')))
+        if self.path not in ("/file", "/flaky"):
+            self.send_response(404, "Not Found")
+            self.end_headers()
+            return
+
+        start, end = 0, len(self.content) - 1
+        rng = self.headers.get('Range')
+        if rng:
+            m = re.match(r'bytes=(\d+)-(\d*)', rng)
+            start = int(m.group(1))
+            if m.group(2):
+                end = int(m.group(2))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}"
+                             .format(start, end, len(self.content)))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        body = self.content[start:end+1]
+        if self.path == "/flaky" and not rng and not self.flaked:
+            self.flaked.append(True)
+            self.wfile.write(body[:100000])
+            self.wfile.flush()
+            self.close_connection = 1
+            return
+        self.wfile.write(body)
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    def handle_error(self, request, client_address):
+        # clients may hang up early (e.g. after reading just the headers)
+        pass
+
+class TestRESTServiceClientDownloads(test.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadedHTTPServer(("localhost", 0), RangedHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.base = "http://localhost:{0}".format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.outdir = self.tf.mkdir("downloads")
+        del RangedHandler.requests[:]
+        del RangedHandler.flaked[:]
+
+    def tearDown(self):
+        self.tf.clean()
+
+    def read(self, filepath):
+        with open(filepath, 'rb') as fd:
+            return fd.read()
+
+    def test_session(self):
+        cli = dcli.RESTServiceClient(self.base, {"chunk_size": 4096})
+        self.assertEqual(cli.chunk_size, 4096)
+        self.assertIs(cli.session, cli.session)
+        cli.close()
+        self.assertIsNone(cli._session)
+
+    def test_retrieve_file(self):
+        cli = dcli.RESTServiceClient(self.base)
+        out = os.path.join(self.outdir, "file.zip")
+        cli.retrieve_file("/file", out)
+        self.assertEqual(self.read(out), RangedHandler.content)
+        self.assertFalse(os.path.exists(out+".part"))
+
+        with self.assertRaises(dcli.DistribResourceNotFound):
+            cli.retrieve_file("/goob", os.path.join(self.outdir, "goob.zip"))
+        self.assertEqual(os.listdir(self.outdir), ["file.zip"])
+
+    def test_retrieve_file_resume(self):
+        cli = dcli.RESTServiceClient(self.base, {"retries": 1})
+        out = os.path.join(self.outdir, "file.zip")
+        cli.retrieve_file("/flaky", out)
+        self.assertEqual(self.read(out), RangedHandler.content)
+
+        self.assertEqual(len(RangedHandler.requests), 2)
+        self.assertIsNone(RangedHandler.requests[0][1])
+        self.assertTrue(RangedHandler.requests[1][1].startswith("bytes="))
+        self.assertNotEqual(RangedHandler.requests[1][1], "bytes=0-")
+
+    def test_retrieve_file_parallel(self):
+        cli = dcli.RESTServiceClient(self.base, {"parallel_downloads": 4,
+                                                 "parallel_threshold": 1000})
+        out = os.path.join(self.outdir, "file.zip")
+        cli.retrieve_file("/file", out)
+        self.assertEqual(self.read(out), RangedHandler.content)
+        ranges = [r[1] for r in RangedHandler.requests if r[1]]
+        self.assertEqual(len(ranges), 4)
+
+        # below the threshold, a single request is made
+        del RangedHandler.requests[:]
+        cli.cfg['parallel_threshold'] = 10000000
+        cli.retrieve_file("/file", out)
+        self.assertEqual(self.read(out), RangedHandler.content)
+        self.assertEqual(RangedHandler.requests, [("/file", None)])
+
+    def test_get_stream(self):
+        cli = dcli.RESTServiceClient(self.base)
+        fd = cli.get_stream("/file")
+        try:
+            self.assertEqual(fd.read(), RangedHandler.content)
+        finally:
+            fd.close()
+
 
 if __name__ == '__main__':
     test.main()
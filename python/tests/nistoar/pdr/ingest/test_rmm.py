@@ -288,6 +288,24 @@ class TestIngestClient(test.TestCase):
         self.assertTrue(os.path.exists(os.path.join(self.successdir,"bro.json")))
         self.assertTrue(os.path.exists(os.path.join(self.successdir,"bru.json")))
 
+    def test_submit_all_concurrent(self):
+        rec = getrec()
+        names = ["bru", "bro", "bre", "bra"]
+        for name in names:
+            self.cl.stage(rec, name)
+
+        self.cl._workers = 3
+        results = self.cl.submit_all()
+        self.assertEqual(sorted(results['succeeded']), sorted(names))
+        self.assertEqual(results['failed'], [])
+        self.assertEqual(results['skipped'], [])
+        self.assertEqual(sorted(results['latency'].keys()), sorted(names))
+        
+        for name in names:
+            self.assertFalse(os.path.exists(os.path.join(self.stagedir, name+".json")))
+            self.assertTrue(os.path.exists(os.path.join(self.successdir, name+".json")))
+        self.assertEqual(os.listdir(self.inprogdir), [])
+
     def test_submit_modeall(self):
         rec = getrec()
         self.cl.stage(rec, 'bru')
@@ -214,6 +214,22 @@ class TestDataChecker(test.TestCase):
         self.assertFalse(self.ckr.available_in_cached_bag(nerdm))
         self.assertEqual(self.ckr.unavailable_files(), ['goob.json'])
         self.assertFalse(self.ckr.all_files_available())
+
+    def test_availability_report(self):
+        rep = self.ckr.availability_report()
+        self.assertEqual(rep.get('trial1.json'), self.ckr.AVAIL_IN_BAG)
+        self.assertEqual(rep.get('trial2.json'), self.ckr.AVAIL_IN_CACHED_BAG)
+        self.assertEqual(rep.get('trial3/trial3a.json'), self.ckr.AVAIL_IN_CACHED_BAG)
+        self.assertNotIn(self.ckr.AVAIL_NOT, rep.values())
+
+        cmps = [self.ckr.bag.nerd_metadata_for('trial2.json')]
+        cmps.append(dict(cmps[0]))
+        cmps[1]['filepath'] = "goob.json"
+        cmps[1]['downloadURL'] = "http://localhost:9091/od/ds/goob.json"
+        rep = self.ckr.availability_report(components=cmps)
+        self.assertEqual(list(rep.keys()), ['trial2.json', 'goob.json'])
+        self.assertEqual(rep['trial2.json'], self.ckr.AVAIL_IN_CACHED_BAG)
+        self.assertEqual(rep['goob.json'], self.ckr.AVAIL_NOT)
         
         
 class TestDataCheckerWithService(test.TestCase):
@@ -259,6 +275,14 @@ class TestDataCheckerWithService(test.TestCase):
         self.assertEqual(self.ckr.bag.name, "pdr2210.3_1_3.mbag0_3-5")
         self.assertTrue(self.ckr.log)
         self.assertTrue(self.ckr._distsvc)
+        self.assertIsNotNone(self.ckr._baginfo)
+
+        # caching can be turned off
+        self.config['repo_access']['distrib_service']['listing_cache_ttl'] = 0
+        self.ckr = dc.DataChecker(NISTBag(self.hbag), self.config,
+                                  logging.getLogger("datachecker"))
+        self.assertTrue(self.ckr._distsvc)
+        self.assertIsNone(self.ckr._baginfo)
 
     def test_head_url(self):
         (stat, msg) = dc.DataChecker.head_url(
@@ -353,6 +377,32 @@ class TestDataCheckerWithService(test.TestCase):
     def test_unavailable_files(self):
         self.assertEqual(len(self.ckr.unavailable_files()), 0)
         self.assertTrue(self.ckr.all_files_available())
+
+    def test_availability_report(self):
+        self.config['store_dir'] = self.tf.mkdir("emptystore")
+        self.config['url_check_workers'] = 3
+        self.ckr = dc.DataChecker(NISTBag(self.hbag), self.config,
+                                  logging.getLogger("datachecker"))
+
+        cmps = [ self.ckr.bag.nerd_metadata_for('trial1.json'),
+                 self.ckr.bag.nerd_metadata_for('trial2.json') ]
+        for i in range(4):
+            cmps.append({"@type": ["nrdp:DataFile", "dcat:Distribution"],
+                         "downloadURL":
+                               "http://localhost:9091/od/ds/_aip/pdr1010.mbag0_3-1.zip"
+                                if i % 2 else "http://localhost:9091/od/ds/goob"+str(i) })
+        rep = self.ckr.availability_report(components=cmps)
+
+        self.assertEqual(len(rep), 5)
+        self.assertEqual(rep['trial1.json'], self.ckr.AVAIL_IN_BAG)
+        self.assertEqual(rep['trial2.json'], self.ckr.AVAIL_IN_REMOTE_BAG)
+        self.assertEqual(rep["http://localhost:9091/od/ds/_aip/pdr1010.mbag0_3-1.zip"],
+                         self.ckr.AVAIL_VIA_URL)
+        self.assertEqual(rep["http://localhost:9091/od/ds/goob0"], self.ckr.AVAIL_NOT)
+        self.assertEqual(rep["http://localhost:9091/od/ds/goob2"], self.ckr.AVAIL_NOT)
+
+        rep = self.ckr.availability_report(True, components=cmps)
+        self.assertEqual(rep['trial2.json'], self.ckr.AVAIL_NOT)
         
         
 
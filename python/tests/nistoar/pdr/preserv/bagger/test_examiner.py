@@ -0,0 +1,161 @@
+import os, sys, pdb, time, threading
+import unittest as test
+
+from nistoar.testing import *
+from nistoar.pdr.preserv.bagger import examiner as exmnr
+
+def setUpModule():
+    ensure_tmpdir()
+
+def tearDownModule():
+    rmtmpdir()
+
+class TestFileExaminerService(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.dir = self.tf.mkdir("examiner")
+        self.svc = exmnr.FileExaminerService(1)
+        self.examined = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def tearDown(self):
+        self.gate.set()
+        self.svc.wait_for_all(5)
+        self.tf.clean()
+
+    def mkfiles(self, bag, sizes):
+        out = {}
+        for name, size in sizes:
+            path = os.path.join(self.dir, bag+"_"+name)
+            with open(path, 'w') as fd:
+                fd.write("x" * size)
+            out[name] = path
+        return out
+
+    def examine(self, filepath, location):
+        self.gate.wait(5)
+        if filepath.startswith("bad"):
+            raise RuntimeError("bad file")
+        self.examined.append((os.path.basename(location).split('_')[0], filepath))
+
+    def test_smallest_first(self):
+        files = self.mkfiles("a", [("big", 300), ("small", 10), ("medium", 100)])
+        done = []
+        self.svc.submit("a", files, self.examine, lambda: done.append(1))
+        self.assertTrue(self.svc.wait("a", 5))
+        self.assertEqual([f for b, f in self.examined], ["small", "medium", "big"])
+        self.assertEqual(done, [1])
+        self.assertFalse(self.svc.is_active("a"))
+        self.assertEqual(dict(self.svc.status("a")),
+                         {"queued": 0, "running": 0, "done": 3, "failed": 0})
+
+    def test_fair(self):
+        self.gate.clear()
+        self.svc.submit("a", self.mkfiles("a", [("1", 1), ("2", 2), ("3", 3)]),
+                        self.examine)
+        n = 50
+        while n > 0 and self.svc.status("a")["running"] == 0:
+            n -= 1
+            time.sleep(0.01)
+
+        # a is still next in line after its first file
+        self.svc.submit("b", self.mkfiles("b", [("1", 1), ("2", 2)]), self.examine)
+        self.assertTrue(self.svc.is_active("b"))
+        self.gate.set()
+        self.assertTrue(self.svc.wait_for_all(5))
+        self.assertEqual(self.examined, [("a", "1"), ("a", "2"), ("b", "1"),
+                                         ("a", "3"), ("b", "2")])
+
+    def test_status(self):
+        self.gate.clear()
+        files = self.mkfiles("a", [("1", 1), ("2", 2)])
+        files["bad"] = files["1"]
+        self.svc.submit("a", files, self.examine)
+        time.sleep(0.1)
+        self.assertEqual(dict(self.svc.status("a")),
+                         {"queued": 2, "running": 1, "done": 0, "failed": 0})
+        self.assertFalse(self.svc.wait("a", 0.05))
+        self.gate.set()
+        self.assertTrue(self.svc.wait("a", 5))
+        self.assertEqual(dict(self.svc.status("a")),
+                         {"queued": 0, "running": 0, "done": 2, "failed": 1})
+
+        # counters are reset on resubmission
+        self.svc.submit("a", {"1": files["1"]}, self.examine)
+        self.assertTrue(self.svc.wait("a", 5))
+        self.assertEqual(dict(self.svc.status("a")),
+                         {"queued": 0, "running": 0, "done": 1, "failed": 0})
+
+        self.assertIsNone(self.svc.status("goob"))
+        self.svc.forget("a")
+        self.assertIsNone(self.svc.status("a"))
+
+    def test_forget_active(self):
+        self.gate.clear()
+        self.svc.submit("a", self.mkfiles("a", [("1", 1), ("2", 2)]), self.examine)
+        self.svc.forget("a")
+        self.assertIsNotNone(self.svc.status("a"))
+        self.gate.set()
+        self.assertTrue(self.svc.wait("a", 5))
+        n = 50
+        while n > 0 and self.svc.status("a") is not None:
+            n -= 1
+            time.sleep(0.01)
+        self.assertIsNone(self.svc.status("a"))
+        self.assertEqual(len(self.examined), 2)
+
+        # a resubmission cancels a pending forget
+        self.gate.clear()
+        self.svc.submit("a", self.mkfiles("a", [("1", 1)]), self.examine)
+        self.svc.forget("a")
+        self.svc.submit("a", self.mkfiles("a", [("2", 2)]), self.examine)
+        self.gate.set()
+        self.assertTrue(self.svc.wait("a", 5))
+        time.sleep(0.05)
+        self.assertEqual(self.svc.status("a")["done"], 2)
+
+    def test_bounded(self):
+        self.svc.set_max_workers(2)
+        lock = threading.Lock()
+        running = [0, 0]
+        def examine(filepath, location):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+        for bag in "abc":
+            self.svc.submit(bag, self.mkfiles(bag, [("1", 1), ("2", 2), ("3", 3)]),
+                            examine)
+        self.assertTrue(self.svc.wait_for_all(5))
+        self.assertEqual(running[1], 2)
+        for bag in "abc":
+            self.assertEqual(self.svc.status(bag)["done"], 3)
+
+    def test_whendone(self):
+        # whendone is called even when there is nothing to examine
+        done = []
+        self.svc.submit("a", {}, self.examine, lambda: done.append(1))
+        self.assertEqual(done, [1])
+
+        inworker = []
+        def whendone():
+            inworker.append(self.svc.in_worker("a"))
+        self.svc.submit("a", self.mkfiles("a", [("1", 1)]), self.examine, whendone)
+        self.assertTrue(self.svc.wait("a", 5))
+        self.assertEqual(inworker, [True])
+        self.assertFalse(self.svc.in_worker())
+
+    def test_service_for(self):
+        svc = exmnr.examiner_service_for({"max_workers": 3})
+        self.assertIs(exmnr.examiner_service_for(), svc)
+        self.assertEqual(svc.max_workers, 3)
+        exmnr.examiner_service_for({"max_workers": 2})
+        self.assertEqual(svc.max_workers, 2)
+
+
+if __name__ == '__main__':
+    test.main()
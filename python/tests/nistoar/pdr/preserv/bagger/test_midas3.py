@@ -419,9 +419,13 @@ class TestMIDASMetadataBaggerMixed(test.TestCase):
         self.assertTrue(os.path.exists(self.bagr.bagdir+".lock"))
         self.assertTrue(os.path.exists(os.path.join(self.bagr.bagdir,"preserv.log")))
         self.assertTrue(self.bagr.bagbldr.logfile_is_connected())
+        self.bagr.fileExaminer.service.submit(self.bagr.fileExaminer.id, {},
+                                              lambda f, l: None)
+        self.assertIsNotNone(self.bagr.fileExaminer.status())
         self.bagr.done()
         self.assertTrue(not self.bagr.bagbldr.logfile_is_connected())
         self.assertTrue(os.path.exists(self.bagr.bagdir+".lock"))
+        self.assertIsNone(self.bagr.fileExaminer.status())
         
     def test_apply_pod_wremove(self):
         self.assertTrue(not os.path.exists(self.bagr.bagdir))
@@ -565,6 +569,53 @@ class TestMIDASMetadataBaggerMixed(test.TestCase):
             self.assertIn('size', comp)
             self.assertIn('checksum', comp)
         
+    def test_ensure_data_files_snapshot(self):
+        inpodfile = os.path.join(self.upldir,"1491","_pod.json")
+        self.bagr.apply_pod(inpodfile)
+
+        # files waiting to be examined are not recorded as scanned
+        self.bagr.ensure_data_files(examine=False)
+        queued = list(self.bagr.fileExaminer.files.keys())
+        self.assertEqual(len(queued), 4)
+        snap = self.bagr.sipscanner.load_snapshot() or {}
+        for filepath in queued:
+            self.assertNotIn(filepath, snap)
+
+        # e.g. the service restarted before they were examined
+        self.bagr.fileExaminer.files.clear()
+        self.bagr.ensure_data_files(examine="sync")
+        snap = self.bagr.sipscanner.load_snapshot()
+        self.assertEqual(sorted(snap.keys()), sorted(self.bagr.datafiles.keys()))
+        for filepath in self.bagr.datafiles:
+            comp = self.bagr.bagbldr.bag.nerd_metadata_for(filepath)
+            self.assertIn('checksum', comp)
+
+        # nothing left to examine
+        self.bagr.ensure_data_files(examine=False)
+        self.assertEqual(len(self.bagr.fileExaminer.files), 0)
+
+    def test_examined_snapshot_batches(self):
+        inpodfile = os.path.join(self.upldir,"1491","_pod.json")
+        self.bagr.apply_pod(inpodfile)
+        updates = []
+        update = self.bagr.sipscanner.update
+        def record_update(entries):
+            updates.append(list(entries.keys()))
+            update(entries)
+        self.bagr.sipscanner.update = record_update
+
+        # the examined files are recorded together once all are done
+        self.bagr.ensure_data_files(examine="sync")
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(sorted(updates[0]), sorted(self.bagr.datafiles.keys()))
+
+        # ...or in batches
+        self.bagr.sipscanner.clear()
+        self.bagr.fileExaminer.batch_size = 3
+        del updates[:]
+        self.bagr.ensure_data_files(examine="sync")
+        self.assertEqual([len(u) for u in updates], [3, 1])
+
     def test_check_checksum_files(self):
         inpodfile = os.path.join(self.upldir,"1491","_pod.json")
         metadir = os.path.join(self.bagdir, 'metadata')
@@ -344,6 +344,36 @@ class TestUpdatePrepper(test.TestCase):
         self.assertIn("bagit.txt", contents)
         self.assertIn("bag-info.txt", contents)
 
+    def test_unpack_bag_as_nopayload(self):
+        root = self.tf.track("goober")
+        bagzip = os.path.join(self.bagsdir, "ABCDEFG.2.mbag0_4-4.zip")
+        
+        self.prepr._unpack_bag_as(bagzip, root, payload=False)
+        contents = [f for f in os.listdir(root)]
+        self.assertIn("metadata", contents)
+        self.assertIn("multibag", contents)
+        self.assertIn("bag-info.txt", contents)
+        self.assertIn("data", contents)
+        self.assertEqual(os.listdir(os.path.join(root, "data")), [])
+        self.assertGreater(len(os.listdir(os.path.join(root, "metadata"))), 0)
+
+    def test_read_bag_member(self):
+        bagzip = os.path.join(self.bagsdir, "ABCDEFG.2.mbag0_4-4.zip")
+        
+        data = json.loads(self.prepr.read_bag_member(bagzip, "metadata/nerdm.json"))
+        self.assertIn("@id", data)
+
+        fd = self.prepr.open_bag_member(bagzip, "bagit.txt")
+        try:
+            self.assertIn("BagIt-Version", fd.read())
+        finally:
+            fd.close()
+
+        with self.assertRaises(KeyError):
+            self.prepr.read_bag_member(bagzip, "metadata/goober.json")
+        with self.assertRaises(prepupd.StateException):
+            self.prepr.read_bag_member(bagzip[:-4]+".7z", "bagit.txt")
+
     def test_create_from_headbag(self):
         headbag = os.path.join(self.bagsdir, "ABCDEFG.1.mbag0_4-2.zip")
         root = os.path.join(self.tf.mkdir("update"), "goober")
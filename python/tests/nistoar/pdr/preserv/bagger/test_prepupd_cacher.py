@@ -4,7 +4,7 @@ import unittest as test
 
 from nistoar.testing import *
 from nistoar.pdr.preserv.bagger import prepupd
-from nistoar.pdr import distrib
+from nistoar.pdr import distrib, utils
 
 pdrdir = os.path.dirname(os.path.dirname(os.path.dirname(
             os.path.abspath(__file__))))
@@ -214,6 +214,122 @@ class TestHeadBagCacher(test.TestCase):
 
         self.assertIsNone(self.cacher.cache_headbag("goober"))
 
+    def test_confirm_bagfile_ledger(self):
+        hbfile = os.path.join(datadir,"pdr1010.mbag0_3-2.zip")
+        shutil.copy(hbfile, self.cachedir)
+        hbfile = os.path.join(self.cachedir, "pdr1010.mbag0_3-2.zip")
+        info = {"aipid": "pdr1010", "name": "pdr1010.mbag0_3-2.zip",
+                "sinceVersion": "1", 'checksum': {'algorithm': "sha256",
+    "hash": "c35f2b8ec2a4b462c77c6c60548f9a61dc1c043ddb4ba11b388312240c1c78e0"}}
+
+        calls = []
+        checksum_of = prepupd.utils.checksum_of
+        def counting_checksum_of(fp):
+            calls.append(fp)
+            return checksum_of(fp)
+        prepupd.utils.checksum_of = counting_checksum_of
+        try:
+            self.cacher.confirm_bagfile(info)
+            self.assertEqual(len(calls), 1)
+            self.assertTrue(os.path.exists(os.path.join(self.infodir, "_checksums.json")))
+
+            # unchanged file is not re-read
+            self.cacher.confirm_bagfile(info)
+            self.assertEqual(len(calls), 1)
+
+            # a changed file is
+            with open(hbfile, 'a') as fd:
+                fd.write("x")
+            with self.assertRaises(prepupd.CorruptedBagError):
+                self.cacher.confirm_bagfile(info, False)
+            self.assertEqual(len(calls), 2)
+        finally:
+            prepupd.utils.checksum_of = checksum_of
+
+    def test_evict(self):
+        names = ["pdr1010.mbag0_3-%d.zip" % i for i in range(4)]
+        for name in names:
+            with open(os.path.join(self.cachedir, name), 'w') as fd:
+                fd.write("x" * 100)
+        for name in [names[2], names[0], names[3], names[1]]:
+            self.cacher._record_access(name)
+            time.sleep(0.01)
+        self.assertEqual([b[0] for b in self.cacher.cached_bags()],
+                         [names[2], names[0], names[3], names[1]])
+
+        self.assertEqual(self.cacher.evict(), [])
+        self.assertEqual(self.cacher.evict(max_size=250, keep=[names[2]]),
+                         [names[0], names[3]])
+        self.assertEqual(sorted([b[0] for b in self.cacher.cached_bags()]),
+                         [names[1], names[2]])
+        self.assertNotIn(names[0], self.cacher._recall_access())
+        self.assertIn(names[2], self.cacher._recall_access())
+
+    def test_evict_busy(self):
+        names = ["pdr1010.mbag0_3-%d.zip" % i for i in range(2)] + \
+                ["pdr2020.mbag0_3-0.zip", "pdr3030.mbag0_3-0.zip"]
+        for name in names + ["pdr4040.mbag0_3-0.zip.part"]:
+            with open(os.path.join(self.cachedir, name), 'w') as fd:
+                fd.write("x" * 100)
+        for name in names[:3]:
+            self.cacher._record_access(name)
+            time.sleep(0.01)
+
+        # downloads in progress are not cached bags
+        self.assertEqual([b[0] for b in self.cacher.cached_bags()][-3:], names[:3])
+        self.assertEqual(len(self.cacher.cached_bags()), 4)
+
+        # pdr1010 is being fetched; pdr3030 is not yet recorded as cached
+        lock = utils.LockedFile(os.path.join(self.cacher._lockdir, "pdr1010"), 'a')
+        with lock:
+            self.assertEqual(self.cacher.evict(max_size=100), [names[2]])
+        self.assertTrue(os.path.exists(os.path.join(self.cachedir, names[3])))
+        self.assertTrue(os.path.exists(os.path.join(self.cachedir,
+                                                    "pdr4040.mbag0_3-0.zip.part")))
+
+        # recently requested bags are not evicted
+        self.cacher.min_idle = 60
+        self.assertEqual(self.cacher.evict(max_size=100), [])
+        self.cacher.min_idle = 0
+        self.assertEqual(self.cacher.evict(max_size=100), [names[0], names[1]])
+
+    def test_cache_headbag_shared_fetch(self):
+        fetches = []
+        class FakeBagClient(object):
+            def __init__(self, aipid, svc):
+                pass
+            def describe_head_for_version(self, version):
+                return {"aipid": "pdr1010", "name": "pdr1010.mbag0_3-2.zip",
+                        "sinceVersion": "1", 'checksum': {'algorithm': "sha256",
+    "hash": "c35f2b8ec2a4b462c77c6c60548f9a61dc1c043ddb4ba11b388312240c1c78e0"}}
+            def save_bag(self, name, destdir):
+                fetches.append(name)
+                time.sleep(0.2)
+                shutil.copy(os.path.join(datadir, name), destdir)
+
+        import threading
+        BagDistribClient = prepupd.distrib.BagDistribClient
+        prepupd.distrib.BagDistribClient = FakeBagClient
+        try:
+            self.cacher.max_size = 10
+            results = []
+            def fetch():
+                results.append(self.cacher.cache_headbag("pdr1010", "1"))
+            threads = [threading.Thread(target=fetch) for i in range(3)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            prepupd.distrib.BagDistribClient = BagDistribClient
+
+        hbfile = os.path.join(self.cachedir, "pdr1010.mbag0_3-2.zip")
+        self.assertEqual(fetches, ["pdr1010.mbag0_3-2.zip"])
+        self.assertEqual(results, [hbfile]*3)
+
+        # the bag just requested is not evicted even though it exceeds max_size
+        self.assertTrue(os.path.exists(hbfile))
+
         
         
                     
@@ -0,0 +1,107 @@
+import os, sys, pdb, time, json
+import unittest as test
+
+from nistoar.testing import *
+from nistoar.pdr.preserv.bagger import sipscan
+
+def setUpModule():
+    ensure_tmpdir()
+
+def tearDownModule():
+    rmtmpdir()
+
+class TestSIPScanner(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.revdir = self.tf.mkdir("review")
+        self.upldir = self.tf.mkdir("upload")
+        self.snapfile = self.tf.track("sipscan.json")
+        for path in ["a.txt", "sub/b.txt", "sub/deep/c.txt", ".hidden", "_pod.json",
+                     "_sub/d.txt", ".git/e.txt"]:
+            self.write(self.revdir, path, "review")
+        self.write(self.upldir, "a.txt", "upload")
+        self.scanner = sipscan.SIPScanner([self.revdir, self.upldir], self.snapfile)
+
+    def tearDown(self):
+        self.tf.clean()
+
+    def write(self, root, path, content):
+        path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fd:
+            fd.write(content)
+
+    def test_scan_files(self):
+        files = sipscan.scan_files([self.revdir, self.upldir])
+        self.assertEqual(sorted(files.keys()),
+                         ["a.txt", "sub/b.txt", "sub/deep/c.txt"])
+        self.assertEqual(files["a.txt"][0], os.path.join(self.upldir, "a.txt"))
+        self.assertEqual(files["a.txt"][1], 6)
+        self.assertEqual(files["sub/b.txt"][0], os.path.join(self.revdir, "sub/b.txt"))
+        st = os.stat(os.path.join(self.revdir, "sub/b.txt"))
+        self.assertEqual(files["sub/b.txt"][1:], (st.st_size, st.st_mtime, st.st_ino))
+
+    def test_scan_files_noscandir(self):
+        files = sipscan.scan_files([self.revdir, self.upldir])
+        sd = sipscan.scandir
+        sipscan.scandir = None
+        try:
+            self.assertEqual(sipscan.scan_files([self.revdir, self.upldir]), files)
+        finally:
+            sipscan.scandir = sd
+
+    def test_compare(self):
+        current = self.scanner.scan()
+        self.assertIsNone(self.scanner.load_snapshot())
+        diff = self.scanner.compare(current)
+        self.assertEqual(sorted(diff['added']), ["a.txt", "sub/b.txt", "sub/deep/c.txt"])
+        self.assertEqual(diff['changed'], [])
+        self.assertEqual(diff['removed'], [])
+
+        self.scanner.save(current)
+        self.assertTrue(os.path.isfile(self.snapfile))
+        self.assertEqual(self.scanner.load_snapshot(), current)
+        diff = self.scanner.compare(self.scanner.scan())
+        self.assertEqual(diff, {"added": [], "changed": [], "removed": []})
+
+        self.write(self.revdir, "sub/b.txt", "changed!")
+        os.remove(os.path.join(self.revdir, "sub/deep/c.txt"))
+        self.write(self.revdir, "sub/new.txt", "new")
+        os.remove(os.path.join(self.upldir, "a.txt"))     # now found in review
+        diff = self.scanner.compare(self.scanner.scan())
+        self.assertEqual(diff['added'], ["sub/new.txt"])
+        self.assertEqual(sorted(diff['changed']), ["a.txt", "sub/b.txt"])
+        self.assertEqual(diff['removed'], ["sub/deep/c.txt"])
+
+    def test_only(self):
+        current = self.scanner.scan()
+        self.scanner.save(current, ["a.txt", "sub/b.txt"])
+        self.assertEqual(sorted(self.scanner.load_snapshot().keys()), ["a.txt", "sub/b.txt"])
+
+        diff = self.scanner.compare(self.scanner.scan(), ["a.txt", "sub/deep/c.txt"])
+        self.assertEqual(diff, {"added": ["sub/deep/c.txt"], "changed": [], "removed": []})
+
+    def test_update(self):
+        current = self.scanner.scan()
+        self.scanner.update({"a.txt": current["a.txt"]})
+        self.assertEqual(list(self.scanner.load_snapshot().keys()), ["a.txt"])
+        self.scanner.update({"sub/b.txt": current["sub/b.txt"]})
+        diff = self.scanner.compare(current)
+        self.assertEqual(diff, {"added": ["sub/deep/c.txt"], "changed": [], "removed": []})
+
+    def test_forget(self):
+        self.scanner.forget(["a.txt"])
+        self.scanner.save(self.scanner.scan())
+        self.scanner.forget(["a.txt"])
+        diff = self.scanner.compare(self.scanner.scan())
+        self.assertEqual(diff, {"added": ["a.txt"], "changed": [], "removed": []})
+
+        self.scanner.clear()
+        self.assertFalse(os.path.exists(self.snapfile))
+        self.assertEqual(len(self.scanner.compare(self.scanner.scan())['added']), 3)
+
+
+if __name__ == '__main__':
+    test.main()
@@ -347,7 +347,224 @@ class TestNISTBag(test.TestCase):
     def test_is_headbag(self):
         self.assertTrue(self.bag.is_headbag())
 
-                         
+class TestIndexedNISTBag(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.bagdir = self.tf.track("samplembag")
+        shutil.copytree(bagdir, self.bagdir)
+        self.bag = bag.NISTBag(self.bagdir, use_index=True)
+
+    def tearDown(self):
+        self.bag = None
+        self.tf.clean()
+
+    def test_index(self):
+        self.assertFalse(os.path.exists(self.bag.index_file()))
+        self.assertIsNotNone(self.bag.index)
+        self.assertTrue(os.path.exists(self.bag.index_file()))
+        self.assertEqual(len(self.bag.index), 4)
+        self.assertTrue(self.bag.index.is_complete())
+
+        self.bag.drop_index()
+        self.assertFalse(os.path.exists(self.bag.index_file()))
+        self.assertEqual(len(self.bag.index), 4)
+        self.bag.drop_index(True)
+        self.assertIsNone(self.bag.index)
+
+        self.assertIsNone(bag.NISTBag(self.bagdir).index)
+
+    def test_nerdm_record(self):
+        data = self.bag.nerdm_record()
+        self.assertIn("ediid", data)
+        self.assertEqual(len(data['components']), 5)
+        for comp in data['components']:
+            self.assertNotIn("_schema", comp)
+        self.assertEqual([c.get('filepath') for c in data['components'][-4:]],
+                         ["trial1.json", "trial2.json", "trial3", 
+                          "trial3/trial3a.json"])
+
+        # changes to the metadata are picked up
+        nerdf = self.bag.nerd_file_for("trial2.json")
+        with open(nerdf) as fd:
+            md = json.load(fd, object_pairs_hook=OrderedDict)
+        md['title'] = "A New Title for this file"
+        with open(nerdf, 'w') as fd:
+            json.dump(md, fd, indent=4)
+        data = self.bag.nerdm_record()
+        self.assertEqual(data['components'][-3]['title'], md['title'])
+
+    def test_is_data_file(self):
+        self.assertTrue( self.bag.is_data_file("trial1.json") )
+        self.assertFalse( self.bag.is_data_file("trial3") )
+        self.assertFalse( self.bag.is_data_file("trial4") )
+
+        os.remove(os.path.join(self.bag.data_dir, "trial1.json"))
+        self.assertTrue( self.bag.is_data_file("trial1.json") )
+
+    def test_is_subcoll(self):
+        self.assertTrue( self.bag.is_subcoll("trial3") )
+        self.assertFalse( self.bag.is_subcoll("trial1.json") )
+
+        shutil.rmtree(os.path.join(self.bag.data_dir, "trial3"))
+        self.assertTrue( self.bag.is_subcoll("trial3") )
+
+    def test_subcoll_children(self):
+        shutil.rmtree(os.path.join(self.bag.data_dir, "trial3"))
+        children = self.bag.subcoll_children("")
+        self.assertEqual(len(children), 3)
+        for child in "trial1.json trial2.json trial3".split():
+            self.assertIn(child, children)
+        self.assertEqual(self.bag.subcoll_children("trial3"), ["trial3a.json"])
+
+    def test_iter_data_components(self):
+        self.assertEqual(list(self.bag.iter_data_components()),
+                         ["trial1.json", "trial2.json", "trial3",
+                          "trial3/trial3a.json"])
+        self.assertEqual(list(self.bag.iter_data_components("DataFile")),
+                         ["trial1.json", "trial2.json", "trial3/trial3a.json"])
+        self.assertEqual(list(self.bag.iter_data_components("nrdp:Subcollection")),
+                         ["trial3"])
+
+        # without an index
+        self.bag = bag.NISTBag(self.bagdir)
+        self.assertEqual(sorted(self.bag.iter_data_components("DataFile")),
+                         ["trial1.json", "trial2.json", "trial3/trial3a.json"])
+
+    def test_index_component(self):
+        self.assertEqual(len(self.bag.index), 4)
+        shutil.rmtree(os.path.join(self.bag.metadata_dir, "trial3"))
+        self.bag.unindex_component("trial3")
+        self.assertEqual(list(self.bag.iter_data_components()),
+                         ["trial1.json", "trial2.json"])
+
+        mdir = os.path.join(self.bag.metadata_dir, "trial3")
+        os.mkdir(mdir)
+        with open(os.path.join(mdir, "nerdm.json"), 'w') as fd:
+            json.dump({"@type": ["nrdp:Subcollection"], "filepath": "trial3"}, fd)
+        self.bag.index_component("trial3")
+        self.assertTrue(self.bag.index.exists("trial3"))
+        self.assertTrue(self.bag.is_subcoll("trial3"))
+
+        # an instance not using the index removes it when notified of changes
+        bag.NISTBag(self.bagdir).index_component("trial3")
+        self.assertFalse(os.path.exists(self.bag.index_file()))
+
+    def test_unindexed_writes(self):
+        self.assertEqual(len(self.bag.index), 4)
+
+        # metadata written without updating the index
+        mdir = os.path.join(self.bag.metadata_dir, "trial4")
+        os.mkdir(mdir)
+        with open(os.path.join(mdir, "nerdm.json"), 'w') as fd:
+            json.dump({"@type": ["nrdp:Subcollection"], "filepath": "trial4"}, fd)
+        shutil.rmtree(os.path.join(self.bag.metadata_dir, "trial3"))
+        shutil.rmtree(os.path.join(self.bag.data_dir, "trial3"))
+        nerdf = self.bag.nerd_file_for("trial2.json")
+        with open(nerdf) as fd:
+            md = json.load(fd, object_pairs_hook=OrderedDict)
+        md['@type'] = ["nrdp:Subcollection"]
+        with open(nerdf, 'w') as fd:
+            json.dump(md, fd, indent=4)
+
+        self.assertTrue(self.bag.is_subcoll("trial4"))
+        self.assertFalse(self.bag.is_data_file("trial3/trial3a.json"))
+        self.assertTrue(self.bag.is_data_file("trial1.json"))
+        self.assertEqual(list(self.bag.iter_data_components()),
+                         ["trial1.json", "trial2.json", "trial4"])
+        self.assertEqual(list(self.bag.iter_data_components("DataFile")),
+                         ["trial1.json"])
+        self.assertEqual(sorted(self.bag.subcoll_children("")),
+                         ["trial1.json", "trial2.json", "trial4"])
+
+    def test_trusted_index(self):
+        self.assertEqual(len(self.bag.index), 4)
+        self.assertEqual(sorted(self.bag.subcoll_children("")),
+                         ["trial1.json", "trial2.json", "trial3"])
+
+        # an unchanged tree is not rescanned
+        def nosync(idx):
+            raise AssertionError("unexpected index resync")
+        self.bag._sync_index = nosync
+        self.bag.index.put("trial3/trial3a.json",
+                           self.bag.nerd_metadata_for("trial3/trial3a.json"))
+        self.bag.index_component("trial1.json")
+        self.assertEqual(list(self.bag.iter_data_components("DataFile")),
+                         ["trial1.json", "trial2.json", "trial3/trial3a.json"])
+        self.assertEqual(self.bag.subcoll_children("trial3"), ["trial3a.json"])
+        self.assertIsNotNone(self.bag.nerdm_record())
+
+class TestCachedNISTBag(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.bagdir = self.tf.track("samplembag")
+        shutil.copytree(bagdir, self.bagdir)
+        self.bag = bag.NISTBag(self.bagdir, cache_record=True)
+
+    def tearDown(self):
+        self.bag = None
+        self.tf.clean()
+
+    def update_title(self, filepath, title):
+        nerdf = self.bag.nerd_file_for(filepath)
+        with open(nerdf) as fd:
+            md = json.load(fd, object_pairs_hook=OrderedDict)
+        md['title'] = title
+        with open(nerdf, 'w') as fd:
+            json.dump(md, fd, indent=4)
+
+    def get_comp(self, nerdm, filepath):
+        return [c for c in nerdm['components'] if c.get('filepath') == filepath][0]
+
+    def test_nerdm_record(self):
+        data = self.bag.nerdm_record()
+        self.assertEqual(data, bag.NISTBag(self.bagdir).nerdm_record())
+        self.assertEqual(len(data['components']), 5)
+
+        # the returned record can be changed without affecting the cache
+        data['components'].pop()
+        data['title'] = "Goob"
+        data = self.bag.nerdm_record()
+        self.assertEqual(len(data['components']), 5)
+        self.assertNotEqual(data['title'], "Goob")
+
+    def test_component_changed(self):
+        self.bag.nerdm_record()
+
+        # unreported changes are not picked up
+        self.update_title("trial2.json", "A New Title")
+        data = self.bag.nerdm_record()
+        self.assertNotEqual(self.get_comp(data, "trial2.json").get('title'),
+                            "A New Title")
+
+        self.bag.component_changed("trial2.json")
+        data = self.bag.nerdm_record()
+        self.assertEqual(self.get_comp(data, "trial2.json")['title'], "A New Title")
+        self.assertEqual(len(data['components']), 5)
+
+        self.update_title("", "A New Dataset Title")
+        self.bag.component_changed("")
+        data = self.bag.nerdm_record()
+        self.assertEqual(data['title'], "A New Dataset Title")
+        self.assertEqual(len(data['components']), 5)
+
+    def test_removed(self):
+        self.bag.nerdm_record()
+        shutil.rmtree(os.path.join(self.bag.metadata_dir, "trial3"))
+        self.bag.component_changed("trial3")
+        data = self.bag.nerdm_record()
+        self.assertEqual(len(data['components']), 3)
+        self.assertNotIn("trial3/trial3a.json",
+                         [c.get('filepath') for c in data['components']])
+
+    def test_forget_cached_record(self):
+        self.bag.nerdm_record()
+        self.update_title("trial2.json", "A New Title")
+        self.bag.forget_cached_record()
+        data = self.bag.nerdm_record()
+        self.assertEqual(self.get_comp(data, "trial2.json")['title'], "A New Title")
+
 
 if __name__ == '__main__':
     test.main()
@@ -586,6 +586,54 @@ class TestBuilder2(test.TestCase):
         self.assertFalse( os.path.exists(os.path.join(self.bag.bagdir,
                                                       "data", "trial1.json")) )
 
+    def test_component_index(self):
+        self.cfg['component_index'] = True
+        self.bag = bldr.BagBuilder(self.tf.root, "testbag", self.cfg)
+        path = os.path.join("trial1","gold","trial1.json")
+
+        self.bag.add_data_file(path, os.path.join(datadir,"trial1.json"))
+        idx = self.bag.bag.index
+        self.assertIsNotNone(idx)
+        self.assertEqual(idx.filepaths(), ["trial1", "trial1/gold", path])
+        self.assertEqual(idx.filepaths("DataFile"), [path])
+        self.assertEqual(self.bag.bag.subcoll_children("trial1"), ["gold"])
+
+        self.bag.update_metadata_for(path, {"title": "All that glitters"})
+        self.assertEqual(idx.metadata_for(path)[0]['title'], "All that glitters")
+
+        self.assertTrue(self.bag.remove_component("trial1/gold"))
+        self.assertEqual(idx.filepaths(), ["trial1"])
+
+        self.bag.add_data_file("trial2.json", os.path.join(datadir,"trial2.json"))
+        self.assertTrue(os.path.exists(self.bag.bag.index_file()))
+        self.bag.finalize_bag()
+        self.assertFalse(os.path.exists(self.bag.bag.index_file()))
+
+    def test_cache_nerdm_record(self):
+        self.cfg['cache_nerdm_record'] = True
+        self.bag = bldr.BagBuilder(self.tf.root, "testbag", self.cfg)
+        path = os.path.join("trial1","gold","trial1.json")
+
+        self.bag.update_metadata_for("", {"title": "Loot"})
+        self.bag.add_data_file(path, os.path.join(datadir,"trial1.json"))
+        nerdm = self.bag.bag.nerdm_record(True)
+        self.assertEqual(nerdm['title'], "Loot")
+        self.assertEqual([c['filepath'] for c in nerdm['components']],
+                         ["trial1", "trial1/gold", path])
+
+        self.bag.update_metadata_for(path, {"title": "All that glitters"})
+        self.bag.update_annotations_for("trial1", {"title": "Gold plated"})
+        self.bag.update_metadata_for("", {"title": "Treasure"})
+        nerdm = self.bag.bag.nerdm_record(True)
+        self.assertEqual(nerdm['title'], "Treasure")
+        self.assertEqual(nerdm['components'][0]['title'], "Gold plated")
+        self.assertEqual(nerdm['components'][2]['title'], "All that glitters")
+        self.assertNotIn('title', self.bag.bag.nerdm_record(False)['components'][0])
+
+        self.assertTrue(self.bag.remove_component("trial1/gold"))
+        nerdm = self.bag.bag.nerdm_record(True)
+        self.assertEqual([c['filepath'] for c in nerdm['components']], ["trial1"])
+
     def test_remove_nonfile_component(self):
         self.bag.define_component("@id:goober", "nrd:Goober")
         self.bag.define_component("@id:#readme.txt", "nrd:Hidden")
@@ -1136,6 +1184,34 @@ class TestBuilder2(test.TestCase):
         self.assertEqual(md['filepath'], "gurn")
         self.assertEqual(md['@id'], "cmps/gurn")
 
+    def test_add_data_file_checksums(self):
+        srcfile = os.path.join(datadir, "trial1.json")
+        self.bag.csengine.cfg['extra_algorithms'] = ['md5']
+        self.bag.csengine.cache = None
+        def noread(filepath, algorithm=None):
+            raise AssertionError("file re-read for checksum: "+filepath)
+        self.bag.csengine.checksum_of = noread
+
+        # the checksums calculated while copying go straight into the metadata
+        self.bag.add_data_file("gurn/trial1.json", srcfile)
+        md = self.bag.bag.nerd_metadata_for("gurn/trial1.json")
+        self.assertEqual(md['checksum'], {"algorithm": {'@type': 'Thing',
+                                                        "tag": "sha256" },
+    "hash": "d155d99281ace123351a311084cd8e34edda6a9afcddd76eb039bad479595ec9"})
+        self.assertEqual([c['algorithm']['tag'] for c in md['alternateChecksums']],
+                         ["md5"])
+        self.assertEqual(len(md['alternateChecksums'][0]['hash']), 32)
+
+        # they are kept when an unchanged file is examined again...
+        del self.bag.csengine.checksum_of
+        md = self.bag.describe_data_file(srcfile, "gurn/trial1.json")
+        self.assertIn('alternateChecksums', md)
+
+        # ...but not when it has changed
+        md = self.bag.describe_data_file(os.path.join(datadir, "trial2.json"),
+                                         "gurn/trial1.json")
+        self.assertNotIn('alternateChecksums', md)
+
     def test_update_ediid(self):
         self.assertIsNone(self.bag.ediid)
         self.bag.ediid = "9999"
@@ -0,0 +1,85 @@
+import os, sys, pdb
+import unittest as test
+
+from nistoar.testing import *
+import nistoar.pdr.preserv.bagit.index as idx
+
+def setUpModule():
+    ensure_tmpdir()
+
+def tearDownModule():
+    rmtmpdir()
+
+class TestComponentIndex(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.idxfile = self.tf.track("test_index.sqlite")
+        self.idx = idx.ComponentIndex(self.idxfile)
+
+    def tearDown(self):
+        self.idx.close()
+        self.tf.clean()
+
+    def load(self):
+        self.idx.put("a", {"@type": ["nrdp:Subcollection"], "filepath": "a"})
+        self.idx.put("a/b.txt", {"@type": ["nrdp:DataFile", "dcat:Distribution"],
+                                 "filepath": "a/b.txt"}, (3, 2.0))
+        self.idx.put("a_x", {"@type": ["nrdp:DataFile"], "filepath": "a_x"})
+
+    def test_ctor(self):
+        self.assertEqual(self.idx.file, self.idxfile)
+        self.assertTrue(os.path.exists(self.idxfile))
+        self.assertEqual(len(self.idx), 0)
+        self.assertFalse(self.idx.is_complete())
+
+    def test_put(self):
+        self.load()
+        self.assertEqual(len(self.idx), 3)
+        self.assertTrue(self.idx.exists("a/b.txt"))
+        self.assertFalse(self.idx.exists("b.txt"))
+        self.assertEqual(self.idx.types_of("a/b.txt"), ["DataFile", "Distribution"])
+        self.assertIsNone(self.idx.types_of("b.txt"))
+
+        md = self.idx.metadata_for("a/b.txt")
+        self.assertEqual(md[0]['filepath'], "a/b.txt")
+        self.assertEqual(md[1:], (3, 2.0))
+        self.assertIsNone(self.idx.metadata_for("b.txt"))
+
+        self.idx.put("a/b.txt", {"@type": ["nrdp:ChecksumFile"]})
+        self.assertEqual(len(self.idx), 3)
+        self.assertEqual(self.idx.types_of("a/b.txt"), ["ChecksumFile"])
+
+    def test_queries(self):
+        self.load()
+        self.assertEqual(self.idx.filepaths(), ["a", "a/b.txt", "a_x"])
+        self.assertEqual(self.idx.filepaths("DataFile"), ["a/b.txt", "a_x"])
+        self.assertEqual(self.idx.filepaths("nrdp:DataFile"), ["a/b.txt", "a_x"])
+        self.assertEqual(self.idx.filepaths("Subcollection"), ["a"])
+        self.assertEqual(self.idx.children_of(""), ["a", "a_x"])
+        self.assertEqual(self.idx.children_of("a"), ["b.txt"])
+        self.assertEqual(self.idx.children_of("a_x"), [])
+
+    def test_remove(self):
+        self.load()
+        self.idx.remove("a")
+        self.assertEqual(self.idx.filepaths(), ["a_x"])
+        self.assertEqual(self.idx.filepaths("DataFile"), ["a_x"])
+
+    def test_complete(self):
+        self.load()
+        self.idx.mark_complete()
+        self.assertTrue(self.idx.is_complete())
+        self.idx.close()
+
+        self.idx = idx.ComponentIndex(self.idxfile)
+        self.assertTrue(self.idx.is_complete())
+        self.assertEqual(len(self.idx), 3)
+
+        self.idx.clear()
+        self.assertFalse(self.idx.is_complete())
+        self.assertEqual(len(self.idx), 0)
+
+
+if __name__ == '__main__':
+    test.main()
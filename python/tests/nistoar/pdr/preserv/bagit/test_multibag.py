@@ -123,6 +123,60 @@ class TestOARSplitter(test.TestCase):
         for mf in mfs:
             self.assertLess(mf['totalsize'], 1.05*400000)
 
+    def test_plan_balanced(self):
+        bagdir = os.path.join(self.workdir,"dataset")
+        mkbag(bagdir)
+
+        with self.assertRaises(ValueError):
+            multibag.OARSplitter(400000, strategy="goob")
+
+        for strategy in ("ffd", "balanced"):
+            spltr = multibag.OARSplitter(400000, strategy=strategy)
+            plan = spltr.plan(bagdir)
+
+            self.assertIsInstance(plan, multibag.OARSplitPlan)
+            self.assertTrue(plan.is_complete())
+            mfs = list(plan.manifests())
+            self.assertGreater(len(mfs), 1)
+            for i in range(len(mfs)-1):
+                self.assertEqual(len([p for p in mfs[i]['contents']
+                                        if p.startswith("metadata/")]), 0)
+            self.assertEqual(len([p for p in mfs[-1]['contents']
+                                  if p.startswith("metadata/")]), 22)
+            for mf in mfs:
+                self.assertLess(mf['totalsize'], 1.05*400000)
+
+class TestPackFiles(test.TestCase):
+
+    def setUp(self):
+        sizes = [("a/1", 40), ("a/2", 30), ("a/3", 20), ("b/x", 70), ("c/y", 10),
+                 ("big", 500)]
+        self.finfos = [{"path": "/data/"+p, "size": s} for p, s in sizes]
+
+    def summarize(self, groups):
+        return [(sum([f['size'] for f in g]), [f['path'][6:] for f in g]) for g in groups]
+
+    def test_ffd(self):
+        groups = multibag.pack_files(self.finfos, 100, 80, "ffd")
+        self.assertEqual(self.summarize(groups),
+                         [(80, ["a/1", "a/2", "c/y"]), (20, ["a/3"]), (70, ["b/x"]),
+                          (500, ["big"])])
+
+    def test_balanced(self):
+        groups = multibag.pack_files(self.finfos, 100, 80, "balanced")
+        self.assertEqual(self.summarize(groups),
+                         [(70, ["a/1", "a/2"]), (30, ["a/3", "c/y"]), (70, ["b/x"]),
+                          (500, ["big"])])
+
+    def test_nolimit(self):
+        groups = multibag.pack_files(self.finfos, 0)
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(len(groups[0]), 6)
+        self.assertEqual(multibag.pack_files([], 0), [])
+
+        with self.assertRaises(ValueError):
+            multibag.pack_files(self.finfos, 100, 80, "goob")
+
 class TestMultibagSplitter(test.TestCase):
 
     def setUp(self):
@@ -159,6 +213,24 @@ class TestMultibagSplitter(test.TestCase):
         self.assertEqual(self.spltr.maxhbsz, 10000000)
         self.assertEqual(self.spltr.trgsz, 10000000)
 
+    def test_plan(self):
+        cfg = { "max_bag_size": 300000, "split_strategy": "balanced" }
+        self.spltr = multibag.MultibagSplitter(self.bagdir, cfg)
+        plan = self.spltr.plan()
+        self.assertEqual(plan['strategy'], "balanced")
+        self.assertGreater(len(plan['members']), 1)
+        self.assertTrue(plan['members'][-1]['head'])
+        self.assertFalse(plan['members'][0]['head'])
+        self.assertEqual(plan['total_size'], sum([m['size'] for m in plan['members']]))
+        for m in plan['members']:
+            self.assertGreater(m['count'], 0)
+
+        # nothing is written to disk
+        self.assertEqual(os.listdir(self.workdir), ["dataset-0"])
+
+        with self.assertRaises(multibag.ConfigurationException):
+            multibag.MultibagSplitter(self.bagdir, {"split_strategy": "goob"})
+
     def test_check(self):
         cfg = {
             "max_bag_size": 1000000000,
@@ -295,7 +367,32 @@ class TestMultibagSplitter(test.TestCase):
         except Exception as ex:
             self.assertEqual(len(ex.errors), 2)
 
-                         
+    def test_verify_complete_threaded(self):
+        cfg = {
+            "max_bag_size": 400000,
+            "max_headbag_size": 50000,
+            "verify_complete": False,
+            "verify_threads": 3
+        }
+        self.spltr = multibag.MultibagSplitter(self.bagdir, cfg)
+
+        bags = self.spltr.split(self.workdir)
+        report = self.spltr._verify_complete(self.bagdir, bags)
+        self.assertEqual(report['members'], len(bags))
+        self.assertEqual(report['files'], 44)
+        self.assertGreaterEqual(report['total_time'], report['scan_time'])
+
+        with open(os.path.join(bags[0],"manifest-sha256.txt")) as fd:
+            datafile = fd.readline().strip().split()[-1]
+        os.remove(os.path.join(bags[0], datafile))
+
+        try:
+            self.spltr._verify_complete(self.bagdir, bags)
+            self.fail("Failed to raise Validation exception")
+        except Exception as ex:
+            self.assertEqual(len(ex.errors), 1)
+            self.assertIn(datafile, ex.errors[0])
+
     def test_confirm_found(self):
         cfg = {
             "max_bag_size": 400000,
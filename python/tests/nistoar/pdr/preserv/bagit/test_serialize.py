@@ -1,4 +1,4 @@
-import os, pdb, sys, json, logging
+import os, pdb, sys, json, logging, hashlib, time
 import subprocess as sp
 import zipfile as zip
 import unittest as test
@@ -7,6 +7,8 @@ from nistoar.testing import *
 from nistoar.pdr.preserv.bagit import serialize as ser
 import nistoar.pdr.preserv.bagit.builder as bldr
 from nistoar.pdr.preserv.bagit.exceptions import BagSerializationError
+from nistoar.pdr.exceptions import StateException
+from nistoar.pdr.preserv import checksum
 
 def setUpModule():
     global loghdlr
@@ -28,6 +30,7 @@ def tearDownModule():
 
 exedir = os.path.dirname(__file__)
 badsip = os.path.join(os.path.dirname(exedir),"data","badsip")
+samplembag = os.path.join(os.path.dirname(exedir),"data","samplembag")
 
 log = logging.getLogger()
 
@@ -105,6 +108,110 @@ class TestSerialize(test.TestCase):
             ser.zip7_serialize(baddir, destdir, log, destfile)
         self.assertTrue(not os.path.exists(outzip))
 
+class TestZipStream(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.tmpdir = self.tf.mkdir("ser")
+        
+    def tearDown(self):
+        self.tf.clean()
+
+    def sha256(self, filepath):
+        with open(filepath, 'rb') as fd:
+            return hashlib.sha256(fd.read()).hexdigest()
+
+    def test_is_compressed(self):
+        self.assertTrue(ser._is_compressed("goob.zip"))
+        self.assertTrue(ser._is_compressed("goob.JPG"))
+        self.assertTrue(ser._is_compressed("goob.tar.gz"))
+        self.assertFalse(ser._is_compressed("goob.json"))
+        self.assertFalse(ser._is_compressed("goob.txt"))
+
+    def test_writer(self):
+        outzip = os.path.join(self.tmpdir, "test.zip")
+        with open(outzip, 'wb') as fd:
+            zw = ser.ZipStreamWriter(fd)
+            zw.add_dir("badsip")
+            zw.add_file(os.path.join(badsip, "trial1.json"), "badsip/trial1.json")
+            zw.add_file(os.path.join(badsip, "trial1.json"), "badsip/stored.json",
+                        False)
+            csum = zw.close()
+        self.assertEqual(csum, self.sha256(outzip))
+        self.assertEqual(zw.size, os.stat(outzip).st_size)
+
+        z = zip.ZipFile(outzip)
+        self.assertIsNone(z.testzip())
+        self.assertEqual(z.namelist(),
+                  ["badsip/", "badsip/trial1.json", "badsip/stored.json"])
+        self.assertEqual(z.getinfo("badsip/trial1.json").compress_type,
+                         zip.ZIP_DEFLATED)
+        self.assertEqual(z.getinfo("badsip/stored.json").compress_type,
+                         zip.ZIP_STORED)
+        with open(os.path.join(badsip, "trial1.json"), 'rb') as fd:
+            self.assertEqual(z.read("badsip/stored.json"), fd.read())
+
+    def test_zip64(self):
+        # force the use of ZIP64 structures on a small archive
+        limits = (ser._ZIP64_LIMIT, ser._ZIP64_ENTRY_THRESHOLD,
+                  ser._ZIP_COUNT_LIMIT)
+        ser._ZIP64_LIMIT = 200
+        ser._ZIP64_ENTRY_THRESHOLD = 100
+        ser._ZIP_COUNT_LIMIT = 5
+        try:
+            outzip = ser.zipstream_serialize(samplembag, self.tmpdir, log)
+        finally:
+            (ser._ZIP64_LIMIT, ser._ZIP64_ENTRY_THRESHOLD,
+             ser._ZIP_COUNT_LIMIT) = limits
+
+        z = zip.ZipFile(outzip)
+        self.assertIsNone(z.testzip())
+        self.assertIn("samplembag/data/trial1.json", z.namelist())
+        with open(os.path.join(samplembag, "data", "trial1.json"), 'rb') as fd:
+            self.assertEqual(z.read("samplembag/data/trial1.json"), fd.read())
+
+    def test_zipstream_serialize(self):
+        progress = []
+        outzip = ser.zipstream_serialize(samplembag, self.tmpdir, log,
+                                 progress=lambda d, t: progress.append((d, t)))
+        self.assertEqual(outzip, os.path.join(self.tmpdir, "samplembag.zip"))
+        self.assertTrue(zip.is_zipfile(outzip))
+        z = zip.ZipFile(outzip)
+        self.assertIsNone(z.testzip())
+        contents = z.namelist()
+        self.assertIn("samplembag/", contents)
+        self.assertIn("samplembag/bagit.txt", contents)
+        self.assertIn("samplembag/data/trial1.json", contents)
+
+        self.assertTrue(len(progress) > 0)
+        self.assertEqual(progress[-1][0], progress[-1][1])
+
+        # the checksum was cached
+        self.assertEqual(
+            checksum.default_cache.get(checksum.file_signature(outzip)),
+            self.sha256(outzip))
+
+    def test_zipstream_serialize_fail(self):
+        with self.assertRaises(StateException):
+            ser.zipstream_serialize(os.path.join(badsip, "goob"), self.tmpdir,
+                                    log)
+        self.assertTrue(not os.path.exists(os.path.join(self.tmpdir,"goob.zip")))
+
+class TestBandwidthLimiter(test.TestCase):
+
+    def test_nolimit(self):
+        lim = ser.BandwidthLimiter(0)
+        start = time.time()
+        lim.consume(100000000)
+        self.assertLess(time.time() - start, 0.1)
+
+    def test_limit(self):
+        lim = ser.BandwidthLimiter(1000)
+        start = time.time()
+        lim.consume(200)
+        lim.consume(200)
+        self.assertGreater(time.time() - start, 0.35)
+
 class TestDefaultSerializer(test.TestCase):
     def setUp(self):
         self.tf = Tempfiles()
@@ -115,6 +222,7 @@ class TestDefaultSerializer(test.TestCase):
         
     def testCtor(self):
         self.assertIn('zip', self.ser.formats)
+        self.assertIn('zipcmd', self.ser.formats)
         self.assertIn('7z', self.ser.formats)
 
     def test_zip(self):
@@ -6,6 +6,7 @@ from collections import OrderedDict
 
 from nistoar.testing import *
 import nistoar.pdr.preserv.bagit.validate.bagit as val
+import nistoar.pdr.preserv.checksum as cs
 import nistoar.pdr.preserv.bagit.bag as bag
 import nistoar.pdr.preserv.bagit.exceptions as bagex
 import nistoar.pdr.exceptions as exceptions
@@ -202,6 +203,54 @@ class TestBagItValidator(test.TestCase):
         errs = self.valid8.test_manifest(self.bag)
         self.assertEqual(len(errs.failed()), 0)
             
+    def test_test_manifest_ledger(self):
+        ledgerdir = self.tf.track("ledgers")
+        self.valid8.cfg = {
+            "test_manifest": { "checksum_ledger_dir": ledgerdir },
+            "checksum": { "workers": 2 }
+        }
+        errs = self.valid8.test_manifest(self.bag)
+        self.assertEqual(errs.failed(), [],
+                      "False Positives: "+ str([str(e) for e in errs.failed()]))
+        ledgerf = os.path.join(ledgerdir, self.bag.name+".csledger.json")
+        self.assertTrue(os.path.isfile(ledgerf))
+        with open(ledgerf) as fd:
+            ledger = json.load(fd)
+        self.assertIn("data/trial1.json", ledger)
+
+        # alter a file without changing its size, mtime, or inode: as the
+        # ledger says it is unchanged, it is not re-read
+        cs.default_cache.clear()
+        df = os.path.join(self.bag.data_dir, "trial1.json")
+        st = os.stat(df)
+        with open(df, 'r+') as fd:
+            c = fd.read(1)
+            fd.seek(0)
+            fd.write((c == ' ' and '\t') or ' ')
+        os.utime(df, (st.st_atime, st.st_mtime))
+        errs = self.valid8.test_manifest(self.bag)
+        self.assertEqual(errs.failed(), [])
+
+        # without the ledger, the change is detected
+        self.valid8.cfg = {}
+        errs = self.valid8.test_manifest(self.bag)
+        self.assertEqual(len(errs.failed()), 1)
+        self.assertTrue(has_error(errs, "3-2-2"))
+
+        # a changed mtime forces a re-check
+        self.valid8.cfg = {
+            "test_manifest": { "checksum_ledger_dir": ledgerdir }
+        }
+        cs.default_cache.clear()
+        os.utime(df, (st.st_atime, st.st_mtime + 5))
+        errs = self.valid8.test_manifest(self.bag)
+        self.assertEqual(len(errs.failed()), 1)
+        self.assertTrue(has_error(errs, "3-2-2"))
+
+        # ...and the failure is remembered
+        errs = self.valid8.test_manifest(self.bag)
+        self.assertTrue(has_error(errs, "3-2-2"))
+
     def test_test_baginfo(self):
         errs = self.valid8.test_baginfo(self.bag)
         self.assertEqual(errs.failed(), [],
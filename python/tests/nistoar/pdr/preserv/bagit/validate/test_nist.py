@@ -432,6 +432,58 @@ class TestMultibagValidator(test.TestCase):
         self.assertEqual(errs.failed()[0].label, "4.1-4-2c")
         self.assertEqual(errs.failed()[1].label, "4.1-4-2a")
 
+    def test_parallel_nerdm_validity(self):
+        # make the subcollection metadata invalid
+        mdf = os.path.join(self.bag.metadata_dir, "trial3", "nerdm.json")
+        with open(mdf) as fd:
+            data = json.load(fd, object_pairs_hook=OrderedDict)
+        data['filepath'] = [ data['filepath'] ]
+        with open(mdf,'w') as fd:
+            json.dump(data, fd, indent=2, separators=(',', ': '))
+
+        expect = [str(e) for e in
+                  self.valid8.test_nerdm_validity(self.bag).failed()]
+        self.assertGreater(len(expect), 0)
+
+        for pool in "thread process".split():
+            valid8 = val.NISTBagValidator({ "nerdm_schema_dir": schemadir,
+                                            "validation_workers": 2,
+                                            "validation_pool": pool })
+            errs = valid8.test_nerdm_validity(self.bag)
+            self.assertEqual([str(e) for e in errs.failed()], expect)
+
+        with self.assertRaises(exceptions.ConfigurationException):
+            val.NISTBagValidator({ "nerdm_schema_dir": schemadir,
+                                   "validation_pool": "goob" })
+
+    def test_validate_scans_once(self):
+        scans = []
+        loaded = []
+        class CountingScan(val._MetadataTreeScan):
+            def __init__(self, bag):
+                super(CountingScan, self).__init__(bag)
+                scans.append(self)
+            def load(self, nerdmf):
+                if nerdmf not in self._loaded:
+                    loaded.append(nerdmf)
+                return super(CountingScan, self).load(nerdmf)
+
+        origscan = val._MetadataTreeScan
+        val._MetadataTreeScan = CountingScan
+        try:
+            errs = self.valid8.validate(self.bag)
+        finally:
+            val._MetadataTreeScan = origscan
+
+        self.assertEqual(len(scans), 1)
+        self.assertIn(os.path.join(self.bag.metadata_dir, "nerdm.json"), loaded)
+        self.assertIn(os.path.join(self.bag.metadata_dir, "trial1.json",
+                                   "nerdm.json"), loaded)
+        self.assertEqual(len(loaded), len(set(loaded)))
+        self.assertFalse([e for e in errs.failed()
+                          if e.label.startswith("4.1-4") or
+                             e.label.startswith("4.1-3")])
+
         
         
         
@@ -0,0 +1,154 @@
+import os, pdb, sys, json, time
+import unittest as test
+
+from nistoar.testing import *
+from nistoar.pdr.preserv.service import scheduler as sched
+
+def setUpModule():
+    ensure_tmpdir()
+def tearDownModule():
+    rmtmpdir()
+
+class TestSIPQueue(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.qfile = os.path.join(self.tf.mkdir("status"), sched.QUEUE_FILENAME)
+        self.queue = sched.SIPQueue(self.qfile)
+
+    def tearDown(self):
+        self.tf.clean()
+
+    def test_ctor(self):
+        self.assertEqual(self.queue.file, self.qfile)
+        self.assertFalse(os.path.exists(self.qfile))
+        self.assertEqual(len(self.queue), 0)
+        self.assertTrue(os.path.exists(self.qfile))
+
+    def test_notransaction(self):
+        with self.assertRaises(RuntimeError):
+            self.queue.push("goob", "MIDAS3-SIP")
+        with self.assertRaises(RuntimeError):
+            self.queue.pop()
+
+    def test_pushpop(self):
+        with self.queue.transaction():
+            ent = self.queue.push("goob", "MIDAS3-SIP")
+            self.assertEqual(ent['id'], "goob")
+            self.assertEqual(ent['siptype'], "MIDAS3-SIP")
+            self.assertEqual(ent['priority'], 0)
+            self.queue.push("gurn", "MIDAS3-SIP", True)
+            self.queue.push("goob", "MIDAS3-SIP")
+        self.assertEqual(len(self.queue), 2)
+
+        # persisted
+        with open(self.qfile) as fd:
+            data = json.load(fd)
+        self.assertEqual([e['id'] for e in data['pending']], ["goob", "gurn"])
+
+        queue = sched.SIPQueue(self.qfile)
+        with queue.transaction():
+            self.assertEqual(queue.position("gurn"), 2)
+            self.assertEqual(queue.position("hank"), 0)
+            ent = queue.pop()
+            self.assertEqual(ent['id'], "goob")
+            ent = queue.pop()
+            self.assertEqual(ent['id'], "gurn")
+            self.assertTrue(ent['asupdate'])
+            self.assertIsNone(queue.pop())
+            self.assertEqual(len(queue._data['waits']), 2)
+
+    def test_priority(self):
+        with self.queue.transaction():
+            self.queue.push("a", "MIDAS3-SIP")
+            self.queue.push("b", "MIDAS3-SIP", True, 1)
+            self.queue.push("c", "MIDAS3-SIP")
+            self.queue.push("d", "MIDAS3-SIP", True, 1)
+            self.assertEqual([e['id'] for e in self.queue.pending()],
+                             ["b", "d", "a", "c"])
+            self.assertEqual(self.queue.position("a"), 3)
+            self.assertTrue(self.queue.remove("d"))
+            self.assertFalse(self.queue.remove("d"))
+            self.assertEqual([self.queue.pop()['id'] for i in range(3)],
+                             ["b", "a", "c"])
+
+    def test_rollback(self):
+        with self.queue.transaction():
+            self.queue.push("a", "MIDAS3-SIP")
+        try:
+            with self.queue.transaction():
+                self.queue.pop()
+                raise ValueError("oops")
+        except ValueError:
+            pass
+        self.assertEqual(len(self.queue), 1)
+
+    def test_nested(self):
+        with self.queue.transaction():
+            self.queue.push("a", "MIDAS3-SIP")
+            with self.queue.transaction():
+                self.queue.push("b", "MIDAS3-SIP")
+            self.assertEqual(len(self.queue), 2)
+        self.assertEqual(len(self.queue), 2)
+
+    def test_running(self):
+        alive = set([101, 102])
+        with self.queue.transaction():
+            self.assertEqual(self.queue.free_slots(2), 2)
+            self.queue.add_running(101, self.queue.push("a", "MIDAS3-SIP"))
+            self.queue.add_running(102, self.queue.push("b", "MIDAS3-SIP"))
+            self.assertEqual(self.queue.free_slots(2), 0)
+            self.assertEqual(self.queue.free_slots(1), 0)
+            self.assertEqual(list(self.queue.running().keys()), [101, 102])
+            self.assertEqual(self.queue.running()[102]['id'], "b")
+
+            self.queue.finish(101)
+            self.assertEqual(self.queue.free_slots(2), 1)
+            self.assertEqual(self.queue.prune(lambda p: p in alive), [])
+
+            alive.remove(102)
+            died = self.queue.prune(lambda p: p in alive)
+            self.assertEqual([e['id'] for e in died], ["b"])
+            self.assertEqual(self.queue.free_slots(2), 2)
+            self.assertEqual(self.queue._data['completed'], 1)
+
+    @test.skipIf(not os.path.exists("/proc/self/stat"), "process tokens not supported")
+    def test_token(self):
+        tok = sched.process_token(os.getpid())
+        self.assertTrue(tok)
+        self.assertEqual(sched.process_token(os.getpid()), tok)
+
+        alive = lambda p: True
+        with self.queue.transaction():
+            self.queue.add_running(os.getpid(), self.queue.push("a", "MIDAS3-SIP"), tok)
+            self.assertTrue(self.queue.is_running("a"))
+            self.assertEqual(self.queue.prune(alive), [])
+
+            # the process ID was reused by another process
+            self.queue._data['running'][str(os.getpid())]['token'] = "0"
+            self.assertEqual([e['id'] for e in self.queue.prune(alive)], ["a"])
+            self.assertFalse(self.queue.is_running("a"))
+
+    def test_stats(self):
+        with self.queue.transaction():
+            stats = self.queue.stats(2)
+            self.assertEqual(stats['queue_depth'], 0)
+            self.assertEqual(stats['running'], 0)
+            self.assertEqual(stats['max_workers'], 2)
+            self.assertEqual(stats['oldest_wait'], 0.0)
+            self.assertEqual(stats['mean_wait'], 0.0)
+
+            self.queue.push("a", "MIDAS3-SIP")
+            self.queue.push("b", "MIDAS3-SIP")
+            self.queue._data['pending'][0]['queue_time'] -= 10
+            self.queue.add_running(101, self.queue.pop())
+            stats = self.queue.stats(2)
+            self.assertEqual(stats['queue_depth'], 1)
+            self.assertEqual(stats['running'], 1)
+            self.assertGreaterEqual(stats['mean_wait'], 10.0)
+            self.assertGreaterEqual(stats['max_wait'], 10.0)
+            self.assertLess(stats['oldest_wait'], 10.0)
+
+        
+if __name__ == '__main__':
+    test.main()
@@ -409,6 +409,86 @@ class TestMultiprocPreservationService(test.TestCase):
         self.assertTrue(os.path.exists(os.path.join(self.store,
                                     self.midasid+".1_0_0.mbag0_4-0.zip.sha256")))
         
+    def test_queue_stats(self):
+        self.assertIsNone(self.svc._queue)
+        (reqs, stats) = self.svc.requests(withstats=True)
+        self.assertEqual(len(reqs), 0)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertIsNone(stats['max_workers'])
+
+        self.config['scheduler'] = { "max_workers": 2 }
+        self.svc = serv.MultiprocPreservationService(self.config)
+        self.assertEqual(self.svc._queue.file,
+                         os.path.join(self.statusdir, "_queue.json"))
+        (reqs, stats) = self.svc.requests(withstats=True)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['running'], 0)
+        self.assertEqual(stats['max_workers'], 2)
+
+    def test_launch_queued(self):
+        self.config['scheduler'] = { "max_workers": 1 }
+        self.svc = serv.MultiprocPreservationService(self.config)
+
+        # occupy the only worker slot
+        with self.svc._queue.transaction():
+            self.svc._queue.add_running(os.getpid(), {"id": "goob"})
+
+        hndlr = self.svc._make_handler(self.midasid, 'midas')
+        self.assertTrue(hndlr.isready())
+        (stat, proc) = self.svc._launch_handler(hndlr, 10)
+        self.assertIsNone(proc)
+        self.assertEqual(stat['state'], status.QUEUED)
+        self.assertIn("number 1 in line", stat['message'])
+        stats = self.svc.queue_stats()
+        self.assertEqual(stats['queue_depth'], 1)
+        self.assertEqual(stats['running'], 1)
+
+        # a re-request keeps its place in line
+        stat = self.svc.preserve(self.midasid, 'midas')
+        self.assertEqual(stat['state'], status.QUEUED)
+        stats = self.svc.queue_stats()
+        self.assertEqual(stats['queue_depth'], 1)
+
+        # when the worker finishes, it picks up the queued SIP
+        ent = self.svc._next_queued(os.getpid())
+        self.assertEqual(ent['id'], self.midasid)
+        self.assertEqual(ent['siptype'], "MIDAS-SIP")
+        self.assertIsNone(self.svc._next_queued(os.getpid()))
+        stats = self.svc.queue_stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['running'], 0)
+        self.assertEqual(stats['completed'], 2)
+
+    @test.skipIf(not os.path.exists("/proc/self/stat"), "process tokens not supported")
+    def test_dispatch_on_restart(self):
+        self.config['scheduler'] = { "max_workers": 1 }
+        started = []
+        class FakeProc(object):
+            pid = os.getpid()
+        class Service(serv.MultiprocPreservationService):
+            def _start_worker(self, sipid, siptype, asupdate, timeout):
+                started.append(sipid)
+                return FakeProc()
+
+        # a worker registered under a process ID that has since been reused
+        queue = serv.SIPQueue(os.path.join(self.statusdir, "_queue.json"))
+        with queue.transaction():
+            queue.add_running(os.getpid(), {"id": "goob"}, "goob")
+            queue.push(self.midasid, "MIDAS-SIP")
+
+        self.svc = Service(self.config)
+        self.assertEqual(started, [self.midasid])
+        with queue.transaction():
+            self.assertEqual(len(queue.pending()), 0)
+            self.assertEqual([e['id'] for e in queue.running().values()], [self.midasid])
+
+        # not dispatched when constructed inside a worker
+        with queue.transaction():
+            queue.finish(os.getpid())
+            queue.push("goob", "MIDAS-SIP")
+        Service(self.config, False)
+        self.assertEqual(started, [self.midasid])
+
     def test_subprocess_handle(self):
         try: 
             serv._subprocess_handle(self.svc.cfg, "SUBDIR/pres.log", self.midasid, "MIDAS-SIP", False, 5)
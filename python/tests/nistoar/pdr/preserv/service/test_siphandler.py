@@ -1,4 +1,4 @@
-import os, pdb, sys, logging, yaml, stat
+import os, pdb, sys, re, logging, yaml, stat, threading, time, errno
 import unittest as test
 
 from nistoar.testing import *
@@ -251,6 +251,116 @@ class TestMIDASSIPHandler(test.TestCase):
         self.assertGreater(os.stat(destfile).st_size, 1)
             
         
+    def _make_artifacts(self, names):
+        srcdir = os.path.join(self.troot, "outbox")
+        os.mkdir(srcdir)
+        out = []
+        for name in names:
+            bagfile = os.path.join(srcdir, name)
+            with open(bagfile, 'w') as fd:
+                fd.write(name * 1000)
+            with open(bagfile+".sha256", 'w') as fd:
+                fd.write(self.sip._csengine.checksum_of(bagfile))
+                fd.write('\n')
+            out.extend([bagfile, bagfile+".sha256"])
+        return out
+
+    def test_deliver(self):
+        self.sip.cfg['delivery'] = { 'workers': 2 }
+        names = [self.midasid+".1_0_0.mbag0_4-%d.zip" % i for i in range(3)]
+        savefiles = self._make_artifacts(names)
+
+        saved = self.sip._deliver(savefiles, self.store)
+        self.assertEqual(len(saved), 6)
+        self.assertEqual(sorted(os.listdir(self.store)),
+                         sorted([os.path.basename(f) for f in savefiles]))
+        for f in savefiles:
+            with open(f) as fd:
+                src = fd.read()
+            with open(os.path.join(self.store, os.path.basename(f))) as fd:
+                self.assertEqual(fd.read(), src)
+
+        dlstat = self.sip._status.data['user']['delivery']
+        self.assertEqual(dlstat['files'], 6)
+        self.assertEqual(dlstat['bytes'], sum([os.stat(f).st_size for f in savefiles]))
+        self.assertIn('bytes_per_sec', dlstat)
+        self.assertIn('bytes/s', self.sip._status.message)
+
+    def test_deliver_badchecksum(self):
+        names = [self.midasid+".1_0_0.mbag0_4-%d.zip" % i for i in range(2)]
+        savefiles = self._make_artifacts(names)
+        with open(savefiles[3], 'w') as fd:
+            fd.write("0"*64 + '\n')
+
+        with self.assertRaises(PreservationException):
+            self.sip._deliver(savefiles, self.store)
+        self.assertEqual(self.sip.state, status.FAILED)
+        self.assertEqual(os.listdir(self.store), [])
+
+    def test_deliver_rollback_inflight(self):
+        # one bag fails while the others are still being copied
+        self.sip.cfg['delivery'] = { 'workers': 3 }
+        names = [self.midasid+".1_0_0.mbag0_4-%d.zip" % i for i in range(3)]
+        savefiles = self._make_artifacts(names)
+
+        copy_file = self.sip._csengine.copy_file
+        started = []
+        failed = threading.Event()
+        lock = threading.Lock()
+        def flaky_copy(src, dest, algs=None):
+            with lock:
+                started.append(src)
+            if src.endswith("-0.zip"):
+                n = 200
+                while n > 0 and len(started) < 3:
+                    n -= 1
+                    time.sleep(0.01)
+                failed.set()
+                raise IOError(errno.EIO, "disk failure", dest)
+            failed.wait(5)
+            time.sleep(0.05)
+            return copy_file(src, dest, algs)
+        self.sip._csengine.copy_file = flaky_copy
+
+        with self.assertRaises(PreservationException) as cm:
+            self.sip._deliver(savefiles, self.store)
+        self.assertIn("disk failure", cm.exception.errors[0])
+        self.assertEqual(self.sip.state, status.FAILED)
+        self.assertEqual(os.listdir(self.store), [])
+
+    def test_serialize_progress(self):
+        # the overall percentage must not go down as members start
+        bags = []
+        for i in range(3):
+            bagd = os.path.join(self.troot, "bag%d" % i)
+            os.mkdir(bagd)
+            with open(os.path.join(bagd, "data.txt"), 'w') as fd:
+                fd.write("x" * 1000 * (i+1))
+            bags.append(bagd)
+        self.sip._split_bag = lambda bagdir: bags
+        self.sip.cfg['cleanup_unserialized_bags'] = False
+
+        class FakeSerializer(object):
+            def serialize(self, bagdir, destdir, format=None, log=None,
+                          progress=None, throttle=None):
+                total = 1000 * (bags.index(bagdir)+1)
+                for done in (0, total // 2, total):
+                    progress(done, total)
+                outfile = os.path.join(destdir, os.path.basename(bagdir)+".zip")
+                with open(outfile, 'w') as fd:
+                    fd.write("zip")
+                return outfile
+        self.sip._ser = FakeSerializer()
+
+        reports = []
+        self.sip._status.record_progress = lambda msg: reports.append(msg)
+        outfiles = self.sip._serialize(bags[0], self.store)
+        self.assertEqual(len(outfiles), 6)
+
+        pcts = [int(re.search(r': (\d+)%', r).group(1)) for r in reports]
+        self.assertEqual(pcts, [0, 16, 33, 33, 50, 66, 66, 83, 100])
+        self.assertEqual(reports[-1], "Serializing: 100% (6000 of 6000 bytes)")
+
     def test_is_preserved(self):
         self.assertEqual(self.sip.state, status.FORGOTTEN)
         self.assertFalse(self.sip._is_preserved())
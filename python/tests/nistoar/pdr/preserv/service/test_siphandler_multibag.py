@@ -233,6 +233,31 @@ class TestMultibagSIPHandler(test.TestCase):
         
 
 
+    def test_split_parallel(self):
+        # test serializing several member bags concurrently
+        self.config['multibag'] = { "max_headbag_size": 100,
+                                    "max_bag_size": 2000 }
+        self.config['serialization'] = { "workers": 3,
+                                         "max_bytes_per_sec": 100000000 }
+        self.replicate_sip(self.sipdata, os.path.join(self.revdir, "1491"))
+        self.sip = sip.MIDASSIPHandler(self.midasid, self.config)
+
+        self.sip.bagit()
+        self.assertEqual(self.sip.state, status.SUCCESSFUL)
+
+        bagfiles = self.sip.status['bagfiles']
+        self.assertGreater(len(bagfiles), 1)
+        for bf in bagfiles:
+            self.assertTrue(bf['name'].startswith(self.midasid+".1_0_0.mbag0_4-"))
+            self.assertTrue(bf['name'].endswith(".zip"))
+            self.assertIn('serialize_time', bf)
+            self.assertIn('checksum_time', bf)
+            self.assertGreater(bf['size'], 0)
+
+            csumfile = os.path.join(self.store, bf['name']+".sha256")
+            with open(csumfile) as fd:
+                self.assertEqual(bf['sha256'], fd.read().strip())
+
     def test_small_revision(self):
         # test creating small update to an existing dataset
         self.replicate_sip(self.sipdata, os.path.join(self.revdir, "1491"))
@@ -292,6 +292,24 @@ class TestSIPStatus(test.TestCase):
         self.assertEquals(self.status.data['user']['state'], 'in progress')
         self.assertEqual(self.status.data['user']['message'], "chugging...")
 
+    def test_queue(self):
+        self.assertTrue(not os.path.exists(self.status._cachefile))
+
+        self.status.queue()
+        self.assertEquals(self.status.data['user']['state'], 'queued')
+        self.assertEqual(self.status.data['user']['message'], 
+                         status.user_message[status.QUEUED])
+        self.assertIn('queue_time', self.status.data['user'])
+        self.assertIn('queued', self.status.data['user'])
+        data = self.read_data(self.status._cachefile)
+        self.assertEquals(data['user']['state'], status.QUEUED)
+
+        self.status.queue("3rd in line")
+        self.assertEqual(self.status.data['user']['message'], "3rd in line")
+
+        self.status.start()
+        self.assertEquals(self.status.data['user']['state'], 'in progress')
+
     def test_user_export(self):
         self.status.update(status.FAILED)
         self.status = status.SIPStatus.for_update('ffff', self.cfg)
@@ -365,6 +383,145 @@ class TestSIPStatus(test.TestCase):
 
 
 
+class TestSQLiteStatusStore(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.cachedir = self.tf.mkdir("status")
+        self.store = status.SQLiteStatusStore(os.path.join(self.cachedir, "status.sqlite"))
+
+    def tearDown(self):
+        self.tf.clean()
+
+    def mkdata(self, id, state, uptime):
+        return {'user': {'id': id, 'state': state, 'update_time': uptime}, 'sys': {},
+                'history': []}
+
+    def test_getput(self):
+        self.assertIsNone(self.store.get("ffff"))
+        self.store.put("ffff", self.mkdata("ffff", status.PENDING, 10.0))
+        data = self.store.get("ffff")
+        self.assertEqual(data['user']['state'], status.PENDING)
+        self.assertEqual(self.store.ids(), ["ffff"])
+
+        data['user']['state'] = status.SUCCESSFUL
+        self.store.put("ffff", data)
+        self.assertEqual(self.store.get("ffff")['user']['state'], status.SUCCESSFUL)
+        self.assertEqual(self.store.count(), 1)
+
+        self.store.delete("ffff")
+        self.assertIsNone(self.store.get("ffff"))
+        self.assertEqual(self.store.ids(), [])
+
+        conn = self.store._connect()
+        try:
+            mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        finally:
+            conn.close()
+        self.assertEqual(mode, "wal")
+
+    def test_query(self):
+        for i, state in enumerate([status.SUCCESSFUL, status.FAILED, status.SUCCESSFUL,
+                                   status.IN_PROGRESS, status.SUCCESSFUL]):
+            id = "sip%d" % i
+            self.store.put(id, self.mkdata(id, state, 100.0 + i))
+
+        self.assertEqual([s['id'] for s in self.store.query()],
+                         ["sip4", "sip3", "sip2", "sip1", "sip0"])
+        self.assertEqual([s['id'] for s in self.store.query(status.SUCCESSFUL)],
+                         ["sip4", "sip2", "sip0"])
+        self.assertEqual([s['id'] for s in
+                          self.store.query([status.FAILED, status.IN_PROGRESS])],
+                         ["sip3", "sip1"])
+        self.assertEqual([s['id'] for s in self.store.query(since=102.0)],
+                         ["sip4", "sip3", "sip2"])
+        self.assertEqual([s['id'] for s in self.store.query(since=101.0, before=103.0)],
+                         ["sip2", "sip1"])
+        self.assertEqual([s['id'] for s in self.store.query(limit=2, offset=1)],
+                         ["sip3", "sip2"])
+        self.assertEqual([s['id'] for s in self.store.query(offset=3)],
+                         ["sip1", "sip0"])
+        self.assertEqual(self.store.query(status.FAILED)[0],
+                         {"id": "sip1", "state": status.FAILED, "update_time": 101.0})
+
+        self.assertEqual(self.store.count(), 5)
+        self.assertEqual(self.store.count(status.SUCCESSFUL), 3)
+        self.assertEqual(self.store.count(status.SUCCESSFUL, since=101.5), 2)
+
+class TestSIPStatusSQLite(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.cachedir = self.tf.mkdir("status")
+        self.cfg = { 'cachedir': self.cachedir, 'backend': 'sqlite' }
+        self.status = status.SIPStatus("ark:/88434/ffff", self.cfg)
+
+    def tearDown(self):
+        self.tf.clean()
+
+    def test_cache(self):
+        self.assertEqual(self.status.state, status.FORGOTTEN)
+        self.status.data['gurn'] = 'goob'
+        self.status.start()
+        self.assertFalse(os.path.exists(self.status._cachefile))
+        self.assertTrue(os.path.exists(os.path.join(self.cachedir, "_status.sqlite")))
+
+        stat = status.SIPStatus("ark:/88434/ffff", self.cfg)
+        self.assertEqual(stat.state, status.IN_PROGRESS)
+        self.assertEqual(stat.data['gurn'], 'goob')
+        self.assertIn('update_time', stat.data['user'])
+
+        self.status.update(status.SUCCESSFUL)
+        stat.refresh()
+        self.assertEqual(stat.state, status.SUCCESSFUL)
+
+        self.assertEqual(status.SIPStatus.requests(self.cfg), ["ffff"])
+
+    def test_for_update(self):
+        self.status.update(status.SUCCESSFUL)
+        stat = status.SIPStatus.for_update("ark:/88434/ffff", self.cfg)
+        self.assertEqual(stat.state, status.PENDING)
+        self.assertEqual(stat.data['history'][0]['state'], status.SUCCESSFUL)
+
+    def test_query(self):
+        status.SIPStatus("aaaa", self.cfg).update(status.FAILED)
+        self.status.update(status.SUCCESSFUL)
+        self.assertEqual([s['id'] for s in status.SIPStatus.query(self.cfg)],
+                         ["ffff", "aaaa"])
+        self.assertEqual([s['id'] for s in
+                          status.SIPStatus.query(self.cfg, status.FAILED)], ["aaaa"])
+
+        # the file-based backend gives the same answers
+        jcfg = { 'cachedir': self.tf.mkdir("jstatus") }
+        status.SIPStatus("aaaa", jcfg).update(status.FAILED)
+        status.SIPStatus("ffff", jcfg).update(status.SUCCESSFUL)
+        self.assertEqual([s['id'] for s in status.SIPStatus.query(jcfg)],
+                         ["ffff", "aaaa"])
+        self.assertEqual([s['id'] for s in status.SIPStatus.query(jcfg, status.FAILED)],
+                         ["aaaa"])
+        self.assertEqual([s['id'] for s in status.SIPStatus.query(jcfg, limit=1, offset=1)],
+                         ["aaaa"])
+
+    def test_migrate(self):
+        jcfg = { 'cachedir': self.cachedir }
+        status.SIPStatus("aaaa", jcfg).update(status.FAILED)
+        status.SIPStatus("ark:/88434/bbbb", jcfg).update(status.SUCCESSFUL)
+        newer = status.SIPStatus("bbbb", self.cfg)
+        newer.update(status.IN_PROGRESS)
+        older = status.SIPStatus("aaaa", self.cfg)
+        older.data['user']['update_time'] = 1.0
+        older._store.put("aaaa", older.data)
+
+        self.assertEqual(status.migrate_status_files(jcfg), 1)
+        self.assertEqual(status.SIPStatus("aaaa", self.cfg).state, status.FAILED)
+        self.assertEqual(status.SIPStatus("bbbb", self.cfg).state, status.IN_PROGRESS)
+        self.assertTrue(os.path.exists(os.path.join(self.cachedir, "aaaa.json")))
+
+        self.assertEqual(status.migrate_status_files(jcfg, remove=True), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.cachedir, "aaaa.json")))
+        self.assertFalse(os.path.exists(os.path.join(self.cachedir, "bbbb.json")))
+        self.assertEqual(sorted(status.SIPStatus.requests(self.cfg)), ["aaaa", "bbbb"])
+
         
 
 if __name__ == '__main__':
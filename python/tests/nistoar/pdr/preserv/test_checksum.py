@@ -0,0 +1,192 @@
+import os, sys, pdb, shutil, time
+import unittest as test
+
+from nistoar.testing import *
+import nistoar.pdr.preserv.checksum as cs
+from nistoar.pdr.utils import checksum_of
+from nistoar.pdr.exceptions import ConfigurationException
+
+datadir = os.path.join(os.path.dirname(__file__), "data")
+sipdir = os.path.join(datadir, "simplesip")
+datafiles = [os.path.join(sipdir, f) for f in
+             "trial1.json trial2.json trial3/trial3a.json".split()]
+
+def setUpModule():
+    ensure_tmpdir()
+
+def tearDownModule():
+    rmtmpdir()
+
+class TestFunctions(test.TestCase):
+
+    def test_hash_file(self):
+        for f in datafiles:
+            self.assertEqual(cs.hash_file(f), checksum_of(f))
+            self.assertEqual(cs.hash_file(f, bufsize=100), checksum_of(f))
+        self.assertEqual(len(cs.hash_file(datafiles[0], "md5")), 32)
+
+    def test_file_signature(self):
+        sig = cs.file_signature(datafiles[0])
+        self.assertEqual(sig[0], os.path.abspath(datafiles[0]))
+        self.assertEqual(sig[1], os.stat(datafiles[0]).st_size)
+        self.assertEqual(len(sig), 4)
+
+class TestChecksumCache(test.TestCase):
+
+    def test_get_put(self):
+        cache = cs.ChecksumCache()
+        sig = cs.file_signature(datafiles[0])
+        self.assertIsNone(cache.get(sig))
+        cache.put(sig, "abc")
+        self.assertEqual(cache.get(sig), "abc")
+        self.assertIsNone(cache.get(sig, "md5"))
+        self.assertEqual(len(cache), 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_maxsize(self):
+        cache = cs.ChecksumCache(2)
+        cache.put(("a", 1, 1, 1), "a")
+        cache.put(("b", 1, 1, 1), "b")
+        cache.put(("c", 1, 1, 1), "c")
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(("a", 1, 1, 1)))
+        self.assertEqual(cache.get(("c", 1, 1, 1)), "c")
+
+class TestChecksumLedger(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.lfile = self.tf.track("ledger.json")
+
+    def tearDown(self):
+        self.tf.clean()
+
+    def test_get_put(self):
+        ledger = cs.ChecksumLedger(self.lfile)
+        self.assertEqual(len(ledger), 0)
+        sig = ledger.signature_of(datafiles[0])
+        self.assertEqual(len(sig), 3)
+        self.assertIsNone(ledger.get("trial1.json", sig))
+
+        ledger.put("trial1.json", sig, "abc")
+        ledger.put("trial1.json", sig, "de", "md5")
+        self.assertEqual(ledger.get("trial1.json", sig), "abc")
+        self.assertEqual(ledger.get("trial1.json", sig, "md5"), "de")
+        self.assertIsNone(ledger.get("trial1.json", [0, 0, 0]))
+
+        # a new signature invalidates all of the previous checksums
+        ledger.put("trial1.json", [0, 0, 0], "xyz")
+        self.assertIsNone(ledger.get("trial1.json", sig))
+        self.assertIsNone(ledger.get("trial1.json", [0, 0, 0], "md5"))
+        self.assertEqual(ledger.get("trial1.json", [0, 0, 0]), "xyz")
+
+    def test_save(self):
+        ledger = cs.ChecksumLedger(self.lfile)
+        sig = ledger.signature_of(datafiles[0])
+        ledger.save()
+        self.assertFalse(os.path.exists(self.lfile))
+
+        ledger.put("trial1.json", sig, "abc")
+        ledger.save()
+        self.assertTrue(os.path.exists(self.lfile))
+
+        ledger = cs.ChecksumLedger(self.lfile)
+        self.assertEqual(len(ledger), 1)
+        self.assertEqual(ledger.get("trial1.json", sig), "abc")
+
+        with open(self.lfile, 'w') as fd:
+            fd.write("goob")
+        ledger = cs.ChecksumLedger(self.lfile)
+        self.assertEqual(len(ledger), 0)
+
+class TestChecksumEngine(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.cache = cs.ChecksumCache()
+        self.eng = cs.ChecksumEngine({'workers': 3}, self.cache)
+
+    def tearDown(self):
+        self.tf.clean()
+
+    def test_ctor(self):
+        self.assertEqual(self.eng.workers, 3)
+        self.assertEqual(self.eng.pooltype, "thread")
+        self.assertEqual(self.eng.bufsize, cs.DEF_BUFSIZE)
+        self.assertIs(self.eng.cache, self.cache)
+
+        eng = cs.ChecksumEngine()
+        self.assertEqual(eng.workers, 1)
+        self.assertIs(eng.cache, cs.default_cache)
+
+        eng = cs.ChecksumEngine({'use_cache': False})
+        self.assertIsNone(eng.cache)
+
+        with self.assertRaises(ConfigurationException):
+            cs.ChecksumEngine({'pool': 'goob'})
+
+    def test_checksum_of(self):
+        self.assertEqual(self.eng.checksum_of(datafiles[0]),
+                         checksum_of(datafiles[0]))
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.eng.checksum_of(datafiles[0]),
+                         checksum_of(datafiles[0]))
+        self.assertEqual(len(self.cache), 1)
+
+    def test_cache_invalidated_by_change(self):
+        fp = os.path.join(self.tf.mkdir("cs"), "data.txt")
+        with open(fp, 'w') as fd:
+            fd.write("hello\n")
+        first = self.eng.checksum_of(fp)
+        self.assertEqual(first, checksum_of(fp))
+
+        with open(fp, 'w') as fd:
+            fd.write("goodbye, world\n")
+        self.assertNotEqual(self.eng.checksum_of(fp), first)
+        self.assertEqual(self.eng.checksum_of(fp), checksum_of(fp))
+
+    def test_checksums_of(self):
+        sums = self.eng.checksums_of(datafiles)
+        self.assertEqual(list(sums.keys()), datafiles)
+        for f in datafiles:
+            self.assertEqual(sums[f], checksum_of(f))
+        self.assertEqual(len(self.cache), 3)
+
+    def test_process_pool(self):
+        eng = cs.ChecksumEngine({'workers': 2, 'pool': 'process'}, self.cache)
+        sums = eng.checksums_of(datafiles)
+        for f in datafiles:
+            self.assertEqual(sums[f], checksum_of(f))
+
+        # results from the processes are cached in this process
+        self.assertEqual(len(self.cache), 3)
+
+    def test_copy_file(self):
+        dest = os.path.join(self.tf.mkdir("cs"), "trial1.json")
+        sums = self.eng.copy_file(datafiles[0], dest)
+        self.assertEqual(list(sums.keys()), ["sha256"])
+        self.assertEqual(sums["sha256"], checksum_of(datafiles[0]))
+        self.assertEqual(checksum_of(dest), checksum_of(datafiles[0]))
+
+        # both source and destination checksums are now cached
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get(cs.file_signature(dest)), sums["sha256"])
+
+        sums = self.eng.copy_file(datafiles[1], os.path.dirname(dest),
+                                  ["sha256", "md5"])
+        self.assertEqual(list(sums.keys()), ["sha256", "md5"])
+        dest = os.path.join(os.path.dirname(dest), "trial2.json")
+        self.assertEqual(sums["md5"], cs.hash_file(dest, "md5"))
+        self.assertEqual(self.eng.checksum_of(dest, "md5"), sums["md5"])
+
+        with self.assertRaises(shutil.Error):
+            self.eng.copy_file(dest, dest)
+
+    def test_precalculate(self):
+        self.eng.precalculate(datafiles[:2])
+        self.assertEqual(len(self.cache), 2)
+
+
+if __name__ == '__main__':
+    test.main()
@@ -298,6 +298,35 @@ class TestPrePubMetadataService(test.TestCase):
         with self.assertRaises(serv.IDNotFound):
             self.srv.resolve_id("asldkfjsdalfk")
 
+    def test_resolve_id_cached(self):
+        indir = os.path.join(self.workdir, os.path.basename(self.testsip))
+        shutil.copytree(self.testsip, indir)
+        self.config['upload_dir'] = os.path.join(indir, "upload")
+        self.config['review_dir'] = os.path.join(indir, "review")
+        self.srv = serv.PrePubMetadataService(self.config)
+        normid = self.srv.normalize_id(self.midasid)
+
+        mdata = self.srv.resolve_id(self.midasid)
+        self.assertIsNotNone(self.srv._reccache.get(normid))
+
+        made = []
+        mknerdm = self.srv.make_nerdm_record
+        def make_nerdm_record(*args, **kw):
+            made.append(args[0])
+            return mknerdm(*args, **kw)
+        self.srv.make_nerdm_record = make_nerdm_record
+
+        data = self.srv.resolve_id(self.midasid)
+        self.assertEqual(data, mdata)
+        self.assertEqual(made, [])
+
+        # a change to the SIP triggers a rebuild
+        with open(os.path.join(indir, "review", "1491", "newfile.txt"), 'w') as fd:
+            fd.write("hello\n")
+        data = self.srv.resolve_id(self.midasid)
+        self.assertEqual(len(made), 1)
+        self.assertIn("newfile.txt", [c.get('filepath') for c in data['components']])
+
     def test_resolve_arkid(self):
         indir = os.path.join(self.workdir, os.path.basename(self.testsip))
         shutil.copytree(self.testsip, indir)
@@ -1,5 +1,5 @@
 from __future__ import absolute_import
-import os, pdb, requests, logging, time, json
+import os, pdb, requests, logging, time, json, re
 from collections import OrderedDict, Mapping
 from StringIO import StringIO
 import unittest as test
@@ -13,6 +13,7 @@ class TestWebRecorder(test.TestCase):
     def setUp(self):
         self.tf = Tempfiles()
         self.recfile = self.tf.track("webrec.log")
+        self.tf.track("webrec.log.idx")
         self.rcrdr = webrec.WebRecorder(self.recfile)
 
     def tearDown(self):
@@ -381,6 +382,127 @@ class TestWebRecorder(test.TestCase):
         self.assertEqual(len(rec.headers), 0)
 
 
+    def test_record_index(self):
+        idxfile = webrec.index_file_for(self.recfile)
+        self.rcrdr.recHEAD("/foo/gurn")
+        self.rcrdr.recPOST("/foo/bar", body="a\nb\nc\n")
+        self.rcrdr.recGET("/foo/gurn")
+        self.assertTrue(os.path.exists(idxfile))
+        self.assertEqual(os.stat(idxfile).st_size, 24)
+
+        with open(self.recfile) as fd:
+            offs = [p for p in self._line_offsets(fd) if p[1].startswith("=*=")]
+        self.assertEqual(len(offs), 3)
+        with open(idxfile, 'rb') as fd:
+            idx = [webrec._OFFSET.unpack(fd.read(8))[0] for i in range(3)]
+        self.assertEqual(idx, [p[0] for p in offs])
+
+        # index is rebuilt if missing
+        os.remove(idxfile)
+        self.assertEqual(webrec.sync_record_index(self.recfile), 3)
+        with open(idxfile, 'rb') as fd:
+            self.assertEqual(fd.read(), "".join([webrec._OFFSET.pack(i) for i in idx]))
+
+        # records written without the index are picked up by the next recording
+        self.rcrdr.close_file()
+        with open(self.recfile, 'a') as fd:
+            fd.write("=*= 2020-05-01 13:00:00,000 pubserver.GET /foo/added\n")
+        self.rcrdr.open_file()
+        self.rcrdr.recDELETE("/foo/bar")
+        self.assertEqual(os.stat(idxfile).st_size, 40)
+        parser = webrec.RequestLogParser(self.recfile)
+        self.assertEqual(parser.get_record(3).resource, "/foo/added")
+        self.assertEqual(parser.get_record(4).op, "DELETE")
+
+        # index is rebuilt if it does not match the log
+        with open(idxfile, 'ab') as fd:
+            fd.write(webrec._OFFSET.pack(3))
+        self.assertEqual(parser.count_records(), 5)
+        self.assertEqual(os.stat(idxfile).st_size, 40)
+
+    def _line_offsets(self, fd):
+        while True:
+            pos = fd.tell()
+            line = fd.readline()
+            if not line:
+                break
+            yield (pos, line)
+
+    def test_parser_get_record(self):
+        self.rcrdr.recHEAD("/foo/gurn")
+        self.rcrdr.recPOST("/foo/bar", headers=["Accept: text/json"], body="a\nb\nc\n")
+        self.rcrdr.recGET("/foo/gurn")
+
+        parser = webrec.RequestLogParser(self.recfile)
+        rec = parser.get_record(1)
+        self.assertEqual(rec.op, "POST")
+        self.assertEqual(rec.resource, "/foo/bar")
+        self.assertEqual(rec.headers, ["Accept: text/json"])
+        self.assertEqual(rec.body, "a\nb\nc\n\n\n")
+        self.assertEqual(parser.get_record(-1).op, "GET")
+        self.assertEqual(parser.get_record(-3).op, "HEAD")
+        with self.assertRaises(IndexError):
+            parser.get_record(3)
+        with self.assertRaises(IndexError):
+            parser.get_record(-4)
+
+    def test_parser_iter_records(self):
+        with open(self.recfile, 'w') as fd:
+            fd.write("=*= 2020-05-01 13:00:00,000 pubserver.GET /foo/gurn\n\n")
+            fd.write("=*= 2020-05-01 13:05:00,000 pubserver.PUT /foo/bar\n-+-\n{}\n")
+            fd.write("=*= 2020-05-01 13:10:00,000 pubserver.GET /goob/gurn\n\n")
+            fd.write("=*= 2020-05-01 13:15:00,000 pubserver.DELETE /foo/bar\n\n")
+            fd.write("=*= 2020-05-01 13:20:00,000 pubserver.GET /foo/bar\n\n")
+
+        parser = webrec.RequestLogParser(self.recfile)
+        self.assertEqual([r.time for r in parser.iter_records()],
+                         ["2020-05-01 13:%02d:00,000" % m for m in range(0, 25, 5)])
+        self.assertEqual([r.op for r in parser.iter_records(op="GET")],
+                         ["GET", "GET", "GET"])
+        self.assertEqual([r.op for r in parser.iter_records(op=["PUT", "DELETE"])],
+                         ["PUT", "DELETE"])
+        self.assertEqual([r.resource for r in parser.iter_records(resource="/foo/")],
+                         ["/foo/gurn", "/foo/bar", "/foo/bar", "/foo/bar"])
+        self.assertEqual([r.resource for r in
+                          parser.iter_records(resource=re.compile(r"/gurn$"))],
+                         ["/foo/gurn", "/goob/gurn"])
+        self.assertEqual([r.op for r in parser.iter_records(op="GET", resource="/foo/")],
+                         ["GET", "GET"])
+        self.assertEqual([r.time[11:16] for r in
+                          parser.iter_records(since="2020-05-01 13:05")],
+                         ["13:05", "13:10", "13:15", "13:20"])
+        self.assertEqual([r.time[11:16] for r in
+                          parser.iter_records(since="2020-05-01 13:06",
+                                              until="2020-05-01 13:20")],
+                         ["13:10", "13:15"])
+        self.assertEqual([r.time[11:16] for r in
+                          parser.iter_records(1, 2, since="2020-05-01 13:06")],
+                         ["13:10"])
+        self.assertEqual([r.time[11:16] for r in parser.iter_records(-2, op="GET")],
+                         ["13:20"])
+        self.assertEqual(list(parser.iter_records(since="2020-05-02")), [])
+
+        t = time.mktime(time.strptime("2020-05-01 13:12:00", "%Y-%m-%d %H:%M:%S"))
+        self.assertEqual([r.time[11:16] for r in parser.iter_records(since=t)],
+                         ["13:15", "13:20"])
+
+    def test_parser_memory_index(self):
+        self.rcrdr.recHEAD("/foo/gurn")
+        self.rcrdr.recGET("/foo/bar")
+        os.remove(webrec.index_file_for(self.recfile))
+
+        parser = webrec.RequestLogParser(self.recfile)
+        def cantwrite(recfile):
+            raise IOError("read-only")
+        sync = webrec.sync_record_index
+        webrec.sync_record_index = cantwrite
+        try:
+            self.assertEqual(parser.count_records(), 2)
+            self.assertEqual(parser.get_record(-1).resource, "/foo/bar")
+            self.assertEqual(len(parser._memidx), 2)
+        finally:
+            webrec.sync_record_index = sync
+
 
 if __name__ == '__main__':
     test.main()
@@ -0,0 +1,141 @@
+import os, sys, pdb, time
+import unittest as test
+
+from nistoar.testing import *
+from nistoar.pdr.publish import nerdcache as nc
+
+def setUpModule():
+    ensure_tmpdir()
+
+def tearDownModule():
+    rmtmpdir()
+
+class TestPathStamp(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.dir = self.tf.mkdir("sip")
+        self.file = os.path.join(self.dir, "a.txt")
+        with open(self.file, 'w') as fd:
+            fd.write("hello")
+
+    def tearDown(self):
+        self.tf.clean()
+
+    def test_file(self):
+        st = nc.path_stamp(self.file)
+        self.assertEqual(st[:2], (1, 5))
+        self.assertEqual(nc.path_stamp(self.file), st)
+        with open(self.file, 'a') as fd:
+            fd.write(" world")
+        self.assertNotEqual(nc.path_stamp(self.file), st)
+
+        self.assertIsNone(nc.path_stamp(os.path.join(self.dir, "goob")))
+
+    def test_dir(self):
+        st = nc.path_stamp(self.dir)
+        self.assertEqual(st[:2], (1, 5))
+        self.assertEqual(nc.path_stamp(self.dir), st)
+
+        # a change to a file at the top of the tree is noticed
+        with open(self.file, 'a') as fd:
+            fd.write(" world")
+        st = nc.path_stamp(self.dir)
+        self.assertEqual(st[:2], (1, 11))
+
+        os.mkdir(os.path.join(self.dir, "sub"))
+        st2 = nc.path_stamp(self.dir)
+        self.assertNotEqual(st2, st)
+        self.assertEqual(st2[0], 2)
+
+        # a file added or removed deep in the tree is noticed
+        os.mkdir(os.path.join(self.dir, "sub", "deep"))
+        st = nc.path_stamp(self.dir)
+        self.assertEqual(st[0], 3)
+        time.sleep(0.02)
+        bfile = os.path.join(self.dir, "sub", "deep", "b.txt")
+        with open(bfile, 'w') as fd:
+            fd.write("goob")
+        st2 = nc.path_stamp(self.dir)
+        self.assertNotEqual(st2, st)
+        self.assertEqual(st2[0], 3)
+        time.sleep(0.02)
+        os.remove(bfile)
+        self.assertNotEqual(nc.path_stamp(self.dir), st2)
+
+    def test_dir_skips_deep_files(self):
+        os.makedirs(os.path.join(self.dir, "sub", "deep"))
+        for i in range(3):
+            with open(os.path.join(self.dir, "sub", "deep", "f%d.txt" % i), 'w') as fd:
+                fd.write("data")
+
+        stats = []
+        orig = os.stat
+        def counting_stat(path):
+            stats.append(path)
+            return orig(path)
+        os.stat = counting_stat
+        try:
+            st = nc.path_stamp(self.dir)
+        finally:
+            os.stat = orig
+
+        self.assertEqual(st[0], 3)
+        self.assertFalse([p for p in stats if os.path.basename(p).startswith('f')])
+
+class TestNERDmRecordCache(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.dir = self.tf.mkdir("sip")
+        self.file = os.path.join(self.dir, "a.txt")
+        with open(self.file, 'w') as fd:
+            fd.write("hello")
+        self.cache = nc.NERDmRecordCache(2)
+
+    def tearDown(self):
+        self.tf.clean()
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get("mds2-1000"))
+        rec = {"@id": "ark:/88434/mds2-1000", "title": "Goob"}
+        self.cache.put("mds2-1000", rec, self.cache.stamp([self.dir]))
+        self.assertEqual(len(self.cache), 1)
+
+        out = self.cache.get("mds2-1000")
+        self.assertEqual(out, rec)
+        out['title'] = "Gurn"
+        self.assertEqual(self.cache.get("mds2-1000")['title'], "Goob")
+
+        self.cache.remove("mds2-1000")
+        self.assertIsNone(self.cache.get("mds2-1000"))
+
+    def test_invalidate(self):
+        rec = {"@id": "ark:/88434/mds2-1000", "title": "Goob"}
+        self.cache.put("mds2-1000", rec, self.cache.stamp([self.dir]))
+        self.assertIsNotNone(self.cache.get("mds2-1000"))
+
+        with open(os.path.join(self.dir, "b.txt"), 'w') as fd:
+            fd.write("new")
+        self.assertIsNone(self.cache.get("mds2-1000"))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lru(self):
+        stamps = self.cache.stamp([self.file])
+        self.cache.put("a", {"n": 1}, stamps)
+        self.cache.put("b", {"n": 2}, stamps)
+        self.assertIsNotNone(self.cache.get("a"))
+        self.cache.put("c", {"n": 3}, stamps)
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), {"n": 1})
+        self.assertEqual(self.cache.get("c"), {"n": 3})
+
+    def test_disabled(self):
+        cache = nc.NERDmRecordCache(0)
+        cache.put("a", {"n": 1}, cache.stamp([self.file]))
+        self.assertIsNone(cache.get("a"))
+
+
+if __name__ == '__main__':
+    test.main()
@@ -0,0 +1,141 @@
+import os, sys, pdb, time
+import unittest as test
+from email.utils import formatdate
+from wsgiref.headers import Headers
+
+from nistoar.testing import *
+from nistoar.pdr.publish import streamfile as sf
+
+def setUpModule():
+    ensure_tmpdir()
+
+def tearDownModule():
+    rmtmpdir()
+
+class FakeHandler(object):
+    def __init__(self):
+        self._hdr = Headers([])
+        self.status = None
+    def add_header(self, name, value):
+        self._hdr.add_header(name, value)
+    def set_response(self, code, message):
+        self.code = code
+    def end_headers(self):
+        self.status = self.code
+    def header(self, name):
+        return self._hdr.get(name)
+
+class TestStreamFile(test.TestCase):
+
+    def setUp(self):
+        self.tf = Tempfiles()
+        self.dir = self.tf.mkdir("streamfile")
+        self.file = os.path.join(self.dir, "data.txt")
+        self.data = "".join([str(i % 10) for i in range(2500)])
+        with open(self.file, 'w') as fd:
+            fd.write(self.data)
+        self.hdlr = FakeHandler()
+
+    def tearDown(self):
+        self.tf.clean()
+
+    def test_iter_file(self):
+        chunks = list(sf.iter_file(self.file, chunksize=1000))
+        self.assertEqual([len(c) for c in chunks], [1000, 1000, 500])
+        self.assertEqual("".join(chunks), self.data)
+
+        chunks = list(sf.iter_file(self.file, 900, 1200, 1000))
+        self.assertEqual([len(c) for c in chunks], [1000, 200])
+        self.assertEqual("".join(chunks), self.data[900:2100])
+
+    def test_parse_range(self):
+        env = {}
+        self.assertIsNone(sf.parse_range(env, 2500, '"a"', 0))
+        env['HTTP_RANGE'] = "bytes=0-0"
+        self.assertEqual(sf.parse_range(env, 2500, '"a"', 0), (0, 0))
+        env['HTTP_RANGE'] = "bytes=100-"
+        self.assertEqual(sf.parse_range(env, 2500, '"a"', 0), (100, 2499))
+        env['HTTP_RANGE'] = "bytes=-100"
+        self.assertEqual(sf.parse_range(env, 2500, '"a"', 0), (2400, 2499))
+        env['HTTP_RANGE'] = "bytes=100-5000"
+        self.assertEqual(sf.parse_range(env, 2500, '"a"', 0), (100, 2499))
+        env['HTTP_RANGE'] = "bytes=0-10,20-30"
+        self.assertIsNone(sf.parse_range(env, 2500, '"a"', 0))
+        env['HTTP_RANGE'] = "bytes=3000-"
+        with self.assertRaises(ValueError):
+            sf.parse_range(env, 2500, '"a"', 0)
+
+        env['HTTP_RANGE'] = "bytes=100-"
+        env['HTTP_IF_RANGE'] = '"b"'
+        self.assertIsNone(sf.parse_range(env, 2500, '"a"', 0))
+        env['HTTP_IF_RANGE'] = '"a"'
+        self.assertEqual(sf.parse_range(env, 2500, '"a"', 0), (100, 2499))
+
+    def test_send_whole(self):
+        env = {'REQUEST_METHOD': 'GET'}
+        body = sf.send_file_response(self.hdlr, env, self.file, 1000)
+        self.assertEqual(self.hdlr.status, 200)
+        self.assertEqual(self.hdlr.header('Content-Length'), "2500")
+        self.assertEqual(self.hdlr.header('Accept-Ranges'), "bytes")
+        self.assertTrue(self.hdlr.header('ETag'))
+        self.assertTrue(self.hdlr.header('Last-Modified'))
+        self.assertEqual("".join(body), self.data)
+
+    def test_send_file_wrapper(self):
+        wrapped = []
+        def file_wrapper(fd, blksize):
+            wrapped.append(blksize)
+            return iter(lambda: fd.read(blksize), '')
+        env = {'REQUEST_METHOD': 'GET', 'wsgi.file_wrapper': file_wrapper}
+        body = sf.send_file_response(self.hdlr, env, self.file, 1000)
+        self.assertEqual("".join(body), self.data)
+        self.assertEqual(wrapped, [1000])
+
+    def test_send_head(self):
+        env = {'REQUEST_METHOD': 'HEAD'}
+        body = sf.send_file_response(self.hdlr, env, self.file)
+        self.assertEqual(self.hdlr.status, 200)
+        self.assertEqual(self.hdlr.header('Content-Length'), "2500")
+        self.assertEqual(body, [])
+
+    def test_send_range(self):
+        env = {'REQUEST_METHOD': 'GET', 'HTTP_RANGE': "bytes=1000-1099"}
+        body = sf.send_file_response(self.hdlr, env, self.file)
+        self.assertEqual(self.hdlr.status, 206)
+        self.assertEqual(self.hdlr.header('Content-Length'), "100")
+        self.assertEqual(self.hdlr.header('Content-Range'), "bytes 1000-1099/2500")
+        self.assertEqual("".join(body), self.data[1000:1100])
+
+        self.hdlr = FakeHandler()
+        env['HTTP_RANGE'] = "bytes=5000-"
+        body = sf.send_file_response(self.hdlr, env, self.file)
+        self.assertEqual(self.hdlr.status, 416)
+        self.assertEqual(self.hdlr.header('Content-Range'), "bytes */2500")
+        self.assertEqual(body, [])
+
+    def test_conditional(self):
+        etag = sf.file_etag(os.stat(self.file))
+        env = {'REQUEST_METHOD': 'GET', 'HTTP_IF_NONE_MATCH': etag}
+        body = sf.send_file_response(self.hdlr, env, self.file)
+        self.assertEqual(self.hdlr.status, 304)
+        self.assertEqual(body, [])
+
+        self.hdlr = FakeHandler()
+        env['HTTP_IF_NONE_MATCH'] = '"goob"'
+        body = sf.send_file_response(self.hdlr, env, self.file)
+        self.assertEqual(self.hdlr.status, 200)
+
+        self.hdlr = FakeHandler()
+        del env['HTTP_IF_NONE_MATCH']
+        env['HTTP_IF_MODIFIED_SINCE'] = formatdate(time.time() + 60, usegmt=True)
+        body = sf.send_file_response(self.hdlr, env, self.file)
+        self.assertEqual(self.hdlr.status, 304)
+
+        self.hdlr = FakeHandler()
+        env['HTTP_IF_MODIFIED_SINCE'] = formatdate(time.time() - 3600, usegmt=True)
+        body = sf.send_file_response(self.hdlr, env, self.file)
+        self.assertEqual(self.hdlr.status, 200)
+
+
+if __name__ == '__main__':
+    test.main()
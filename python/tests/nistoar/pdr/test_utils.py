@@ -258,6 +258,51 @@ class TestLockedFile(test.TestCase):
 
         self.assertEqual(data, "tatroaor")
 
+    def test_try_open(self):
+        held = threading.Event()
+        release = threading.Event()
+        def hold():
+            with utils.LockedFile(self.lfile, 'a'):
+                held.set()
+                release.wait(5)
+        t = threading.Thread(target=hold)
+        t.start()
+        try:
+            self.assertTrue(held.wait(5))
+            lf = utils.LockedFile(self.lfile, 'a')
+            self.assertIsNone(lf.try_open())
+            self.assertIsNone(lf.fo)
+            self.assertIsNone(utils.LockedFile(self.lfile).try_open())
+        finally:
+            release.set()
+            t.join()
+
+        lf = utils.LockedFile(self.lfile, 'a')
+        self.assertIsNotNone(lf.try_open())
+        self.assertIsNone(utils.LockedFile(self.lfile, 'a').try_open())
+        lf.close()
+
+    def test_try_open_otherproc(self):
+        flag = self.tf("locked.txt")
+        script = "import fcntl, time, os\n" + \
+                 "fd = open({0!r}, 'a')\n".format(self.lfile) + \
+                 "fcntl.lockf(fd, fcntl.LOCK_EX)\n" + \
+                 "open({0!r}, 'w').close()\n".format(flag) + \
+                 "time.sleep(1)\n"
+        proc = subprocess.Popen([sys.executable, "-c", script])
+        try:
+            n = 100
+            while n > 0 and not os.path.exists(flag):
+                n -= 1
+                time.sleep(0.02)
+            self.assertIsNone(utils.LockedFile(self.lfile, 'a').try_open())
+        finally:
+            proc.wait()
+
+        lf = utils.LockedFile(self.lfile, 'a')
+        self.assertIsNotNone(lf.try_open())
+        lf.close()
+
 class TestJsonIO(test.TestCase):
     # this class focuses on testing the locking of JSON file IO
     
@@ -347,7 +392,65 @@ class TestJsonIO(test.TestCase):
         self.assertIn('@id', self.td)
         self.assertEqual(self.td['foo'], 'bar')
 
-    
+class TestSubmitBatch(test.TestCase):
+
+    class Flaky(Exception):
+        pass
+    class Bad(Exception):
+        pass
+
+    def setUp(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def submit(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            ncalls = self.calls[name]
+        time.sleep(0.02)
+        if name.startswith("flaky") and ncalls < 3:
+            raise self.Flaky(name)
+        if name.startswith("bad"):
+            raise self.Bad(name)
+        if name.startswith("gone"):
+            raise KeyError(name)
+        if name.startswith("oops"):
+            raise RuntimeError(name)
+
+    def test_sequential(self):
+        res = utils.submit_batch(self.submit, ["a", "bad1", "b", "gone"],
+                                 failures=(self.Bad,), skippable=(KeyError,))
+        self.assertEqual(res['succeeded'], ["a", "b"])
+        self.assertEqual(res['failed'], ["bad1"])
+        self.assertEqual(res['skipped'], ["gone"])
+        self.assertEqual(sorted(res['latency'].keys()), ["a", "b", "bad1", "gone"])
+        self.assertGreater(res['latency']['a'], 0.01)
+
+    def test_concurrent(self):
+        names = ["r"+str(i) for i in range(8)]
+        t0 = time.time()
+        res = utils.submit_batch(self.submit, names, 8)
+        self.assertLess(time.time() - t0, 8 * 0.02)
+        self.assertEqual(res['succeeded'], names)
+        self.assertEqual(res['failed'], [])
+
+    def test_retry(self):
+        res = utils.submit_batch(self.submit, ["flaky", "a"], 2, retryable=(self.Flaky,),
+                                 failures=(self.Flaky,), retries=1, backoff=0.01)
+        self.assertEqual(res['succeeded'], ["a"])
+        self.assertEqual(res['failed'], ["flaky"])
+        self.assertEqual(self.calls['flaky'], 2)
+
+        self.calls = {}
+        res = utils.submit_batch(self.submit, ["flaky", "a"], 2, retryable=(self.Flaky,),
+                                 failures=(self.Flaky,), retries=2, backoff=0.01)
+        self.assertEqual(res['succeeded'], ["flaky", "a"])
+        self.assertEqual(self.calls['flaky'], 3)
+
+    def test_abort(self):
+        with self.assertRaises(RuntimeError):
+            utils.submit_batch(self.submit, ["a", "oops", "b", "c"])
+        self.assertEqual(sorted(self.calls.keys()), ["a", "oops"])
 
 
 if __name__ == '__main__':
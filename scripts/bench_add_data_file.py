@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+#
+# Compare the performance of BagBuilder.add_data_file() when it copies a file
+# and then re-reads it to calculate its checksum against copying the file
+# while checksumming it in a single pass.
+#
+# The two modes are run alternately (swapping which goes first each round) for
+# a number of rounds.  Before each run, the source files are evicted from the
+# page cache (via posix_fadvise() where available or, with --drop-caches, by 
+# asking the kernel to drop all clean caches, which requires root) so that the
+# extra read of the copy-then-hash mode is not served from memory.
+#
+from __future__ import print_function
+import os, sys, time, json, shutil, tempfile, logging
+from argparse import ArgumentParser
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+oarpypath = os.path.join(basedir, "python")
+if 'OAR_HOME' in os.environ:
+    basedir = os.environ['OAR_HOME']
+    oarpypath = os.path.join(basedir, "lib", "python") +":"+ \
+                os.path.join(basedir, "python")
+
+if 'OAR_PYTHONPATH' in os.environ:
+    oarpypath = os.environ['OAR_PYTHONPATH']
+
+sys.path.extend(oarpypath.split(os.pathsep))
+try:
+    import nistoar
+except ImportError as e:
+    nistoardir = os.path.join(basedir, "python")
+    sys.path.append(nistoardir)
+    import nistoar
+
+from nistoar.pdr.preserv.bagit.builder import BagBuilder
+from nistoar.pdr.preserv import checksum
+
+prog = os.path.basename(sys.argv[0])
+if not prog or prog == 'python':
+    prog = "bench_add_data_file"
+
+description = \
+"""time adding data files to a bag with and without checksum-while-copying"""
+
+epilog = None
+
+def define_opts(progname=None):
+    parser = ArgumentParser(progname, None, description, epilog)
+    parser.add_argument('-n', '--count', metavar='N', type=int, default=10,
+                        dest='count', help="the number of files to add")
+    parser.add_argument('-s', '--size', metavar='MB', type=int, default=100,
+                        dest='size', help="the size of each file in megabytes")
+    parser.add_argument('-w', '--workdir', metavar='DIR', type=str, dest='workdir',
+                        help="the directory to write test files and bags to; "+
+                             "a temporary directory is created by default")
+    parser.add_argument('-r', '--rounds', metavar='N', type=int, default=3,
+                        dest='rounds', help="the number of times to run each mode")
+    parser.add_argument('-D', '--drop-caches', action='store_true', dest='dropcaches',
+                        help="drop the kernel's page cache before each run "+
+                             "(requires root)")
+    parser.add_argument('-k', '--keep', action='store_true', dest='keep',
+                        help="do not delete the work directory when done")
+
+    return parser
+
+def make_files(srcdir, count, size):
+    chunk = os.urandom(1024 * 1024)
+    out = []
+    for i in range(count):
+        fp = os.path.join(srcdir, "file{0}.dat".format(i))
+        with open(fp, 'wb') as fd:
+            for j in range(size):
+                fd.write(chunk)
+            fd.flush()
+            os.fsync(fd.fileno())
+        out.append(fp)
+    return out
+
+def uncache(files, dropcaches=False):
+    """
+    evict the given files from the page cache so that they must be read from
+    storage.  Return False if this could not be done.
+    """
+    if dropcaches:
+        try:
+            os.system("sync")
+            with open("/proc/sys/vm/drop_caches", 'w') as fd:
+                fd.write("1\n")
+            return True
+        except (IOError, OSError) as ex:
+            print("{0}: unable to drop caches: {1}".format(prog, str(ex)),
+                  file=sys.stderr)
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    for fp in files:
+        fd = os.open(fp, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+def time_add(workdir, name, files, cfg):
+    checksum.default_cache.clear()
+    bagdir = os.path.join(workdir, name)
+    if os.path.exists(bagdir):
+        shutil.rmtree(bagdir)
+    bldr = BagBuilder(workdir, name, cfg, logger=logging.getLogger(name))
+    try:
+        start = time.time()
+        for fp in files:
+            bldr.add_data_file(os.path.basename(fp), fp)
+        return time.time() - start
+    finally:
+        bldr.disconnect_logfile()
+        shutil.rmtree(bagdir, ignore_errors=True)
+
+def main(args):
+    parser = define_opts(prog)
+    opts = parser.parse_args(args)
+
+    workdir = opts.workdir
+    if not workdir:
+        workdir = tempfile.mkdtemp(prefix=prog+"_")
+    srcdir = os.path.join(workdir, "src")
+    if not os.path.exists(srcdir):
+        os.makedirs(srcdir)
+
+    try:
+        files = make_files(srcdir, opts.count, opts.size)
+        nbytes = opts.count * opts.size * 1024 * 1024
+
+        modes = [("copy_then_hash",  {"checksum_on_copy": False}),
+                 ("hash_while_copy", {"checksum_on_copy": True })]
+        times = dict([(m[0], []) for m in modes])
+        uncached = True
+        for i in range(max(1, opts.rounds)):
+            # alternate which mode goes first
+            for label, cfg in (modes if i % 2 == 0 else list(reversed(modes))):
+                uncached = uncache(files, opts.dropcaches) and uncached
+                times[label].append(time_add(workdir, label, files, cfg))
+
+        results = { "file_count": opts.count, "total_bytes": nbytes,
+                    "rounds": max(1, opts.rounds), "source_uncached": uncached }
+        for label in times:
+            secs = sorted(times[label])[len(times[label]) // 2]
+            results[label] = { "seconds": times[label], "median_seconds": secs,
+                               "bytes_per_sec": nbytes / secs }
+
+        print(json.dumps(results, indent=4, separators=(',', ': ')))
+
+    finally:
+        if not opts.keep and not opts.workdir:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
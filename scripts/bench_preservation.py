@@ -0,0 +1,469 @@
+#! /usr/bin/env python
+#
+# Measure how the stages of the MIDAS3 preservation pipeline--building the
+# preservation bag, finalizing and validating it, splitting it into multibag
+# members, and serializing those members--scale with the number and size of
+# files in an SIP.
+#
+# A synthetic MIDAS3 SIP (a review data directory plus the metadata bag built
+# from it) is generated, and the SIP is preserved via MIDAS3SIPHandler.bagit().
+# Each stage is timed by wrapping the class method that implements it; the
+# results--elapsed time, throughput, peak RSS, and the number of files opened
+# during each stage--are written out as JSON.  A stage's RSS figures come from
+# sampling the process's current resident set size while the stage is active
+# (via /proc/self/statm, where available); they include any stages nested
+# within it.
+#
+from __future__ import print_function
+import os, sys, time, json, shutil, tempfile, logging, random, threading
+import resource, io, __builtin__
+from collections import OrderedDict
+from argparse import ArgumentParser
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+oarpypath = os.path.join(basedir, "python")
+if 'OAR_HOME' in os.environ:
+    basedir = os.environ['OAR_HOME']
+    oarpypath = os.path.join(basedir, "lib", "python") +":"+ \
+                os.path.join(basedir, "python")
+
+if 'OAR_PYTHONPATH' in os.environ:
+    oarpypath = os.environ['OAR_PYTHONPATH']
+
+sys.path.extend(oarpypath.split(os.pathsep))
+try:
+    import nistoar
+except ImportError as e:
+    nistoardir = os.path.join(basedir, "python")
+    sys.path.append(nistoardir)
+    import nistoar
+
+from nistoar.pdr.preserv.service import siphandler as sip
+from nistoar.pdr.preserv.bagger import midas3
+from nistoar.pdr.preserv.bagit.builder import BagBuilder
+from nistoar.pdr.preserv.bagit.validate.nist import NISTAIPValidator
+from nistoar.pdr.preserv.bagit.multibag import MultibagSplitter
+from nistoar.pdr.preserv.bagit.serialize import DefaultSerializer
+from nistoar.pdr.preserv import checksum
+
+prog = os.path.basename(sys.argv[0])
+if not prog or prog == 'python':
+    prog = "bench_preservation"
+
+description = \
+"""time the stages of preserving a synthetic MIDAS3 SIP"""
+
+epilog = """
+A SIZEDIST value has one of the forms, "fixed:N", "uniform:MIN:MAX", or
+"lognormal:MU:SIGMA", where sizes are in bytes (for lognormal, the size is
+exp(N(MU,SIGMA)) bytes).
+"""
+
+MIDASID = "3A1EE2F169DD3B8CE0531A570681DB5D9999"
+CHUNK = 1024 * 1024
+
+# the stages that get timed:  (label, class, method name)
+STAGES = [
+    ("bagit",     sip.MIDAS3SIPHandler,       "bagit"),
+    ("make_bag",  midas3.PreservationBagger,  "make_bag"),
+    ("build",     midas3.PreservationBagger,  "prepare"),
+    ("finalize",  BagBuilder,                 "finalize_bag"),
+    ("validate",  NISTAIPValidator,           "validate"),
+    ("split",     MultibagSplitter,           "check_and_split"),
+    ("serialize", DefaultSerializer,          "serialize")
+]
+
+def define_opts(progname=None):
+    parser = ArgumentParser(progname, None, description, epilog)
+    parser.add_argument('-n', '--count', metavar='N', type=int, default=100,
+                        dest='count', help="the number of data files in the SIP")
+    parser.add_argument('-s', '--size-dist', metavar='SIZEDIST', type=str,
+                        default="fixed:1048576", dest='sizedist',
+                        help="the distribution of data file sizes (see below)")
+    parser.add_argument('-d', '--depth', metavar='D', type=int, default=2,
+                        dest='depth', help="the maximum subcollection depth of "+
+                                           "the data files")
+    parser.add_argument('-f', '--fanout', metavar='N', type=int, default=3,
+                        dest='fanout', help="the number of subcollections in "+
+                                            "each collection")
+    parser.add_argument('-r', '--seed', metavar='N', type=int, default=0,
+                        dest='seed', help="the random seed to use to lay out "+
+                                          "and size the files")
+    parser.add_argument('-m', '--max-bag-size', metavar='BYTES', type=int,
+                        default=200000000, dest='maxbagsz',
+                        help="the maximum size of a multibag member bag")
+    parser.add_argument('-M', '--max-headbag-size', metavar='BYTES', type=int,
+                        default=2000000, dest='maxhbsz',
+                        help="the maximum size of the multibag head bag")
+    parser.add_argument('-c', '--config', metavar='FILE', type=str,
+                        dest='config', help="a JSON file containing SIPHandler "+
+                                            "configuration to merge in")
+    parser.add_argument('-o', '--output', metavar='FILE', type=str, dest='output',
+                        help="write the JSON results to this file (default: "+
+                             "standard out)")
+    parser.add_argument('-w', '--workdir', metavar='DIR', type=str, dest='workdir',
+                        help="the directory to write the SIP and bags to; "+
+                             "a temporary directory is created by default")
+    parser.add_argument('-k', '--keep', action='store_true', dest='keep',
+                        help="do not delete the work directory when done")
+
+    return parser
+
+def size_generator(sizedist, rand):
+    """
+    return a function that returns a random file size according to the given
+    distribution specification.
+    """
+    parts = sizedist.split(':')
+    try:
+        if parts[0] == "fixed" and len(parts) == 2:
+            size = int(parts[1])
+            return lambda: size
+        if parts[0] == "uniform" and len(parts) == 3:
+            lo, hi = int(parts[1]), int(parts[2])
+            return lambda: rand.randint(lo, hi)
+        if parts[0] == "lognormal" and len(parts) == 3:
+            mu, sigma = float(parts[1]), float(parts[2])
+            return lambda: int(rand.lognormvariate(mu, sigma))
+    except ValueError:
+        pass
+    raise ValueError("Bad size distribution specification: "+sizedist)
+
+def make_data_files(datadir, count, sizedist, depth, fanout, seed):
+    """
+    write synthetic data files into the given directory, returning a list of
+    their paths relative to that directory.
+    """
+    rand = random.Random(seed)
+    nextsize = size_generator(sizedist, rand)
+    chunk = os.urandom(CHUNK)
+
+    out = []
+    for i in range(count):
+        parts = ["coll{0}".format(rand.randrange(fanout))
+                 for d in range(rand.randint(0, depth))]
+        parts.append("file{0}.dat".format(i))
+        filepath = "/".join(parts)
+        fp = os.path.join(datadir, *parts)
+        if not os.path.exists(os.path.dirname(fp)):
+            os.makedirs(os.path.dirname(fp))
+
+        size = max(0, nextsize())
+        with open(fp, 'wb') as fd:
+            # make each file's contents unique
+            head = "{0}\n".format(filepath)[:size]
+            fd.write(head)
+            left = size - len(head)
+            while left > 0:
+                fd.write(chunk[:min(left, CHUNK)])
+                left -= CHUNK
+        out.append(filepath)
+
+    return out
+
+def make_pod(midasid, filepaths):
+    """
+    return a POD record describing a dataset with the given files
+    """
+    dlbase = "https://data.nist.gov/od/ds/{0}/".format(midasid)
+    return OrderedDict([
+        ("@type", "dcat:Dataset"),
+        ("accessLevel", "public"),
+        ("bureauCode", [ "006:55" ]),
+        ("contactPoint", OrderedDict([
+            ("fn", "NIST Data Support Team"),
+            ("hasEmail", "mailto:datasupport@nist.gov")
+        ])),
+        ("description", "Synthetic dataset for benchmarking preservation"),
+        ("identifier", midasid),
+        ("keyword", [ "benchmark" ]),
+        ("language", [ "en" ]),
+        ("license", "http://www.nist.gov/open/license.cfm"),
+        ("modified", time.strftime("%Y-%m-%d")),
+        ("programCode", [ "006:045" ]),
+        ("publisher", OrderedDict([
+            ("@type", "org:Organization"),
+            ("name", "National Institute of Standards and Technology")
+        ])),
+        ("title", "Preservation Benchmark Dataset"),
+        ("distribution", [ OrderedDict([
+            ("downloadURL", dlbase + fp),
+            ("mediaType", "application/octet-stream"),
+            ("title", os.path.basename(fp))
+        ]) for fp in filepaths ])
+    ])
+
+def make_config(workdir, opts):
+    """
+    return the MIDAS3SIPHandler configuration to use
+    """
+    config = {
+        'working_dir': workdir,
+        'review_dir': os.path.join(workdir, "review"),
+        'staging_dir': os.path.join(workdir, "staging"),
+        'store_dir': os.path.join(workdir, "store"),
+        'restricted_store_dir': os.path.join(workdir, "restricted"),
+        'mdbags_dir': os.path.join(workdir, "mdbags"),
+        'status_manager': { 'cachedir': os.path.join(workdir, "status") },
+        'bagger': {
+            'relative_to_indir': True,
+            'bag_builder': {
+                'init_bag_info': {
+                    'Source-Organization': [
+                        "National Institute of Standards and Technology" ],
+                    'Contact-Name': "NIST Data Support Team",
+                    'Contact-Email': [ "datasupport@nist.gov" ],
+                    'Organization-Address': [
+                        "100 Bureau Dr., Gaithersburg, MD 20899" ],
+                    'NIST-BagIt-Version': "0.4",
+                    'NIST-POD-Metadata': "metadata/pod.json",
+                    'NIST-NERDm-Metadata': "metadata/nerdm.json",
+                    'Multibag-Version': "0.4",
+                    'Multibag-Tag-Directory': "multibag"
+                },
+                'finalize': {
+                    'trim_folders': True,
+                    'confirm_checksums': False
+                }
+            }
+        },
+        'ingester': { 'submit': "none" },
+        'multibag': {
+            'max_headbag_size': opts.maxhbsz,
+            'max_bag_size': opts.maxbagsz
+        }
+    }
+    if opts.config:
+        with open(opts.config) as fd:
+            merge_config(config, json.load(fd))
+    return config
+
+def merge_config(base, update):
+    for key, val in update.items():
+        if isinstance(val, dict) and isinstance(base.get(key), dict):
+            merge_config(base[key], val)
+        else:
+            base[key] = val
+    return base
+
+class StageMonitor(object):
+    """
+    a collector of the time, memory, and file-open counts of pipeline stages.
+
+    Stages are monitored by wrapping a class's method; stages may be nested
+    (e.g. "validate" happens within "make_bag"), and a stage may be entered
+    more than once, in which case the measurements are accumulated.  File
+    opens are counted by wrapping the builtin open functions, and each open
+    is counted against every stage that is active (in any thread) at the
+    time.
+
+    Memory use is measured by sampling the current RSS at a stage's entry and
+    exit and periodically (every sample_interval seconds) while it is active:
+    peak_rss_kb is the largest RSS seen while the stage was active, and
+    rss_growth_kb is the total change in RSS from entry to exit.  Both include
+    the memory used by nested stages.
+    """
+
+    def __init__(self, sample_interval=0.05):
+        self.stats = OrderedDict()
+        self.sample_interval = sample_interval
+        self._active = {}
+        self._peaks = {}
+        self._lock = threading.Lock()
+        self._restore = []
+        self._sampler = None
+        self._stopped = threading.Event()
+
+    def _stat(self, stage):
+        if stage not in self.stats:
+            self.stats[stage] = OrderedDict([("calls", 0), ("seconds", 0.0),
+                                             ("files_opened", 0),
+                                             ("peak_rss_kb", 0),
+                                             ("rss_growth_kb", 0)])
+        return self.stats[stage]
+
+    def _count_open(self):
+        with self._lock:
+            for stage, depth in self._active.items():
+                if depth > 0:
+                    self.stats[stage]['files_opened'] += 1
+
+    def _sample(self):
+        # record the current RSS against the peaks of all active stages
+        rss = currentrss()
+        with self._lock:
+            for stage, depth in self._active.items():
+                if depth > 0:
+                    self._peaks[stage] = max(self._peaks.get(stage, 0), rss)
+        return rss
+
+    def _run_sampler(self):
+        while not self._stopped.wait(self.sample_interval):
+            self._sample()
+
+    def enter(self, stage):
+        rss = currentrss()
+        with self._lock:
+            self._stat(stage)['calls'] += 1
+            if not self._active.get(stage):
+                self._peaks[stage] = rss
+            self._active[stage] = self._active.get(stage, 0) + 1
+        return (time.time(), rss)
+
+    def exit(self, stage, start):
+        secs = time.time() - start[0]
+        rss = self._sample()
+        with self._lock:
+            st = self._stat(stage)
+            st['seconds'] += secs
+            st['peak_rss_kb'] = max(st['peak_rss_kb'], self._peaks.get(stage, rss))
+            st['rss_growth_kb'] += rss - start[1]
+            self._active[stage] -= 1
+
+    def wrap_method(self, stage, cls, methname):
+        meth = cls.__dict__.get(methname)
+        func = getattr(cls, methname).im_func
+        mon = self
+        def monitored(*args, **kw):
+            start = mon.enter(stage)
+            try:
+                return func(*args, **kw)
+            finally:
+                mon.exit(stage, start)
+        monitored.__name__ = func.__name__
+        monitored.__doc__ = func.__doc__
+        setattr(cls, methname, monitored)
+        if meth is not None:
+            self._restore.append((setattr, (cls, methname, meth)))
+        else:
+            self._restore.append((delattr, (cls, methname)))
+
+    def wrap_opener(self, module, name):
+        opener = getattr(module, name)
+        mon = self
+        def counted(*args, **kw):
+            mon._count_open()
+            return opener(*args, **kw)
+        setattr(module, name, counted)
+        self._restore.append((setattr, (module, name, opener)))
+
+    def install(self):
+        for stage, cls, methname in STAGES:
+            self.wrap_method(stage, cls, methname)
+        self.wrap_opener(__builtin__, "open")
+        self.wrap_opener(io, "open")
+        self.wrap_opener(os, "open")
+
+        self._stopped.clear()
+        self._sampler = threading.Thread(target=self._run_sampler)
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def uninstall(self):
+        if self._sampler:
+            self._stopped.set()
+            self._sampler.join()
+            self._sampler = None
+        while self._restore:
+            func, args = self._restore.pop()
+            func(*args)
+
+def maxrss():
+    # the peak resident set size of this process so far, in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+_pagekb = resource.getpagesize() / 1024.0
+_open_statm = io.open     # (unwrapped, so that sampling is not counted as file opens)
+
+def currentrss():
+    # the current resident set size of this process, in kilobytes.  Where
+    # /proc is unavailable, the process's peak RSS so far is returned instead.
+    try:
+        with _open_statm("/proc/self/statm", 'rb') as fd:
+            return int(int(fd.read().split()[1]) * _pagekb)
+    except (IOError, OSError, IndexError, ValueError):
+        return maxrss()
+
+def build_sip(config, midasid, opts):
+    """
+    create the synthetic SIP:  the data files in the review directory and
+    the metadata bag describing them.
+    :return tuple:  the list of data file paths and their total size
+    """
+    for key in "review_dir staging_dir store_dir restricted_store_dir mdbags_dir".split():
+        if not os.path.exists(config[key]):
+            os.makedirs(config[key])
+
+    datadir = os.path.join(config['review_dir'], midasid[32:])
+    files = make_data_files(datadir, opts.count, opts.sizedist, opts.depth,
+                            opts.fanout, opts.seed)
+    nbytes = sum([os.stat(os.path.join(datadir, f)).st_size for f in files])
+
+    mdbgr = midas3.MIDASMetadataBagger(midasid, config['mdbags_dir'], datadir)
+    mdbgr.apply_pod(make_pod(midasid, files), validate=False)
+    mdbgr.ensure_data_files(examine="sync")
+    mdbgr.done()
+
+    return files, nbytes
+
+def main(args):
+    parser = define_opts(prog)
+    opts = parser.parse_args(args)
+
+    workdir = opts.workdir
+    if not workdir:
+        workdir = tempfile.mkdtemp(prefix=prog+"_")
+    elif not os.path.exists(workdir):
+        os.makedirs(workdir)
+    config = make_config(workdir, opts)
+
+    try:
+        start = time.time()
+        files, nbytes = build_sip(config, MIDASID, opts)
+        siptime = time.time() - start
+
+        checksum.default_cache.clear()
+        mon = StageMonitor()
+        mon.install()
+        try:
+            handler = sip.MIDAS3SIPHandler(MIDASID, config)
+            handler.bagit()
+        finally:
+            mon.uninstall()
+
+        results = OrderedDict([
+            ("parameters", OrderedDict([
+                ("file_count", opts.count),
+                ("size_distribution", opts.sizedist),
+                ("depth", opts.depth),
+                ("fanout", opts.fanout),
+                ("seed", opts.seed),
+                ("max_headbag_size", opts.maxhbsz),
+                ("max_bag_size", opts.maxbagsz)
+            ])),
+            ("total_bytes", nbytes),
+            ("sip_creation_seconds", siptime),
+            ("serialized_bags", len(handler.status.get('user', {})
+                                               .get('bagfiles', []))),
+            ("stages", mon.stats)
+        ])
+        for stage in results['stages'].values():
+            secs = stage['seconds']
+            stage['bytes_per_sec'] = (secs > 0 and nbytes / secs) or None
+            stage['files_per_sec'] = (secs > 0 and len(files) / secs) or None
+        results['process_peak_rss_kb'] = maxrss()
+
+        out = json.dumps(results, indent=4, separators=(',', ': '))
+        if opts.output:
+            with open(opts.output, 'w') as fd:
+                fd.write(out)
+                fd.write("\n")
+        else:
+            print(out)
+
+    finally:
+        if not opts.keep and not opts.workdir:
+            shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
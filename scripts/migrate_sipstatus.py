@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+#
+from __future__ import print_function
+import os, sys, logging, traceback as tb
+from argparse import ArgumentParser
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+oarpypath = os.path.join(basedir, "python")
+if 'OAR_HOME' in os.environ:
+    basedir = os.environ['OAR_HOME']
+    oarpypath = os.path.join(basedir, "lib", "python") +":"+ \
+                os.path.join(basedir, "python")
+
+if 'OAR_PYTHONPATH' in os.environ:
+    oarpypath = os.environ['OAR_PYTHONPATH']
+
+sys.path.extend(oarpypath.split(os.pathsep))
+try:
+    import nistoar
+except ImportError, e:
+    nistoardir = os.path.join(basedir, "python")
+    sys.path.append(nistoardir)
+    import nistoar
+
+from nistoar.pdr.preserv.service import status
+from nistoar.pdr.exceptions import (PDRException, StateException)
+
+prog = os.path.basename(sys.argv[0])
+if not prog or prog == 'python':
+    prog = "migrate_sipstatus"
+
+description = \
+"""load the preservation status data cached as one JSON file per SIP into the
+SQLite status database (for use with the status_manager's "sqlite" backend)"""
+
+epilog = None
+
+def define_opts(progname=None):
+    parser = ArgumentParser(progname, None, description, epilog)
+    parser.add_argument('cachedir', metavar='CACHEDIR', type=str,
+                        help="the status cache directory containing the JSON files")
+    parser.add_argument('-d', '--db-file', metavar='FILE', type=str, dest='dbfile',
+                        help="the name of the database file to create within "+
+                             "CACHEDIR (default: "+status.SQLiteStatusStore.DEF_DBFILE+")")
+    parser.add_argument('-r', '--remove', action='store_true', dest='remove',
+                        help="remove each JSON file after it has been loaded")
+    parser.add_argument('-v', '--verbose', action='store_true', dest='verbose',
+                        help="print the identifier of each SIP as it is loaded")
+
+    return parser
+
+def main(args):
+    parser = define_opts()
+    opts = parser.parse_args(args)
+
+    if not os.path.isdir(opts.cachedir):
+        raise StateException(opts.cachedir+": not an existing directory")
+    config = { 'cachedir': opts.cachedir, 'backend': 'sqlite' }
+    if opts.dbfile:
+        config['dbfile'] = opts.dbfile
+
+    log = logging.getLogger(prog)
+    logging.basicConfig(format="%(name)s: %(message)s",
+                        level=(opts.verbose and logging.DEBUG) or logging.WARNING)
+
+    n = status.migrate_status_files(config, opts.remove, log)
+    print("Migrated {0} status record{1} into the database".format(n, (n != 1 and "s") or ""))
+
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+        sys.exit(0)
+    except PDRException as e:
+        print(prog+":", str(e), file=sys.stderr)
+        sys.exit(1)
+    except Exception as e:
+        print(prog+":", repr(e), file=sys.stderr)
+        tb.print_exc()
+        sys.exit(10)